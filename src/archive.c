@@ -11,7 +11,71 @@
 #include "pg_probackup.h"
 
 #include <unistd.h>
+#include <fcntl.h>
+#ifndef WIN32
+#include <signal.h>
+#include <sys/select.h>
+#include <sys/socket.h>
+#include <sys/un.h>
+#include <sys/wait.h>
+#endif
+
+/* Directory for segments prefetched by archive-get, in the WAL directory */
+#define WAL_PREFETCH_DIR		"pbk_prefetch"
+#define WAL_PREFETCH_PID_FILE	"prefetch.pid"
+/* Age of WAL_PREFETCH_PID_FILE after which it is considered stale, seconds */
+#define WAL_PREFETCH_LOCK_TIMEOUT	600
+
+/* WAL segment pushed by archive-push or prefetched by archive-get */
+typedef struct
+{
+	char		name[MAXFNAMELEN];
+	pg_atomic_flag lock;
+	bool		done;
+} ArchiveSegment;
 
+typedef struct
+{
+	parray	   *segments;
+	const char *wal_dir;
+	bool		overwrite;
+
+	/*
+	 * Return value from the thread.
+	 * 0 means there is no error, 1 - there is an error.
+	 */
+	int			ret;
+} archive_push_arg;
+
+typedef struct
+{
+	parray	   *segments;
+	const char *prefetch_dir;
+
+	/*
+	 * Return value from the thread.
+	 * 0 means there is no error, 1 - there is an error.
+	 */
+	int			ret;
+} archive_get_arg;
+
+static void archive_push_segments(char *wal_file_path, char *wal_file_name,
+								  bool overwrite);
+static void collect_ready_segments(const char *wal_dir,
+								   const char *wal_file_name,
+								   parray *segments, int max_segments);
+static void *push_wal_segments(void *arg);
+static bool get_prefetched_wal_file(const char *prefetch_dir,
+									const char *wal_file_name,
+									const char *to_path);
+static void prefetch_wal_files(const char *prefetch_dir,
+							   const char *wal_file_name);
+static bool read_prefetch_lock(const char *pid_file, int *pid,
+							   long *start_time, char *last_name);
+static bool prefetch_lock_is_stale(const char *pid_file, TimeLineID tli,
+								   XLogSegNo segno);
+static void fetch_wal_segments(parray *segments, const char *prefetch_dir);
+static void *prefetch_wal_segments(void *arg);
 static void push_wal_file(const char *from_path, const char *to_path,
 						  bool is_compress, bool overwrite);
 static void get_wal_file(const char *from_path, const char *to_path);
@@ -37,11 +101,33 @@ static void copy_file_attributes(const char *from_path,
 int
 do_archive_push(char *wal_file_path, char *wal_file_name, bool overwrite)
 {
-	char		backup_wal_file_path[MAXPGPATH];
+	archive_push_segments(wal_file_path, wal_file_name, overwrite);
+
+	elog(INFO, "pg_probackup archive-push completed successfully");
+
+	return 0;
+}
+
+/*
+ * Push the WAL segment to the archive. Relative path of the segment is
+ * resolved against the current directory, which is PGDATA of the server.
+ * If archive_batch_size is greater than one, other segments ready for
+ * archiving are pushed too and marked as archived, so the server doesn't
+ * call archive_command for them.
+ */
+static void
+archive_push_segments(char *wal_file_path, char *wal_file_name, bool overwrite)
+{
 	char		absolute_wal_file_path[MAXPGPATH];
+	char		wal_dir[MAXPGPATH];
 	char		current_dir[MAXPGPATH];
 	uint64		system_id;
-	bool		is_compress = false;
+	parray	   *segments;
+	int			n_threads;
+	int			i;
+	pthread_t  *threads;
+	archive_push_arg *threads_args;
+	ArchiveSegment *segment;
 
 	if (wal_file_name == NULL && wal_file_path == NULL)
 		elog(ERROR, "required parameters are not specified: --wal-file-name %%f --wal-file-path %%p");
@@ -72,24 +158,198 @@ do_archive_push(char *wal_file_path, char *wal_file_name, bool overwrite)
 	/* Create 'archlog_path' directory. Do nothing if it already exists. */
 	fio_mkdir(arclog_path, DIR_PERMISSION, FIO_BACKUP_HOST);
 
+	if (instance_config.compress_alg == PGLZ_COMPRESS)
+		elog(ERROR, "pglz compression is not supported");
+
 	join_path_components(absolute_wal_file_path, current_dir, wal_file_path);
-	join_path_components(backup_wal_file_path, arclog_path, wal_file_name);
+	strncpy(wal_dir, absolute_wal_file_path, MAXPGPATH);
+	get_parent_directory(wal_dir);
+
+	/* The requested segment goes first */
+	segments = parray_new();
+	segment = pgut_new(ArchiveSegment);
+	StrNCpy(segment->name, wal_file_name, MAXFNAMELEN);
+	pg_atomic_clear_flag(&segment->lock);
+	segment->done = false;
+	parray_append(segments, segment);
+
+	if (archive_batch_size > 1)
+		collect_ready_segments(wal_dir, wal_file_name, segments,
+							   archive_batch_size - 1);
+
+	/* setup threads */
+	n_threads = Min(num_threads, (int) parray_num(segments));
+	threads = (pthread_t *) palloc(sizeof(pthread_t) * n_threads);
+	threads_args = (archive_push_arg *) palloc(sizeof(archive_push_arg) *
+											   n_threads);
+
+	thread_interrupted = false;
+	for (i = 0; i < n_threads; i++)
+	{
+		archive_push_arg *arg = &(threads_args[i]);
 
-	elog(INFO, "pg_probackup archive-push from %s to %s", absolute_wal_file_path, backup_wal_file_path);
+		arg->segments = segments;
+		arg->wal_dir = wal_dir;
+		arg->overwrite = overwrite;
+		/* By default there are some error */
+		arg->ret = 1;
 
-	if (instance_config.compress_alg == PGLZ_COMPRESS)
-		elog(ERROR, "pglz compression is not supported");
+		pthread_create(&threads[i], NULL, push_wal_segments, arg);
+	}
+
+	/* Wait threads */
+	for (i = 0; i < n_threads; i++)
+		pthread_join(threads[i], NULL);
+
+	pfree(threads);
+	pfree(threads_args);
+
+	segment = (ArchiveSegment *) parray_get(segments, 0);
+	if (!segment->done)
+		elog(ERROR, "WAL segment \"%s\" was not pushed", wal_file_name);
+
+	/* The server marks the requested segment as archived itself */
+	for (i = 1; i < parray_num(segments); i++)
+	{
+		char		ready_path[MAXPGPATH];
+		char		done_path[MAXPGPATH];
+
+		segment = (ArchiveSegment *) parray_get(segments, i);
+		if (!segment->done)
+		{
+			elog(WARNING, "WAL segment \"%s\" was not pushed, it will be pushed later",
+				 segment->name);
+			continue;
+		}
+
+		snprintf(ready_path, MAXPGPATH, "%s/archive_status/%s.ready",
+				 wal_dir, segment->name);
+		snprintf(done_path, MAXPGPATH, "%s/archive_status/%s.done",
+				 wal_dir, segment->name);
+		if (fio_rename(ready_path, done_path, FIO_DB_HOST) < 0)
+			elog(WARNING, "Cannot rename \"%s\" to \"%s\": %s",
+				 ready_path, done_path, strerror(errno));
+	}
+
+	parray_walk(segments, pfree);
+	parray_free(segments);
+}
+
+static int
+compare_segment_names(const void *name1, const void *name2)
+{
+	return strcmp(*(char **) name1, *(char **) name2);
+}
+
+/*
+ * Add up to max_segments other segments ready for archiving to the list,
+ * oldest first, in the order the server would archive them.
+ */
+static void
+collect_ready_segments(const char *wal_dir, const char *wal_file_name,
+					   parray *segments, int max_segments)
+{
+	char		status_dir[MAXPGPATH];
+	DIR		   *dir;
+	struct dirent *ent;
+	parray	   *ready;
+	int			i;
+
+	join_path_components(status_dir, wal_dir, "archive_status");
+	dir = fio_opendir(status_dir, FIO_DB_HOST);
+	if (dir == NULL)
+	{
+		elog(WARNING, "Cannot open directory \"%s\": %s", status_dir,
+			 strerror(errno));
+		return;
+	}
+
+	ready = parray_new();
+	while ((ent = fio_readdir(dir)) != NULL)
+	{
+		size_t		len = strlen(ent->d_name);
+		char	   *name;
+
+		if (len <= strlen(".ready") ||
+			strcmp(ent->d_name + len - strlen(".ready"), ".ready") != 0)
+			continue;
+		len -= strlen(".ready");
+		if (len >= MAXFNAMELEN)
+			continue;
+
+		name = pgut_malloc(len + 1);
+		memcpy(name, ent->d_name, len);
+		name[len] = '\0';
+
+		if (strcmp(name, wal_file_name) == 0)
+		{
+			pfree(name);
+			continue;
+		}
+		parray_append(ready, name);
+	}
+	fio_closedir(dir);
+
+	parray_qsort(ready, compare_segment_names);
+
+	for (i = 0; i < parray_num(ready) && i < max_segments; i++)
+	{
+		ArchiveSegment *segment = pgut_new(ArchiveSegment);
+
+		StrNCpy(segment->name, (char *) parray_get(ready, i), MAXFNAMELEN);
+		pg_atomic_clear_flag(&segment->lock);
+		segment->done = false;
+		parray_append(segments, segment);
+	}
+
+	parray_walk(ready, pfree);
+	parray_free(ready);
+}
+
+/*
+ * Push WAL segments of the list, which are not taken by other threads.
+ */
+static void *
+push_wal_segments(void *arg)
+{
+	archive_push_arg *arguments = (archive_push_arg *) arg;
+	int			i;
+
+	for (i = 0; i < parray_num(arguments->segments); i++)
+	{
+		ArchiveSegment *segment = (ArchiveSegment *) parray_get(arguments->segments, i);
+		char		from_path[MAXPGPATH];
+		char		to_path[MAXPGPATH];
+		bool		is_compress = false;
+
+		if (!pg_atomic_test_set_flag(&segment->lock))
+			continue;
+
+		/* check for interrupt */
+		if (interrupted || thread_interrupted)
+			elog(ERROR, "Interrupted during WAL archiving");
+
+		join_path_components(from_path, arguments->wal_dir, segment->name);
+		join_path_components(to_path, arclog_path, segment->name);
+
+		elog(INFO, "pg_probackup archive-push from %s to %s", from_path, to_path);
 
 #ifdef HAVE_LIBZ
-	if (instance_config.compress_alg == ZLIB_COMPRESS)
-		is_compress = IsXLogFileName(wal_file_name);
+		if (instance_config.compress_alg == ZLIB_COMPRESS)
+			is_compress = IsXLogFileName(segment->name);
 #endif
 
-	push_wal_file(absolute_wal_file_path, backup_wal_file_path, is_compress,
-				  overwrite);
-	elog(INFO, "pg_probackup archive-push completed successfully");
+		push_wal_file(from_path, to_path, is_compress, arguments->overwrite);
+		segment->done = true;
+	}
 
-	return 0;
+	/* Close connection with remote agent */
+	fio_disconnect();
+
+	/* WAL segments pushing is successful */
+	arguments->ret = 0;
+
+	return NULL;
 }
 
 /*
@@ -122,12 +382,819 @@ do_archive_get(char *wal_file_path, char *wal_file_name)
 
 	elog(INFO, "pg_probackup archive-get from %s to %s",
 		 backup_wal_file_path, absolute_wal_file_path);
+
+	if (archive_prefetch > 0 && IsXLogFileName(wal_file_name))
+	{
+		char		prefetch_dir[MAXPGPATH];
+
+		/* Prefetched segments are kept in the destination directory */
+		strncpy(prefetch_dir, absolute_wal_file_path, MAXPGPATH);
+		get_parent_directory(prefetch_dir);
+		join_path_components(prefetch_dir, prefetch_dir, WAL_PREFETCH_DIR);
+
+		if (!get_prefetched_wal_file(prefetch_dir, wal_file_name,
+									 absolute_wal_file_path))
+			get_wal_file(backup_wal_file_path, absolute_wal_file_path);
+		elog(INFO, "pg_probackup archive-get completed successfully");
+
+		prefetch_wal_files(prefetch_dir, wal_file_name);
+		return 0;
+	}
+
 	get_wal_file(backup_wal_file_path, absolute_wal_file_path);
 	elog(INFO, "pg_probackup archive-get completed successfully");
 
 	return 0;
 }
 
+/*
+ * Move the segment prefetched by previous archive-get calls to to_path.
+ * Returns false if the segment wasn't prefetched.
+ */
+static bool
+get_prefetched_wal_file(const char *prefetch_dir, const char *wal_file_name,
+						const char *to_path)
+{
+	char		prefetched_path[MAXPGPATH];
+	struct stat	st;
+
+	join_path_components(prefetched_path, prefetch_dir, wal_file_name);
+
+	if (fio_stat(prefetched_path, &st, true, FIO_DB_HOST) != 0)
+		return false;
+
+	if (st.st_size != instance_config.xlog_seg_size)
+	{
+		elog(WARNING, "Prefetched WAL file \"%s\" has size %lu, expected %u",
+			 prefetched_path, (unsigned long) st.st_size,
+			 instance_config.xlog_seg_size);
+		fio_unlink(prefetched_path, FIO_DB_HOST);
+		return false;
+	}
+
+	if (fio_rename(prefetched_path, to_path, FIO_DB_HOST) < 0)
+	{
+		elog(WARNING, "Cannot rename WAL file \"%s\" to \"%s\": %s",
+			 prefetched_path, to_path, strerror(errno));
+		return false;
+	}
+
+	elog(INFO, "WAL file \"%s\" was prefetched", wal_file_name);
+	return true;
+}
+
+/*
+ * Start prefetching of archive_prefetch segments following wal_file_name on
+ * its timeline into prefetch_dir. Segments are fetched by a background
+ * process, so the server replays the requested segment meanwhile. Only one
+ * prefetching process works at a time, it is registered in the
+ * WAL_PREFETCH_PID_FILE file with its start time and the last segment to
+ * prefetch, see prefetch_lock_is_stale().
+ */
+static void
+prefetch_wal_files(const char *prefetch_dir, const char *wal_file_name)
+{
+	TimeLineID	tli;
+	XLogSegNo	segno;
+	DIR		   *dir;
+	struct dirent *ent;
+	parray	   *segments;
+	int			i;
+	char		pid_file[MAXPGPATH];
+	int			pid_fd;
+	char		last_name[MAXFNAMELEN];
+	char		buf[64 + MAXFNAMELEN];
+	int			prefetch_pid;
+	long		start_time;
+#ifndef WIN32
+	pid_t		pid;
+#endif
+
+	GetXLogFromFileName(wal_file_name, &tli, &segno,
+						instance_config.xlog_seg_size);
+
+	if (fio_mkdir(prefetch_dir, DIR_PERMISSION, FIO_DB_HOST) != 0)
+	{
+		elog(WARNING, "Cannot create directory \"%s\": %s", prefetch_dir,
+			 strerror(errno));
+		return;
+	}
+
+	/* Remove segments which won't be requested */
+	dir = fio_opendir(prefetch_dir, FIO_DB_HOST);
+	if (dir == NULL)
+	{
+		elog(WARNING, "Cannot open directory \"%s\": %s", prefetch_dir,
+			 strerror(errno));
+		return;
+	}
+	while ((ent = fio_readdir(dir)) != NULL)
+	{
+		TimeLineID	file_tli;
+		XLogSegNo	file_segno;
+
+		if (!IsXLogFileName(ent->d_name))
+			continue;
+
+		GetXLogFromFileName(ent->d_name, &file_tli, &file_segno,
+							instance_config.xlog_seg_size);
+		if (file_tli != tli || file_segno <= segno ||
+			file_segno > segno + archive_prefetch)
+		{
+			char		path[MAXPGPATH];
+
+			join_path_components(path, prefetch_dir, ent->d_name);
+			fio_unlink(path, FIO_DB_HOST);
+		}
+	}
+	fio_closedir(dir);
+
+	/* Segments to fetch */
+	segments = parray_new();
+	for (i = 1; i <= archive_prefetch; i++)
+	{
+		ArchiveSegment *segment = pgut_new(ArchiveSegment);
+		char		path[MAXPGPATH];
+
+		GetXLogFileName(segment->name, tli, segno + i,
+						instance_config.xlog_seg_size);
+		join_path_components(path, prefetch_dir, segment->name);
+		if (fio_access(path, F_OK, FIO_DB_HOST) == 0)
+		{
+			pfree(segment);
+			continue;
+		}
+		pg_atomic_clear_flag(&segment->lock);
+		segment->done = false;
+		parray_append(segments, segment);
+	}
+
+	if (parray_num(segments) == 0)
+		goto cleanup;
+
+	/* Check that nobody prefetches segments already */
+	join_path_components(pid_file, prefetch_dir, WAL_PREFETCH_PID_FILE);
+	pid_fd = open(pid_file, O_RDWR | O_CREAT | O_EXCL, FILE_PERMISSION);
+	if (pid_fd < 0 && errno == EEXIST)
+	{
+		if (!prefetch_lock_is_stale(pid_file, tli, segno))
+			goto cleanup;
+
+		/* The process has gone or is useless, its files are incomplete */
+		unlink(pid_file);
+		pid_fd = open(pid_file, O_RDWR | O_CREAT | O_EXCL, FILE_PERMISSION);
+	}
+	if (pid_fd < 0)
+	{
+		elog(WARNING, "Cannot create file \"%s\": %s", pid_file,
+			 strerror(errno));
+		goto cleanup;
+	}
+
+	GetXLogFileName(last_name, tli, segno + archive_prefetch,
+					instance_config.xlog_seg_size);
+
+#ifndef WIN32
+	/* The child must not share the remote agent connection with us */
+	fio_disconnect();
+	fflush(stdout);
+	fflush(stderr);
+
+	pid = fork();
+	if (pid < 0)
+	{
+		elog(WARNING, "Cannot start WAL prefetching: %s", strerror(errno));
+		close(pid_fd);
+		unlink(pid_file);
+		goto cleanup;
+	}
+	else if (pid > 0)
+	{
+		/* The server waits for archive-get only */
+		snprintf(buf, sizeof(buf), "%d %ld %s\n",
+				 (int) pid, (long) time(NULL), last_name);
+		if (write(pid_fd, buf, strlen(buf)) != strlen(buf))
+			elog(WARNING, "Cannot write file \"%s\": %s", pid_file,
+				 strerror(errno));
+		close(pid_fd);
+		goto cleanup;
+	}
+
+	/* Don't get signals sent to the process group of the server */
+	setsid();
+	close(pid_fd);
+#else
+	/* Segments are fetched by this process */
+	snprintf(buf, sizeof(buf), "%d %ld %s\n",
+			 (int) getpid(), (long) time(NULL), last_name);
+	if (write(pid_fd, buf, strlen(buf)) != strlen(buf))
+		elog(WARNING, "Cannot write file \"%s\": %s", pid_file,
+			 strerror(errno));
+	close(pid_fd);
+#endif
+
+	fetch_wal_segments(segments, prefetch_dir);
+
+	/* The file may belong to a process which considered us stale */
+	if (read_prefetch_lock(pid_file, &prefetch_pid, &start_time, last_name) &&
+		prefetch_pid == (int) getpid())
+		unlink(pid_file);
+#ifndef WIN32
+	exit(0);
+#endif
+
+cleanup:
+	parray_walk(segments, pfree);
+	parray_free(segments);
+}
+
+/*
+ * Read pid, start time and the last segment of the prefetching process from
+ * WAL_PREFETCH_PID_FILE. Returns false if the file is absent or incomplete.
+ */
+static bool
+read_prefetch_lock(const char *pid_file, int *pid, long *start_time,
+				   char *last_name)
+{
+	FILE	   *fp;
+	int			n;
+
+	fp = fopen(pid_file, "r");
+	if (fp == NULL)
+		return false;
+	n = fscanf(fp, "%d %ld %24s", pid, start_time, last_name);
+	fclose(fp);
+
+	return n == 3 && IsXLogFileName(last_name);
+}
+
+/*
+ * Check whether WAL_PREFETCH_PID_FILE may be ignored by the archive-get
+ * requesting segment segno on timeline tli. It is stale if:
+ * - the last segment of its process isn't after the requested one, the
+ *   process prefetches nothing useful then. This also covers a reused pid
+ *   and systems where we can't check the process, e.g. Windows;
+ * - it is older than WAL_PREFETCH_LOCK_TIMEOUT;
+ * - its process has gone.
+ */
+static bool
+prefetch_lock_is_stale(const char *pid_file, TimeLineID tli, XLogSegNo segno)
+{
+	int			prefetch_pid = 0;
+	long		start_time = 0;
+	char		last_name[MAXFNAMELEN];
+	TimeLineID	last_tli;
+	XLogSegNo	last_segno;
+
+	if (!read_prefetch_lock(pid_file, &prefetch_pid, &start_time, last_name))
+	{
+		struct stat st;
+
+		/* The file may be not written yet by its creator */
+		if (stat(pid_file, &st) != 0)
+			return true;
+		return time(NULL) - st.st_mtime > WAL_PREFETCH_LOCK_TIMEOUT;
+	}
+
+	GetXLogFromFileName(last_name, &last_tli, &last_segno,
+						instance_config.xlog_seg_size);
+	if (last_tli != tli || last_segno <= segno)
+		return true;
+
+	if (time(NULL) - start_time > WAL_PREFETCH_LOCK_TIMEOUT)
+		return true;
+
+#ifndef WIN32
+	if (prefetch_pid <= 0 || (kill(prefetch_pid, 0) != 0 && errno == ESRCH))
+		return true;
+#endif
+
+	elog(LOG, "WAL files up to \"%s\" are prefetched by process %d",
+		 last_name, prefetch_pid);
+	return false;
+}
+
+/*
+ * Fetch the segments into prefetch_dir using num_threads threads. Segments
+ * after the last one in the archive are skipped.
+ */
+static void
+fetch_wal_segments(parray *segments, const char *prefetch_dir)
+{
+	archive_get_arg arg;
+	int			n_threads;
+	int			i;
+	pthread_t  *threads;
+	archive_get_arg *threads_args;
+
+	n_threads = Min(num_threads, (int) parray_num(segments));
+
+	/* A single thread reuses the agent connection of the process */
+	if (n_threads == 1)
+	{
+		arg.segments = segments;
+		arg.prefetch_dir = prefetch_dir;
+		arg.ret = 1;
+		prefetch_wal_segments(&arg);
+		return;
+	}
+
+	threads = (pthread_t *) palloc(sizeof(pthread_t) * n_threads);
+	threads_args = (archive_get_arg *) palloc(sizeof(archive_get_arg) *
+											  n_threads);
+
+	thread_interrupted = false;
+	for (i = 0; i < n_threads; i++)
+	{
+		archive_get_arg *thread_arg = &(threads_args[i]);
+
+		thread_arg->segments = segments;
+		thread_arg->prefetch_dir = prefetch_dir;
+		/* By default there are some error */
+		thread_arg->ret = 1;
+
+		pthread_create(&threads[i], NULL, prefetch_wal_segments, thread_arg);
+	}
+
+	/* Wait threads */
+	for (i = 0; i < n_threads; i++)
+		pthread_join(threads[i], NULL);
+
+	pfree(threads);
+	pfree(threads_args);
+}
+
+/*
+ * Fetch segments of the list, which are not taken by other threads.
+ */
+static void *
+prefetch_wal_segments(void *arg)
+{
+	archive_get_arg *arguments = (archive_get_arg *) arg;
+	int			i;
+
+	for (i = 0; i < parray_num(arguments->segments); i++)
+	{
+		ArchiveSegment *segment = (ArchiveSegment *) parray_get(arguments->segments, i);
+		char		from_path[MAXPGPATH];
+		char		gz_from_path[MAXPGPATH];
+		char		to_path[MAXPGPATH];
+		char		to_path_temp[MAXPGPATH];
+
+		if (!pg_atomic_test_set_flag(&segment->lock))
+			continue;
+
+		/* check for interrupt */
+		if (interrupted || thread_interrupted)
+			elog(ERROR, "Interrupted during WAL prefetching");
+
+		join_path_components(from_path, arclog_path, segment->name);
+		snprintf(gz_from_path, sizeof(gz_from_path), "%s.gz", from_path);
+		join_path_components(to_path, arguments->prefetch_dir, segment->name);
+		snprintf(to_path_temp, sizeof(to_path_temp), "%s.partial", to_path);
+
+		/* The segment isn't archived yet */
+		if (fio_access(from_path, F_OK, FIO_BACKUP_HOST) != 0 &&
+			fio_access(gz_from_path, F_OK, FIO_BACKUP_HOST) != 0)
+			continue;
+
+		/* Remove the file left by an interrupted prefetching */
+		fio_unlink(to_path_temp, FIO_DB_HOST);
+
+		get_wal_file(from_path, to_path);
+		segment->done = true;
+	}
+
+	/* Close connection with remote agent */
+	fio_disconnect();
+
+	/* WAL segments prefetching is successful */
+	arguments->ret = 0;
+
+	return NULL;
+}
+
+/*
+ * Archive server.
+ *
+ * archive-server listens on a Unix socket and pushes WAL segments on behalf
+ * of archive-push clients, so archive_command doesn't have to read the
+ * instance configuration and check the instance for every segment. Every
+ * request is served by a child process forked from the server, which already
+ * has the configuration in its memory, up to num_threads requests are served
+ * concurrently. Remote agents are not shared by the children, each of them
+ * starts its own agent if the backup catalog is remote. Messages of the child
+ * are sent to the client, which prints them to its stderr, and the result of
+ * the push follows a zero byte.
+ */
+#define ARCHIVE_SERVER_MAGIC	0x50425341	/* "PBSA" */
+
+typedef struct ArchiveServerRequest
+{
+	uint32		magic;
+	uint32		overwrite;
+	char		program_version[100];
+	char		backup_path[MAXPGPATH];
+	char		instance_name[MAXPGPATH];
+	char		cwd[MAXPGPATH];		/* PGDATA of the client */
+	char		wal_file_path[MAXPGPATH];
+	char		wal_file_name[MAXPGPATH];
+} ArchiveServerRequest;
+
+#ifndef WIN32
+
+static pid_t archive_server_pid = 0;
+
+static void
+archive_server_sigterm(SIGNAL_ARGS)
+{
+	interrupted = true;
+}
+
+/* Remove the socket of the server at exit, child processes leave it alone */
+static void
+archive_server_cleanup(bool fatal, void *userdata)
+{
+	if (getpid() == archive_server_pid)
+		unlink((const char *) userdata);
+}
+
+/* Try to read specified amount of bytes unless error or EOF are encountered */
+static ssize_t
+archive_read_all(int fd, void *buf, size_t size)
+{
+	size_t		offs = 0;
+
+	while (offs < size)
+	{
+		ssize_t		rc = read(fd, (char *) buf + offs, size - offs);
+
+		if (rc < 0)
+		{
+			if (errno == EINTR)
+				continue;
+			return rc;
+		}
+		else if (rc == 0)
+			break;
+		offs += rc;
+	}
+	return offs;
+}
+
+/* Try to write specified amount of bytes unless error is encountered */
+static ssize_t
+archive_write_all(int fd, const void *buf, size_t size)
+{
+	size_t		offs = 0;
+
+	while (offs < size)
+	{
+		ssize_t		rc = write(fd, (const char *) buf + offs, size - offs);
+
+		if (rc <= 0)
+		{
+			if (errno == EINTR)
+				continue;
+			return rc;
+		}
+		offs += rc;
+	}
+	return offs;
+}
+
+static void
+archive_socket_address(const char *socket_path, struct sockaddr_un *addr)
+{
+	if (strlen(socket_path) >= sizeof(addr->sun_path))
+		elog(ERROR, "Archive server socket path \"%s\" is too long",
+			 socket_path);
+
+	MemSet(addr, 0, sizeof(struct sockaddr_un));
+	addr->sun_family = AF_UNIX;
+	strcpy(addr->sun_path, socket_path);
+}
+
+/*
+ * Serve the request of the client in a child process of the server.
+ */
+static void
+archive_server_child(int listen_fd, int conn_fd)
+{
+	ArchiveServerRequest request;
+	int			saved_stderr;
+	char		result[1 + sizeof(int32)];
+	int32		status = 0;
+
+	close(listen_fd);
+	pqsignal(SIGTERM, SIG_DFL);
+
+	errno = 0;
+	if (archive_read_all(conn_fd, &request, sizeof(request)) != sizeof(request))
+		elog(ERROR, "Cannot read archive server request: %s",
+			 errno ? strerror(errno) : "end of data");
+
+	/* From now on messages are sent to the client */
+	saved_stderr = dup(STDERR_FILENO);
+	if (saved_stderr < 0 || dup2(conn_fd, STDERR_FILENO) < 0)
+		elog(ERROR, "Cannot redirect stderr: %s", strerror(errno));
+
+	if (request.magic != ARCHIVE_SERVER_MAGIC)
+		elog(ERROR, "Invalid archive server request");
+	request.program_version[sizeof(request.program_version) - 1] = '\0';
+	request.backup_path[MAXPGPATH - 1] = '\0';
+	request.instance_name[MAXPGPATH - 1] = '\0';
+	request.cwd[MAXPGPATH - 1] = '\0';
+	request.wal_file_path[MAXPGPATH - 1] = '\0';
+	request.wal_file_name[MAXPGPATH - 1] = '\0';
+
+	if (strcmp(request.program_version, PROGRAM_VERSION) != 0)
+		elog(ERROR, "Archive server version %s doesn't match pg_probackup version %s",
+			 PROGRAM_VERSION, request.program_version);
+	if (strcmp(request.backup_path, backup_path) != 0 ||
+		strcmp(request.instance_name, instance_name) != 0)
+		elog(ERROR, "Archive server serves instance '%s' of backup catalog \"%s\"",
+			 instance_name, backup_path);
+
+	if (chdir(request.cwd) != 0)
+		elog(ERROR, "Cannot change directory to \"%s\": %s",
+			 request.cwd, strerror(errno));
+
+	archive_push_segments(request.wal_file_path, request.wal_file_name,
+						  request.overwrite != 0);
+
+	elog(INFO, "pg_probackup archive-push completed successfully");
+
+	/* Let the client go, the segment is in the archive already */
+	result[0] = '\0';
+	memcpy(result + 1, &status, sizeof(status));
+	if (archive_write_all(conn_fd, result, sizeof(result)) != sizeof(result))
+		elog(WARNING, "Cannot send result to archive-push client: %s",
+			 strerror(errno));
+
+	dup2(saved_stderr, STDERR_FILENO);
+	close(saved_stderr);
+	close(conn_fd);
+
+	exit(0);
+}
+
+/*
+ * Entry point of archive-server command.
+ */
+int
+do_archive_server(const char *socket_path)
+{
+	struct sockaddr_un addr;
+	int			listen_fd;
+	int			n_children = 0;
+	pid_t		pid;
+	int			status;
+
+	if (socket_path == NULL)
+		elog(ERROR, "required parameter not specified: --archive-socket");
+
+	if (instance_config.pgdata == NULL)
+		elog(ERROR, "cannot read pg_probackup.conf for this instance");
+
+	if (instance_config.compress_alg == PGLZ_COMPRESS)
+		elog(ERROR, "pglz compression is not supported");
+
+	archive_socket_address(socket_path, &addr);
+
+	listen_fd = socket(AF_UNIX, SOCK_STREAM, 0);
+	if (listen_fd < 0)
+		elog(ERROR, "Cannot create socket: %s", strerror(errno));
+
+	/* Remove the socket left by a crashed server */
+	if (connect(listen_fd, (struct sockaddr *) &addr, sizeof(addr)) == 0)
+		elog(ERROR, "Archive server is already running on socket \"%s\"",
+			 socket_path);
+	close(listen_fd);
+	unlink(socket_path);
+
+	listen_fd = socket(AF_UNIX, SOCK_STREAM, 0);
+	if (listen_fd < 0)
+		elog(ERROR, "Cannot create socket: %s", strerror(errno));
+	if (bind(listen_fd, (struct sockaddr *) &addr, sizeof(addr)) < 0)
+		elog(ERROR, "Cannot bind socket \"%s\": %s", socket_path,
+			 strerror(errno));
+
+	archive_server_pid = getpid();
+	pgut_atexit_push(archive_server_cleanup, (void *) socket_path);
+
+	if (chmod(socket_path, FILE_PERMISSION) < 0)
+		elog(ERROR, "Cannot change mode of socket \"%s\": %s", socket_path,
+			 strerror(errno));
+	if (listen(listen_fd, SOMAXCONN) < 0)
+		elog(ERROR, "Cannot listen on socket \"%s\": %s", socket_path,
+			 strerror(errno));
+
+	/* Clients may go away without waiting for the result */
+	pqsignal(SIGPIPE, SIG_IGN);
+	pqsignal(SIGTERM, archive_server_sigterm);
+
+	elog(INFO, "pg_probackup archive-server is listening on \"%s\"",
+		 socket_path);
+
+	while (!interrupted)
+	{
+		fd_set		rset;
+		struct timeval timeout;
+		int			conn_fd;
+		int			rc;
+
+		/* Reap finished requests */
+		while ((pid = waitpid(-1, &status, WNOHANG)) > 0)
+			n_children--;
+
+		/* Wait for a free slot */
+		if (n_children >= num_threads)
+		{
+			if (waitpid(-1, &status, 0) > 0)
+				n_children--;
+			continue;
+		}
+
+		FD_ZERO(&rset);
+		FD_SET(listen_fd, &rset);
+		timeout.tv_sec = 1;
+		timeout.tv_usec = 0;
+
+		rc = select(listen_fd + 1, &rset, NULL, NULL, &timeout);
+		if (rc < 0)
+		{
+			if (errno == EINTR)
+				continue;
+			elog(ERROR, "select() failed: %s", strerror(errno));
+		}
+		if (rc == 0)
+			continue;
+
+		conn_fd = accept(listen_fd, NULL, NULL);
+		if (conn_fd < 0)
+		{
+			if (errno == EINTR || errno == ECONNABORTED)
+				continue;
+			elog(ERROR, "Cannot accept connection on socket \"%s\": %s",
+				 socket_path, strerror(errno));
+		}
+
+		pid = fork();
+		if (pid < 0)
+			elog(WARNING, "Cannot fork archive server process: %s",
+				 strerror(errno));
+		else if (pid == 0)
+			archive_server_child(listen_fd, conn_fd);
+		else
+			n_children++;
+		close(conn_fd);
+	}
+
+	elog(INFO, "pg_probackup archive-server is shutting down");
+
+	close(listen_fd);
+	unlink(socket_path);
+
+	/* Wait for requests in progress */
+	while (n_children > 0)
+	{
+		pid = waitpid(-1, &status, 0);
+		if (pid > 0)
+			n_children--;
+		else if (errno != EINTR)
+			break;
+	}
+
+	return 0;
+}
+
+/*
+ * Push the WAL segment through the archive server listening on socket_path.
+ * Returns exit code of the push or -1 if the server isn't available and the
+ * segment should be pushed by the caller.
+ */
+int
+archive_server_push(const char *socket_path, char *wal_file_path,
+					char *wal_file_name, bool overwrite)
+{
+	struct sockaddr_un addr;
+	ArchiveServerRequest request;
+	int			sock;
+	char		buf[BLCKSZ];
+	char		result[sizeof(int32)];
+	size_t		result_len = 0;
+	bool		got_result = false;
+	int32		status;
+
+	/* Let archive_push_segments() complain about missing parameters */
+	if (wal_file_path == NULL || wal_file_name == NULL)
+		return -1;
+
+	if (strlen(socket_path) >= sizeof(addr.sun_path) ||
+		strlen(wal_file_path) >= MAXPGPATH ||
+		strlen(wal_file_name) >= MAXPGPATH)
+		return -1;
+	archive_socket_address(socket_path, &addr);
+
+	MemSet(&request, 0, sizeof(request));
+	request.magic = ARCHIVE_SERVER_MAGIC;
+	request.overwrite = overwrite;
+	StrNCpy(request.program_version, PROGRAM_VERSION,
+			sizeof(request.program_version));
+	StrNCpy(request.backup_path, backup_path, MAXPGPATH);
+	StrNCpy(request.instance_name, instance_name, MAXPGPATH);
+	StrNCpy(request.wal_file_path, wal_file_path, MAXPGPATH);
+	StrNCpy(request.wal_file_name, wal_file_name, MAXPGPATH);
+	if (!getcwd(request.cwd, sizeof(request.cwd)))
+		elog(ERROR, "getcwd() error");
+
+	sock = socket(AF_UNIX, SOCK_STREAM, 0);
+	if (sock < 0)
+		elog(ERROR, "Cannot create socket: %s", strerror(errno));
+
+	if (connect(sock, (struct sockaddr *) &addr, sizeof(addr)) < 0)
+	{
+		elog(LOG, "Cannot connect to archive server \"%s\": %s",
+			 socket_path, strerror(errno));
+		close(sock);
+		return -1;
+	}
+
+	if (archive_write_all(sock, &request, sizeof(request)) != sizeof(request))
+	{
+		elog(LOG, "Cannot send request to archive server \"%s\": %s",
+			 socket_path, strerror(errno));
+		close(sock);
+		return -1;
+	}
+
+	/* Print messages of the server until the result */
+	while (result_len < sizeof(result))
+	{
+		ssize_t		rc = read(sock, buf, sizeof(buf));
+		char	   *msg_end;
+
+		if (rc < 0)
+		{
+			if (errno == EINTR)
+				continue;
+			elog(ERROR, "Cannot read from archive server \"%s\": %s",
+				 socket_path, strerror(errno));
+		}
+		if (rc == 0)
+			break;
+
+		if (got_result)
+		{
+			msg_end = buf;
+			rc = Min(rc, (ssize_t) (sizeof(result) - result_len));
+		}
+		else
+		{
+			msg_end = memchr(buf, '\0', rc);
+			if (msg_end == NULL)
+			{
+				fwrite(buf, 1, rc, stderr);
+				continue;
+			}
+			fwrite(buf, 1, msg_end - buf, stderr);
+			got_result = true;
+			rc -= msg_end - buf + 1;
+			msg_end++;
+			rc = Min(rc, (ssize_t) (sizeof(result) - result_len));
+		}
+		memcpy(result + result_len, msg_end, rc);
+		result_len += rc;
+	}
+	close(sock);
+
+	/* The push failed, the server has sent the reason */
+	if (result_len < sizeof(result))
+		return ERROR;
+
+	memcpy(&status, result, sizeof(status));
+	return status;
+}
+
+#else
+
+int
+do_archive_server(const char *socket_path)
+{
+	elog(ERROR, "archive-server is not supported on Windows");
+	return 1;
+}
+
+int
+archive_server_push(const char *socket_path, char *wal_file_path,
+					char *wal_file_name, bool overwrite)
+{
+	return -1;
+}
+
+#endif
+
 /* ------------- INTERNAL FUNCTIONS ---------- */
 /*
  * Copy WAL segment from pgdata to archive catalog with possible compression.
@@ -50,7 +50,42 @@ const char *progname = "pg_probackup";
 /* list of files contained in backup */
 static parray *backup_files_list = NULL;
 
-/* We need critical section for datapagemap_add() in case of using threads */
+/*
+ * Index of data files of backup_files_list by relation segment. It is used
+ * to find files changed by WAL records, see process_block_change().
+ */
+typedef struct RelSegEntry
+{
+	Oid			spcNode;
+	Oid			dbNode;
+	Oid			relNode;
+	int			segno;
+	int			file_num;		/* index in rel_seg_files, -1 if the slot is free */
+} RelSegEntry;
+
+static RelSegEntry *rel_seg_index = NULL;
+static uint32 rel_seg_index_size = 0;	/* power of 2 */
+static pgFile **rel_seg_files = NULL;
+static int	n_rel_seg_files = 0;
+
+/*
+ * Bloom filter of the relations of rel_seg_index. WAL records are checked
+ * against it before their blocks are looked up, see extractPageInfo().
+ */
+static uint8 *rel_filter = NULL;
+static uint32 rel_filter_bits = 0;	/* power of 2 */
+
+/*
+ * Every thread collects page maps of changed files into its own array of
+ * n_rel_seg_files page maps. The arrays are merged into backup_files_list by
+ * merge_block_changes(), which also starts a new generation of the arrays.
+ */
+static __thread datapagemap_t *thread_pagemaps = NULL;
+static __thread uint32 thread_pagemaps_generation = 0;
+static uint32 pagemaps_generation = 0;
+static parray *pagemaps_list = NULL;
+
+/* We need critical section for pagemaps_list in case of using threads */
 static pthread_mutex_t backup_pagemap_mutex = PTHREAD_MUTEX_INITIALIZER;
 
 /*
@@ -93,6 +128,8 @@ static bool pg_stop_backup_is_sent = false;
 static void backup_cleanup(bool fatal, void *userdata);
 
 static void *backup_files(void *arg);
+static parray *split_data_files(parray *files, parray *prev_filelist);
+static void skip_unchanged_files(parray *files, parray *prev_filelist);
 
 static void do_backup_instance(PGconn *backup_conn);
 
@@ -107,6 +144,8 @@ static XLogRecPtr wait_wal_lsn(XLogRecPtr lsn, bool is_start_lsn,
 							   bool wait_prev_segment);
 static void wait_replica_wal_lsn(XLogRecPtr lsn, bool is_start_backup, PGconn *backup_conn);
 static void make_pagemap_from_ptrack(parray* files, PGconn* backup_conn);
+static void build_rel_seg_index(parray *files);
+static void free_rel_seg_index(void);
 static void *StreamLog(void *arg);
 
 static void check_external_for_tablespaces(parray *external_list,
@@ -169,6 +208,10 @@ do_backup_instance(PGconn *backup_conn)
 	parray	   *prev_backup_filelist = NULL;
 	parray	   *backup_list = NULL;
 	parray	   *external_dirs = NULL;
+	parray	   *backup_ranges_list = NULL;
+	pgFileScheduler *scheduler;
+	PageIndexMap index_map;
+	char		index_path[MAXPGPATH];
 
 	pgFile	   *pg_control = NULL;
 	PGconn	   *master_conn = NULL;
@@ -390,8 +433,10 @@ do_backup_instance(PGconn *backup_conn)
 		 * reading WAL segments present in archives up to the point
 		 * where this backup has started.
 		 */
+		build_rel_seg_index(backup_files_list);
 		extractPageMap(arclog_path, current.tli, instance_config.xlog_seg_size,
 					   prev_backup->start_lsn, current.start_lsn);
+		free_rel_seg_index();
 	}
 	else if (current.backup_mode == BACKUP_MODE_DIFF_PTRACK)
 	{
@@ -445,6 +490,23 @@ do_backup_instance(PGconn *backup_conn)
 	if (prev_backup_filelist)
 		parray_qsort(prev_backup_filelist, pgFileComparePathWithExternal);
 
+	/* Let several threads copy big data files simultaneously */
+	if (num_threads > 1)
+		backup_ranges_list = split_data_files(backup_files_list,
+											  prev_backup_filelist);
+
+	/* Let the remote agent find unchanged non-data files in one pass */
+	if (current.backup_mode != BACKUP_MODE_FULL && IsSshProtocol())
+		skip_unchanged_files(backup_files_list, prev_backup_filelist);
+
+	/* Spread the threads across the devices holding the files */
+	scheduler = file_scheduler_new(backup_files_list, instance_config.pgdata,
+								   external_dirs, FIO_DB_HOST);
+
+	/* Page indexes of data files are collected into the single file */
+	pgBackupGetPath(&current, index_path, lengthof(index_path), PAGE_INDEX_FILE);
+	open_page_index_map(&index_map, index_path);
+
 	/* init thread args with own file lists */
 	threads = (pthread_t *) palloc(sizeof(pthread_t) * num_threads);
 	threads_args = (backup_files_arg *) palloc(sizeof(backup_files_arg)*num_threads);
@@ -458,6 +520,9 @@ do_backup_instance(PGconn *backup_conn)
 		arg->external_prefix = external_prefix;
 		arg->external_dirs = external_dirs;
 		arg->files_list = backup_files_list;
+		arg->scheduler = scheduler;
+		arg->ranges_list = backup_ranges_list;
+		arg->index_map = &index_map;
 		arg->prev_filelist = prev_backup_filelist;
 		arg->prev_start_lsn = prev_backup_start_lsn;
 		arg->conn_arg.conn = NULL;
@@ -489,6 +554,22 @@ do_backup_instance(PGconn *backup_conn)
 	else
 		elog(ERROR, "Data files transferring failed");
 
+	close_page_index_map(&index_map);
+	file_scheduler_free(scheduler);
+
+	if (backup_ranges_list)
+	{
+		for (i = 0; i < parray_num(backup_ranges_list); i++)
+		{
+			pgFileRange *range = (pgFileRange *) parray_get(backup_ranges_list, i);
+
+			/* ranges of a file are allocated as a single array */
+			if (range->range_num == 0)
+				pg_free(range);
+		}
+		parray_free(backup_ranges_list);
+	}
+
 	/* Remove disappeared during backup files from backup_list */
 	for (i = 0; i < parray_num(backup_files_list); i++)
 	{
@@ -698,6 +779,7 @@ do_backup(time_t start_time, bool no_validate)
 	current.compress_level = instance_config.compress_level;
 
 	current.stream = stream_wal;
+	current.page_dedup = page_dedup;
 
 	is_ptrack_support = pg_ptrack_support(backup_conn);
 	if (is_ptrack_support)
@@ -751,6 +833,10 @@ do_backup(time_t start_time, bool no_validate)
 	do_backup_instance(backup_conn);
 	pgut_atexit_pop(backup_cleanup, NULL);
 
+	/* make pages added to the page store visible to other processes */
+	if (current.page_dedup)
+		page_store_close();
+
 	/* compute size of wal files of this backup stored in the archive */
 	if (!current.stream)
 	{
@@ -1987,16 +2073,73 @@ backup_files(void *arg)
 	int			i;
 	backup_files_arg *arguments = (backup_files_arg *) arg;
 	int			n_backup_files_list = parray_num(arguments->files_list);
+	int			n_backup_ranges_list = 0;
+	pgFile	   *file;
+	int			device = -1;
+	int			num;
+
+	if (arguments->ranges_list)
+		n_backup_ranges_list = parray_num(arguments->ranges_list);
+
+	/* backup ranges of big data files, they are the heaviest part of work */
+	for (i = 0; i < n_backup_ranges_list; i++)
+	{
+		pgFileRange *range = (pgFileRange *) parray_get(arguments->ranges_list, i);
+		char		to_path[MAXPGPATH];
+
+		if (!pg_atomic_test_set_flag(&range->lock))
+			continue;
+		file = range->file;
+		elog(VERBOSE, "Copying range %d of file:  \"%s\" ",
+			 range->range_num, file->path);
+
+		/* check for interrupt */
+		if (interrupted || thread_interrupted)
+			elog(ERROR, "interrupted during backup");
+
+		if (progress)
+			elog(INFO, "Progress: (%d/%d). Process range %d of %d of file \"%s\"",
+				 i + 1, n_backup_ranges_list, range->range_num + 1,
+				 range->n_ranges, file->path);
+
+		join_path_components(to_path, arguments->to_root,
+							 file->path + strlen(arguments->from_root) + 1);
+
+		backup_data_file_range(arguments, to_path, range,
+							   arguments->prev_start_lsn,
+							   current.backup_mode,
+							   instance_config.compress_alg,
+							   instance_config.compress_level);
+		append_data_file_range(to_path, range);
+
+		/* The thread which finished the last range completes the file */
+		if (pg_atomic_sub_fetch_u32(&range->first->n_unfinished, 1) != 0)
+			continue;
+
+		if (!join_data_file_ranges(to_path, range->first, current.backup_mode))
+		{
+			write_page_index(arguments->index_map, file);
+
+			/* disappeared file not to be confused with 'not changed' */
+			if (file->write_size != FILE_NOT_FOUND)
+				file->write_size = BYTES_INVALID;
+			elog(VERBOSE, "File \"%s\" was not copied to backup", file->path);
+			continue;
+		}
+
+		write_page_index(arguments->index_map, file);
+
+		elog(VERBOSE, "File \"%s\". Copied "INT64_FORMAT " bytes",
+			 file->path, file->write_size);
+	}
 
 	/* backup a file */
-	for (i = 0; i < n_backup_files_list; i++)
+	while ((file = file_scheduler_next(arguments->scheduler, &device,
+									   &num)) != NULL)
 	{
 		int			ret;
 		struct stat	buf;
-		pgFile	   *file = (pgFile *) parray_get(arguments->files_list, i);
 
-		if (!pg_atomic_test_set_flag(&file->lock))
-			continue;
 		elog(VERBOSE, "Copying file:  \"%s\" ", file->path);
 
 		/* check for interrupt */
@@ -2005,7 +2148,7 @@ backup_files(void *arg)
 
 		if (progress)
 			elog(INFO, "Progress: (%d/%d). Process file \"%s\"",
-				 i + 1, n_backup_files_list, file->path);
+				 num, n_backup_files_list, file->path);
 
 		/* stat file to check its current state */
 		ret = fio_stat(file->path, &buf, true, FIO_DB_HOST);
@@ -2064,17 +2207,22 @@ backup_files(void *arg)
 			if (file->is_datafile && !file->is_cfs)
 			{
 				char		to_path[MAXPGPATH];
+				bool		copied;
 
 				join_path_components(to_path, arguments->to_root,
 									 file->path + strlen(arguments->from_root) + 1);
 
 				/* backup block by block if datafile AND not compressed by cfs*/
-				if (!backup_data_file(arguments, to_path, file,
-									  arguments->prev_start_lsn,
-									  current.backup_mode,
-									  instance_config.compress_alg,
-									  instance_config.compress_level,
-									  true))
+				copied = backup_data_file(arguments, to_path, file,
+										  arguments->prev_start_lsn,
+										  current.backup_mode,
+										  instance_config.compress_alg,
+										  instance_config.compress_level,
+										  true);
+
+				write_page_index(arguments->index_map, file);
+
+				if (!copied)
 				{
 					/* disappeared file not to be confused with 'not changed' */
 					if (file->write_size != FILE_NOT_FOUND)
@@ -2137,6 +2285,7 @@ backup_files(void *arg)
 	/* Close connection */
 	if (arguments->conn_arg.conn)
 		pgut_disconnect(arguments->conn_arg.conn);
+	fio_disconnect();
 
 	/* Data files transferring is successful */
 	arguments->ret = 0;
@@ -2144,6 +2293,157 @@ backup_files(void *arg)
 	return NULL;
 }
 
+/*
+ * Split data files larger than BACKUP_RANGE_BLOCKS blocks into ranges, which
+ * are claimed by backup threads independently. Files are expected to be
+ * sorted by size, so the ranges of the biggest files go first.
+ * Such files are locked here to prevent backup_files() from copying them
+ * as a whole.
+ */
+static parray *
+split_data_files(parray *files, parray *prev_filelist)
+{
+	parray	   *ranges = parray_new();
+	int			i;
+
+	for (i = parray_num(files) - 1; i >= 0; i--)
+	{
+		pgFile	   *file = (pgFile *) parray_get(files, i);
+		BlockNumber	nblocks = file->size / BLCKSZ;
+		pgFileRange *file_ranges;
+		int			n_ranges;
+		int			j;
+
+		if (!S_ISREG(file->mode) || !file->is_datafile || file->is_cfs ||
+			file->external_dir_num || nblocks <= BACKUP_RANGE_BLOCKS)
+			continue;
+
+		/* Check that file exist in previous backup */
+		if (current.backup_mode != BACKUP_MODE_FULL)
+		{
+			pgFile		key;
+
+			key.path = GetRelativePath(file->path, instance_config.pgdata);
+			key.external_dir_num = 0;
+
+			if (parray_bsearch(prev_filelist, &key, pgFileComparePathWithExternal))
+				file->exists_in_prev = true;
+		}
+
+		/* Unchanged file is skipped by backup_data_file() as a whole */
+		if ((current.backup_mode == BACKUP_MODE_DIFF_PAGE ||
+			current.backup_mode == BACKUP_MODE_DIFF_PTRACK) &&
+			file->pagemap.bitmapsize == PageBitmapIsEmpty &&
+			file->exists_in_prev && !file->pagemap_isabsent)
+			continue;
+
+		n_ranges = (nblocks + BACKUP_RANGE_BLOCKS - 1) / BACKUP_RANGE_BLOCKS;
+		file_ranges = (pgFileRange *) pgut_malloc(sizeof(pgFileRange) * n_ranges);
+		MemSet(file_ranges, 0, sizeof(pgFileRange) * n_ranges);
+
+		for (j = 0; j < n_ranges; j++)
+		{
+			pgFileRange *range = &file_ranges[j];
+
+			range->file = file;
+			range->range_num = j;
+			range->n_ranges = n_ranges;
+			range->start_block = j * BACKUP_RANGE_BLOCKS;
+			/* the last range takes blocks appended during backup too */
+			range->end_block = (j == n_ranges - 1) ? InvalidBlockNumber :
+				(j + 1) * BACKUP_RANGE_BLOCKS;
+			range->first = file_ranges;
+			pg_atomic_clear_flag(&range->lock);
+			pg_atomic_clear_flag(&range->append_lock);
+
+			parray_append(ranges, range);
+		}
+		pg_atomic_init_u32(&file_ranges->n_unfinished, n_ranges);
+
+		/* The file is copied by ranges */
+		pg_atomic_test_set_flag(&file->lock);
+
+		elog(VERBOSE, "File \"%s\" is split into %d ranges", file->path, n_ranges);
+	}
+
+	return ranges;
+}
+
+/*
+ * Find non-data files which are not changed since the previous backup.
+ * backup_files() computes CRC of such files one by one, which takes many
+ * round trips for the remote database host, so here they are checked by the
+ * agent in batches. Unchanged files are locked to prevent backup_files()
+ * from copying them.
+ */
+static void
+skip_unchanged_files(parray *files, parray *prev_filelist)
+{
+	fio_file_check *checks;
+	pgFile	  **checked_files;
+	int			n_checks = 0;
+	int			n_unchanged = 0;
+	int			i;
+
+	checks = (fio_file_check *) palloc(sizeof(fio_file_check) *
+									   parray_num(files));
+	checked_files = (pgFile **) palloc(sizeof(pgFile *) * parray_num(files));
+
+	for (i = 0; i < parray_num(files); i++)
+	{
+		pgFile	   *file = (pgFile *) parray_get(files, i);
+		pgFile	  **prev_file;
+		pgFile		key;
+
+		/* Data files and pg_control are always processed by backup_files() */
+		if (!S_ISREG(file->mode) || (file->is_datafile && !file->is_cfs))
+			continue;
+		if (!file->external_dir_num && strcmp(file->name, "pg_control") == 0)
+			continue;
+
+		key.path = file->rel_path;
+		key.external_dir_num = file->external_dir_num;
+
+		prev_file = (pgFile **) parray_bsearch(prev_filelist, &key,
+											   pgFileComparePathWithExternal);
+		if (prev_file == NULL)
+			continue;
+		file->exists_in_prev = true;
+
+		checks[n_checks].path = file->path;
+		checks[n_checks].mtime = current.parent_backup;
+		checks[n_checks].size = (*prev_file)->size;
+		checks[n_checks].crc = (*prev_file)->crc;
+		checked_files[n_checks] = file;
+		n_checks++;
+	}
+
+	fio_check_unchanged_files(checks, n_checks, FIO_DB_HOST);
+
+	for (i = 0; i < n_checks; i++)
+	{
+		pgFile	   *file = checked_files[i];
+
+		if (!checks[i].unchanged)
+			continue;
+
+		file->crc = checks[i].crc;
+		file->read_size = checks[i].size;
+		file->write_size = BYTES_INVALID;
+
+		/* The file is not copied */
+		pg_atomic_test_set_flag(&file->lock);
+		n_unchanged++;
+		elog(VERBOSE, "Skipping the unchanged file: %s", file->path);
+	}
+
+	elog(LOG, "%d of %d non-data files are not changed since the previous backup",
+		 n_unchanged, n_checks);
+
+	pfree(checks);
+	pfree(checked_files);
+}
+
 /*
  * Extract information about files in backup_list parsing their names:
  * - remove temp tables from the list
@@ -2280,35 +2580,178 @@ set_cfs_datafiles(parray *files, const char *root, char *relative, size_t i)
 	free(cfs_tblspc_path);
 }
 
+static uint32
+rel_seg_hash(Oid spcNode, Oid dbNode, Oid relNode, int segno)
+{
+	uint32		h = spcNode;
+
+	h = (h * 0x9E3779B1) ^ dbNode;
+	h = (h * 0x9E3779B1) ^ relNode;
+	h = (h * 0x9E3779B1) ^ (uint32) segno;
+
+	return h ^ (h >> 15);
+}
+
+/* Positions of the relation in rel_filter */
+static void
+rel_filter_positions(Oid spcNode, Oid dbNode, Oid relNode,
+					 uint32 *pos1, uint32 *pos2)
+{
+	uint32		mask = rel_filter_bits - 1;
+
+	*pos1 = rel_seg_hash(spcNode, dbNode, relNode, 0) & mask;
+	*pos2 = rel_seg_hash(relNode, dbNode, spcNode, -1) & mask;
+}
+
+/*
+ * Find the slot of the relation segment in rel_seg_index. Returns the free
+ * slot where the segment should be inserted if the segment is not found.
+ */
+static RelSegEntry *
+rel_seg_find(Oid spcNode, Oid dbNode, Oid relNode, int segno)
+{
+	uint32		mask = rel_seg_index_size - 1;
+	uint32		pos = rel_seg_hash(spcNode, dbNode, relNode, segno) & mask;
+
+	for (;;)
+	{
+		RelSegEntry *entry = &rel_seg_index[pos];
+
+		if (entry->file_num == -1 ||
+			(entry->relNode == relNode && entry->segno == segno &&
+			 entry->dbNode == dbNode && entry->spcNode == spcNode))
+			return entry;
+
+		pos = (pos + 1) & mask;
+	}
+}
+
 /*
- * Find pgfile by given rnode in the backup_files_list
- * and add given blkno to its pagemap.
+ * Build the index of main fork segments of the data files in "files" and
+ * the filter of their relations.
+ */
+static void
+build_rel_seg_index(parray *files)
+{
+	int			n_datafiles = 0;
+	uint32		i;
+
+	for (i = 0; i < parray_num(files); i++)
+	{
+		pgFile	   *file = (pgFile *) parray_get(files, i);
+
+		if (file->is_datafile)
+			n_datafiles++;
+	}
+
+	/* Keep the index at most half full */
+	rel_seg_index_size = 16;
+	while (rel_seg_index_size < (uint32) n_datafiles * 2)
+		rel_seg_index_size *= 2;
+
+	rel_seg_index = pgut_newarray(RelSegEntry, rel_seg_index_size);
+	for (i = 0; i < rel_seg_index_size; i++)
+		rel_seg_index[i].file_num = -1;
+	rel_seg_files = pgut_newarray(pgFile *, Max(n_datafiles, 1));
+	n_rel_seg_files = 0;
+
+	/* 16 bits per data file keep false positives of the filter rare */
+	rel_filter_bits = 1024;
+	while (rel_filter_bits < (uint32) n_datafiles * 16)
+		rel_filter_bits *= 2;
+	rel_filter = (uint8 *) pgut_malloc(rel_filter_bits / 8);
+	memset(rel_filter, 0, rel_filter_bits / 8);
+
+	for (i = 0; i < parray_num(files); i++)
+	{
+		pgFile	   *file = (pgFile *) parray_get(files, i);
+		RelSegEntry *entry;
+		uint32		pos1,
+					pos2;
+
+		if (!file->is_datafile)
+			continue;
+
+		entry = rel_seg_find(file->tblspcOid, file->dbOid, file->relOid,
+							 file->segno);
+		if (entry->file_num != -1)
+			continue;
+
+		entry->spcNode = file->tblspcOid;
+		entry->dbNode = file->dbOid;
+		entry->relNode = file->relOid;
+		entry->segno = file->segno;
+		entry->file_num = n_rel_seg_files;
+		rel_seg_files[n_rel_seg_files++] = file;
+
+		rel_filter_positions(file->tblspcOid, file->dbOid, file->relOid,
+							 &pos1, &pos2);
+		rel_filter[pos1 / 8] |= 1 << (pos1 % 8);
+		rel_filter[pos2 / 8] |= 1 << (pos2 % 8);
+	}
+
+	pagemaps_list = parray_new();
+	pagemaps_generation++;
+}
+
+static void
+free_rel_seg_index(void)
+{
+	merge_block_changes();
+
+	pg_free(rel_seg_index);
+	rel_seg_index = NULL;
+	rel_seg_index_size = 0;
+	pg_free(rel_seg_files);
+	rel_seg_files = NULL;
+	n_rel_seg_files = 0;
+	pg_free(rel_filter);
+	rel_filter = NULL;
+	rel_filter_bits = 0;
+	parray_free(pagemaps_list);
+	pagemaps_list = NULL;
+}
+
+/*
+ * Check if the relation may have data files in backup_files_list. Changes of
+ * other relations, e.g. of excluded databases or of temporary and unlogged
+ * relations, need not be passed to process_block_change().
+ */
+bool
+relation_in_backup_filter(RelFileNode rnode)
+{
+	uint32		pos1,
+				pos2;
+
+	if (rel_filter == NULL)
+		return true;
+
+	rel_filter_positions(rnode.spcNode, rnode.dbNode, rnode.relNode,
+						 &pos1, &pos2);
+
+	return (rel_filter[pos1 / 8] & (1 << (pos1 % 8))) != 0 &&
+		(rel_filter[pos2 / 8] & (1 << (pos2 % 8))) != 0;
+}
+
+/*
+ * Find the data file by given rnode in the index of backup_files_list
+ * and add given blkno to the page map collected by the thread.
+ * Only the main fork is tracked, other forks are copied entirely.
  */
 void
 process_block_change(ForkNumber forknum, RelFileNode rnode, BlockNumber blkno)
 {
-	char	   *path;
-	char	   *rel_path;
 	BlockNumber blkno_inseg;
 	int			segno;
-	pgFile	  **file_item;
-	pgFile		f;
+	RelSegEntry *entry;
+
+	if (forknum != MAIN_FORKNUM)
+		return;
 
 	segno = blkno / RELSEG_SIZE;
 	blkno_inseg = blkno % RELSEG_SIZE;
 
-	rel_path = relpathperm(rnode, forknum);
-	if (segno > 0)
-		path = psprintf("%s/%s.%u", instance_config.pgdata, rel_path, segno);
-	else
-		path = psprintf("%s/%s", instance_config.pgdata, rel_path);
-
-	pg_free(rel_path);
-
-	f.path = path;
-	/* backup_files_list should be sorted before */
-	file_item = (pgFile **) parray_bsearch(backup_files_list, &f,
-										   pgFileComparePath);
+	entry = rel_seg_find(rnode.spcNode, rnode.dbNode, rnode.relNode, segno);
 
 	/*
 	 * If we don't have any record of this file in the file map, it means
@@ -2316,19 +2759,71 @@ process_block_change(ForkNumber forknum, RelFileNode rnode, BlockNumber blkno)
 	 * backup. We can safely ignore it. If it is a new relation file, the
 	 * backup would simply copy it as-is.
 	 */
-	if (file_item)
+	if (entry->file_num == -1)
+		return;
+
+	if (thread_pagemaps_generation != pagemaps_generation)
 	{
-		/* We need critical section only we use more than one threads */
-		if (num_threads > 1)
-			pthread_lock(&backup_pagemap_mutex);
+		thread_pagemaps = (datapagemap_t *)
+			palloc0(sizeof(datapagemap_t) * n_rel_seg_files);
+		thread_pagemaps_generation = pagemaps_generation;
+
+		pthread_lock(&backup_pagemap_mutex);
+		parray_append(pagemaps_list, thread_pagemaps);
+		pthread_mutex_unlock(&backup_pagemap_mutex);
+	}
+
+	datapagemap_add(&thread_pagemaps[entry->file_num], blkno_inseg);
+}
 
-		datapagemap_add(&(*file_item)->pagemap, blkno_inseg);
+/*
+ * Merge page maps collected by the threads into backup_files_list. Should be
+ * called when no thread is calling process_block_change().
+ */
+void
+merge_block_changes(void)
+{
+	int			i,
+				j;
+
+	for (i = 0; i < parray_num(pagemaps_list); i++)
+	{
+		datapagemap_t *pagemaps = (datapagemap_t *) parray_get(pagemaps_list, i);
 
-		if (num_threads > 1)
-			pthread_mutex_unlock(&backup_pagemap_mutex);
+		for (j = 0; j < n_rel_seg_files; j++)
+		{
+			datapagemap_t *dst = &rel_seg_files[j]->pagemap;
+			datapagemap_t *src = &pagemaps[j];
+			int			k;
+
+			if (src->bitmapsize == 0)
+				continue;
+
+			/* Take the page map of the thread as is */
+			if (dst->bitmap == NULL)
+			{
+				*dst = *src;
+				continue;
+			}
+
+			if (dst->bitmapsize < src->bitmapsize)
+			{
+				dst->bitmap = pg_realloc(dst->bitmap, src->bitmapsize);
+				memset(dst->bitmap + dst->bitmapsize, 0,
+					   src->bitmapsize - dst->bitmapsize);
+				dst->bitmapsize = src->bitmapsize;
+			}
+			for (k = 0; k < src->bitmapsize; k++)
+				dst->bitmap[k] |= src->bitmap[k];
+			pg_free(src->bitmap);
+		}
+		pfree(pagemaps);
 	}
 
-	pg_free(path);
+	parray_free(pagemaps_list);
+	pagemaps_list = parray_new();
+	/* The threads will allocate new arrays */
+	pagemaps_generation++;
 }
 
 /*
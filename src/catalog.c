@@ -301,6 +301,532 @@ IsDir(const char *dirpath, const char *entry, fio_location location)
 	return fio_stat(path, &st, false, location) == 0 && S_ISDIR(st.st_mode);
 }
 
+/*
+ * Catalog index.
+ *
+ * BACKUP_CATALOG_INDEX_FILE of the instance keeps contents of BACKUP_CONTROL_FILE
+ * of all backups together with modification time and size of these files. An
+ * entry is used by catalog_get_backup_list() only if BACKUP_CONTROL_FILE
+ * wasn't modified since the entry was saved, so checking the catalog costs a
+ * stat() call per backup instead of reading and parsing of the control file.
+ * The index is read only by the same version of the program which wrote it,
+ * so fields are stored as is.
+ */
+#define CATALOG_INDEX_MAGIC		"PBCI"
+
+/* Age of a stale lock of the index in seconds */
+#define CATALOG_INDEX_LOCK_TIMEOUT	60
+
+/* CatalogIndexEntry flags */
+#define CATALOG_INDEX_STREAM		0x01
+#define CATALOG_INDEX_FROM_REPLICA	0x02
+#define CATALOG_INDEX_PAGE_DEDUP	0x04
+
+typedef struct CatalogIndexHeader
+{
+	char		magic[4];
+	uint32		n_entries;
+	char		program_version[100];
+	pg_crc32	crc;			/* CRC of the entries */
+	uint32		padding;
+} CatalogIndexHeader;
+
+/* Entry is followed by primary_conninfo and external_dir_str strings */
+typedef struct CatalogIndexEntry
+{
+	int64		control_mtime;	/* mtime of BACKUP_CONTROL_FILE */
+	int64		control_size;	/* size of BACKUP_CONTROL_FILE */
+	int64		start_time;
+	int64		merge_time;
+	int64		end_time;
+	int64		recovery_time;
+	int64		parent_backup;
+	int64		data_bytes;
+	int64		wal_bytes;
+	XLogRecPtr	start_lsn;
+	XLogRecPtr	stop_lsn;
+	uint32		backup_mode;
+	uint32		status;
+	TimeLineID	tli;
+	TransactionId recovery_xid;
+	uint32		compress_alg;
+	int32		compress_level;
+	uint32		block_size;
+	uint32		wal_block_size;
+	uint32		checksum_version;
+	uint32		flags;
+	uint32		conninfo_len;	/* length of the string including '\0' */
+	uint32		external_dirs_len;
+	char		program_version[100];
+	char		server_version[100];
+} CatalogIndexEntry;
+
+/* Backup of the catalog index */
+typedef struct CatalogIndexItem
+{
+	pgBackup   *backup;
+	time_t		control_mtime;
+	off_t		control_size;
+} CatalogIndexItem;
+
+static int
+catalog_index_item_compare(const void *a, const void *b)
+{
+	const CatalogIndexItem *item1 = *(CatalogIndexItem **) a;
+	const CatalogIndexItem *item2 = *(CatalogIndexItem **) b;
+
+	if (item1->backup->start_time > item2->backup->start_time)
+		return 1;
+	else if (item1->backup->start_time < item2->backup->start_time)
+		return -1;
+	else
+		return 0;
+}
+
+static void
+catalog_index_item_free(void *item)
+{
+	pgBackupFree(((CatalogIndexItem *) item)->backup);
+	pfree(item);
+}
+
+static CatalogIndexItem *
+catalog_index_item_new(pgBackup *backup, struct stat *st)
+{
+	CatalogIndexItem *item = pgut_new(CatalogIndexItem);
+
+	item->backup = backup;
+	if (st)
+	{
+		item->control_mtime = st->st_mtime;
+		item->control_size = st->st_size;
+	}
+	else
+	{
+		item->control_mtime = 0;
+		item->control_size = 0;
+	}
+	return item;
+}
+
+/* Make a copy of the backup which can be freed by pgBackupFree() */
+static pgBackup *
+pgBackupCopy(pgBackup *backup)
+{
+	pgBackup   *copy = pgut_new(pgBackup);
+
+	memcpy(copy, backup, sizeof(pgBackup));
+	copy->parent_backup_link = NULL;
+	if (backup->primary_conninfo)
+		copy->primary_conninfo = pgut_strdup(backup->primary_conninfo);
+	if (backup->external_dir_str)
+		copy->external_dir_str = pgut_strdup(backup->external_dir_str);
+	return copy;
+}
+
+/*
+ * Take the lock of the catalog index, which is held while the index is read,
+ * modified and written. The lock is considered stale if its owner doesn't
+ * exist or if it is older than CATALOG_INDEX_LOCK_TIMEOUT seconds, updates of
+ * the index take much less. If "wait" is false and the lock is busy, returns
+ * false at once: the index is only a cache and may be left as is.
+ */
+static bool
+lock_catalog_index(bool wait)
+{
+	char		lock_file[MAXPGPATH];
+	char		buffer[64];
+	int			fd;
+	int			ntries;
+	int			len;
+
+	join_path_components(lock_file, backup_instance_path,
+						 BACKUP_CATALOG_INDEX_LOCK_FILE);
+
+	for (ntries = 0;; ntries++)
+	{
+		struct stat	st;
+		int			encoded_pid = 0;
+
+		fd = fio_open(lock_file, O_RDWR | O_CREAT | O_EXCL, FIO_BACKUP_HOST);
+		if (fd >= 0)
+			break;
+
+		if (errno != EEXIST || ntries > CATALOG_INDEX_LOCK_TIMEOUT * 10)
+		{
+			elog(LOG, "Cannot create lock file \"%s\": %s", lock_file,
+				 strerror(errno));
+			return false;
+		}
+
+		if (fio_stat(lock_file, &st, false, FIO_BACKUP_HOST) != 0)
+			continue;			/* lock was released, try again */
+
+		fd = fio_open(lock_file, O_RDONLY, FIO_BACKUP_HOST);
+		if (fd >= 0)
+		{
+			if ((len = fio_read(fd, buffer, sizeof(buffer) - 1)) > 0)
+			{
+				buffer[len] = '\0';
+				encoded_pid = atoi(buffer);
+			}
+			fio_close(fd);
+		}
+
+		/* The owner may not have written its PID yet */
+		if (time(NULL) - st.st_mtime < CATALOG_INDEX_LOCK_TIMEOUT &&
+			(encoded_pid <= 0 ||
+			 (encoded_pid != getpid() && kill(encoded_pid, 0) == 0)))
+		{
+			if (!wait)
+				return false;
+			pg_usleep(100000L);	/* 100 ms */
+			continue;
+		}
+
+		elog(LOG, "Remove stale lock file \"%s\"", lock_file);
+		if (fio_unlink(lock_file, FIO_BACKUP_HOST) < 0 && errno != ENOENT)
+		{
+			elog(LOG, "Cannot remove lock file \"%s\": %s", lock_file,
+				 strerror(errno));
+			return false;
+		}
+	}
+
+	snprintf(buffer, sizeof(buffer), "%d\n", getpid());
+	if (fio_write(fd, buffer, strlen(buffer)) != strlen(buffer) ||
+		fio_close(fd) != 0)
+	{
+		elog(LOG, "Cannot write lock file \"%s\": %s", lock_file,
+			 strerror(errno));
+		fio_unlink(lock_file, FIO_BACKUP_HOST);
+		return false;
+	}
+
+	return true;
+}
+
+static void
+unlock_catalog_index(void)
+{
+	char		lock_file[MAXPGPATH];
+
+	join_path_components(lock_file, backup_instance_path,
+						 BACKUP_CATALOG_INDEX_LOCK_FILE);
+	if (fio_unlink(lock_file, FIO_BACKUP_HOST) < 0 && errno != ENOENT)
+		elog(WARNING, "Cannot remove lock file \"%s\": %s", lock_file,
+			 strerror(errno));
+}
+
+/*
+ * Read the catalog index of the instance. Returns NULL if there is no index
+ * or it cannot be used, the list sorted by backup ID otherwise.
+ */
+static parray *
+read_catalog_index(void)
+{
+	char	   *buf;
+	size_t		size;
+	size_t		pos;
+	CatalogIndexHeader *header;
+	pg_crc32	crc;
+	parray	   *items;
+	uint32		i;
+
+	buf = slurpFile(backup_instance_path, BACKUP_CATALOG_INDEX_FILE, &size,
+					true, FIO_BACKUP_HOST);
+	if (buf == NULL)
+		return NULL;
+
+	header = (CatalogIndexHeader *) buf;
+	if (size < sizeof(CatalogIndexHeader) ||
+		memcmp(header->magic, CATALOG_INDEX_MAGIC, sizeof(header->magic)) != 0 ||
+		strncmp(header->program_version, PROGRAM_VERSION,
+				sizeof(header->program_version)) != 0)
+	{
+		elog(LOG, "Catalog index of instance \"%s\" is ignored", instance_name);
+		pg_free(buf);
+		return NULL;
+	}
+
+	INIT_FILE_CRC32(true, crc);
+	COMP_FILE_CRC32(true, crc, buf + sizeof(CatalogIndexHeader),
+					size - sizeof(CatalogIndexHeader));
+	FIN_FILE_CRC32(true, crc);
+	if (!EQ_CRC32C(crc, header->crc))
+	{
+		elog(WARNING, "Catalog index of instance \"%s\" has invalid CRC",
+			 instance_name);
+		pg_free(buf);
+		return NULL;
+	}
+
+	items = parray_new();
+	pos = sizeof(CatalogIndexHeader);
+	for (i = 0; i < header->n_entries; i++)
+	{
+		CatalogIndexEntry entry;
+		CatalogIndexItem *item;
+		pgBackup   *backup;
+
+		if (pos + sizeof(CatalogIndexEntry) > size)
+			goto bad_format;
+		memcpy(&entry, buf + pos, sizeof(CatalogIndexEntry));
+		pos += sizeof(CatalogIndexEntry);
+		if (pos + entry.conninfo_len + entry.external_dirs_len > size)
+			goto bad_format;
+
+		backup = pgut_new(pgBackup);
+		pgBackupInit(backup);
+		backup->start_time = (time_t) entry.start_time;
+		backup->backup_id = backup->start_time;
+		backup->merge_time = (time_t) entry.merge_time;
+		backup->end_time = (time_t) entry.end_time;
+		backup->recovery_time = (time_t) entry.recovery_time;
+		backup->parent_backup = (time_t) entry.parent_backup;
+		backup->data_bytes = entry.data_bytes;
+		backup->wal_bytes = entry.wal_bytes;
+		backup->start_lsn = entry.start_lsn;
+		backup->stop_lsn = entry.stop_lsn;
+		backup->backup_mode = (BackupMode) entry.backup_mode;
+		backup->status = (BackupStatus) entry.status;
+		backup->tli = entry.tli;
+		backup->recovery_xid = entry.recovery_xid;
+		backup->compress_alg = (CompressAlg) entry.compress_alg;
+		backup->compress_level = entry.compress_level;
+		backup->block_size = entry.block_size;
+		backup->wal_block_size = entry.wal_block_size;
+		backup->checksum_version = entry.checksum_version;
+		backup->stream = (entry.flags & CATALOG_INDEX_STREAM) != 0;
+		backup->from_replica = (entry.flags & CATALOG_INDEX_FROM_REPLICA) != 0;
+		backup->page_dedup = (entry.flags & CATALOG_INDEX_PAGE_DEDUP) != 0;
+		StrNCpy(backup->program_version, entry.program_version,
+				sizeof(backup->program_version));
+		StrNCpy(backup->server_version, entry.server_version,
+				sizeof(backup->server_version));
+		if (entry.conninfo_len > 0)
+		{
+			backup->primary_conninfo = pgut_malloc(entry.conninfo_len);
+			memcpy(backup->primary_conninfo, buf + pos, entry.conninfo_len);
+			backup->primary_conninfo[entry.conninfo_len - 1] = '\0';
+			pos += entry.conninfo_len;
+		}
+		if (entry.external_dirs_len > 0)
+		{
+			backup->external_dir_str = pgut_malloc(entry.external_dirs_len);
+			memcpy(backup->external_dir_str, buf + pos,
+				   entry.external_dirs_len);
+			backup->external_dir_str[entry.external_dirs_len - 1] = '\0';
+			pos += entry.external_dirs_len;
+		}
+
+		item = catalog_index_item_new(backup, NULL);
+		item->control_mtime = (time_t) entry.control_mtime;
+		item->control_size = (off_t) entry.control_size;
+		parray_append(items, item);
+	}
+
+	pg_free(buf);
+	parray_qsort(items, catalog_index_item_compare);
+	return items;
+
+bad_format:
+	elog(WARNING, "Catalog index of instance \"%s\" is corrupted", instance_name);
+	pg_free(buf);
+	parray_walk(items, catalog_index_item_free);
+	parray_free(items);
+	return NULL;
+}
+
+/*
+ * Atomically write the catalog index of the instance. The caller holds the
+ * lock of the index. Errors are not fatal, the index is only a cache of
+ * BACKUP_CONTROL_FILE files.
+ */
+static void
+write_catalog_index(parray *items)
+{
+	char		path[MAXPGPATH];
+	char		path_temp[MAXPGPATH];
+	CatalogIndexHeader header;
+	char	   *buf;
+	size_t		size;
+	size_t		max_size;
+	time_t		now = time(NULL);
+	FILE	   *fp;
+	int			i;
+
+	max_size = sizeof(CatalogIndexHeader) +
+		sizeof(CatalogIndexEntry) * parray_num(items) + BLCKSZ;
+	buf = pgut_malloc(max_size);
+	size = sizeof(CatalogIndexHeader);
+
+	for (i = 0; i < parray_num(items); i++)
+	{
+		CatalogIndexItem *item = (CatalogIndexItem *) parray_get(items, i);
+		pgBackup   *backup = item->backup;
+		CatalogIndexEntry entry;
+
+		MemSet(&entry, 0, sizeof(CatalogIndexEntry));
+		/*
+		 * The control file may be modified again within the same second
+		 * without changing its mtime, such entry has to be read from the
+		 * control file next time.
+		 */
+		entry.control_mtime = (item->control_mtime < now - 1) ?
+			item->control_mtime : 0;
+		entry.control_size = item->control_size;
+		entry.start_time = backup->start_time;
+		entry.merge_time = backup->merge_time;
+		entry.end_time = backup->end_time;
+		entry.recovery_time = backup->recovery_time;
+		entry.parent_backup = backup->parent_backup;
+		entry.data_bytes = backup->data_bytes;
+		entry.wal_bytes = backup->wal_bytes;
+		entry.start_lsn = backup->start_lsn;
+		entry.stop_lsn = backup->stop_lsn;
+		entry.backup_mode = backup->backup_mode;
+		entry.status = backup->status;
+		entry.tli = backup->tli;
+		entry.recovery_xid = backup->recovery_xid;
+		entry.compress_alg = backup->compress_alg;
+		entry.compress_level = backup->compress_level;
+		entry.block_size = backup->block_size;
+		entry.wal_block_size = backup->wal_block_size;
+		entry.checksum_version = backup->checksum_version;
+		if (backup->stream)
+			entry.flags |= CATALOG_INDEX_STREAM;
+		if (backup->from_replica)
+			entry.flags |= CATALOG_INDEX_FROM_REPLICA;
+		if (backup->page_dedup)
+			entry.flags |= CATALOG_INDEX_PAGE_DEDUP;
+		StrNCpy(entry.program_version, backup->program_version,
+				sizeof(entry.program_version));
+		StrNCpy(entry.server_version, backup->server_version,
+				sizeof(entry.server_version));
+		if (backup->primary_conninfo)
+			entry.conninfo_len = strlen(backup->primary_conninfo) + 1;
+		if (backup->external_dir_str)
+			entry.external_dirs_len = strlen(backup->external_dir_str) + 1;
+
+		if (size + sizeof(CatalogIndexEntry) + entry.conninfo_len +
+			entry.external_dirs_len > max_size)
+		{
+			max_size = (size + sizeof(CatalogIndexEntry) + entry.conninfo_len +
+						entry.external_dirs_len) * 2;
+			buf = pgut_realloc(buf, max_size);
+		}
+
+		memcpy(buf + size, &entry, sizeof(CatalogIndexEntry));
+		size += sizeof(CatalogIndexEntry);
+		if (entry.conninfo_len > 0)
+		{
+			memcpy(buf + size, backup->primary_conninfo, entry.conninfo_len);
+			size += entry.conninfo_len;
+		}
+		if (entry.external_dirs_len > 0)
+		{
+			memcpy(buf + size, backup->external_dir_str,
+				   entry.external_dirs_len);
+			size += entry.external_dirs_len;
+		}
+	}
+
+	MemSet(&header, 0, sizeof(CatalogIndexHeader));
+	memcpy(header.magic, CATALOG_INDEX_MAGIC, sizeof(header.magic));
+	header.n_entries = parray_num(items);
+	StrNCpy(header.program_version, PROGRAM_VERSION,
+			sizeof(header.program_version));
+	INIT_FILE_CRC32(true, header.crc);
+	COMP_FILE_CRC32(true, header.crc, buf + sizeof(CatalogIndexHeader),
+					size - sizeof(CatalogIndexHeader));
+	FIN_FILE_CRC32(true, header.crc);
+	memcpy(buf, &header, sizeof(CatalogIndexHeader));
+
+	join_path_components(path, backup_instance_path, BACKUP_CATALOG_INDEX_FILE);
+	snprintf(path_temp, sizeof(path_temp), "%s.tmp.%d", path, getpid());
+
+	fp = fio_fopen(path_temp, PG_BINARY_W, FIO_BACKUP_HOST);
+	if (fp == NULL)
+	{
+		elog(LOG, "Cannot open catalog index \"%s\": %s", path_temp,
+			 strerror(errno));
+		pg_free(buf);
+		return;
+	}
+
+	if (fio_fwrite(fp, buf, size) != size)
+	{
+		elog(LOG, "Cannot write catalog index \"%s\": %s", path_temp,
+			 strerror(errno));
+		fio_fclose(fp);
+		fio_unlink(path_temp, FIO_BACKUP_HOST);
+	}
+	else if (fio_fflush(fp) || fio_fclose(fp))
+	{
+		elog(LOG, "Cannot write catalog index \"%s\": %s", path_temp,
+			 strerror(errno));
+		fio_unlink(path_temp, FIO_BACKUP_HOST);
+	}
+	else if (fio_rename(path_temp, path, FIO_BACKUP_HOST) < 0)
+	{
+		elog(LOG, "Cannot rename catalog index \"%s\" to \"%s\": %s",
+			 path_temp, path, strerror(errno));
+		fio_unlink(path_temp, FIO_BACKUP_HOST);
+	}
+
+	pg_free(buf);
+}
+
+/*
+ * Put the backup into the catalog index after its BACKUP_CONTROL_FILE was
+ * written.
+ */
+static void
+update_catalog_index(pgBackup *backup)
+{
+	parray	   *items;
+	CatalogIndexItem key_item;
+	CatalogIndexItem *key = &key_item;
+	CatalogIndexItem **found;
+	char		path[MAXPGPATH];
+	struct stat	st;
+
+	pgBackupGetPath(backup, path, lengthof(path), BACKUP_CONTROL_FILE);
+	if (fio_stat(path, &st, false, FIO_BACKUP_HOST) != 0)
+		return;
+
+	if (!lock_catalog_index(true))
+		return;
+
+	items = read_catalog_index();
+	if (items == NULL)
+		items = parray_new();
+
+	key_item.backup = backup;
+	found = (CatalogIndexItem **) parray_bsearch(items, &key,
+												 catalog_index_item_compare);
+	if (found)
+	{
+		pgBackupFree((*found)->backup);
+		(*found)->backup = pgBackupCopy(backup);
+		(*found)->control_mtime = st.st_mtime;
+		(*found)->control_size = st.st_size;
+	}
+	else
+	{
+		parray_append(items,
+					  catalog_index_item_new(pgBackupCopy(backup), &st));
+		parray_qsort(items, catalog_index_item_compare);
+	}
+
+	write_catalog_index(items);
+	unlock_catalog_index();
+
+	parray_walk(items, catalog_index_item_free);
+	parray_free(items);
+}
+
 /*
  * Create list of backups.
  * If 'requested_backup_id' is INVALID_BACKUP_ID, return list of all backups.
@@ -313,6 +839,10 @@ catalog_get_backup_list(time_t requested_backup_id)
 	DIR		   *data_dir = NULL;
 	struct dirent *data_ent = NULL;
 	parray	   *backups = NULL;
+	parray	   *index;
+	parray	   *index_items;
+	bool		index_changed = false;
+	bool		index_locked = false;
 	int			i;
 
 	/* open backup instance backups directory */
@@ -324,6 +854,15 @@ catalog_get_backup_list(time_t requested_backup_id)
 		goto err_proc;
 	}
 
+	/*
+	 * The index is rewritten only if its lock is taken before control files
+	 * are read, otherwise an entry written by a concurrent update could be
+	 * replaced with the old one.
+	 */
+	index_locked = lock_catalog_index(false);
+	index = read_catalog_index();
+	index_items = parray_new();
+
 	/* scan the directory and list backups */
 	backups = parray_new();
 	for (; (data_ent = fio_readdir(data_dir)) != NULL; errno = 0)
@@ -331,18 +870,55 @@ catalog_get_backup_list(time_t requested_backup_id)
 		char		backup_conf_path[MAXPGPATH];
 		char		data_path[MAXPGPATH];
 		pgBackup   *backup = NULL;
+		struct stat	st;
+		CatalogIndexItem **cached = NULL;
 
-		/* skip not-directory entries and hidden entries */
-		if (!IsDir(backup_instance_path, data_ent->d_name, FIO_BACKUP_HOST)
-			|| data_ent->d_name[0] == '.')
+		/* skip hidden entries */
+		if (data_ent->d_name[0] == '.')
 			continue;
 
 		/* open subdirectory of specific backup */
 		join_path_components(data_path, backup_instance_path, data_ent->d_name);
-
-		/* read backup information from BACKUP_CONTROL_FILE */
 		snprintf(backup_conf_path, MAXPGPATH, "%s/%s", data_path, BACKUP_CONTROL_FILE);
-		backup = readBackupControlFile(backup_conf_path);
+
+		if (fio_stat(backup_conf_path, &st, false, FIO_BACKUP_HOST) == 0)
+		{
+			pgBackup	key_backup;
+			CatalogIndexItem key_item;
+			CatalogIndexItem *key = &key_item;
+
+			key_backup.start_time = base36dec(data_ent->d_name);
+			key_item.backup = &key_backup;
+			if (index &&
+				strcmp(base36enc(key_backup.start_time), data_ent->d_name) == 0)
+				cached = (CatalogIndexItem **) parray_bsearch(index, &key,
+											catalog_index_item_compare);
+
+			/* use the index entry if the control file wasn't changed */
+			if (cached && (*cached)->control_mtime != 0 &&
+				(*cached)->control_mtime == st.st_mtime &&
+				(*cached)->control_size == st.st_size)
+			{
+				backup = pgBackupCopy((*cached)->backup);
+				parray_append(index_items,
+							  catalog_index_item_new(pgBackupCopy(backup), &st));
+			}
+			else
+			{
+				/* read backup information from BACKUP_CONTROL_FILE */
+				backup = readBackupControlFile(backup_conf_path);
+				if (backup &&
+					strcmp(base36enc(backup->start_time), data_ent->d_name) == 0)
+				{
+					parray_append(index_items,
+								  catalog_index_item_new(pgBackupCopy(backup), &st));
+					index_changed = true;
+				}
+			}
+		}
+		/* skip not-directory entries */
+		else if (!IsDir(backup_instance_path, data_ent->d_name, FIO_BACKUP_HOST))
+			continue;
 
 		if (!backup)
 		{
@@ -379,6 +955,28 @@ catalog_get_backup_list(time_t requested_backup_id)
 		goto err_proc;
 	}
 
+	/* rewrite the index if some backups were read or deleted */
+	if (index_locked &&
+		(index_changed || index == NULL ||
+		 parray_num(index) != parray_num(index_items)))
+	{
+		parray_qsort(index_items, catalog_index_item_compare);
+		write_catalog_index(index_items);
+	}
+	if (index_locked)
+	{
+		unlock_catalog_index();
+		index_locked = false;
+	}
+
+	if (index)
+	{
+		parray_walk(index, catalog_index_item_free);
+		parray_free(index);
+	}
+	parray_walk(index_items, catalog_index_item_free);
+	parray_free(index_items);
+
 	fio_closedir(data_dir);
 	data_dir = NULL;
 
@@ -404,6 +1002,8 @@ catalog_get_backup_list(time_t requested_backup_id)
 	return backups;
 
 err_proc:
+	if (index_locked)
+		unlock_catalog_index();
 	if (data_dir)
 		fio_closedir(data_dir);
 	if (backups)
@@ -522,6 +1122,8 @@ pgBackupWriteControl(FILE *out, pgBackup *backup)
 			deparse_compress_alg(backup->compress_alg));
 	fio_fprintf(out, "compress-level = %d\n", backup->compress_level);
 	fio_fprintf(out, "from-replica = %s\n", backup->from_replica ? "true" : "false");
+	if (backup->page_dedup)
+		fio_fprintf(out, "page-dedup = true\n");
 
 	fio_fprintf(out, "\n#Compatibility\n");
 	fio_fprintf(out, "block-size = %u\n", backup->block_size);
@@ -623,6 +1225,8 @@ write_backup(pgBackup *backup)
 		elog(ERROR, "Cannot rename configuration file \"%s\" to \"%s\": %s",
 			 path_temp, path, strerror(errno_temp));
 	}
+
+	update_catalog_index(backup);
 }
 
 /*
@@ -645,7 +1249,11 @@ write_backup_filelist(pgBackup *backup, parray *files, const char *root,
 		elog(ERROR, "Cannot open file list \"%s\": %s", path_temp,
 			 strerror(errno));
 
-	print_file_list(fp, files, root, external_prefix, external_list);
+	if (filelist_format == FILELIST_TEXT)
+		print_file_list(fp, files, root, external_prefix, external_list);
+	else
+		write_binary_file_list(fp, files, root, external_prefix,
+							   external_list);
 
 	if (fio_fflush(fp) || fio_fclose(fp))
 	{
@@ -707,6 +1315,7 @@ readBackupControlFile(const char *path)
 		{'s', 0, "compress-alg",		&compress_alg, SOURCE_FILE_STRICT},
 		{'u', 0, "compress-level",		&backup->compress_level, SOURCE_FILE_STRICT},
 		{'b', 0, "from-replica",		&backup->from_replica, SOURCE_FILE_STRICT},
+		{'b', 0, "page-dedup",			&backup->page_dedup, SOURCE_FILE_STRICT},
 		{'s', 0, "primary-conninfo",	&backup->primary_conninfo, SOURCE_FILE_STRICT},
 		{'s', 0, "external-dirs",		&backup->external_dir_str, SOURCE_FILE_STRICT},
 		{0}
@@ -879,6 +1488,10 @@ parse_compress_alg(const char *arg)
 		return ZLIB_COMPRESS;
 	else if (pg_strncasecmp("pglz", arg, len) == 0)
 		return PGLZ_COMPRESS;
+	else if (pg_strncasecmp("zstd", arg, len) == 0)
+		return ZSTD_COMPRESS;
+	else if (pg_strncasecmp("lz4", arg, len) == 0)
+		return LZ4_COMPRESS;
 	else if (pg_strncasecmp("none", arg, len) == 0)
 		return NONE_COMPRESS;
 	else
@@ -899,6 +1512,10 @@ deparse_compress_alg(int alg)
 			return "zlib";
 		case PGLZ_COMPRESS:
 			return "pglz";
+		case ZSTD_COMPRESS:
+			return "zstd";
+		case LZ4_COMPRESS:
+			return "lz4";
 	}
 
 	return NULL;
@@ -934,8 +1551,10 @@ pgBackupInit(pgBackup *backup)
 
 	backup->stream = false;
 	backup->from_replica = false;
+	backup->page_dedup = false;
 	backup->parent_backup = INVALID_BACKUP_ID;
 	backup->parent_backup_link = NULL;
+	backup->wal_valid = false;
 	backup->primary_conninfo = NULL;
 	backup->program_version[0] = '\0';
 	backup->server_version[0] = '\0';
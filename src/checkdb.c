@@ -195,6 +195,9 @@ check_files(void *arg)
 			elog(WARNING, "unexpected file type %d", buf.st_mode);
 	}
 
+	/* Close connection with remote agent */
+	fio_disconnect();
+
 	/* Ret values:
 	 * 0 everything is ok
 	 * 1 thread errored during execution, e.g. interruption (default value)
@@ -22,8 +22,24 @@
 #include <zlib.h>
 #endif
 
+#ifdef HAVE_LIBZSTD
+#include <zstd.h>
+#endif
+
+#ifdef HAVE_LIBLZ4
+#include <lz4.h>
+#include <lz4hc.h>
+#endif
+
 #include "utils/thread.h"
 
+/* Protects PageIndexMap shared by backup or merge threads */
+static pthread_mutex_t page_index_mutex = PTHREAD_MUTEX_INITIALIZER;
+
+/* Size of outputs of ranges waiting to be appended, see pgFileRange */
+static size_t range_buffers_size = 0;
+static pthread_mutex_t range_buffers_mutex = PTHREAD_MUTEX_INITIALIZER;
+
 /* Union to ease operations on relation pages */
 typedef union DataPage
 {
@@ -55,6 +71,82 @@ zlib_decompress(void *dst, size_t dst_size, void const *src, size_t src_size)
 }
 #endif
 
+#ifdef HAVE_LIBZSTD
+/* Implementation of zstd compression method */
+static int32
+zstd_compress(void *dst, size_t dst_size, void const *src, size_t src_size,
+			  int level, const char **errormsg)
+{
+	size_t		rc = ZSTD_compress(dst, dst_size, src, src_size, level);
+
+	if (ZSTD_isError(rc))
+	{
+		if (errormsg)
+			*errormsg = ZSTD_getErrorName(rc);
+		return -1;
+	}
+	return rc;
+}
+
+/* Implementation of zstd decompression method */
+static int32
+zstd_decompress(void *dst, size_t dst_size, void const *src, size_t src_size,
+				const char **errormsg)
+{
+	size_t		rc = ZSTD_decompress(dst, dst_size, src, src_size);
+
+	if (ZSTD_isError(rc))
+	{
+		if (errormsg)
+			*errormsg = ZSTD_getErrorName(rc);
+		return -1;
+	}
+	return rc;
+}
+#endif
+
+#ifdef HAVE_LIBLZ4
+/*
+ * Implementation of lz4 compression method. Level 0 and 1 mean the fast
+ * lz4 compressor, higher levels use lz4hc.
+ */
+static int32
+lz4_compress(void *dst, size_t dst_size, void const *src, size_t src_size,
+			 int level, const char **errormsg)
+{
+	int			rc;
+
+	if (level <= 1)
+		rc = LZ4_compress_default(src, dst, src_size, dst_size);
+	else
+		rc = LZ4_compress_HC(src, dst, src_size, dst_size, level);
+
+	if (rc <= 0)
+	{
+		if (errormsg)
+			*errormsg = "lz4 compression failed";
+		return -1;
+	}
+	return rc;
+}
+
+/* Implementation of lz4 decompression method */
+static int32
+lz4_decompress(void *dst, size_t dst_size, void const *src, size_t src_size,
+			   const char **errormsg)
+{
+	int			rc = LZ4_decompress_safe(src, dst, src_size, dst_size);
+
+	if (rc < 0)
+	{
+		if (errormsg)
+			*errormsg = "lz4 data is corrupted";
+		return -1;
+	}
+	return rc;
+}
+#endif
+
 /*
  * Compresses source into dest using algorithm. Returns the number of bytes
  * written in the destination buffer, or -1 if compression fails.
@@ -77,9 +169,19 @@ do_compress(void* dst, size_t dst_size, void const* src, size_t src_size,
 					*errormsg = zError(ret);
 				return ret;
 			}
+#endif
+#ifdef HAVE_LIBZSTD
+		case ZSTD_COMPRESS:
+			return zstd_compress(dst, dst_size, src, src_size, level, errormsg);
+#endif
+#ifdef HAVE_LIBLZ4
+		case LZ4_COMPRESS:
+			return lz4_compress(dst, dst_size, src, src_size, level, errormsg);
 #endif
 		case PGLZ_COMPRESS:
 			return pglz_compress(src, src_size, dst, PGLZ_strategy_always);
+		default:
+			break;
 	}
 
 	return -1;
@@ -89,7 +191,7 @@ do_compress(void* dst, size_t dst_size, void const* src, size_t src_size,
  * Decompresses source into dest using algorithm. Returns the number of bytes
  * decompressed in the destination buffer, or -1 if decompression fails.
  */
-static int32
+int32
 do_decompress(void* dst, size_t dst_size, void const* src, size_t src_size,
 			  CompressAlg alg, const char **errormsg)
 {
@@ -109,9 +211,22 @@ do_decompress(void* dst, size_t dst_size, void const* src, size_t src_size,
 					*errormsg = zError(ret);
 				return ret;
 			}
+#endif
+#ifdef HAVE_LIBZSTD
+		case ZSTD_COMPRESS:
+			return zstd_decompress(dst, dst_size, src, src_size, errormsg);
+#endif
+#ifdef HAVE_LIBLZ4
+		case LZ4_COMPRESS:
+			return lz4_decompress(dst, dst_size, src, src_size, errormsg);
 #endif
 		case PGLZ_COMPRESS:
 			return pglz_decompress(src, src_size, dst, dst_size);
+		default:
+			/* backup was taken by the build with more compression methods */
+			if (errormsg)
+				*errormsg = "Compression algorithm is not supported by this build";
+			break;
 	}
 
 	return -1;
@@ -490,11 +605,30 @@ compress_and_backup_page(pgFile *file, BlockNumber blknum,
 			memcpy(write_buffer + sizeof(header), page, BLCKSZ);
 			write_buffer_size += header.compressed_size;
 		}
+
+		/* Refer to the page store instead of writing the page */
+		if (page_dedup)
+		{
+			PageStoreKey key;
+
+			page_store_key(page, &key);
+			if (page_store_put(&key, write_buffer + sizeof(header),
+							   header.compressed_size,
+							   header.compressed_size == BLCKSZ ? NONE_COMPRESS : calg))
+			{
+				header.compressed_size = PageIsDeduplicated;
+				memcpy(write_buffer, &header, sizeof(header));
+				memcpy(write_buffer + sizeof(header), &key, sizeof(key));
+				write_buffer_size = sizeof(header) + sizeof(key);
+			}
+		}
 	}
 
 	/* elog(VERBOSE, "backup blkno %u, compressed_size %d write_buffer_size %ld",
 				  blknum, header.compressed_size, write_buffer_size); */
 
+	page_index_add(file, blknum, header.compressed_size, file->write_size);
+
 	/* Update CRC */
 	COMP_FILE_CRC32(true, *crc, write_buffer, write_buffer_size);
 
@@ -512,6 +646,127 @@ compress_and_backup_page(pgFile *file, BlockNumber blknum,
 	file->write_size += write_buffer_size;
 }
 
+/*
+ * Copy blocks [start_block, end_block) of the data file "in" into the backup
+ * file "out". Pass InvalidBlockNumber as end_block to copy the file up to its
+ * end. Only blocks marked in pagemap are copied in case of PAGE and
+ * PTRACK backups. Returns the number of processed blocks, the number of
+ * skipped blocks is returned in n_blocks_skipped. "truncated" is set if
+ * the relation turned out to be shorter than end_block.
+ */
+static BlockNumber
+backup_data_blocks(backup_files_arg *arguments, pgFile *file,
+				   FILE *in, FILE *out,
+				   BlockNumber start_block, BlockNumber end_block,
+				   XLogRecPtr prev_backup_start_lsn, BackupMode backup_mode,
+				   CompressAlg calg, int clevel,
+				   BlockNumber *n_blocks_skipped, bool *truncated)
+{
+	BlockNumber	blknum = 0;
+	BlockNumber	nblocks = 0;
+	BlockNumber	n_blocks_read = 0;
+	int			page_state;
+	char		curr_page[BLCKSZ];
+
+	/*
+	 * Compute expected number of blocks in the file.
+	 * NOTE This is a normal situation, if the file size has changed
+	 * since the moment we computed it.
+	 */
+	nblocks = file->size/BLCKSZ;
+
+	/*
+	 * Read each page, verify checksum and write it to backup.
+	 * If page map is empty or file is not present in previous backup
+	 * backup all pages of the relation.
+	 *
+	 * We will enter here if backup_mode is FULL or DELTA.
+	 */
+	if (file->pagemap.bitmapsize == PageBitmapIsEmpty ||
+		file->pagemap_isabsent || !file->exists_in_prev)
+	{
+		if (backup_mode != BACKUP_MODE_DIFF_PTRACK && fio_is_remote_file(in))
+		{
+			int rc = fio_send_pages(in, out, file, start_block, Min(end_block, nblocks),
+									backup_mode == BACKUP_MODE_DIFF_DELTA && file->exists_in_prev ? prev_backup_start_lsn : InvalidXLogRecPtr,
+									NULL, n_blocks_skipped, truncated, calg, clevel);
+			if (rc == PAGE_CHECKSUM_MISMATCH && is_ptrack_support)
+				goto RetryUsingPtrack;
+			if (rc < 0)
+				elog(ERROR, "Failed to read file %s: %s",
+					 file->path, rc == PAGE_CHECKSUM_MISMATCH ? "data file checksum mismatch" : strerror(-rc));
+			n_blocks_read = rc;
+		}
+		else
+		{
+		  RetryUsingPtrack:
+			for (blknum = start_block; blknum < Min(end_block, nblocks); blknum++)
+			{
+				page_state = prepare_page(&(arguments->conn_arg), file, prev_backup_start_lsn,
+										  blknum, nblocks, in, n_blocks_skipped,
+										  backup_mode, curr_page, true, current.checksum_version);
+				compress_and_backup_page(file, blknum, in, out, &(file->crc),
+										  page_state, curr_page, calg, clevel);
+				n_blocks_read++;
+				if (page_state == PageIsTruncated)
+				{
+					*truncated = true;
+					break;
+				}
+			}
+		}
+	}
+	/*
+	 * If page map is not empty we scan only changed blocks.
+	 *
+	 * We will enter here if backup_mode is PAGE or PTRACK. PTRACK backup
+	 * reads pages from shared buffers, so only PAGE backup of remote file
+	 * passes the pagemap to the agent, which sends back only changed blocks.
+	 */
+	else if (backup_mode == BACKUP_MODE_DIFF_PAGE && fio_is_remote_file(in))
+	{
+		int rc = fio_send_pages(in, out, file, start_block, end_block,
+								InvalidXLogRecPtr, &file->pagemap,
+								n_blocks_skipped, truncated, calg, clevel);
+		if (rc == PAGE_CHECKSUM_MISMATCH && is_ptrack_support)
+			goto RetryChangedUsingPtrack;
+		if (rc < 0)
+			elog(ERROR, "Failed to read file %s: %s",
+				 file->path, rc == PAGE_CHECKSUM_MISMATCH ? "data file checksum mismatch" : strerror(-rc));
+		n_blocks_read = rc;
+	}
+	else
+	{
+		datapagemap_iterator_t *iter;
+
+	  RetryChangedUsingPtrack:
+		iter = datapagemap_iterate(&file->pagemap);
+		while (datapagemap_next(iter, &blknum))
+		{
+			if (blknum < start_block)
+				continue;
+			if (blknum >= end_block)
+				break;
+
+			page_state = prepare_page(&(arguments->conn_arg), file, prev_backup_start_lsn,
+									  blknum, nblocks, in, n_blocks_skipped,
+									  backup_mode, curr_page, true, current.checksum_version);
+			compress_and_backup_page(file, blknum, in, out, &(file->crc),
+									  page_state, curr_page, calg, clevel);
+			n_blocks_read++;
+			if (page_state == PageIsTruncated)
+			{
+				*truncated = true;
+				break;
+			}
+		}
+
+		pg_free(iter);
+	}
+
+	return n_blocks_read;
+}
+
 /*
  * Backup data file in the from_root directory to the to_root directory with
  * same relative path. If prev_backup_start_lsn is not NULL, only pages with
@@ -528,12 +783,9 @@ backup_data_file(backup_files_arg* arguments,
 {
 	FILE		*in;
 	FILE		*out;
-	BlockNumber	blknum = 0;
-	BlockNumber	nblocks = 0;
 	BlockNumber	n_blocks_skipped = 0;
 	BlockNumber	n_blocks_read = 0;
-	int			page_state;
-	char		curr_page[BLCKSZ];
+	bool		truncated = false;
 
 	/*
 	 * Skip unchanged file only if it exists in previous backup.
@@ -556,6 +808,7 @@ backup_data_file(backup_files_arg* arguments,
 	/* reset size summary */
 	file->read_size = 0;
 	file->write_size = 0;
+	file->n_page_index = 0;
 	INIT_FILE_CRC32(true, file->crc);
 
 	/* open backup mode file for read */
@@ -590,13 +843,6 @@ backup_data_file(backup_files_arg* arguments,
 		elog(WARNING, "File: %s, invalid file size %zu", file->path, file->size);
 	}
 
-	/*
-	 * Compute expected number of blocks in the file.
-	 * NOTE This is a normal situation, if the file size has changed
-	 * since the moment we computed it.
-	 */
-	nblocks = file->size/BLCKSZ;
-
 	/* open backup file for write  */
 	out = fio_fopen(to_path, PG_BINARY_W, FIO_BACKUP_HOST);
 	if (out == NULL)
@@ -607,70 +853,18 @@ backup_data_file(backup_files_arg* arguments,
 			 to_path, strerror(errno_tmp));
 	}
 
-	/*
-	 * Read each page, verify checksum and write it to backup.
-	 * If page map is empty or file is not present in previous backup
-	 * backup all pages of the relation.
-	 *
-	 * We will enter here if backup_mode is FULL or DELTA.
-	 */
-	if (file->pagemap.bitmapsize == PageBitmapIsEmpty ||
-		file->pagemap_isabsent || !file->exists_in_prev)
-	{
-		if (backup_mode != BACKUP_MODE_DIFF_PTRACK && fio_is_remote_file(in))
-		{
-			int rc = fio_send_pages(in, out, file,
-									backup_mode == BACKUP_MODE_DIFF_DELTA && file->exists_in_prev ? prev_backup_start_lsn : InvalidXLogRecPtr,
-									&n_blocks_skipped, calg, clevel);
-			if (rc == PAGE_CHECKSUM_MISMATCH && is_ptrack_support)
-				goto RetryUsingPtrack;
-			if (rc < 0)
-				elog(ERROR, "Failed to read file %s: %s",
-					 file->path, rc == PAGE_CHECKSUM_MISMATCH ? "data file checksum mismatch" : strerror(-rc));
-			n_blocks_read = rc;
-		}
-		else
-		{
-		  RetryUsingPtrack:
-			for (blknum = 0; blknum < nblocks; blknum++)
-			{
-				page_state = prepare_page(&(arguments->conn_arg), file, prev_backup_start_lsn,
-										  blknum, nblocks, in, &n_blocks_skipped,
-										  backup_mode, curr_page, true, current.checksum_version);
-				compress_and_backup_page(file, blknum, in, out, &(file->crc),
-										  page_state, curr_page, calg, clevel);
-				n_blocks_read++;
-				if (page_state == PageIsTruncated)
-					break;
-			}
-		}
-		if (backup_mode == BACKUP_MODE_DIFF_DELTA)
-			file->n_blocks = n_blocks_read;
-	}
-	/*
-	 * If page map is not empty we scan only changed blocks.
-	 *
-	 * We will enter here if backup_mode is PAGE or PTRACK.
-	 */
-	else
-	{
-		datapagemap_iterator_t *iter;
-		iter = datapagemap_iterate(&file->pagemap);
-		while (datapagemap_next(iter, &blknum))
-		{
-			page_state = prepare_page(&(arguments->conn_arg), file, prev_backup_start_lsn,
-									  blknum, nblocks, in, &n_blocks_skipped,
-									  backup_mode, curr_page, true, current.checksum_version);
-			compress_and_backup_page(file, blknum, in, out, &(file->crc),
-									  page_state, curr_page, calg, clevel);
-			n_blocks_read++;
-			if (page_state == PageIsTruncated)
-				break;
-		}
+	n_blocks_read = backup_data_blocks(arguments, file, in, out,
+									   0, InvalidBlockNumber,
+									   prev_backup_start_lsn, backup_mode,
+									   calg, clevel,
+									   &n_blocks_skipped, &truncated);
+
+	if (backup_mode == BACKUP_MODE_DIFF_DELTA)
+		file->n_blocks = n_blocks_read;
 
+	if (file->pagemap.bitmapsize != PageBitmapIsEmpty &&
+		!file->pagemap_isabsent && file->exists_in_prev)
 		pg_free(file->pagemap.bitmap);
-		pg_free(iter);
-	}
 
 	/* update file permission */
 	if (fio_chmod(to_path, FILE_PERMISSION, FIO_BACKUP_HOST) == -1)
@@ -699,6 +893,7 @@ backup_data_file(backup_files_arg* arguments,
 		if (fio_unlink(to_path, FIO_BACKUP_HOST) == -1)
 			elog(ERROR, "cannot remove file \"%s\": %s", to_path,
 				 strerror(errno));
+		file->n_page_index = 0;
 		return false;
 	}
 
@@ -706,58 +901,408 @@ backup_data_file(backup_files_arg* arguments,
 }
 
 /*
- * Restore files in the from_root directory to the to_root directory with
- * same relative path.
- *
- * If write_header is true then we add header to each restored block, currently
- * it is used for MERGE command.
+ * Backup one range of a big data file. The output of the range is kept in
+ * memory, counters of the range are filled here and the output is appended
+ * to the backup file by append_data_file_range().
  */
 void
-restore_data_file(const char *to_path, pgFile *file, bool allow_truncate,
-				  bool write_header, uint32 backup_version)
+backup_data_file_range(backup_files_arg* arguments,
+					   const char *to_path, pgFileRange *range,
+					   XLogRecPtr prev_backup_start_lsn, BackupMode backup_mode,
+					   CompressAlg calg, int clevel)
 {
-	FILE	   *in = NULL;
-	FILE	   *out = NULL;
-	BackupPageHeader header;
-	BlockNumber	blknum = 0,
-				truncate_from = 0;
-	bool		need_truncate = false;
+	FILE	   *in;
+	FILE	   *out;
+	char		part_path[MAXPGPATH];
+	pgFile		part;
 
-	/* BYTES_INVALID allowed only in case of restoring file from DELTA backup */
-	if (file->write_size != BYTES_INVALID)
+	/*
+	 * Ranges of the same file are copied concurrently, so use a private
+	 * copy of the pgFile to collect sizes and CRC of the part.
+	 */
+	part = *range->file;
+	part.read_size = 0;
+	part.write_size = 0;
+	part.page_index = NULL;
+	part.n_page_index = 0;
+	part.max_page_index = 0;
+	INIT_FILE_CRC32(true, part.crc);
+
+	in = fio_fopen(part.path, PG_BINARY_R, FIO_DB_HOST);
+	if (in == NULL)
 	{
-		/* open backup mode file for read */
-		in = fopen(file->path, PG_BINARY_R);
-		if (in == NULL)
+		if (errno == ENOENT)
 		{
-			elog(ERROR, "Cannot open backup file \"%s\": %s", file->path,
-				 strerror(errno));
+			elog(LOG, "File \"%s\" is not found", part.path);
+			range->missing = true;
+			return;
 		}
+
+		elog(ERROR, "cannot open file \"%s\": %s",
+			 part.path, strerror(errno));
 	}
 
-	/*
-	 * Open backup file for write. 	We use "r+" at first to overwrite only
-	 * modified pages for differential restore. If the file does not exist,
-	 * re-open it with "w" to create an empty file.
-	 */
-	out = fio_fopen(to_path, PG_BINARY_R "+", FIO_DB_HOST);
+	snprintf(part_path, MAXPGPATH, "%s.%d", to_path, range->range_num);
+#ifndef WIN32
+	out = open_memstream(&range->buf, &range->buf_size);
+#else
+	/* There is no open_memstream(), write the part file */
+	out = fio_fopen(part_path, PG_BINARY_W, FIO_BACKUP_HOST);
+	range->spilled = true;
+#endif
 	if (out == NULL)
 	{
 		int errno_tmp = errno;
-		fclose(in);
-		elog(ERROR, "Cannot open restore target file \"%s\": %s",
-			 to_path, strerror(errno_tmp));
+		fio_fclose(in);
+		elog(ERROR, "cannot open backup file \"%s\": %s",
+			 part_path, strerror(errno_tmp));
 	}
 
-	while (true)
-	{
-		off_t		write_pos;
-		size_t		read_len;
-		DataPage	compressed_page; /* used as read buffer */
-		DataPage	page;
-		int32		uncompressed_size = 0;
+	range->n_blocks_read = backup_data_blocks(arguments, &part, in, out,
+											  range->start_block,
+											  range->end_block,
+											  prev_backup_start_lsn,
+											  backup_mode, calg, clevel,
+											  &range->n_blocks_skipped,
+											  &range->truncated);
 
-		/* File didn`t changed. Nothig to copy */
+	if (range->spilled)
+	{
+		if (fio_fflush(out) != 0 ||
+			fio_fclose(out))
+			elog(ERROR, "cannot write backup file \"%s\": %s",
+				 part_path, strerror(errno));
+	}
+	else if (ferror(out) || fclose(out) != 0)
+		elog(ERROR, "cannot write backup file \"%s\": %s",
+			 part_path, strerror(errno));
+	fio_fclose(in);
+
+	range->read_size = part.read_size;
+	range->write_size = part.write_size;
+	range->page_index = part.page_index;
+	range->n_page_index = part.n_page_index;
+	range->file->compress_alg = calg;
+}
+
+/*
+ * Move the output of the range from memory into the part file
+ * "<to_path>.<range_num>".
+ */
+static void
+spill_data_file_range(const char *to_path, pgFileRange *range)
+{
+	char		part_path[MAXPGPATH];
+	FILE	   *out;
+
+	snprintf(part_path, MAXPGPATH, "%s.%d", to_path, range->range_num);
+	out = fio_fopen(part_path, PG_BINARY_W, FIO_BACKUP_HOST);
+	if (out == NULL)
+		elog(ERROR, "cannot open backup file \"%s\": %s",
+			 part_path, strerror(errno));
+
+	if (fio_fwrite(out, range->buf, range->buf_size) != range->buf_size ||
+		fio_fflush(out) != 0 ||
+		fio_fclose(out))
+		elog(ERROR, "cannot write backup file \"%s\": %s",
+			 part_path, strerror(errno));
+
+	free(range->buf);
+	range->buf = NULL;
+	range->spilled = true;
+}
+
+/*
+ * Append the output of the range to the backup file, computing CRC and size
+ * summary of the file. Ranges after the first truncated or missing range are
+ * thrown away.
+ */
+static void
+append_range_output(const char *to_path, pgFileRange *range)
+{
+	pgFileRange *first = range->first;
+	pgFile	   *file = range->file;
+	char		part_path[MAXPGPATH];
+	int			j;
+
+	snprintf(part_path, MAXPGPATH, "%s.%d", to_path, range->range_num);
+
+	if (range->missing)
+		first->stop = true;
+
+	if (!first->stop)
+	{
+		if (first->out == NULL)
+		{
+			file->read_size = 0;
+			file->write_size = 0;
+			file->n_page_index = 0;
+			INIT_FILE_CRC32(true, file->crc);
+
+			first->out = fio_fopen(to_path, PG_BINARY_W, FIO_BACKUP_HOST);
+			if (first->out == NULL)
+				elog(ERROR, "cannot open backup file \"%s\": %s",
+					 to_path, strerror(errno));
+		}
+
+		if (range->spilled)
+		{
+			FILE	   *in;
+			char		buf[BLCKSZ * 8];
+			ssize_t		read_len;
+
+			in = fio_fopen(part_path, PG_BINARY_R, FIO_BACKUP_HOST);
+			if (in == NULL)
+				elog(ERROR, "cannot open backup file \"%s\": %s",
+					 part_path, strerror(errno));
+
+			while ((read_len = fio_fread(in, buf, sizeof(buf))) > 0)
+			{
+				COMP_FILE_CRC32(true, file->crc, buf, read_len);
+				if (fio_fwrite(first->out, buf, read_len) != (size_t) read_len)
+					elog(ERROR, "cannot write backup file \"%s\": %s",
+						 to_path, strerror(errno));
+			}
+			if (read_len < 0)
+				elog(ERROR, "cannot read backup file \"%s\": %s",
+					 part_path, strerror(errno));
+			fio_fclose(in);
+		}
+		else if (range->buf_size > 0)
+		{
+			COMP_FILE_CRC32(true, file->crc, range->buf, range->buf_size);
+			if (fio_fwrite(first->out, range->buf,
+						   range->buf_size) != range->buf_size)
+				elog(ERROR, "cannot write backup file \"%s\": %s",
+					 to_path, strerror(errno));
+		}
+
+		/* positions in the range output are shifted by the preceding ranges */
+		for (j = 0; j < range->n_page_index; j++)
+			page_index_add(file, range->page_index[j].block,
+						   range->page_index[j].compressed_size,
+						   range->page_index[j].pos + file->write_size);
+
+		file->read_size += range->read_size;
+		file->write_size += range->write_size;
+		range->appended = true;
+
+		/* relation ends here, the following ranges are empty */
+		if (range->truncated)
+			first->stop = true;
+	}
+
+	if (range->buf)
+	{
+		pthread_lock(&range_buffers_mutex);
+		range_buffers_size -= range->buf_size;
+		pthread_mutex_unlock(&range_buffers_mutex);
+
+		free(range->buf);
+		range->buf = NULL;
+	}
+
+	if (range->page_index)
+	{
+		pg_free(range->page_index);
+		range->page_index = NULL;
+	}
+
+	if (range->spilled &&
+		fio_unlink(part_path, FIO_BACKUP_HOST) == -1)
+		elog(ERROR, "cannot remove file \"%s\": %s", part_path,
+			 strerror(errno));
+}
+
+/*
+ * Append the copied range and the following finished ranges to the backup
+ * file in block order. If preceding ranges are not finished yet, the output
+ * stays in memory and is appended by the thread which finishes them, so
+ * the data is written once. When waiting outputs take more than a range per
+ * thread the output is moved into the part file.
+ */
+void
+append_data_file_range(const char *to_path, pgFileRange *range)
+{
+	pgFileRange *first = range->first;
+
+	if (range->buf != NULL)
+	{
+		bool		spill;
+
+		/* the next range to append is not kept waiting */
+		pthread_lock(&range_buffers_mutex);
+		spill = range->range_num != first->next_append &&
+			range_buffers_size + range->buf_size >
+			(size_t) num_threads * BACKUP_RANGE_BLOCKS * BLCKSZ;
+		if (!spill)
+			range_buffers_size += range->buf_size;
+		pthread_mutex_unlock(&range_buffers_mutex);
+
+		if (spill)
+			spill_data_file_range(to_path, range);
+	}
+
+	range->done = true;
+	pg_memory_barrier();
+
+	/* Only one thread appends ranges of the file at a time */
+	while (pg_atomic_test_set_flag(&first->append_lock))
+	{
+		while (first->next_append < first->n_ranges &&
+			   first[first->next_append].done)
+		{
+			append_range_output(to_path, &first[first->next_append]);
+			first->next_append++;
+		}
+
+		pg_atomic_clear_flag(&first->append_lock);
+		pg_memory_barrier();
+
+		/* The next range could be finished while the lock was held */
+		if (first->next_append >= first->n_ranges ||
+			!first[first->next_append].done)
+			break;
+	}
+}
+
+/*
+ * Complete the backup file of the data file copied by ranges, when all ranges
+ * are appended. Returns false if the file should not be included into
+ * the backup, as backup_data_file() does.
+ */
+bool
+join_data_file_ranges(const char *to_path, pgFileRange *first,
+					  BackupMode backup_mode)
+{
+	pgFile	   *file = first->file;
+	BlockNumber	n_blocks_read = 0;
+	BlockNumber	n_blocks_skipped = 0;
+	bool		missing = false;
+	int			i;
+
+	for (i = 0; i < first->n_ranges; i++)
+	{
+		missing = missing || first[i].missing;
+		if (first[i].appended)
+		{
+			n_blocks_read += first[i].n_blocks_read;
+			n_blocks_skipped += first[i].n_blocks_skipped;
+		}
+	}
+
+	if (first->out == NULL)
+	{
+		file->read_size = 0;
+		file->write_size = 0;
+		file->n_page_index = 0;
+		INIT_FILE_CRC32(true, file->crc);
+	}
+	FIN_FILE_CRC32(true, file->crc);
+
+	if (file->pagemap.bitmapsize != PageBitmapIsEmpty &&
+		!file->pagemap_isabsent && file->exists_in_prev)
+		pg_free(file->pagemap.bitmap);
+
+	if (missing)
+	{
+		if (first->out != NULL)
+		{
+			fio_fclose(first->out);
+			if (fio_unlink(to_path, FIO_BACKUP_HOST) == -1)
+				elog(ERROR, "cannot remove file \"%s\": %s", to_path,
+					 strerror(errno));
+		}
+		elog(LOG, "File \"%s\" is not found", file->path);
+		file->write_size = FILE_NOT_FOUND;
+		file->n_page_index = 0;
+		return false;
+	}
+
+	if (backup_mode == BACKUP_MODE_DIFF_DELTA)
+		file->n_blocks = n_blocks_read;
+
+	/* update file permission */
+	if (fio_chmod(to_path, FILE_PERMISSION, FIO_BACKUP_HOST) == -1)
+	{
+		int errno_tmp = errno;
+		fio_fclose(first->out);
+		elog(ERROR, "cannot change mode of \"%s\": %s", to_path,
+			 strerror(errno_tmp));
+	}
+
+	if (fio_fflush(first->out) != 0 ||
+		fio_fclose(first->out))
+		elog(ERROR, "cannot write backup file \"%s\": %s",
+			 to_path, strerror(errno));
+	first->out = NULL;
+
+	/* See comment in backup_data_file() */
+	if (n_blocks_read != 0 && n_blocks_read == n_blocks_skipped)
+	{
+		if (fio_unlink(to_path, FIO_BACKUP_HOST) == -1)
+			elog(ERROR, "cannot remove file \"%s\": %s", to_path,
+				 strerror(errno));
+		file->n_page_index = 0;
+		return false;
+	}
+
+	return true;
+}
+
+/*
+ * Restore files in the from_root directory to the to_root directory with
+ * same relative path.
+ *
+ * If write_header is true then we add header to each restored block, currently
+ * it is used for MERGE command.
+ */
+void
+restore_data_file(const char *to_path, pgFile *file, bool allow_truncate,
+				  bool write_header, uint32 backup_version)
+{
+	FILE	   *in = NULL;
+	FILE	   *out = NULL;
+	BackupPageHeader header;
+	BlockNumber	blknum = 0,
+				truncate_from = 0;
+	bool		need_truncate = false;
+
+	/* BYTES_INVALID allowed only in case of restoring file from DELTA backup */
+	if (file->write_size != BYTES_INVALID)
+	{
+		/* open backup mode file for read */
+		in = fopen(file->path, PG_BINARY_R);
+		if (in == NULL)
+		{
+			elog(ERROR, "Cannot open backup file \"%s\": %s", file->path,
+				 strerror(errno));
+		}
+	}
+
+	/*
+	 * Open backup file for write. 	We use "r+" at first to overwrite only
+	 * modified pages for differential restore. If the file does not exist,
+	 * re-open it with "w" to create an empty file.
+	 */
+	out = fio_fopen(to_path, PG_BINARY_R "+", FIO_DB_HOST);
+	if (out == NULL)
+	{
+		int errno_tmp = errno;
+		fclose(in);
+		elog(ERROR, "Cannot open restore target file \"%s\": %s",
+			 to_path, strerror(errno_tmp));
+	}
+
+	while (true)
+	{
+		off_t		write_pos;
+		size_t		read_len;
+		DataPage	compressed_page; /* used as read buffer */
+		DataPage	page;
+		int32		uncompressed_size = 0;
+
+		/* File didn`t changed. Nothig to copy */
 		if (file->write_size == BYTES_INVALID)
 			break;
 
@@ -815,6 +1360,23 @@ restore_data_file(const char *to_path, pgFile *file, bool allow_truncate,
 			break;
 		}
 
+		if (header.compressed_size == PageIsDeduplicated)
+		{
+			PageStoreKey key;
+
+			/* The page itself is kept in the page store */
+			if (fread(&key, 1, sizeof(key), in) != sizeof(key))
+				elog(ERROR, "Cannot read page store key of block %u of \"%s\"",
+					 blknum, file->path);
+
+			if (!page_store_get(&key, page.data))
+				elog(ERROR, "Block %u of \"%s\" is missing in the page store",
+					 blknum, file->path);
+
+			uncompressed_size = BLCKSZ;
+			goto write_page;
+		}
+
 		Assert(header.compressed_size <= BLCKSZ);
 
 		/* read a page from file */
@@ -849,6 +1411,7 @@ restore_data_file(const char *to_path, pgFile *file, bool allow_truncate,
 					 file->path, uncompressed_size);
 		}
 
+write_page:
 		write_pos = (write_header) ? blknum * (BLCKSZ + sizeof(header)) :
 									 blknum * BLCKSZ;
 
@@ -940,6 +1503,410 @@ restore_data_file(const char *to_path, pgFile *file, bool allow_truncate,
 		fclose(in);
 }
 
+/* Block of the restored file and the backup it is taken from */
+typedef struct RestoreBlock
+{
+	BlockNumber	block;
+	int			source;			/* index in sources, 0 is the newest backup */
+	int64		pos;			/* offset of the page record in the backup file */
+} RestoreBlock;
+
+static int
+restore_block_compare(const void *a, const void *b)
+{
+	const RestoreBlock *rb1 = (const RestoreBlock *) a;
+	const RestoreBlock *rb2 = (const RestoreBlock *) b;
+
+	if (rb1->block != rb2->block)
+		return rb1->block < rb2->block ? -1 : 1;
+	return rb1->source - rb2->source;
+}
+
+/*
+ * Read the page of the record, which header was read from "in" already,
+ * into "page" uncompressing it if necessary.
+ */
+static void
+read_page_record(FILE *in, pgFile *file, BackupPageHeader *header,
+				 char *page, uint32 backup_version)
+{
+	DataPage	compressed_page;
+	size_t		read_len;
+
+	if (header->compressed_size == PageIsDeduplicated)
+	{
+		PageStoreKey key;
+
+		if (fread(&key, 1, sizeof(key), in) != sizeof(key))
+			elog(ERROR, "Cannot read page store key of block %u of \"%s\"",
+				 header->block, file->path);
+
+		if (!page_store_get(&key, page))
+			elog(ERROR, "Block %u of \"%s\" is missing in the page store",
+				 header->block, file->path);
+		return;
+	}
+
+	if (header->compressed_size <= 0 || header->compressed_size > BLCKSZ)
+		elog(ERROR, "Invalid size %d of block %u of \"%s\"",
+			 header->compressed_size, header->block, file->path);
+
+	read_len = fread(compressed_page.data, 1,
+					 MAXALIGN(header->compressed_size), in);
+	if (read_len != MAXALIGN(header->compressed_size))
+		elog(ERROR, "Cannot read block %u of \"%s\" read %zu of %d",
+			 header->block, file->path, read_len, header->compressed_size);
+
+	/* See comment in restore_data_file() */
+	if (header->compressed_size != BLCKSZ
+		|| page_may_be_compressed(compressed_page.data, file->compress_alg,
+								  backup_version))
+	{
+		const char *errormsg = NULL;
+		int32		uncompressed_size;
+
+		uncompressed_size = do_decompress(page, BLCKSZ,
+										  compressed_page.data,
+										  header->compressed_size,
+										  file->compress_alg, &errormsg);
+		if (uncompressed_size < 0 && errormsg != NULL)
+			elog(WARNING, "An error occured during decompressing block %u of file \"%s\": %s",
+				 header->block, file->path, errormsg);
+
+		if (uncompressed_size != BLCKSZ)
+			elog(ERROR, "Page of file \"%s\" uncompressed to %d bytes. != BLCKSZ",
+				 file->path, uncompressed_size);
+	}
+	else
+		memcpy(page, compressed_page.data, BLCKSZ);
+}
+
+/*
+ * Decide which backup every block of the data file is taken from.
+ * "sources" are copies of the file in the backups of the chain, from the
+ * newest backup to the FULL one. Every block is taken from the newest backup
+ * which contains it, unless a newer backup truncated the relation below
+ * the block. Returns blocks sorted by block number, "n_blocks" is set to
+ * their number.
+ */
+static RestoreBlock *
+plan_chain_blocks(RestoreFileSource *sources, int n_sources, int *n_blocks)
+{
+	RestoreBlock *blocks = NULL;
+	int			max_blocks = 0;
+	BlockNumber	limit = InvalidBlockNumber;
+	int			i,
+				j;
+
+	*n_blocks = 0;
+
+	for (i = 0; i < n_sources; i++)
+	{
+		pgFile	   *file = sources[i].file;
+		BackupPageIndex *index = NULL;
+		int			n_index = 0;
+		BlockNumber	cutoff = limit;
+		BlockNumber	truncated = InvalidBlockNumber;
+
+		/* Relation size is known for DELTA backups */
+		if (file->n_blocks != BLOCKNUM_INVALID)
+			cutoff = Min(cutoff, (BlockNumber) file->n_blocks);
+
+		if (file->write_size != BYTES_INVALID)
+		{
+			if (file->idx_num > 0)
+				index = read_page_index(file, sources[i].index_path);
+			if (index != NULL)
+				n_index = file->idx_num;
+			else
+			{
+				/* No index or it is broken, scan page headers */
+				build_page_index(file, file->path);
+				index = file->page_index;
+				n_index = file->n_page_index;
+				file->page_index = NULL;
+				file->n_page_index = 0;
+				file->max_page_index = 0;
+			}
+		}
+
+		for (j = 0; j < n_index; j++)
+		{
+			RestoreBlock *rb;
+
+			if (index[j].compressed_size == PageIsTruncated)
+			{
+				truncated = index[j].block;
+				break;
+			}
+			if (index[j].block >= cutoff)
+				continue;
+
+			if (*n_blocks == max_blocks)
+			{
+				max_blocks = Max(max_blocks * 2, 64);
+				blocks = pgut_realloc(blocks, max_blocks * sizeof(RestoreBlock));
+			}
+			rb = &blocks[(*n_blocks)++];
+			rb->block = index[j].block;
+			rb->source = i;
+			rb->pos = index[j].pos;
+		}
+		pg_free(index);
+
+		/* Blocks truncated by this backup are not taken from older ones */
+		limit = Min(cutoff, truncated);
+	}
+
+	qsort(blocks, *n_blocks, sizeof(RestoreBlock), restore_block_compare);
+
+	/* Keep only the newest copy of every block */
+	for (i = 0, j = 0; i < *n_blocks; i++)
+	{
+		if (j > 0 && blocks[i].block == blocks[j - 1].block)
+			continue;
+		blocks[j++] = blocks[i];
+	}
+	*n_blocks = j;
+
+	return blocks;
+}
+
+/*
+ * Restore the data file from the chain of backups in a single pass.
+ * "sources" are copies of the file in the backups of the chain, from the
+ * newest backup to the FULL one, see plan_chain_blocks(). Every block is
+ * written into the target file only once.
+ *
+ * If "incremental" is true, the target file may exist already. Its blocks
+ * which are equal to the blocks of the backup are not rewritten, and the file
+ * is truncated to the size of the restored relation.
+ */
+void
+restore_data_file_chain(const char *to_path, RestoreFileSource *sources,
+						int n_sources, bool incremental)
+{
+	RestoreBlock *blocks;
+	int			n_blocks;
+	BlockNumber	next_block = 0;
+	BlockNumber	n_restored = 0;
+	BlockNumber	n_unchanged = 0;
+	FILE	  **ins;
+	FILE	   *out;
+	int			i,
+				j;
+
+	blocks = plan_chain_blocks(sources, n_sources, &n_blocks);
+
+	out = fio_fopen(to_path, incremental ? PG_BINARY_R "+" : PG_BINARY_W,
+					FIO_DB_HOST);
+	if (out == NULL)
+		elog(ERROR, "Cannot open restore target file \"%s\": %s",
+			 to_path, strerror(errno));
+
+	ins = (FILE **) pgut_malloc(n_sources * sizeof(FILE *));
+	MemSet(ins, 0, n_sources * sizeof(FILE *));
+
+	for (j = 0; j < n_blocks; j++)
+	{
+		RestoreBlock *rb = &blocks[j];
+		pgFile	   *file = sources[rb->source].file;
+		BackupPageHeader header;
+		DataPage	page;
+
+		if (interrupted || thread_interrupted)
+			elog(ERROR, "Interrupted during restore database");
+
+		if (ins[rb->source] == NULL)
+		{
+			ins[rb->source] = fopen(file->path, PG_BINARY_R);
+			if (ins[rb->source] == NULL)
+				elog(ERROR, "Cannot open backup file \"%s\": %s", file->path,
+					 strerror(errno));
+		}
+
+		if (fseek(ins[rb->source], rb->pos, SEEK_SET) != 0 ||
+			fread(&header, 1, sizeof(header), ins[rb->source]) != sizeof(header))
+			elog(ERROR, "Cannot read header of block %u of \"%s\": %s",
+				 rb->block, file->path, strerror(errno));
+
+		if (header.block != rb->block)
+			elog(ERROR, "Backup is broken at block %u of \"%s\"",
+				 rb->block, file->path);
+
+		read_page_record(ins[rb->source], file, &header, page.data,
+						 sources[rb->source].backup_version);
+		n_restored = rb->block + 1;
+
+		/* Keep the block of the existing file if it is the same */
+		if (incremental)
+		{
+			DataPage	old_page;
+
+			if (fio_pread(out, old_page.data, (off_t) rb->block * BLCKSZ) == BLCKSZ &&
+				PageGetLSN(old_page.data) == PageGetLSN(page.data) &&
+				((PageHeader) old_page.data)->pd_checksum ==
+					((PageHeader) page.data)->pd_checksum &&
+				memcmp(old_page.data, page.data, BLCKSZ) == 0)
+			{
+				n_unchanged++;
+				continue;
+			}
+		}
+
+		/* Blocks are written in order, seek only over holes */
+		if (rb->block != next_block &&
+			fio_fseek(out, (off_t) rb->block * BLCKSZ) < 0)
+			elog(ERROR, "Cannot seek block %u of \"%s\": %s",
+				 rb->block, to_path, strerror(errno));
+
+		if (fio_fwrite(out, page.data, BLCKSZ) != BLCKSZ)
+			elog(ERROR, "Cannot write block %u of \"%s\": %s",
+				 rb->block, to_path, strerror(errno));
+		next_block = rb->block + 1;
+	}
+
+	for (i = 0; i < n_sources; i++)
+		if (ins[i])
+			fclose(ins[i]);
+	pg_free(ins);
+	pg_free(blocks);
+
+	/* Cut off blocks of the existing file which are beyond the relation */
+	if (incremental)
+	{
+		if (fio_fflush(out) != 0 ||
+			fio_ftruncate(out, (off_t) n_restored * BLCKSZ) != 0)
+			elog(ERROR, "Cannot truncate \"%s\": %s", to_path,
+				 strerror(errno));
+
+		elog(VERBOSE, "Restored %u blocks of \"%s\", %u blocks are unchanged",
+			 n_restored, to_path, n_unchanged);
+	}
+
+	/* update file permission */
+	if (fio_chmod(to_path, sources[0].file->mode, FIO_DB_HOST) == -1)
+	{
+		int errno_tmp = errno;
+
+		fio_fclose(out);
+		elog(ERROR, "Cannot change mode of \"%s\": %s", to_path,
+			 strerror(errno_tmp));
+	}
+
+	if (fio_fflush(out) != 0 ||
+		fio_fclose(out))
+		elog(ERROR, "Cannot write \"%s\": %s", to_path, strerror(errno));
+}
+
+/*
+ * Merge copies of the data file from the backups of the chain into the new
+ * backup file "to_path" without decompressing the pages: records of the
+ * blocks are copied as is, only their order is changed. "sources" are ordered
+ * as for restore_data_file_chain(), pages of all of them must be compressed
+ * by the same algorithm. write_size, crc and page index of "file" are set
+ * according to the new file.
+ */
+void
+merge_data_file(const char *to_path, pgFile *file,
+				RestoreFileSource *sources, int n_sources)
+{
+	RestoreBlock *blocks;
+	int			n_blocks;
+	FILE	  **ins;
+	FILE	   *out;
+	pg_crc32	crc;
+	int			i,
+				j;
+
+	blocks = plan_chain_blocks(sources, n_sources, &n_blocks);
+
+	out = fopen(to_path, PG_BINARY_W);
+	if (out == NULL)
+		elog(ERROR, "Cannot open merge target file \"%s\": %s",
+			 to_path, strerror(errno));
+
+	ins = (FILE **) pgut_malloc(n_sources * sizeof(FILE *));
+	MemSet(ins, 0, n_sources * sizeof(FILE *));
+
+	INIT_FILE_CRC32(true, crc);
+	file->write_size = 0;
+	file->n_page_index = 0;
+
+	for (j = 0; j < n_blocks; j++)
+	{
+		RestoreBlock *rb = &blocks[j];
+		pgFile	   *from_file = sources[rb->source].file;
+		BackupPageHeader header;
+		DataPage	payload;
+		size_t		payload_size;
+
+		if (interrupted || thread_interrupted)
+			elog(ERROR, "Interrupted during merging backups");
+
+		if (ins[rb->source] == NULL)
+		{
+			ins[rb->source] = fopen(from_file->path, PG_BINARY_R);
+			if (ins[rb->source] == NULL)
+				elog(ERROR, "Cannot open backup file \"%s\": %s",
+					 from_file->path, strerror(errno));
+		}
+
+		if (fseek(ins[rb->source], rb->pos, SEEK_SET) != 0 ||
+			fread(&header, 1, sizeof(header), ins[rb->source]) != sizeof(header))
+			elog(ERROR, "Cannot read header of block %u of \"%s\": %s",
+				 rb->block, from_file->path, strerror(errno));
+
+		if (header.block != rb->block)
+			elog(ERROR, "Backup is broken at block %u of \"%s\"",
+				 rb->block, from_file->path);
+
+		if (header.compressed_size == PageIsDeduplicated)
+			payload_size = sizeof(PageStoreKey);
+		else if (header.compressed_size > 0 && header.compressed_size <= BLCKSZ)
+			payload_size = MAXALIGN(header.compressed_size);
+		else
+			elog(ERROR, "Invalid size %d of block %u of \"%s\"",
+				 header.compressed_size, header.block, from_file->path);
+
+		if (fread(payload.data, 1, payload_size, ins[rb->source]) != payload_size)
+			elog(ERROR, "Cannot read block %u of \"%s\"",
+				 header.block, from_file->path);
+
+		page_index_add(file, header.block, header.compressed_size,
+					   file->write_size);
+
+		if (fwrite(&header, 1, sizeof(header), out) != sizeof(header) ||
+			fwrite(payload.data, 1, payload_size, out) != payload_size)
+			elog(ERROR, "Cannot write block %u of \"%s\": %s",
+				 header.block, to_path, strerror(errno));
+
+		COMP_FILE_CRC32(true, crc, &header, sizeof(header));
+		COMP_FILE_CRC32(true, crc, payload.data, payload_size);
+		file->write_size += sizeof(header) + payload_size;
+	}
+
+	FIN_FILE_CRC32(true, crc);
+	file->crc = crc;
+
+	for (i = 0; i < n_sources; i++)
+		if (ins[i])
+			fclose(ins[i]);
+	pg_free(ins);
+	pg_free(blocks);
+
+	if (fflush(out) != 0 ||
+		fclose(out))
+		elog(ERROR, "Cannot write \"%s\": %s", to_path, strerror(errno));
+
+	if (chmod(to_path, FILE_PERMISSION) == -1)
+		elog(ERROR, "Cannot change mode of \"%s\": %s", to_path,
+			 strerror(errno));
+
+	elog(VERBOSE, "Merged %d blocks of \"%s\" without recompression",
+		 n_blocks, to_path);
+}
+
 /*
  * Copy file to backup.
  * We do not apply compression to these files, because
@@ -1351,6 +2318,32 @@ check_file_pages(pgFile *file, XLogRecPtr stop_lsn, uint32 checksum_version,
 			continue;
 		}
 
+		if (header.compressed_size == PageIsDeduplicated)
+		{
+			PageStoreKey key;
+
+			read_len = fread(&key, 1, sizeof(key), in);
+			if (read_len != sizeof(key))
+			{
+				elog(WARNING, "Cannot read page store key of block %u of \"%s\"",
+					 blknum, file->path);
+				return false;
+			}
+
+			COMP_FILE_CRC32(use_crc32c, crc, &key, read_len);
+
+			if (!page_store_get(&key, page.data))
+			{
+				elog(WARNING, "Block %u of \"%s\" is missing in the page store",
+					 blknum, file->path);
+				is_valid = false;
+			}
+			else if (validate_one_page(page.data, file, blknum, stop_lsn,
+									   checksum_version) == PAGE_IS_FOUND_AND_NOT_VALID)
+				is_valid = false;
+			continue;
+		}
+
 		Assert(header.compressed_size <= BLCKSZ);
 
 		read_len = fread(compressed_page.data, 1,
@@ -1416,3 +2409,233 @@ check_file_pages(pgFile *file, XLogRecPtr stop_lsn, uint32 checksum_version,
 
 	return is_valid;
 }
+
+/*
+ * Remember the position of the page record, which is going to be written
+ * into the backup file at offset "pos".
+ */
+void
+page_index_add(pgFile *file, BlockNumber block, int32 compressed_size,
+			   int64 pos)
+{
+	BackupPageIndex *entry;
+
+	if (file->n_page_index == file->max_page_index)
+	{
+		file->max_page_index = Max(file->max_page_index * 2, 64);
+		file->page_index = pgut_realloc(file->page_index,
+							file->max_page_index * sizeof(BackupPageIndex));
+	}
+
+	entry = &file->page_index[file->n_page_index++];
+	entry->block = block;
+	entry->compressed_size = compressed_size;
+	entry->pos = pos;
+}
+
+/*
+ * Build the page index of the existing backup data file by scanning
+ * its page headers.
+ */
+void
+build_page_index(pgFile *file, const char *path)
+{
+	FILE	   *in;
+	BackupPageHeader header;
+	int64		pos = 0;
+
+	file->n_page_index = 0;
+
+	in = fopen(path, PG_BINARY_R);
+	if (in == NULL)
+		elog(ERROR, "Cannot open backup file \"%s\": %s", path,
+			 strerror(errno));
+
+	while (fread(&header, 1, sizeof(header), in) == sizeof(header))
+	{
+		/* Skip holes left by restore_data_file() */
+		if (!(header.block == 0 && header.compressed_size == 0))
+			page_index_add(file, header.block, header.compressed_size, pos);
+
+		pos += sizeof(header);
+		if (header.compressed_size == PageIsDeduplicated)
+			pos += sizeof(PageStoreKey);
+		else if (header.compressed_size > 0)
+			pos += MAXALIGN(header.compressed_size);
+
+		if (fseek(in, pos, SEEK_SET) != 0)
+			elog(ERROR, "Cannot seek block %u of \"%s\": %s",
+				 header.block, path, strerror(errno));
+	}
+
+	if (ferror(in))
+		elog(ERROR, "Cannot read backup file \"%s\": %s", path,
+			 strerror(errno));
+
+	fclose(in);
+}
+
+/*
+ * Create PAGE_INDEX_FILE of the backup for writing indexes.
+ */
+void
+open_page_index_map(PageIndexMap *map, const char *path)
+{
+	strncpy(map->path, path, lengthof(map->path));
+
+	map->fp = fopen(path, PG_BINARY_W);
+	if (map->fp == NULL)
+		elog(ERROR, "Cannot create page index file \"%s\": %s", path,
+			 strerror(errno));
+	map->size = 0;
+}
+
+void
+close_page_index_map(PageIndexMap *map)
+{
+	if (map->fp == NULL)
+		return;
+
+	if (fflush(map->fp) != 0 || fsync(fileno(map->fp)) != 0 ||
+		fclose(map->fp) != 0)
+		elog(ERROR, "Cannot write page index file \"%s\": %s", map->path,
+			 strerror(errno));
+	map->fp = NULL;
+}
+
+/*
+ * Append the page index collected while the backup file was written to
+ * the map and remember its position in the file. The collected index is
+ * freed.
+ */
+void
+write_page_index(PageIndexMap *map, pgFile *file)
+{
+	size_t		len = file->n_page_index * sizeof(BackupPageIndex);
+
+	file->idx_num = 0;
+
+	if (file->n_page_index > 0)
+	{
+		INIT_FILE_CRC32(true, file->idx_crc);
+		COMP_FILE_CRC32(true, file->idx_crc, file->page_index, len);
+		FIN_FILE_CRC32(true, file->idx_crc);
+
+		pthread_lock(&page_index_mutex);
+
+		file->idx_off = map->size;
+		if (fwrite(file->page_index, 1, len, map->fp) != len)
+		{
+			pthread_mutex_unlock(&page_index_mutex);
+			elog(ERROR, "Cannot write page index file \"%s\": %s",
+				 map->path, strerror(errno));
+		}
+		map->size += len;
+
+		pthread_mutex_unlock(&page_index_mutex);
+
+		file->idx_num = file->n_page_index;
+	}
+
+	pg_free(file->page_index);
+	file->page_index = NULL;
+	file->n_page_index = 0;
+	file->max_page_index = 0;
+}
+
+/*
+ * Read the page index of the backup file from PAGE_INDEX_FILE. Returns NULL
+ * if the file has no index or the index is broken.
+ */
+BackupPageIndex *
+read_page_index(pgFile *file, const char *index_path)
+{
+	FILE	   *in;
+	BackupPageIndex *index;
+	size_t		len = file->idx_num * sizeof(BackupPageIndex);
+	pg_crc32	crc;
+
+	if (file->idx_num <= 0)
+		return NULL;
+
+	in = fopen(index_path, PG_BINARY_R);
+	if (in == NULL)
+	{
+		elog(WARNING, "Cannot open page index file \"%s\": %s",
+			 index_path, strerror(errno));
+		return NULL;
+	}
+
+	index = (BackupPageIndex *) pgut_malloc(len);
+
+	if (fseek(in, file->idx_off, SEEK_SET) != 0 ||
+		fread(index, 1, len, in) != len)
+	{
+		elog(WARNING, "Cannot read page index of \"%s\" from \"%s\"",
+			 file->path, index_path);
+		fclose(in);
+		pg_free(index);
+		return NULL;
+	}
+	fclose(in);
+
+	INIT_FILE_CRC32(true, crc);
+	COMP_FILE_CRC32(true, crc, index, len);
+	FIN_FILE_CRC32(true, crc);
+
+	if (crc != file->idx_crc)
+	{
+		elog(WARNING, "Invalid CRC of page index of \"%s\": %X. Expected %X",
+			 file->path, crc, file->idx_crc);
+		pg_free(index);
+		return NULL;
+	}
+
+	return index;
+}
+
+/*
+ * Check that the page index of the backup file points to the page headers.
+ */
+bool
+check_page_index(pgFile *file, const char *index_path)
+{
+	FILE	   *in;
+	BackupPageIndex *index;
+	bool		is_valid = true;
+	int			i;
+
+	index = read_page_index(file, index_path);
+	if (index == NULL)
+		return false;
+
+	in = fopen(file->path, PG_BINARY_R);
+	if (in == NULL)
+	{
+		elog(WARNING, "Cannot open backup file \"%s\": %s", file->path,
+			 strerror(errno));
+		pg_free(index);
+		return false;
+	}
+
+	for (i = 0; i < file->idx_num; i++)
+	{
+		BackupPageHeader header;
+
+		if (fseek(in, index[i].pos, SEEK_SET) != 0 ||
+			fread(&header, 1, sizeof(header), in) != sizeof(header) ||
+			header.block != index[i].block ||
+			header.compressed_size != index[i].compressed_size)
+		{
+			elog(WARNING, "Page index of \"%s\" doesn't match block %u",
+				 file->path, index[i].block);
+			is_valid = false;
+			break;
+		}
+	}
+
+	fclose(in);
+	pg_free(index);
+
+	return is_valid;
+}
@@ -16,6 +16,7 @@
 
 static void delete_walfiles(XLogRecPtr oldest_lsn, TimeLineID oldest_tli,
 							uint32 xlog_seg_size);
+static void delete_wal_summaries(const char *oldestSegmentNeeded);
 static void do_retention_internal(parray *backup_list, parray *to_keep_list,
 									parray *to_purge_list);
 static void do_retention_merge(parray *backup_list, parray *to_keep_list,
@@ -84,6 +85,9 @@ do_delete(time_t backup_id)
 
 	parray_free(delete_list);
 
+	/* Remove pages, which were referenced by deleted backups only */
+	page_store_gc();
+
 	/* Clean WAL segments */
 	if (delete_wal)
 	{
@@ -171,6 +175,9 @@ int do_retention(void)
 	if (delete_expired && !dry_run && !backup_list_is_empty)
 		do_retention_purge(to_keep_list, to_purge_list);
 
+	if ((backup_deleted || backup_merged) && !dry_run)
+		page_store_gc();
+
 	/* TODO: some sort of dry run for delete_wal */
 	if (delete_wal && !dry_run)
 		do_retention_wal();
@@ -794,6 +801,66 @@ delete_walfiles(XLogRecPtr oldest_lsn, TimeLineID oldest_tli,
 	else
 		elog(WARNING, "could not open archive location \"%s\": %s",
 			 arclog_path, strerror(errno));
+
+	delete_wal_summaries(XLogRecPtrIsInvalid(oldest_lsn) ?
+						 NULL : oldestSegmentNeeded);
+}
+
+/*
+ * Delete summaries of WAL segments older than 'oldestSegmentNeeded'. If it is
+ * NULL delete all summaries and their directory.
+ */
+static void
+delete_wal_summaries(const char *oldestSegmentNeeded)
+{
+	char		summary_dir[MAXPGPATH];
+	char		summary_file[MAXPGPATH];
+	DIR		   *dir;
+	struct dirent *de;
+
+	join_path_components(summary_dir, arclog_path, WAL_SUMMARY_DIR);
+
+	if ((dir = opendir(summary_dir)) == NULL)
+	{
+		if (errno != ENOENT)
+			elog(WARNING, "could not open directory \"%s\": %s",
+				 summary_dir, strerror(errno));
+		return;
+	}
+
+	while (errno = 0, (de = readdir(dir)) != NULL)
+	{
+		/*
+		 * Summaries are named after WAL segments, temporary files left by
+		 * interrupted summary building have additional suffix.
+		 */
+		if (strspn(de->d_name, "0123456789ABCDEF") != XLOG_FNAME_LEN)
+			continue;
+
+		if (oldestSegmentNeeded == NULL ||
+			strncmp(de->d_name + 8, oldestSegmentNeeded + 8, 16) < 0)
+		{
+			join_path_components(summary_file, summary_dir, de->d_name);
+			if (unlink(summary_file) != 0)
+			{
+				elog(WARNING, "could not remove file \"%s\": %s",
+					 summary_file, strerror(errno));
+				break;
+			}
+			elog(VERBOSE, "removed WAL summary \"%s\"", summary_file);
+		}
+	}
+
+	if (errno)
+		elog(WARNING, "could not read directory \"%s\": %s",
+			 summary_dir, strerror(errno));
+	if (closedir(dir))
+		elog(WARNING, "could not close directory \"%s\": %s",
+			 summary_dir, strerror(errno));
+
+	if (oldestSegmentNeeded == NULL && rmdir(summary_dir) != 0)
+		elog(WARNING, "could not remove directory \"%s\": %s",
+			 summary_dir, strerror(errno));
 }
 
 
@@ -823,6 +890,9 @@ do_delete_instance(void)
 	/* Delete all wal files. */
 	delete_walfiles(InvalidXLogRecPtr, 0, instance_config.xlog_seg_size);
 
+	/* Delete the page store */
+	page_store_remove();
+
 	/* Delete backup instance config file */
 	join_path_components(instance_config_path, backup_instance_path, BACKUP_CATALOG_CONF_FILE);
 	if (remove(instance_config_path))
@@ -831,6 +901,13 @@ do_delete_instance(void)
 			strerror(errno));
 	}
 
+	/* Delete catalog index, it was rewritten by catalog_get_backup_list() */
+	join_path_components(instance_config_path, backup_instance_path,
+						 BACKUP_CATALOG_INDEX_FILE);
+	if (remove(instance_config_path) && errno != ENOENT)
+		elog(ERROR, "can't remove \"%s\": %s", instance_config_path,
+			strerror(errno));
+
 	/* Delete instance root directories */
 	if (rmdir(backup_instance_path) != 0)
 		elog(ERROR, "can't remove \"%s\": %s", backup_instance_path,
@@ -20,8 +20,12 @@
 #include <unistd.h>
 #include <sys/stat.h>
 #include <dirent.h>
+#ifndef WIN32
+#include <sys/mman.h>
+#endif
 
 #include "utils/configuration.h"
+#include "utils/thread.h"
 
 /*
  * The contents of these directories are removed or recreated during server
@@ -122,8 +126,15 @@ static int BlackListCompare(const void *str1, const void *str2);
 
 static char dir_check_file(pgFile *file);
 static void dir_list_file_internal(parray *files, pgFile *parent, bool exclude,
+								   bool omit_symlink, parray *black_list,
+								   int external_dir_num, fio_location location,
+								   parray *database_dirs);
+static void dir_list_file_parallel(parray *files, pgFile *root,
 								   bool omit_symlink, parray *black_list,
 								   int external_dir_num, fio_location location);
+static void *dir_list_worker(void *arg);
+static void dir_list_remote_entry(const char *rel_path, mode_t mode,
+								  int64 size, void *arg);
 static void opt_path_map(ConfigOption *opt, const char *arg,
 						 TablespaceList *list, const char *type);
 
@@ -132,6 +143,50 @@ static TablespaceList tablespace_dirs = {NULL, NULL};
 /* Extra directories mapping */
 static TablespaceList external_remap_list = {NULL, NULL};
 
+/* Protects state of pgFileScheduler */
+static pthread_mutex_t file_scheduler_mutex = PTHREAD_MUTEX_INITIALIZER;
+
+/* Directory which files are located on the same device */
+typedef struct
+{
+	char		path[MAXPGPATH];
+	int			device;			/* index in pgFileScheduler.devices */
+} FileVolume;
+
+/* State of the remote directory listing */
+typedef struct
+{
+	parray	   *files;
+	const char *root;
+	bool		exclude;
+	int			external_dir_num;
+	char		skip_dir[MAXPGPATH];	/* content of this directory is skipped */
+} RemoteListArg;
+
+/* Database directory listed by a worker of the parallel directory listing */
+typedef struct
+{
+	pgFile	   *dir;
+	parray	   *files;			/* content of the directory */
+	volatile pg_atomic_flag lock;
+} DirListTask;
+
+typedef struct
+{
+	DirListTask *tasks;
+	int			n_tasks;
+	bool		omit_symlink;
+	parray	   *black_list;
+	int			external_dir_num;
+	fio_location location;
+
+	/*
+	 * Return value from the thread.
+	 * 0 means there is no error, 1 - there is an error.
+	 */
+	int			ret;
+} dir_list_arg;
+
 /*
  * Create directory, also create parent directories if necessary.
  */
@@ -320,6 +375,9 @@ pgFileFree(void *file)
 	if (file_ptr->forkName)
 		free(file_ptr->forkName);
 
+	if (file_ptr->page_index)
+		pfree(file_ptr->page_index);
+
 	pfree(file_ptr->path);
 	pfree(file_ptr->rel_path);
 	pfree(file);
@@ -512,8 +570,27 @@ dir_list_file(parray *files, const char *root, bool exclude, bool omit_symlink,
 	if (add_root)
 		parray_append(files, file);
 
-	dir_list_file_internal(files, file, exclude, omit_symlink, black_list,
-						   external_dir_num, location);
+	/* Let the agent walk the remote tree instead of stat'ing each entry */
+	if (fio_is_remote(location))
+	{
+		RemoteListArg arg;
+
+		arg.files = files;
+		arg.root = file->path;
+		arg.exclude = exclude;
+		arg.external_dir_num = external_dir_num;
+		arg.skip_dir[0] = '\0';
+
+		fio_list_tree(file->path, omit_symlink,
+					  exclude ? pgdata_exclude_dir : NULL, black_list,
+					  dir_list_remote_entry, &arg, location);
+	}
+	else if (exclude && num_threads > 1)
+		dir_list_file_parallel(files, file, omit_symlink, black_list,
+							   external_dir_num, location);
+	else
+		dir_list_file_internal(files, file, exclude, omit_symlink, black_list,
+							   external_dir_num, location, NULL);
 
 	if (!add_root)
 		pgFileFree(file);
@@ -728,11 +805,15 @@ dir_check_file(pgFile *file)
  * List files in parent->path directory.  If "exclude" is true do not add into
  * "files" files from pgdata_exclude_files and directories from
  * pgdata_exclude_dir.
+ *
+ * If "database_dirs" is not NULL, database directories are added to "files"
+ * and "database_dirs" but their content is not listed.
  */
 static void
 dir_list_file_internal(parray *files, pgFile *parent, bool exclude,
 					   bool omit_symlink, parray *black_list,
-					   int external_dir_num, fio_location location)
+					   int external_dir_num, fio_location location,
+					   parray *database_dirs)
 {
 	DIR		    *dir;
 	struct dirent *dent;
@@ -816,13 +897,21 @@ dir_list_file_internal(parray *files, pgFile *parent, bool exclude,
 
 		parray_append(files, file);
 
+		/* Content of database directories is listed by the workers */
+		if (database_dirs && S_ISDIR(file->mode) && file->is_database)
+		{
+			parray_append(database_dirs, file);
+			continue;
+		}
+
 		/*
 		 * If the entry is a directory call dir_list_file_internal()
 		 * recursively.
 		 */
 		if (S_ISDIR(file->mode))
 			dir_list_file_internal(files, file, exclude, omit_symlink,
-								   black_list, external_dir_num, location);
+								   black_list, external_dir_num, location,
+								   database_dirs);
 	}
 
 	if (errno && errno != ENOENT)
@@ -835,6 +924,193 @@ dir_list_file_internal(parray *files, pgFile *parent, bool exclude,
 	fio_closedir(dir);
 }
 
+/*
+ * List the directory "root" using several threads.
+ *
+ * The main thread lists everything except the content of database
+ * directories (global, base/<oid> and pg_tblspc/<oid>/<version>/<oid>),
+ * which is listed by num_threads workers. Results of the workers are appended
+ * to "files" in the order of the database directories.
+ */
+static void
+dir_list_file_parallel(parray *files, pgFile *root, bool omit_symlink,
+					   parray *black_list, int external_dir_num,
+					   fio_location location)
+{
+	parray	   *database_dirs = parray_new();
+	DirListTask *tasks;
+	int			n_tasks;
+	int			n_threads;
+	pthread_t  *threads;
+	dir_list_arg *threads_args;
+	bool		list_isok = true;
+	size_t		n_files = parray_num(files);
+	int			i;
+	time_t		start_time,
+				end_time;
+
+	time(&start_time);
+
+	dir_list_file_internal(files, root, true, omit_symlink, black_list,
+						   external_dir_num, location, database_dirs);
+
+	n_tasks = parray_num(database_dirs);
+	if (n_tasks == 0)
+	{
+		parray_free(database_dirs);
+		return;
+	}
+
+	tasks = (DirListTask *) palloc(sizeof(DirListTask) * n_tasks);
+	for (i = 0; i < n_tasks; i++)
+	{
+		tasks[i].dir = (pgFile *) parray_get(database_dirs, i);
+		tasks[i].files = parray_new();
+		pg_atomic_clear_flag(&tasks[i].lock);
+	}
+
+	n_threads = Min(num_threads, n_tasks);
+	threads = (pthread_t *) palloc(sizeof(pthread_t) * n_threads);
+	threads_args = (dir_list_arg *) palloc(sizeof(dir_list_arg) * n_threads);
+
+	thread_interrupted = false;
+	for (i = 0; i < n_threads; i++)
+	{
+		dir_list_arg *arg = &(threads_args[i]);
+
+		arg->tasks = tasks;
+		arg->n_tasks = n_tasks;
+		arg->omit_symlink = omit_symlink;
+		arg->black_list = black_list;
+		arg->external_dir_num = external_dir_num;
+		arg->location = location;
+		/* By default there are some error */
+		arg->ret = 1;
+
+		pthread_create(&threads[i], NULL, dir_list_worker, arg);
+	}
+
+	/* Wait threads */
+	for (i = 0; i < n_threads; i++)
+	{
+		pthread_join(threads[i], NULL);
+		if (threads_args[i].ret == 1)
+			list_isok = false;
+	}
+	if (!list_isok)
+		elog(ERROR, "Cannot list directory \"%s\"", root->path);
+
+	/* Merge results of the workers */
+	for (i = 0; i < n_tasks; i++)
+	{
+		parray_concat(files, tasks[i].files);
+		parray_free(tasks[i].files);
+	}
+
+	time(&end_time);
+	elog(LOG, "Listed %lu files in \"%s\" using %d threads for %d database "
+		 "directories, time elapsed %.0f sec",
+		 (unsigned long) (parray_num(files) - n_files), root->path,
+		 n_threads, n_tasks, difftime(end_time, start_time));
+
+	pfree(tasks);
+	pfree(threads);
+	pfree(threads_args);
+	parray_free(database_dirs);
+}
+
+/*
+ * List content of the database directories assigned to the thread.
+ */
+static void *
+dir_list_worker(void *arg)
+{
+	dir_list_arg *arguments = (dir_list_arg *) arg;
+	int			i;
+
+	for (i = 0; i < arguments->n_tasks; i++)
+	{
+		DirListTask *task = &arguments->tasks[i];
+
+		if (!pg_atomic_test_set_flag(&task->lock))
+			continue;
+
+		/* check for interrupt */
+		if (interrupted || thread_interrupted)
+			elog(ERROR, "interrupted during directory listing");
+
+		dir_list_file_internal(task->files, task->dir, true,
+							   arguments->omit_symlink, arguments->black_list,
+							   arguments->external_dir_num,
+							   arguments->location, NULL);
+	}
+
+	/* Directory listing is successful */
+	arguments->ret = 0;
+
+	return NULL;
+}
+
+/*
+ * Add the entry of the remote directory tree listed by fio_list_tree() into
+ * the list. Entries come in the same order as in dir_list_file_internal(),
+ * so content of the skipped directory follows the directory itself.
+ */
+static void
+dir_list_remote_entry(const char *rel_path, mode_t mode, int64 size, void *arg)
+{
+	RemoteListArg *list_arg = (RemoteListArg *) arg;
+	pgFile	   *file;
+	char		path[MAXPGPATH];
+	char		check_res;
+
+	if (list_arg->skip_dir[0] != '\0')
+	{
+		if (path_is_prefix_of_path(list_arg->skip_dir, rel_path))
+			return;
+		list_arg->skip_dir[0] = '\0';
+	}
+
+	join_path_components(path, list_arg->root, rel_path);
+	file = pgFileInit(path, rel_path);
+	file->size = size;
+	file->mode = mode;
+	file->external_dir_num = list_arg->external_dir_num;
+
+	/*
+	 * Add only files, directories and links. Skip sockets and other
+	 * unexpected file formats.
+	 */
+	if (!S_ISDIR(file->mode) && !S_ISREG(file->mode))
+	{
+		elog(WARNING, "Skip \"%s\": unexpected file format", file->path);
+		pgFileFree(file);
+		return;
+	}
+
+	if (list_arg->exclude)
+	{
+		check_res = dir_check_file(file);
+		if (check_res == CHECK_FALSE)
+		{
+			/* Skip */
+			if (S_ISDIR(file->mode))
+				strlcpy(list_arg->skip_dir, file->rel_path, MAXPGPATH);
+			pgFileFree(file);
+			return;
+		}
+		else if (check_res == CHECK_EXCLUDE_FALSE)
+		{
+			/* We add the directory itself which content was excluded */
+			strlcpy(list_arg->skip_dir, file->rel_path, MAXPGPATH);
+			parray_append(list_arg->files, file);
+			return;
+		}
+	}
+
+	parray_append(list_arg->files, file);
+}
+
 /*
  * Retrieve tablespace path, either relocated or original depending on whether
  * -T was passed or not.
@@ -1131,7 +1407,8 @@ read_tablespace_map(parray *files, const char *backup_dir)
 
 /*
  * Check that all tablespace mapping entries have correct linked directory
- * paths. Linked directories must be empty or do not exist.
+ * paths. Linked directories must be empty or do not exist, unless restore
+ * is incremental: then their contents are reused.
  *
  * If tablespace-mapping option is supplied, all OLDDIR entries must have
  * entries in tablespace_map file.
@@ -1166,7 +1443,10 @@ check_tablespace_mapping(pgBackup *backup)
 				 cell->old_dir);
 	}
 
-	/* 2 - all linked directories must be empty */
+	/*
+	 * 2 - all linked directories must be empty, incremental restore keeps
+	 * their contents
+	 */
 	for (i = 0; i < parray_num(links); i++)
 	{
 		pgFile	   *link = (pgFile *) parray_get(links, i);
@@ -1184,7 +1464,7 @@ check_tablespace_mapping(pgBackup *backup)
 			elog(ERROR, "tablespace directory is not an absolute path: %s\n",
 				 linked_path);
 
-		if (!dir_is_empty(linked_path, FIO_DB_HOST))
+		if (!incremental_restore && !dir_is_empty(linked_path, FIO_DB_HOST))
 			elog(ERROR, "restore tablespace destination is not empty: \"%s\"",
 				 linked_path);
 	}
@@ -1242,8 +1522,11 @@ check_external_dir_mapping(pgBackup *backup)
 				 "backup: \"%s\"", cell->old_dir);
 	}
 
-	/* 2 - all linked directories must be empty */
-	for (i = 0; i < parray_num(external_dirs_to_restore); i++)
+	/*
+	 * 2 - all linked directories must be empty, incremental restore keeps
+	 * their contents
+	 */
+	for (i = 0; i < parray_num(external_dirs_to_restore) && !incremental_restore; i++)
 	{
 		char	    *external_dir = (char *) parray_get(external_dirs_to_restore,
 														i);
@@ -1313,10 +1596,287 @@ print_file_list(FILE *out, const parray *files, const char *root,
 		if (file->n_blocks != BLOCKNUM_INVALID)
 			fio_fprintf(out, ",\"n_blocks\":\"%i\"", file->n_blocks);
 
+		if (file->idx_num > 0)
+			fio_fprintf(out, ",\"idx_off\":\"" INT64_FORMAT "\", "
+						 "\"idx_num\":\"%i\", \"idx_crc\":\"%u\"",
+						 file->idx_off, file->idx_num, file->idx_crc);
+
 		fio_fprintf(out, "}\n");
 	}
 }
 
+/*
+ * Binary backup content list.
+ *
+ * The file consists of FileListHeader, array of fixed size FileListEntry and
+ * the string table. Strings are referenced by their offsets within the table,
+ * directory names and other repeated strings are stored only once. Offset 0
+ * refers to the empty string.
+ *
+ * Numbers are stored in the byte order of the host which wrote the list,
+ * the header contains FILE_LIST_BYTE_ORDER to detect a foreign byte order.
+ */
+#define FILE_LIST_MAGIC			"PBFL"
+#define FILE_LIST_VERSION		2
+#define FILE_LIST_BYTE_ORDER	0x01020304
+#define FILE_LIST_BYTE_ORDER_SWAPPED	0x04030201
+
+/* FileListEntry flags */
+#define FILE_LIST_DATAFILE		0x01
+#define FILE_LIST_CFS			0x02
+
+typedef struct FileListHeader
+{
+	char		magic[4];
+	uint32		version;
+	uint32		n_files;
+	uint32		strings_size;
+	pg_crc32	crc;			/* CRC of entries and the string table */
+	uint32		byte_order;		/* FILE_LIST_BYTE_ORDER */
+} FileListHeader;
+
+typedef struct FileListEntry
+{
+	int64		write_size;
+	int64		idx_off;
+	uint32		mode;
+	pg_crc32	crc;
+	pg_crc32	idx_crc;
+	int32		idx_num;
+	int32		segno;
+	int32		n_blocks;
+	int32		external_dir_num;
+	uint32		dir;			/* offset of the relative directory path */
+	uint32		name;			/* offset of the file name */
+	uint32		linked;			/* offset of the link target */
+	uint32		compress_alg;	/* offset of the compression algorithm name */
+	uint32		flags;
+} FileListEntry;
+
+struct FileListReader
+{
+	char		path[MAXPGPATH];
+	FILE	   *fp;
+	bool		is_binary;
+	char	   *data;			/* contents of the binary file list */
+	size_t		size;
+	bool		mapped;			/* data is mmap'ed */
+	uint32		n_files;
+	uint32		cur;			/* next entry to read */
+	const FileListEntry *entries;
+	const char *strings;
+	uint32		strings_size;
+};
+
+/* String table of the binary file list being written */
+typedef struct FileListStrings
+{
+	char	   *data;
+	uint32		size;
+	uint32		max_size;
+	uint32	   *hash;			/* offsets of interned strings, 0 is empty */
+	uint32		hash_size;
+	uint32		n_hashed;
+} FileListStrings;
+
+static uint32
+file_list_hash(const char *str, size_t len)
+{
+	uint32		h = 2166136261u;
+	size_t		i;
+
+	for (i = 0; i < len; i++)
+	{
+		h ^= (unsigned char) str[i];
+		h *= 16777619u;
+	}
+	return h;
+}
+
+/* Append string to the table */
+static uint32
+file_list_append_string(FileListStrings *strings, const char *str, size_t len)
+{
+	uint32		offset = strings->size;
+
+	if (strings->size + len + 1 > strings->max_size)
+	{
+		while (strings->size + len + 1 > strings->max_size)
+			strings->max_size *= 2;
+		strings->data = pgut_realloc(strings->data, strings->max_size);
+	}
+	memcpy(strings->data + offset, str, len);
+	strings->data[offset + len] = '\0';
+	strings->size += len + 1;
+
+	return offset;
+}
+
+/*
+ * Returns offset of the string in the table, the string is appended only if
+ * it isn't in the table yet.
+ */
+static uint32
+file_list_intern_string(FileListStrings *strings, const char *str, size_t len)
+{
+	uint32		i;
+
+	if (len == 0)
+		return 0;
+
+	/* Keep the hash table at most half full */
+	if (strings->n_hashed * 2 >= strings->hash_size)
+	{
+		uint32	   *old_hash = strings->hash;
+		uint32		old_size = strings->hash_size;
+
+		strings->hash_size = old_size * 2;
+		strings->hash = pgut_malloc(sizeof(uint32) * strings->hash_size);
+		MemSet(strings->hash, 0, sizeof(uint32) * strings->hash_size);
+
+		for (i = 0; i < old_size; i++)
+		{
+			uint32		offset = old_hash[i];
+			uint32		pos;
+
+			if (offset == 0)
+				continue;
+
+			pos = file_list_hash(strings->data + offset,
+								 strlen(strings->data + offset)) &
+				(strings->hash_size - 1);
+			while (strings->hash[pos] != 0)
+				pos = (pos + 1) & (strings->hash_size - 1);
+			strings->hash[pos] = offset;
+		}
+		pg_free(old_hash);
+	}
+
+	i = file_list_hash(str, len) & (strings->hash_size - 1);
+	while (strings->hash[i] != 0)
+	{
+		const char *cur = strings->data + strings->hash[i];
+
+		if (strncmp(cur, str, len) == 0 && cur[len] == '\0')
+			return strings->hash[i];
+		i = (i + 1) & (strings->hash_size - 1);
+	}
+
+	strings->hash[i] = file_list_append_string(strings, str, len);
+	strings->n_hashed++;
+
+	return strings->hash[i];
+}
+
+/*
+ * Write backup content list in binary format. Arguments are the same as of
+ * print_file_list().
+ */
+void
+write_binary_file_list(FILE *out, const parray *files, const char *root,
+					   const char *external_prefix, parray *external_list)
+{
+	FileListHeader header;
+	FileListEntry *entries;
+	FileListStrings strings;
+	size_t		n_files = parray_num(files);
+	size_t		i;
+
+	entries = (FileListEntry *) pgut_malloc(sizeof(FileListEntry) *
+											Max(n_files, 1));
+	MemSet(&strings, 0, sizeof(FileListStrings));
+	strings.max_size = BLCKSZ;
+	strings.data = pgut_malloc(strings.max_size);
+	strings.hash_size = 1024;
+	strings.hash = pgut_malloc(sizeof(uint32) * strings.hash_size);
+	MemSet(strings.hash, 0, sizeof(uint32) * strings.hash_size);
+	/* Empty string */
+	file_list_append_string(&strings, "", 0);
+
+	for (i = 0; i < n_files; i++)
+	{
+		pgFile	   *file = (pgFile *) parray_get(files, i);
+		FileListEntry *entry = &entries[i];
+		char	   *path = file->path;
+		char	   *sep;
+		const char *alg;
+
+		/* omit root directory portion */
+		if (root && strstr(path, root) == path)
+			path = GetRelativePath(path, root);
+		else if (file->external_dir_num && !external_prefix)
+		{
+			Assert(external_list);
+			path = GetRelativePath(path, parray_get(external_list,
+													file->external_dir_num - 1));
+		}
+
+		MemSet(entry, 0, sizeof(FileListEntry));
+
+		sep = last_dir_separator(path);
+		if (sep != NULL)
+		{
+			entry->dir = file_list_intern_string(&strings, path, sep - path);
+			entry->name = file_list_append_string(&strings, sep + 1,
+												  strlen(sep + 1));
+		}
+		else
+			entry->name = file_list_append_string(&strings, path,
+												  strlen(path));
+
+		if (file->linked)
+			entry->linked = file_list_intern_string(&strings, file->linked,
+													strlen(file->linked));
+
+		alg = deparse_compress_alg(file->compress_alg);
+		entry->compress_alg = file_list_intern_string(&strings, alg,
+													  strlen(alg));
+
+		entry->write_size = file->write_size;
+		entry->mode = (uint32) file->mode;
+		entry->crc = file->crc;
+		entry->external_dir_num = file->external_dir_num;
+		entry->segno = file->is_datafile ? file->segno : 0;
+		entry->n_blocks = file->n_blocks;
+		if (file->idx_num > 0)
+		{
+			entry->idx_off = file->idx_off;
+			entry->idx_num = file->idx_num;
+			entry->idx_crc = file->idx_crc;
+		}
+		if (file->is_datafile)
+			entry->flags |= FILE_LIST_DATAFILE;
+		if (file->is_cfs)
+			entry->flags |= FILE_LIST_CFS;
+	}
+
+	MemSet(&header, 0, sizeof(FileListHeader));
+	memcpy(header.magic, FILE_LIST_MAGIC, sizeof(header.magic));
+	header.version = FILE_LIST_VERSION;
+	header.byte_order = FILE_LIST_BYTE_ORDER;
+	header.n_files = (uint32) n_files;
+	header.strings_size = strings.size;
+
+	INIT_FILE_CRC32(true, header.crc);
+	if (n_files > 0)
+		COMP_FILE_CRC32(true, header.crc, entries,
+						sizeof(FileListEntry) * n_files);
+	COMP_FILE_CRC32(true, header.crc, strings.data, strings.size);
+	FIN_FILE_CRC32(true, header.crc);
+
+	if (fio_fwrite(out, &header, sizeof(header)) != sizeof(header) ||
+		(n_files > 0 &&
+		 fio_fwrite(out, entries, sizeof(FileListEntry) * n_files) !=
+			sizeof(FileListEntry) * n_files) ||
+		fio_fwrite(out, strings.data, strings.size) != strings.size)
+		elog(ERROR, "cannot write %s file: %s", DATABASE_FILE_LIST,
+			 strerror(errno));
+
+	pg_free(entries);
+	pg_free(strings.data);
+	pg_free(strings.hash);
+}
+
 /* Parsing states for get_control_value() */
 #define CONTROL_WAIT_NAME			1
 #define CONTROL_INNAME				2
@@ -1461,90 +2021,363 @@ bad_format:
 }
 
 /*
- * Construct parray of pgFile from the backup content list.
- * If root is not NULL, path will be absolute path.
+ * Make pgFile of the file list entry with relative path 'path'. If root is not
+ * NULL, path of the pgFile will be absolute path.
  */
-parray *
-dir_read_file_list(const char *root, const char *external_prefix,
-				   const char *file_txt, fio_location location)
+static pgFile *
+file_list_make_file(const char *path, const char *root,
+					const char *external_prefix, int external_dir_num)
 {
-	FILE   *fp;
-	parray *files;
-	char	buf[MAXPGPATH * 2];
+	char		filepath[MAXPGPATH];
 
-	fp = fio_open_stream(file_txt, location);
-	if (fp == NULL)
-		elog(ERROR, "cannot open \"%s\": %s", file_txt, strerror(errno));
+	if (external_dir_num && external_prefix)
+	{
+		char temp[MAXPGPATH];
 
-	files = parray_new();
+		makeExternalDirPathByNum(temp, external_prefix, external_dir_num);
+		join_path_components(filepath, temp, path);
+	}
+	else if (root)
+		join_path_components(filepath, root, path);
+	else
+		strcpy(filepath, path);
 
-	while (fgets(buf, lengthof(buf), fp))
+	return pgFileInit(filepath, path);
+}
+
+/*
+ * Parse a line of the text backup content list.
+ */
+static pgFile *
+parse_file_list_line(const char *buf, const char *root,
+					 const char *external_prefix)
+{
+	char		path[MAXPGPATH];
+	char		linked[MAXPGPATH];
+	char		compress_alg_string[MAXPGPATH];
+	int64		write_size,
+				mode,		/* bit length of mode_t depends on platforms */
+				is_datafile,
+				is_cfs,
+				external_dir_num,
+				crc,
+				segno,
+				n_blocks,
+				idx_off,
+				idx_num,
+				idx_crc;
+	pgFile	   *file;
+
+	get_control_value(buf, "path", path, NULL, true);
+	get_control_value(buf, "size", NULL, &write_size, true);
+	get_control_value(buf, "mode", NULL, &mode, true);
+	get_control_value(buf, "is_datafile", NULL, &is_datafile, true);
+	get_control_value(buf, "is_cfs", NULL, &is_cfs, false);
+	get_control_value(buf, "crc", NULL, &crc, true);
+	get_control_value(buf, "compress_alg", compress_alg_string, NULL, false);
+	get_control_value(buf, "external_dir_num", NULL, &external_dir_num, false);
+
+	file = file_list_make_file(path, root, external_prefix,
+							   (int) external_dir_num);
+
+	file->write_size = (int64) write_size;
+	file->mode = (mode_t) mode;
+	file->is_datafile = is_datafile ? true : false;
+	file->is_cfs = is_cfs ? true : false;
+	file->crc = (pg_crc32) crc;
+	file->compress_alg = parse_compress_alg(compress_alg_string);
+	file->external_dir_num = external_dir_num;
+
+	/*
+	 * Optional fields
+	 */
+
+	if (get_control_value(buf, "linked", linked, NULL, false) && linked[0])
 	{
-		char		path[MAXPGPATH];
-		char		filepath[MAXPGPATH];
-		char		linked[MAXPGPATH];
-		char		compress_alg_string[MAXPGPATH];
-		int64		write_size,
-					mode,		/* bit length of mode_t depends on platforms */
-					is_datafile,
-					is_cfs,
-					external_dir_num,
-					crc,
-					segno,
-					n_blocks;
-		pgFile	   *file;
+		file->linked = pgut_strdup(linked);
+		canonicalize_path(file->linked);
+	}
+
+	if (get_control_value(buf, "segno", NULL, &segno, false))
+		file->segno = (int) segno;
+
+	if (get_control_value(buf, "n_blocks", NULL, &n_blocks, false))
+		file->n_blocks = (int) n_blocks;
+
+	if (get_control_value(buf, "idx_num", NULL, &idx_num, false))
+	{
+		get_control_value(buf, "idx_off", NULL, &idx_off, true);
+		get_control_value(buf, "idx_crc", NULL, &idx_crc, true);
+		file->idx_num = (int) idx_num;
+		file->idx_off = idx_off;
+		file->idx_crc = (pg_crc32) idx_crc;
+	}
+
+	return file;
+}
+
+/* Returns string of the binary file list by its offset */
+static const char *
+file_list_string(FileListReader *reader, uint32 offset)
+{
+	if (offset >= reader->strings_size)
+		elog(ERROR, "%s file \"%s\" has invalid string offset %u",
+			 DATABASE_FILE_LIST, reader->path, offset);
+	return reader->strings + offset;
+}
 
-		get_control_value(buf, "path", path, NULL, true);
-		get_control_value(buf, "size", NULL, &write_size, true);
-		get_control_value(buf, "mode", NULL, &mode, true);
-		get_control_value(buf, "is_datafile", NULL, &is_datafile, true);
-		get_control_value(buf, "is_cfs", NULL, &is_cfs, false);
-		get_control_value(buf, "crc", NULL, &crc, true);
-		get_control_value(buf, "compress_alg", compress_alg_string, NULL, false);
-		get_control_value(buf, "external_dir_num", NULL, &external_dir_num, false);
+/*
+ * Load the binary file list into memory and check it. Local files are
+ * mmap'ed, remote files are already fetched into memory by fio.
+ */
+static void
+load_binary_file_list(FileListReader *reader)
+{
+	int			fd = fileno(reader->fp);
+	FileListHeader *header;
+	pg_crc32	crc;
+	size_t		entries_size;
+
+#ifdef WIN32
+	/* Stream is opened in text mode */
+	if (fd >= 0)
+		_setmode(fd, _O_BINARY);
+#else
+	if (fd >= 0)
+	{
+		struct stat st;
 
-		if (external_dir_num && external_prefix)
+		if (fstat(fd, &st) < 0)
+			elog(ERROR, "cannot stat \"%s\": %s", reader->path,
+				 strerror(errno));
+		reader->size = st.st_size;
+		if (reader->size > 0)
 		{
-			char temp[MAXPGPATH];
+			reader->data = mmap(NULL, reader->size, PROT_READ, MAP_PRIVATE,
+								fd, 0);
+			if (reader->data == MAP_FAILED)
+				elog(ERROR, "cannot map \"%s\": %s", reader->path,
+					 strerror(errno));
+			reader->mapped = true;
+		}
+	}
+	else
+#endif
+	{
+		size_t		max_size = BLCKSZ;
+		size_t		rc;
 
-			makeExternalDirPathByNum(temp, external_prefix, external_dir_num);
-			join_path_components(filepath, temp, path);
+		rewind(reader->fp);
+		reader->data = pgut_malloc(max_size);
+		while ((rc = fread(reader->data + reader->size, 1,
+						   max_size - reader->size, reader->fp)) > 0)
+		{
+			reader->size += rc;
+			if (reader->size == max_size)
+			{
+				max_size *= 2;
+				reader->data = pgut_realloc(reader->data, max_size);
+			}
 		}
-		else if (root)
-			join_path_components(filepath, root, path);
-		else
-			strcpy(filepath, path);
+		if (ferror(reader->fp))
+			elog(ERROR, "cannot read \"%s\": %s", reader->path,
+				 strerror(errno));
+	}
 
-		file = pgFileInit(filepath, path);
+	if (reader->size < sizeof(FileListHeader))
+		elog(ERROR, "%s file \"%s\" is truncated", DATABASE_FILE_LIST,
+			 reader->path);
+
+	header = (FileListHeader *) reader->data;
+	if (memcmp(header->magic, FILE_LIST_MAGIC, sizeof(header->magic)) != 0)
+		elog(ERROR, "%s file \"%s\" has invalid format", DATABASE_FILE_LIST,
+			 reader->path);
+	if (header->byte_order == FILE_LIST_BYTE_ORDER_SWAPPED)
+		elog(ERROR, "%s file \"%s\" is written on a host with different byte order",
+			 DATABASE_FILE_LIST, reader->path);
+	/* Lists of version 1 have no byte order mark */
+	if (header->version != FILE_LIST_VERSION && header->version != 1)
+		elog(ERROR, "%s file \"%s\" has unsupported version %u",
+			 DATABASE_FILE_LIST, reader->path, header->version);
+	if (header->version != 1 && header->byte_order != FILE_LIST_BYTE_ORDER)
+		elog(ERROR, "%s file \"%s\" has invalid format", DATABASE_FILE_LIST,
+			 reader->path);
+
+	entries_size = sizeof(FileListEntry) * (size_t) header->n_files;
+	if (reader->size != sizeof(FileListHeader) + entries_size +
+		header->strings_size || header->strings_size == 0)
+		elog(ERROR, "%s file \"%s\" has invalid size", DATABASE_FILE_LIST,
+			 reader->path);
+
+	INIT_FILE_CRC32(true, crc);
+	COMP_FILE_CRC32(true, crc, reader->data + sizeof(FileListHeader),
+					reader->size - sizeof(FileListHeader));
+	FIN_FILE_CRC32(true, crc);
+	if (!EQ_CRC32C(crc, header->crc))
+		elog(ERROR, "%s file \"%s\" has invalid CRC", DATABASE_FILE_LIST,
+			 reader->path);
+
+	reader->n_files = header->n_files;
+	reader->entries = (FileListEntry *) (reader->data +
+										 sizeof(FileListHeader));
+	reader->strings = reader->data + sizeof(FileListHeader) + entries_size;
+	reader->strings_size = header->strings_size;
+
+	if (reader->strings[reader->strings_size - 1] != '\0')
+		elog(ERROR, "%s file \"%s\" has invalid string table",
+			 DATABASE_FILE_LIST, reader->path);
+}
 
-		file->write_size = (int64) write_size;
-		file->mode = (mode_t) mode;
-		file->is_datafile = is_datafile ? true : false;
-		file->is_cfs = is_cfs ? true : false;
-		file->crc = (pg_crc32) crc;
-		file->compress_alg = parse_compress_alg(compress_alg_string);
-		file->external_dir_num = external_dir_num;
+/*
+ * Open the backup content list for reading by read_file_list_entry(). Both
+ * text and binary formats are accepted.
+ */
+FileListReader *
+open_file_list(const char *file_txt, fio_location location)
+{
+	FileListReader *reader;
+	int			c;
 
-		/*
-		 * Optional fields
-		 */
+	reader = (FileListReader *) pgut_malloc(sizeof(FileListReader));
+	MemSet(reader, 0, sizeof(FileListReader));
+	strlcpy(reader->path, file_txt, sizeof(reader->path));
 
-		if (get_control_value(buf, "linked", linked, NULL, false) && linked[0])
+	reader->fp = fio_open_stream(file_txt, location);
+	if (reader->fp == NULL)
+		elog(ERROR, "cannot open \"%s\": %s", file_txt, strerror(errno));
+
+	/* Text file list consists of json-like lines */
+	c = getc(reader->fp);
+	if (c != EOF && c != '{')
+	{
+		reader->is_binary = true;
+		load_binary_file_list(reader);
+	}
+	else if (c != EOF)
+	{
+		/* Count the lines to report the number of files */
+		while (c != EOF)
 		{
-			file->linked = pgut_strdup(linked);
-			canonicalize_path(file->linked);
+			if (c == '\n')
+				reader->n_files++;
+			c = getc(reader->fp);
 		}
+		if (ferror(reader->fp))
+			elog(ERROR, "cannot read \"%s\": %s", file_txt, strerror(errno));
+		rewind(reader->fp);
+	}
+
+	return reader;
+}
+
+/*
+ * Returns the number of files in the backup content list.
+ */
+int
+file_list_num(FileListReader *reader)
+{
+	return (int) reader->n_files;
+}
 
-		if (get_control_value(buf, "segno", NULL, &segno, false))
-			file->segno = (int) segno;
+/*
+ * Read the next file of the backup content list. Returns NULL at the end of
+ * the list. If root is not NULL, path will be absolute path.
+ */
+pgFile *
+read_file_list_entry(FileListReader *reader, const char *root,
+					 const char *external_prefix)
+{
+	const FileListEntry *entry;
+	const char *dir;
+	const char *linked;
+	char		path[MAXPGPATH];
+	pgFile	   *file;
 
-		if (get_control_value(buf, "n_blocks", NULL, &n_blocks, false))
-			file->n_blocks = (int) n_blocks;
+	if (!reader->is_binary)
+	{
+		char		buf[MAXPGPATH * 2];
 
-		parray_append(files, file);
+		if (!fgets(buf, lengthof(buf), reader->fp))
+			return NULL;
+		return parse_file_list_line(buf, root, external_prefix);
 	}
 
-	fio_close_stream(fp);
+	if (reader->cur >= reader->n_files)
+		return NULL;
+	entry = &reader->entries[reader->cur++];
+
+	dir = file_list_string(reader, entry->dir);
+	if (dir[0] != '\0')
+		join_path_components(path, dir,
+							 file_list_string(reader, entry->name));
+	else
+		strlcpy(path, file_list_string(reader, entry->name), sizeof(path));
+
+	file = file_list_make_file(path, root, external_prefix,
+							   entry->external_dir_num);
+
+	file->write_size = entry->write_size;
+	file->mode = (mode_t) entry->mode;
+	file->is_datafile = (entry->flags & FILE_LIST_DATAFILE) != 0;
+	file->is_cfs = (entry->flags & FILE_LIST_CFS) != 0;
+	file->crc = entry->crc;
+	file->compress_alg = parse_compress_alg(
+								file_list_string(reader, entry->compress_alg));
+	file->external_dir_num = entry->external_dir_num;
+	file->segno = entry->segno;
+	file->n_blocks = entry->n_blocks;
+	file->idx_off = entry->idx_off;
+	file->idx_num = entry->idx_num;
+	file->idx_crc = entry->idx_crc;
+
+	linked = file_list_string(reader, entry->linked);
+	if (linked[0])
+	{
+		file->linked = pgut_strdup(linked);
+		canonicalize_path(file->linked);
+	}
+
+	return file;
+}
+
+/*
+ * Close the backup content list opened by open_file_list().
+ */
+void
+close_file_list(FileListReader *reader)
+{
+#ifndef WIN32
+	if (reader->mapped)
+		munmap(reader->data, reader->size);
+	else
+#endif
+		pg_free(reader->data);
+
+	fio_close_stream(reader->fp);
+	pg_free(reader);
+}
+
+/*
+ * Construct parray of pgFile from the backup content list.
+ * If root is not NULL, path will be absolute path.
+ */
+parray *
+dir_read_file_list(const char *root, const char *external_prefix,
+				   const char *file_txt, fio_location location)
+{
+	FileListReader *reader;
+	parray	   *files;
+	pgFile	   *file;
+
+	reader = open_file_list(file_txt, location);
+
+	files = parray_new();
+	parray_expand(files, reader->n_files);
+
+	while ((file = read_file_list_entry(reader, root, external_prefix)) != NULL)
+		parray_append(files, file);
+
+	close_file_list(reader);
 	return files;
 }
 
@@ -1689,3 +2522,184 @@ backup_contains_external(const char *dir, parray *dirs_list)
 	search_result = parray_bsearch(dirs_list, dir, BlackListCompare);
 	return search_result != NULL;
 }
+
+/*
+ * Get the directory, which device holds the file: the external directory,
+ * the tablespace or "root".
+ */
+static void
+file_volume_path(pgFile *file, const char *root, parray *external_dirs,
+				 char *path)
+{
+	Oid			tblspcOid;
+
+	if (file->external_dir_num > 0 && external_dirs &&
+		file->external_dir_num <= parray_num(external_dirs))
+		strncpy(path, parray_get(external_dirs, file->external_dir_num - 1),
+				MAXPGPATH);
+	else if (path_is_prefix_of_path(PG_TBLSPC_DIR, file->rel_path) &&
+			 sscanf(file->rel_path, PG_TBLSPC_DIR "/%u", &tblspcOid) == 1)
+		snprintf(path, MAXPGPATH, "%s/%s/%u", root, PG_TBLSPC_DIR, tblspcOid);
+	else
+		strncpy(path, root, MAXPGPATH);
+	path[MAXPGPATH - 1] = '\0';
+}
+
+/*
+ * Group files of "files" by the device they are located on. Paths of the
+ * files are relative to "root" or to the external directories.
+ */
+pgFileScheduler *
+file_scheduler_new(parray *files, const char *root, parray *external_dirs,
+				   fio_location location)
+{
+	pgFileScheduler *scheduler;
+	parray	   *volumes = parray_new();
+	int			i;
+
+	scheduler = pgut_new(pgFileScheduler);
+	scheduler->devices = NULL;
+	scheduler->n_devices = 0;
+	scheduler->last = 0;
+	scheduler->n_files = parray_num(files);
+	scheduler->n_claimed = 0;
+
+	for (i = 0; i < parray_num(files); i++)
+	{
+		pgFile	   *file = (pgFile *) parray_get(files, i);
+		char		path[MAXPGPATH];
+		FileVolume *volume = NULL;
+		int			j;
+
+		file_volume_path(file, root, external_dirs, path);
+		for (j = 0; j < parray_num(volumes); j++)
+		{
+			volume = (FileVolume *) parray_get(volumes, j);
+			if (strcmp(volume->path, path) == 0)
+				break;
+			volume = NULL;
+		}
+
+		/* Find the device of the new volume */
+		if (volume == NULL)
+		{
+			struct stat st;
+			dev_t		dev = 0;
+
+			if (fio_stat(path, &st, true, location) == 0)
+				dev = st.st_dev;
+			else
+				elog(LOG, "Cannot stat \"%s\": %s", path, strerror(errno));
+
+			volume = pgut_new(FileVolume);
+			strncpy(volume->path, path, MAXPGPATH);
+			volume->device = -1;
+
+			for (j = 0; j < scheduler->n_devices; j++)
+				if (scheduler->devices[j].dev == dev)
+					volume->device = j;
+
+			if (volume->device == -1)
+			{
+				pgDeviceQueue *queue;
+
+				scheduler->devices = (pgDeviceQueue *)
+					pgut_realloc(scheduler->devices,
+								 sizeof(pgDeviceQueue) * (scheduler->n_devices + 1));
+				queue = &scheduler->devices[scheduler->n_devices];
+				queue->dev = dev;
+				queue->files = parray_new();
+				queue->next = 0;
+				queue->active = 0;
+				volume->device = scheduler->n_devices++;
+			}
+			parray_append(volumes, volume);
+		}
+
+		parray_append(scheduler->devices[volume->device].files, file);
+	}
+
+	elog(LOG, "Files are located on %d devices", scheduler->n_devices);
+
+	parray_walk(volumes, pfree);
+	parray_free(volumes);
+
+	return scheduler;
+}
+
+/*
+ * Claim the next file for the thread. "device" is the device of the file
+ * claimed by the thread previously (-1 if there is none), it is released
+ * and replaced by the device of the returned file. Number of claimed files
+ * is returned in "num" for progress reporting.
+ *
+ * The file is taken from the device with the least number of working
+ * threads, so while every device has files to process no device gets more
+ * than its share of the threads. Files locked by the caller beforehand are
+ * skipped. Returns NULL when there are no files left.
+ */
+pgFile *
+file_scheduler_next(pgFileScheduler *scheduler, int *device, int *num)
+{
+	pgFile	   *file = NULL;
+
+	pthread_lock(&file_scheduler_mutex);
+
+	if (*device >= 0)
+	{
+		scheduler->devices[*device].active--;
+		*device = -1;
+	}
+
+	while (file == NULL)
+	{
+		pgDeviceQueue *queue;
+		int			best = -1;
+		int			i;
+
+		/* Go round the devices starting from the one after the last claim */
+		for (i = 1; i <= scheduler->n_devices; i++)
+		{
+			int			d = (scheduler->last + i) % scheduler->n_devices;
+
+			queue = &scheduler->devices[d];
+			if (queue->next >= parray_num(queue->files))
+				continue;
+			if (best == -1 || queue->active < scheduler->devices[best].active)
+				best = d;
+		}
+
+		/* All files are claimed */
+		if (best == -1)
+			break;
+
+		queue = &scheduler->devices[best];
+		file = (pgFile *) parray_get(queue->files, queue->next++);
+		if (!pg_atomic_test_set_flag(&file->lock))
+		{
+			file = NULL;
+			continue;
+		}
+
+		queue->active++;
+		scheduler->last = best;
+		*device = best;
+		*num = ++scheduler->n_claimed;
+	}
+
+	pthread_mutex_unlock(&file_scheduler_mutex);
+
+	return file;
+}
+
+/* Free the scheduler, files themselves are not freed */
+void
+file_scheduler_free(pgFileScheduler *scheduler)
+{
+	int			i;
+
+	for (i = 0; i < scheduler->n_devices; i++)
+		parray_free(scheduler->devices[i].files);
+	pg_free(scheduler->devices);
+	pfree(scheduler);
+}
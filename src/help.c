@@ -22,6 +22,7 @@ static void help_add_instance(void);
 static void help_del_instance(void);
 static void help_archive_push(void);
 static void help_archive_get(void);
+static void help_archive_server(void);
 static void help_checkdb(void);
 
 void
@@ -53,6 +54,8 @@ help_command(char *command)
 		help_archive_push();
 	else if (strcmp(command, "archive-get") == 0)
 		help_archive_get();
+	else if (strcmp(command, "archive-server") == 0)
+		help_archive_server();
 	else if (strcmp(command, "checkdb") == 0)
 		help_checkdb();
 	else if (strcmp(command, "--help") == 0
@@ -106,6 +109,7 @@ help_pg_probackup(void)
 	printf(_("                 [--stream [-S slot-name]] [--temp-slot]\n"));
 	printf(_("                 [--backup-pg-log] [-j num-threads] [--progress]\n"));
 	printf(_("                 [--no-validate] [--skip-block-validation]\n"));
+	printf(_("                 [--page-dedup] [--filelist-format=format]\n"));
 	printf(_("                 [--external-dirs=external-directories-paths]\n"));
 	printf(_("                 [--log-level-console=log-level-console]\n"));
 	printf(_("                 [--log-level-file=log-level-file]\n"));
@@ -137,9 +141,10 @@ help_pg_probackup(void)
 	printf(_("                 [--recovery-target-action=pause|promote|shutdown]\n"));
 	printf(_("                 [--restore-as-replica]\n"));
 	printf(_("                 [--no-validate] [--skip-block-validation]\n"));
+	printf(_("                 [--wal-seek]\n"));
 	printf(_("                 [-T OLDDIR=NEWDIR] [--progress]\n"));
 	printf(_("                 [--external-mapping=OLDDIR=NEWDIR]\n"));
-	printf(_("                 [--skip-external-dirs]\n"));
+	printf(_("                 [--skip-external-dirs] [--incremental]\n"));
 	printf(_("                 [--remote-proto] [--remote-host]\n"));
 	printf(_("                 [--remote-port] [--remote-path] [--remote-user]\n"));
 	printf(_("                 [--ssh-options]\n"));
@@ -150,7 +155,7 @@ help_pg_probackup(void)
 	printf(_("                  |--recovery-target-lsn=lsn [--recovery-target-inclusive=boolean]]\n"));
 	printf(_("                 [--recovery-target-timeline=timeline]\n"));
 	printf(_("                 [--recovery-target-name=target-name]\n"));
-	printf(_("                 [--skip-block-validation]\n"));
+	printf(_("                 [--skip-block-validation] [--wal-seek]\n"));
 
 	printf(_("\n  %s checkdb [-B backup-path] [--instance=instance_name]\n"), PROGRAM_NAME);
 	printf(_("                 [-D pgdata-path] [--progress] [-j num-threads]\n"));
@@ -167,6 +172,7 @@ help_pg_probackup(void)
 
 	printf(_("\n  %s merge -B backup-path --instance=instance_name\n"), PROGRAM_NAME);
 	printf(_("                 -i backup-id [--progress] [-j num-threads]\n"));
+	printf(_("                 [--filelist-format=format]\n"));
 
 	printf(_("\n  %s add-instance -B backup-path -D pgdata-path\n"), PROGRAM_NAME);
 	printf(_("                 --instance=instance_name\n"));
@@ -181,7 +187,8 @@ help_pg_probackup(void)
 	printf(_("\n  %s archive-push -B backup-path --instance=instance_name\n"), PROGRAM_NAME);
 	printf(_("                 --wal-file-path=wal-file-path\n"));
 	printf(_("                 --wal-file-name=wal-file-name\n"));
-	printf(_("                 [--overwrite]\n"));
+	printf(_("                 [--overwrite] [--archive-socket=path]\n"));
+	printf(_("                 [-j num-threads] [--batch-size=batch_size]\n"));
 	printf(_("                 [--compress]\n"));
 	printf(_("                 [--compress-algorithm=compress-algorithm]\n"));
 	printf(_("                 [--compress-level=compress-level]\n"));
@@ -192,6 +199,17 @@ help_pg_probackup(void)
 	printf(_("\n  %s archive-get -B backup-path --instance=instance_name\n"), PROGRAM_NAME);
 	printf(_("                 --wal-file-path=wal-file-path\n"));
 	printf(_("                 --wal-file-name=wal-file-name\n"));
+	printf(_("                 [-j num-threads] [--prefetch=num-files]\n"));
+	printf(_("                 [--remote-proto] [--remote-host]\n"));
+	printf(_("                 [--remote-port] [--remote-path] [--remote-user]\n"));
+	printf(_("                 [--ssh-options]\n"));
+
+	printf(_("\n  %s archive-server -B backup-path --instance=instance_name\n"), PROGRAM_NAME);
+	printf(_("                 --archive-socket=path\n"));
+	printf(_("                 [-j num-threads] [--batch-size=batch_size]\n"));
+	printf(_("                 [--compress]\n"));
+	printf(_("                 [--compress-algorithm=compress-algorithm]\n"));
+	printf(_("                 [--compress-level=compress-level]\n"));
 	printf(_("                 [--remote-proto] [--remote-host]\n"));
 	printf(_("                 [--remote-port] [--remote-path] [--remote-user]\n"));
 	printf(_("                 [--ssh-options]\n"));
@@ -222,6 +240,7 @@ help_backup(void)
 	printf(_("                 [--stream [-S slot-name] [--temp-slot]\n"));
 	printf(_("                 [--backup-pg-log] [-j num-threads] [--progress]\n"));
 	printf(_("                 [--no-validate] [--skip-block-validation]\n"));
+	printf(_("                 [--page-dedup] [--filelist-format=format]\n"));
 	printf(_("                 [-E external-directories-paths]\n"));
 	printf(_("                 [--log-level-console=log-level-console]\n"));
 	printf(_("                 [--log-level-file=log-level-file]\n"));
@@ -256,6 +275,9 @@ help_backup(void)
 	printf(_("      --progress                   show progress\n"));
 	printf(_("      --no-validate                disable validation after backup\n"));
 	printf(_("      --skip-block-validation      set to validate only file-level checksum\n"));
+	printf(_("      --page-dedup                 keep identical pages once in the page store\n"));
+	printf(_("      --filelist-format=format     format of the backup content list=binary|text\n"));
+	printf(_("                                   (default: binary)\n"));
 	printf(_("  -E  --external-dirs=external-directories-paths\n"));
 	printf(_("                                   backup some directories not from pgdata \n"));
 	printf(_("                                   (example: --external-dirs=/tmp/dir1:/tmp/dir2)\n"));
@@ -296,9 +318,10 @@ help_backup(void)
 	printf(_("\n  Compression options:\n"));
 	printf(_("      --compress                   alias for --compress-algorithm='zlib' and --compress-level=1\n"));
 	printf(_("      --compress-algorithm=compress-algorithm\n"));
-	printf(_("                                   available options: 'zlib', 'pglz', 'none' (default: none)\n"));
+	printf(_("                                   available options: 'zlib', 'pglz', 'zstd', 'lz4', 'none' (default: none)\n"));
 	printf(_("      --compress-level=compress-level\n"));
-	printf(_("                                   level of compression [0-9] (default: 1)\n"));
+	printf(_("                                   level of compression [0-9], [0-22] for zstd,\n"));
+	printf(_("                                   [0-12] for lz4 (default: 1)\n"));
 
 	printf(_("\n  Archive options:\n"));
 	printf(_("      --archive-timeout=timeout   wait timeout for WAL segment archiving (default: 5min)\n"));
@@ -343,9 +366,10 @@ help_restore(void)
 	printf(_("                 [--recovery-target-action=pause|promote|shutdown]\n"));
 	printf(_("                 [--restore-as-replica]\n"));
 	printf(_("                 [--no-validate] [--skip-block-validation]\n"));
+	printf(_("                 [--wal-seek]\n"));
 	printf(_("                 [-T OLDDIR=NEWDIR] [--progress]\n"));
 	printf(_("                 [--external-mapping=OLDDIR=NEWDIR]\n"));
-	printf(_("                 [--skip-external-dirs]\n"));
+	printf(_("                 [--skip-external-dirs] [--incremental]\n"));
 	printf(_("                 [--remote-proto] [--remote-host]\n"));
 	printf(_("                 [--remote-port] [--remote-path] [--remote-user]\n"));
 	printf(_("                 [--ssh-options]\n\n"));
@@ -377,12 +401,16 @@ help_restore(void)
 	printf(_("                                   to ease setting up a standby server\n"));
 	printf(_("      --no-validate                disable backup validation during restore\n"));
 	printf(_("      --skip-block-validation      set to validate only file-level checksum\n"));
+	printf(_("      --wal-seek                   find WAL segment of recovery target time or lsn\n"));
+	printf(_("                                   by binary search instead of reading all WAL\n"));
 
 	printf(_("  -T, --tablespace-mapping=OLDDIR=NEWDIR\n"));
 	printf(_("                                   relocate the tablespace from directory OLDDIR to NEWDIR\n"));
 	printf(_("      --external-mapping=OLDDIR=NEWDIR\n"));
 	printf(_("                                   relocate the external directory from OLDDIR to NEWDIR\n"));
 	printf(_("      --skip-external-dirs         do not restore all external directories\n"));
+	printf(_("      --incremental                restore into existing PGDATA rewriting only\n"));
+	printf(_("                                   pages which differ from the backup\n"));
 
 	printf(_("\n  Logging options:\n"));
 	printf(_("      --log-level-console=log-level-console\n"));
@@ -426,7 +454,7 @@ help_validate(void)
 	printf(_("                  |--recovery-target-lsn=lsn [--recovery-target-inclusive=boolean]]\n"));
 	printf(_("                 [--recovery-target-timeline=timeline]\n"));
 	printf(_("                 [--recovery-target-name=target-name]\n"));
-	printf(_("                 [--skip-block-validation]\n\n"));
+	printf(_("                 [--skip-block-validation] [--wal-seek]\n\n"));
 
 	printf(_("  -B, --backup-path=backup-path    location of the backup storage area\n"));
 	printf(_("      --instance=instance_name     name of the instance\n"));
@@ -444,6 +472,8 @@ help_validate(void)
 	printf(_("      --recovery-target-name=target-name\n"));
 	printf(_("                                   the named restore point to which recovery will proceed\n"));
 	printf(_("      --skip-block-validation      set to validate only file-level checksum\n"));
+	printf(_("      --wal-seek                   find WAL segment of recovery target time or lsn\n"));
+	printf(_("                                   by binary search instead of reading all WAL\n"));
 
 	printf(_("\n  Logging options:\n"));
 	printf(_("      --log-level-console=log-level-console\n"));
@@ -577,6 +607,7 @@ help_merge(void)
 {
 	printf(_("\n%s merge -B backup-path --instance=instance_name\n"), PROGRAM_NAME);
 	printf(_("                 -i backup-id [-j num-threads] [--progress]\n"));
+	printf(_("                 [--filelist-format=format]\n"));
 	printf(_("                 [--log-level-console=log-level-console]\n"));
 	printf(_("                 [--log-level-file=log-level-file]\n"));
 	printf(_("                 [--log-filename=log-filename]\n"));
@@ -591,6 +622,8 @@ help_merge(void)
 
 	printf(_("  -j, --threads=NUM                number of parallel threads\n"));
 	printf(_("      --progress                   show progress\n"));
+	printf(_("      --filelist-format=format     format of the backup content list=binary|text\n"));
+	printf(_("                                   (default: binary)\n"));
 
 	printf(_("\n  Logging options:\n"));
 	printf(_("      --log-level-console=log-level-console\n"));
@@ -674,9 +707,10 @@ help_set_config(void)
 	printf(_("\n  Compression options:\n"));
 	printf(_("      --compress                   alias for --compress-algorithm='zlib' and --compress-level=1\n"));
 	printf(_("      --compress-algorithm=compress-algorithm\n"));
-	printf(_("                                   available options: 'zlib','pglz','none' (default: 'none')\n"));
+	printf(_("                                   available options: 'zlib','pglz','zstd','lz4','none' (default: 'none')\n"));
 	printf(_("      --compress-level=compress-level\n"));
-	printf(_("                                   level of compression [0-9] (default: 1)\n"));
+	printf(_("                                   level of compression [0-9], [0-22] for zstd,\n"));
+	printf(_("                                   [0-12] for lz4 (default: 1)\n"));
 
 	printf(_("\n  Archive options:\n"));
 	printf(_("      --archive-timeout=timeout   wait timeout for WAL segment archiving (default: 5min)\n"));
@@ -761,7 +795,8 @@ help_archive_push(void)
 	printf(_("\n%s archive-push -B backup-path --instance=instance_name\n"), PROGRAM_NAME);
 	printf(_("                 --wal-file-path=wal-file-path\n"));
 	printf(_("                 --wal-file-name=wal-file-name\n"));
-	printf(_("                 [--overwrite]\n"));
+	printf(_("                 [--overwrite] [--archive-socket=path]\n"));
+	printf(_("                 [-j num-threads] [--batch-size=batch_size]\n"));
 	printf(_("                 [--compress]\n"));
 	printf(_("                 [--compress-algorithm=compress-algorithm]\n"));
 	printf(_("                 [--compress-level=compress-level]\n"));
@@ -776,13 +811,19 @@ help_archive_push(void)
 	printf(_("      --wal-file-name=wal-file-name\n"));
 	printf(_("                                   name of the WAL file to retrieve from the server\n"));
 	printf(_("      --overwrite                  overwrite archived WAL file\n"));
+	printf(_("      --archive-socket=path        pass the WAL file to archive-server listening\n"));
+	printf(_("                                   on this socket, if it is running\n"));
+	printf(_("  -j, --threads=NUM                number of parallel threads\n"));
+	printf(_("      --batch-size=batch_size      push up to this number of WAL files ready for\n"));
+	printf(_("                                   archiving, including the requested one (default: 1)\n"));
 
 	printf(_("\n  Compression options:\n"));
 	printf(_("      --compress                   alias for --compress-algorithm='zlib' and --compress-level=1\n"));
 	printf(_("      --compress-algorithm=compress-algorithm\n"));
-	printf(_("                                   available options: 'zlib','pglz','none' (default: 'none')\n"));
+	printf(_("                                   available options: 'zlib','pglz','zstd','lz4','none' (default: 'none')\n"));
 	printf(_("      --compress-level=compress-level\n"));
-	printf(_("                                   level of compression [0-9] (default: 1)\n"));
+	printf(_("                                   level of compression [0-9], [0-22] for zstd,\n"));
+	printf(_("                                   [0-12] for lz4 (default: 1)\n"));
 
 	printf(_("\n  Remote options:\n"));
 	printf(_("      --remote-proto=protocol      remote protocol to use\n"));
@@ -802,6 +843,7 @@ help_archive_get(void)
 	printf(_("\n%s archive-get -B backup-path --instance=instance_name\n"), PROGRAM_NAME);
 	printf(_("                 --wal-file-path=wal-file-path\n"));
 	printf(_("                 --wal-file-name=wal-file-name\n"));
+	printf(_("                 [-j num-threads] [--prefetch=num-files]\n"));
 	printf(_("                 [--remote-proto] [--remote-host]\n"));
 	printf(_("                 [--remote-port] [--remote-path] [--remote-user]\n"));
 	printf(_("                 [--ssh-options]\n\n"));
@@ -812,6 +854,50 @@ help_archive_get(void)
 	printf(_("                                   relative destination path name of the WAL file on the server\n"));
 	printf(_("      --wal-file-name=wal-file-name\n"));
 	printf(_("                                   name of the WAL file to retrieve from the archive\n"));
+	printf(_("  -j, --threads=NUM                number of parallel threads\n"));
+	printf(_("      --prefetch=num-files         fetch this number of following WAL files\n"));
+	printf(_("                                   in background (default: 0)\n"));
+
+	printf(_("\n  Remote options:\n"));
+	printf(_("      --remote-proto=protocol      remote protocol to use\n"));
+	printf(_("                                   available options: 'ssh', 'none' (default: ssh)\n"));
+	printf(_("      --remote-host=hostname       remote host address or hostname\n"));
+	printf(_("      --remote-port=port           remote host port (default: 22)\n"));
+	printf(_("      --remote-path=path           path to directory with pg_probackup binary on remote host\n"));
+	printf(_("                                   (default: current binary path)\n"));
+	printf(_("      --remote-user=username       user name for ssh connection (default: current user)\n"));
+	printf(_("      --ssh-options=ssh_options    additional ssh options (default: none)\n"));
+	printf(_("                                   (example: --ssh-options='-c cipher_spec -F configfile')\n\n"));
+}
+
+static void
+help_archive_server(void)
+{
+	printf(_("\n%s archive-server -B backup-path --instance=instance_name\n"), PROGRAM_NAME);
+	printf(_("                 --archive-socket=path\n"));
+	printf(_("                 [-j num-threads] [--batch-size=batch_size]\n"));
+	printf(_("                 [--compress]\n"));
+	printf(_("                 [--compress-algorithm=compress-algorithm]\n"));
+	printf(_("                 [--compress-level=compress-level]\n"));
+	printf(_("                 [--remote-proto] [--remote-host]\n"));
+	printf(_("                 [--remote-port] [--remote-path] [--remote-user]\n"));
+	printf(_("                 [--ssh-options]\n\n"));
+
+	printf(_("  -B, --backup-path=backup-path    location of the backup storage area\n"));
+	printf(_("      --instance=instance_name     name of the instance\n"));
+	printf(_("      --archive-socket=path        Unix socket to listen on for archive-push\n"));
+	printf(_("                                   --archive-socket requests\n"));
+	printf(_("  -j, --threads=NUM                number of WAL files pushed concurrently\n"));
+	printf(_("      --batch-size=batch_size      push up to this number of WAL files ready for\n"));
+	printf(_("                                   archiving per request (default: 1)\n"));
+
+	printf(_("\n  Compression options:\n"));
+	printf(_("      --compress                   alias for --compress-algorithm='zlib' and --compress-level=1\n"));
+	printf(_("      --compress-algorithm=compress-algorithm\n"));
+	printf(_("                                   available options: 'zlib','pglz','zstd','lz4','none' (default: 'none')\n"));
+	printf(_("      --compress-level=compress-level\n"));
+	printf(_("                                   level of compression [0-9], [0-22] for zstd,\n"));
+	printf(_("                                   [0-12] for lz4 (default: 1)\n"));
 
 	printf(_("\n  Remote options:\n"));
 	printf(_("      --remote-proto=protocol      remote protocol to use\n"));
@@ -26,6 +26,9 @@ typedef struct
 	const char *from_root;
 	const char *to_external_prefix;
 	const char *from_external_prefix;
+	PageIndexMap *index_map;	/* new page indexes of to_backup */
+	const char *to_index_path;
+	const char *from_index_path;
 
 	/*
 	 * Return value from the thread.
@@ -35,6 +38,10 @@ typedef struct
 } merge_files_arg;
 
 static void *merge_files(void *arg);
+static bool can_merge_pages_as_is(merge_files_arg *argument, pgFile *file,
+								  pgFile *to_file);
+static void merge_pages_as_is(merge_files_arg *argument, pgFile *file,
+							  pgFile *to_file, const char *to_file_path);
 static void
 reorder_external_dirs(pgBackup *to_backup, parray *to_external,
 					  parray *from_external);
@@ -175,13 +182,17 @@ merge_backups(pgBackup *to_backup, pgBackup *from_backup)
 				from_backup_path[MAXPGPATH],
 				from_database_path[MAXPGPATH],
 				from_external_prefix[MAXPGPATH],
-				control_file[MAXPGPATH];
+				control_file[MAXPGPATH],
+				index_path[MAXPGPATH],
+				tmp_index_path[MAXPGPATH],
+				from_index_path[MAXPGPATH];
 	parray	   *files,
 			   *to_files;
 	parray	   *to_external = NULL,
 			   *from_external = NULL;
 	pthread_t  *threads = NULL;
 	merge_files_arg *threads_args = NULL;
+	PageIndexMap index_map;
 	int			i;
 	time_t		merge_time;
 	bool		merge_isok = true;
@@ -294,6 +305,17 @@ merge_backups(pgBackup *to_backup, pgBackup *from_backup)
 		pg_atomic_init_flag(&file->lock);
 	}
 
+	/*
+	 * Index file of to_backup is written anew, so that indexes of replaced
+	 * and removed files don't remain in it.
+	 */
+	pgBackupGetPath(to_backup, index_path, lengthof(index_path),
+					PAGE_INDEX_FILE);
+	snprintf(tmp_index_path, lengthof(tmp_index_path), "%s.tmp", index_path);
+	open_page_index_map(&index_map, tmp_index_path);
+	pgBackupGetPath(from_backup, from_index_path, lengthof(from_index_path),
+					PAGE_INDEX_FILE);
+
 	thread_interrupted = false;
 	for (i = 0; i < num_threads; i++)
 	{
@@ -308,6 +330,9 @@ merge_backups(pgBackup *to_backup, pgBackup *from_backup)
 		arg->from_external = from_external;
 		arg->to_external_prefix = to_external_prefix;
 		arg->from_external_prefix = from_external_prefix;
+		arg->index_map = &index_map;
+		arg->to_index_path = index_path;
+		arg->from_index_path = from_index_path;
 		/* By default there are some error */
 		arg->ret = 1;
 
@@ -326,6 +351,17 @@ merge_backups(pgBackup *to_backup, pgBackup *from_backup)
 	if (!merge_isok)
 		elog(ERROR, "Data files merging failed");
 
+	close_page_index_map(&index_map);
+
+	/*
+	 * Old file list refers to the old index file. If we fail before the new
+	 * list is written, CRC of the indexes won't match and files will be
+	 * indexed by scanning them.
+	 */
+	if (rename(tmp_index_path, index_path) == -1)
+		elog(ERROR, "Could not rename file "%s" to "%s": %s",
+			 tmp_index_path, index_path, strerror(errno));
+
 	/*
 	 * Update to_backup metadata.
 	 * We cannot set backup status to OK just yet,
@@ -504,11 +540,22 @@ merge_files(void *arg)
 			 * If the file wasn't changed in PAGE backup, retreive its
 			 * write_size from previous FULL backup.
 			 */
+			file->idx_num = 0;
 			if (to_file)
 			{
 				file->compress_alg = to_file->compress_alg;
 				file->write_size = to_file->write_size;
 
+				/* Copy the index of the file into the new index file */
+				if (to_file->idx_num > 0)
+				{
+					file->page_index = read_page_index(to_file,
+													   argument->to_index_path);
+					if (file->page_index)
+						file->n_page_index = to_file->idx_num;
+					write_page_index(argument->index_map, file);
+				}
+
 				/*
 				 * Recalculate crc for backup prior to 2.0.25.
 				 */
@@ -546,12 +593,20 @@ merge_files(void *arg)
 
 		if (file->is_datafile && !file->is_cfs)
 		{
+			/*
+			 * Pages compressed by the same algorithm are moved into the
+			 * target file as they are.
+			 */
+			if (can_merge_pages_as_is(argument, file, to_file))
+				merge_pages_as_is(argument, file, to_file, to_file_path);
 			/*
 			 * We need more complicate algorithm if target file should be
-			 * compressed.
+			 * compressed or may refer to the page store, pages don't have
+			 * fixed offsets in such files.
 			 */
-			if (to_backup->compress_alg == PGLZ_COMPRESS ||
-				to_backup->compress_alg == ZLIB_COMPRESS)
+			else if ((to_backup->compress_alg != NONE_COMPRESS &&
+				 to_backup->compress_alg != NOT_DEFINED_COMPRESS) ||
+				to_backup->page_dedup)
 			{
 				char		tmp_file_path[MAXPGPATH];
 				char	   *prev_path;
@@ -613,6 +668,7 @@ merge_files(void *arg)
 								 to_backup->compress_alg,
 								 to_backup->compress_level,
 								 false);
+				write_page_index(argument->index_map, file);
 
 				file->path = prev_path;
 
@@ -638,6 +694,10 @@ merge_files(void *arg)
 				 */
 				file->write_size = pgFileSize(to_file_path);
 				file->crc = pgFileGetCRC(to_file_path, true, true, NULL, FIO_LOCAL_HOST);
+
+				/* Pages were moved, so index the merged file again */
+				build_page_index(file, to_file_path);
+				write_page_index(argument->index_map, file);
 			}
 		}
 		else if (file->external_dir_num)
@@ -679,6 +739,96 @@ merge_files(void *arg)
 	return NULL;
 }
 
+/*
+ * Check if records of the pages of the data file may be moved into the target
+ * backup without decompression.
+ */
+static bool
+can_merge_pages_as_is(merge_files_arg *argument, pgFile *file, pgFile *to_file)
+{
+	pgBackup   *to_backup = argument->to_backup;
+	pgBackup   *from_backup = argument->from_backup;
+
+	/* Uncompressed files are merged in-place */
+	if (to_backup->compress_alg == NONE_COMPRESS ||
+		to_backup->compress_alg == NOT_DEFINED_COMPRESS)
+		return false;
+
+	if (file->compress_alg != to_backup->compress_alg ||
+		(to_file && to_file->compress_alg != to_backup->compress_alg))
+		return false;
+
+	/*
+	 * References to the page store are kept only by backups which use it,
+	 * see page_store_gc().
+	 */
+	if (from_backup->page_dedup && !to_backup->page_dedup)
+		return false;
+
+	/*
+	 * Merged backup gets the current program version, so pages written by
+	 * versions prior to 2.0.23 must be checked by page_may_be_compressed()
+	 * and compressed again.
+	 */
+	if (parse_program_version(from_backup->program_version) < 20023 ||
+		parse_program_version(to_backup->program_version) < 20023)
+		return false;
+
+	return true;
+}
+
+/*
+ * Move records of the pages of the source and the target files into the new
+ * target file, and replace the target file by it.
+ */
+static void
+merge_pages_as_is(merge_files_arg *argument, pgFile *file, pgFile *to_file,
+				  const char *to_file_path)
+{
+	RestoreFileSource sources[2];
+	int			n_sources = 0;
+	char		tmp_file_path[MAXPGPATH];
+	char	   *prev_path = NULL;
+
+	snprintf(tmp_file_path, MAXPGPATH, "%s_tmp", to_file_path);
+
+	elog(VERBOSE, "Move pages of source and target files into the temporary path \"%s\"",
+		 tmp_file_path);
+
+	sources[n_sources].file = file;
+	sources[n_sources].backup_version =
+		parse_program_version(argument->from_backup->program_version);
+	sources[n_sources].index_path = argument->from_index_path;
+	n_sources++;
+
+	if (to_file)
+	{
+		/*
+		 * to_file has relative path, but we need the file in directory
+		 * to_root.
+		 */
+		prev_path = to_file->path;
+		to_file->path = (char *) to_file_path;
+
+		sources[n_sources].file = to_file;
+		sources[n_sources].backup_version =
+			parse_program_version(argument->to_backup->program_version);
+		sources[n_sources].index_path = argument->to_index_path;
+		n_sources++;
+	}
+
+	merge_data_file(tmp_file_path, file, sources, n_sources);
+
+	if (to_file)
+		to_file->path = prev_path;
+
+	if (rename(tmp_file_path, to_file_path) == -1)
+		elog(ERROR, "Could not rename file \"%s\" to \"%s\": %s",
+			 tmp_file_path, to_file_path, strerror(errno));
+
+	write_page_index(argument->index_map, file);
+}
+
 /* Recursively delete a directory and its contents */
 static void
 remove_dir_with_files(const char *path)
@@ -0,0 +1,2000 @@
+/*-------------------------------------------------------------------------
+ *
+ * pagestore.c: content-addressed store of data pages shared by backups.
+ *
+ * When backup is taken with --page-dedup option, every data page is looked
+ * up in the page store of the instance by its key: 64-bit hash and CRC32C of
+ * the page contents. If the key is already there, the backup file gets a
+ * reference to it instead of the page itself. Pages are appended to pack
+ * files:
+ *
+ *   BACKUP_PATH/pages/<instance>/pack_<number>
+ *   BACKUP_PATH/pages/<instance>/pack_<number>.idx
+ *
+ * A pack starts with PageStorePackHeader followed by pages, each one is
+ * prefixed by PageStoreEntryHeader and compressed with the algorithm of
+ * the backup which added the page. A pack is written by a single process and
+ * is not changed after its index, which lists keys and offsets of the pages,
+ * is written.
+ *
+ * Keys are looked up in the on-disk index of the store, which is split into
+ * partitions by the high byte of the hash:
+ *
+ *   BACKUP_PATH/pages/<instance>/index_<partition>
+ *
+ * A partition is a hash table of buckets of PAGE_STORE_BUCKET_SLOTS entries,
+ * a key which doesn't fit into its bucket goes to the next one. The partition
+ * is rebuilt with twice as many buckets when it is 3/4 full. Threads lock
+ * partitions separately, so only threads appending new pages wait for each
+ * other.
+ *
+ * Pages are added to the store by one process at a time, which holds
+ * "write.lock". Pages of backups taken meanwhile are not deduplicated. Packs
+ * left without an index by the failed writer are recovered by the next one.
+ * Pack indexes are the primary data, page_store_gc() builds the partitions
+ * from them anew.
+ *
+ * Processes using the store create pin files "pin_<pid>", page_store_gc()
+ * creates "gc.lock" and does not run while the store is pinned.
+ *
+ * Portions Copyright (c) 2019, Postgres Professional
+ *
+ *-------------------------------------------------------------------------
+ */
+
+#include "pg_probackup.h"
+
+#include <dirent.h>
+#include <signal.h>
+#include <sys/stat.h>
+#include <unistd.h>
+
+#include "utils/thread.h"
+
+#define PAGE_STORE_PACK_MAGIC		0x50535031	/* "PSP1" */
+#define PAGE_STORE_INDEX_MAGIC		0x50535832	/* "PSX2" */
+#define PAGE_STORE_PARTITION_MAGIC	0x50535431	/* "PST1" */
+
+/* Pages are not appended to a pack beyond this size */
+#define PAGE_STORE_PACK_SIZE	((uint32) 1024 * 1024 * 1024)
+
+#define PAGE_STORE_PARTITIONS	256
+#define PAGE_STORE_BUCKET_SLOTS	128
+#define PAGE_STORE_BUCKET_SIZE	\
+	(PAGE_STORE_BUCKET_SLOTS * sizeof(PageStoreIndexEntry))
+#define PAGE_STORE_MIN_BUCKETS	16
+
+#define PAGE_STORE_GC_LOCK		"gc.lock"
+#define PAGE_STORE_WRITE_LOCK	"write.lock"
+
+#define key_partition(key)		((uint32) ((key)->hash >> 56))
+
+typedef struct PageStorePackHeader
+{
+	uint32		magic;
+	uint32		block_size;
+} PageStorePackHeader;
+
+typedef struct PageStoreEntryHeader
+{
+	PageStoreKey key;
+	uint32		compress_alg;
+	int32		compressed_size;	/* BLCKSZ if the page is not compressed */
+} PageStoreEntryHeader;
+
+/* Entry of a pack index and slot of a partition, pack 0 marks a free slot */
+typedef struct PageStoreIndexEntry
+{
+	PageStoreKey key;
+	uint32		pack;
+	uint32		offset;			/* offset of PageStoreEntryHeader */
+	uint32		size;			/* size of the entry with the header */
+	uint32		padding;
+} PageStoreIndexEntry;
+
+typedef struct PageStoreIndexHeader
+{
+	uint32		magic;
+	uint32		n_entries;
+} PageStoreIndexHeader;
+
+/* Header of a partition, takes the place of one bucket */
+typedef struct PageStorePartitionHeader
+{
+	uint32		magic;
+	uint32		n_buckets;		/* power of 2 */
+	uint64		n_entries;		/* may be less than actual after a crash */
+} PageStorePartitionHeader;
+
+typedef struct PageStorePartition
+{
+	pthread_mutex_t mutex;
+	bool		loaded;
+	int			fd;				/* -1 if the partition is absent */
+	uint32		n_buckets;
+	uint64		n_entries;
+	bool		changed;		/* entries were added since the last sync */
+} PageStorePartition;
+
+/* Pack left without an index, its pages beyond "end" are lost */
+typedef struct PageStoreRecoveredPack
+{
+	uint32		pack;
+	uint32		end;
+} PageStoreRecoveredPack;
+
+/* Statistics of a pack collected by page_store_gc() */
+typedef enum PageStorePackAction
+{
+	PACK_ABSENT = 0,
+	PACK_KEEP,
+	PACK_REWRITE,
+	PACK_REMOVE
+} PageStorePackAction;
+
+typedef struct PageStorePackStat
+{
+	PageStorePackAction action;
+	uint32		n_entries;
+	uint32		n_live;
+	uint64		total_size;
+	uint64		live_size;
+} PageStorePackStat;
+
+typedef enum PageStoreWriter
+{
+	WRITER_UNKNOWN = 0,
+	WRITER_YES,
+	WRITER_NO
+} PageStoreWriter;
+
+/*
+ * State of the store in this process. Flags are set under page_store_mutex
+ * and checked without it.
+ */
+static volatile bool store_opened = false;
+static volatile PageStoreWriter store_writer = WRITER_UNKNOWN;
+static bool pin_created = false;
+static bool write_locked = false;
+static bool gc_locked = false;
+static bool unlock_registered = false;
+static bool partitions_initialized = false;
+
+static pthread_mutex_t page_store_mutex = PTHREAD_MUTEX_INITIALIZER;
+
+/* Fields of each partition are protected by its mutex */
+static PageStorePartition partitions[PAGE_STORE_PARTITIONS];
+
+/* Read descriptors of packs, indexed by pack number */
+static int *pack_fds = NULL;
+static uint32 n_pack_fds = 0;
+/* The greatest pack number in the store */
+static uint32 last_pack = 0;
+
+/* Pack written by this process */
+static uint32 cur_pack = 0;
+static int	cur_pack_fd = -1;
+static uint32 cur_pack_size = 0;
+static PageStoreIndexEntry *cur_entries = NULL;
+static uint32 n_cur_entries = 0;
+static uint32 max_cur_entries = 0;
+
+/* Protects pack variables above */
+static pthread_mutex_t pack_mutex = PTHREAD_MUTEX_INITIALIZER;
+
+static void page_store_open(void);
+static void page_store_reset(void);
+static void page_store_append(const PageStoreEntryHeader *header,
+							  const char *data, PageStoreIndexEntry *entry);
+static void page_store_finish_pack(void);
+static void page_store_mark_file(const char *path, FILE **spill);
+
+/*
+ * 64-bit hash of the page contents. It is complemented with CRC32C of the page
+ * to form the store key. Pages with the same key are considered equal, their
+ * contents are not compared.
+ */
+static uint64
+page_hash(const char *page)
+{
+	uint64		h = UINT64CONST(0x9E3779B97F4A7C15);
+	int			i;
+
+	for (i = 0; i < BLCKSZ; i += sizeof(uint64))
+	{
+		uint64		k;
+
+		memcpy(&k, page + i, sizeof(k));
+		k *= UINT64CONST(0x87C37B91114253D5);
+		k = (k << 31) | (k >> 33);
+		h ^= k * UINT64CONST(0x4CF5AD432745937F);
+		h = ((h << 27) | (h >> 37)) * 5 + 0x52DCE729;
+	}
+
+	h ^= h >> 33;
+	h *= UINT64CONST(0xFF51AFD7ED558CCD);
+	h ^= h >> 33;
+	h *= UINT64CONST(0xC4CEB9FE1A85EC53);
+	h ^= h >> 33;
+
+	return h;
+}
+
+/*
+ * Compute the key of the uncompressed page.
+ */
+void
+page_store_key(const char *page, PageStoreKey *key)
+{
+	key->hash = page_hash(page);
+	INIT_CRC32C(key->crc);
+	COMP_CRC32C(key->crc, page, BLCKSZ);
+	FIN_CRC32C(key->crc);
+	key->padding = 0;
+}
+
+static int
+key_compare(const PageStoreKey *key1, const PageStoreKey *key2)
+{
+	if (key1->hash != key2->hash)
+		return key1->hash > key2->hash ? 1 : -1;
+	if (key1->crc != key2->crc)
+		return key1->crc > key2->crc ? 1 : -1;
+	return 0;
+}
+
+static int
+key_qsort_compare(const void *a, const void *b)
+{
+	return key_compare((const PageStoreKey *) a, (const PageStoreKey *) b);
+}
+
+/* Compare index entries by key, then by location */
+static int
+entry_compare(const void *a, const void *b)
+{
+	const PageStoreIndexEntry *entry1 = (const PageStoreIndexEntry *) a;
+	const PageStoreIndexEntry *entry2 = (const PageStoreIndexEntry *) b;
+	int			res = key_compare(&entry1->key, &entry2->key);
+
+	if (res != 0)
+		return res;
+	if (entry1->pack != entry2->pack)
+		return entry1->pack > entry2->pack ? 1 : -1;
+	if (entry1->offset != entry2->offset)
+		return entry1->offset > entry2->offset ? 1 : -1;
+	return 0;
+}
+
+/* Compare index entries by location */
+static int
+entry_location_compare(const void *a, const void *b)
+{
+	const PageStoreIndexEntry *entry1 = (const PageStoreIndexEntry *) a;
+	const PageStoreIndexEntry *entry2 = (const PageStoreIndexEntry *) b;
+
+	if (entry1->pack != entry2->pack)
+		return entry1->pack > entry2->pack ? 1 : -1;
+	if (entry1->offset != entry2->offset)
+		return entry1->offset > entry2->offset ? 1 : -1;
+	return 0;
+}
+
+static void
+pack_file_path(uint32 pack, bool index, char *path, size_t len)
+{
+	snprintf(path, len, "%s/pack_%08X%s", page_store_path, pack,
+			 index ? ".idx" : "");
+}
+
+static void
+partition_file_path(uint32 partno, bool temp, char *path, size_t len)
+{
+	snprintf(path, len, "%s/index_%02X%s", page_store_path, partno,
+			 temp ? ".tmp" : "");
+}
+
+/*
+ * Uncompress the page of the pack entry into "page" and check that it matches
+ * the key of the entry.
+ */
+static bool
+decode_entry(const PageStoreEntryHeader *header, const char *data, char *page)
+{
+	PageStoreKey page_key;
+
+	if (header->compressed_size == BLCKSZ)
+		memcpy(page, data, BLCKSZ);
+	else
+	{
+		const char *errormsg = NULL;
+
+		if (do_decompress(page, BLCKSZ, data, header->compressed_size,
+						  header->compress_alg, &errormsg) != BLCKSZ)
+			return false;
+	}
+
+	page_store_key(page, &page_key);
+	return key_compare(&page_key, &header->key) == 0;
+}
+
+/*
+ * Read index of the pack. Returns NULL if the index is absent or broken.
+ */
+static PageStoreIndexEntry *
+read_pack_index(uint32 pack, uint32 *n_entries)
+{
+	char		path[MAXPGPATH];
+	PageStoreIndexHeader header;
+	PageStoreIndexEntry *entries;
+	FILE	   *in;
+	uint32		i;
+
+	pack_file_path(pack, true, path, lengthof(path));
+
+	in = fopen(path, PG_BINARY_R);
+	if (in == NULL)
+	{
+		if (errno == ENOENT)
+			return NULL;
+		elog(ERROR, "Cannot open page store index \"%s\": %s",
+			 path, strerror(errno));
+	}
+
+	if (fread(&header, 1, sizeof(header), in) != sizeof(header) ||
+		header.magic != PAGE_STORE_INDEX_MAGIC)
+	{
+		fclose(in);
+		elog(WARNING, "Page store index \"%s\" is corrupted", path);
+		return NULL;
+	}
+
+	entries = (PageStoreIndexEntry *)
+		pgut_malloc(sizeof(PageStoreIndexEntry) * Max(header.n_entries, 1));
+	if (fread(entries, sizeof(PageStoreIndexEntry), header.n_entries,
+			  in) != header.n_entries)
+	{
+		fclose(in);
+		pg_free(entries);
+		elog(WARNING, "Page store index \"%s\" is corrupted", path);
+		return NULL;
+	}
+	fclose(in);
+
+	for (i = 0; i < header.n_entries; i++)
+		entries[i].pack = pack;
+
+	*n_entries = header.n_entries;
+	return entries;
+}
+
+/*
+ * Read entries of the pack which has no index and sync it. Reading stops at
+ * the first broken entry, contents of pages are checked against their keys.
+ */
+static PageStoreIndexEntry *
+scan_pack(uint32 pack, uint32 *n_entries)
+{
+	char		path[MAXPGPATH];
+	PageStorePackHeader pack_header;
+	PageStoreEntryHeader header;
+	PageStoreIndexEntry *entries = NULL;
+	uint32		max_entries = 0;
+	uint32		offset = sizeof(PageStorePackHeader);
+	FILE	   *in;
+
+	*n_entries = 0;
+	pack_file_path(pack, false, path, lengthof(path));
+
+	in = fopen(path, PG_BINARY_R);
+	if (in == NULL)
+		elog(ERROR, "Cannot open page store pack \"%s\": %s",
+			 path, strerror(errno));
+
+	if (fread(&pack_header, 1, sizeof(pack_header), in) != sizeof(pack_header) ||
+		pack_header.magic != PAGE_STORE_PACK_MAGIC ||
+		pack_header.block_size != BLCKSZ)
+	{
+		fclose(in);
+		return NULL;
+	}
+
+	while (fread(&header, 1, sizeof(header), in) == sizeof(header))
+	{
+		char		data[BLCKSZ];
+		char		page[BLCKSZ];
+
+		if (header.compressed_size <= 0 || header.compressed_size > BLCKSZ ||
+			fread(data, 1, header.compressed_size,
+				  in) != header.compressed_size ||
+			!decode_entry(&header, data, page))
+			break;
+
+		if (*n_entries == max_entries)
+		{
+			max_entries = Max(max_entries * 2, 1024);
+			entries = (PageStoreIndexEntry *)
+				pgut_realloc(entries, sizeof(PageStoreIndexEntry) * max_entries);
+		}
+		entries[*n_entries].key = header.key;
+		entries[*n_entries].pack = pack;
+		entries[*n_entries].offset = offset;
+		entries[*n_entries].size = sizeof(header) + header.compressed_size;
+		entries[*n_entries].padding = 0;
+		offset += entries[*n_entries].size;
+		(*n_entries)++;
+	}
+
+	if (fsync(fileno(in)) != 0)
+		elog(ERROR, "Cannot sync page store pack \"%s\": %s",
+			 path, strerror(errno));
+	fclose(in);
+
+	return entries;
+}
+
+/*
+ * Write index of the pack, replacing the existing one.
+ */
+static void
+write_pack_index(uint32 pack, PageStoreIndexEntry *entries, uint32 n_entries)
+{
+	char		path[MAXPGPATH];
+	char		tmp_path[MAXPGPATH];
+	PageStoreIndexHeader header;
+	FILE	   *out;
+
+	pack_file_path(pack, true, path, lengthof(path));
+	snprintf(tmp_path, lengthof(tmp_path), "%s.partial", path);
+
+	out = fopen(tmp_path, PG_BINARY_W);
+	if (out == NULL)
+		elog(ERROR, "Cannot create page store index \"%s\": %s",
+			 tmp_path, strerror(errno));
+
+	header.magic = PAGE_STORE_INDEX_MAGIC;
+	header.n_entries = n_entries;
+
+	if (fwrite(&header, 1, sizeof(header), out) != sizeof(header) ||
+		fwrite(entries, sizeof(PageStoreIndexEntry), n_entries,
+			   out) != n_entries ||
+		fflush(out) != 0 || fsync(fileno(out)) != 0)
+	{
+		int			errno_tmp = errno;
+
+		fclose(out);
+		unlink(tmp_path);
+		elog(ERROR, "Cannot write page store index \"%s\": %s",
+			 tmp_path, strerror(errno_tmp));
+	}
+
+	if (fclose(out) != 0 || rename(tmp_path, path) != 0)
+	{
+		int			errno_tmp = errno;
+
+		unlink(tmp_path);
+		elog(ERROR, "Cannot write page store index \"%s\": %s",
+			 path, strerror(errno_tmp));
+	}
+}
+
+static int
+pack_compare(const void *a, const void *b)
+{
+	uint32		pack1 = (uint32) (uintptr_t) *(void * const *) a;
+	uint32		pack2 = (uint32) (uintptr_t) *(void * const *) b;
+
+	if (pack1 > pack2)
+		return 1;
+	else if (pack1 < pack2)
+		return -1;
+	return 0;
+}
+
+/*
+ * List numbers of packs in the store in ascending order.
+ */
+static parray *
+list_packs(void)
+{
+	parray	   *packs = parray_new();
+	DIR		   *dir;
+	struct dirent *dent;
+
+	dir = opendir(page_store_path);
+	if (dir == NULL)
+	{
+		if (errno == ENOENT)
+			return packs;
+		elog(ERROR, "Cannot open page store directory \"%s\": %s",
+			 page_store_path, strerror(errno));
+	}
+
+	while ((dent = readdir(dir)) != NULL)
+	{
+		uint32		pack;
+		int			len = 0;
+
+		if (sscanf(dent->d_name, "pack_%8X%n", &pack, &len) != 1 ||
+			dent->d_name[len] != '\0' || pack == 0)
+			continue;
+
+		parray_append(packs, (void *) (uintptr_t) pack);
+		last_pack = Max(last_pack, pack);
+	}
+	closedir(dir);
+
+	parray_qsort(packs, pack_compare);
+
+	return packs;
+}
+
+/*
+ * Number of buckets of the partition holding "n_entries" entries, the
+ * partition is at most half full.
+ */
+static uint32
+partition_buckets(uint64 n_entries)
+{
+	uint32		n_buckets = PAGE_STORE_MIN_BUCKETS;
+
+	while ((uint64) n_buckets * PAGE_STORE_BUCKET_SLOTS < n_entries * 2)
+		n_buckets *= 2;
+
+	return n_buckets;
+}
+
+static off_t
+bucket_offset(uint32 bucket)
+{
+	/* The first bucket-sized block holds the header */
+	return (off_t) (bucket + 1) * PAGE_STORE_BUCKET_SIZE;
+}
+
+/*
+ * Open the partition file. The caller holds mutex of the partition.
+ */
+static void
+partition_load(uint32 partno)
+{
+	PageStorePartition *part = &partitions[partno];
+	PageStorePartitionHeader header;
+	char		path[MAXPGPATH];
+
+	if (part->loaded)
+		return;
+
+	part->n_buckets = 0;
+	part->n_entries = 0;
+	part->changed = false;
+
+	partition_file_path(partno, false, path, lengthof(path));
+	part->fd = open(path, (write_locked ? O_RDWR : O_RDONLY) | PG_BINARY, 0);
+	if (part->fd < 0)
+	{
+		if (errno != ENOENT)
+			elog(ERROR, "Cannot open page store index \"%s\": %s",
+				 path, strerror(errno));
+	}
+	else
+	{
+		if (pread(part->fd, &header, sizeof(header), 0) != sizeof(header) ||
+			header.magic != PAGE_STORE_PARTITION_MAGIC ||
+			header.n_buckets == 0 ||
+			(header.n_buckets & (header.n_buckets - 1)) != 0)
+			elog(ERROR, "Page store index \"%s\" is corrupted", path);
+
+		part->n_buckets = header.n_buckets;
+		part->n_entries = header.n_entries;
+	}
+
+	part->loaded = true;
+}
+
+/*
+ * Close the partition file, it is opened again on the next access. The caller
+ * holds mutex of the partition.
+ */
+static void
+partition_unload(uint32 partno)
+{
+	PageStorePartition *part = &partitions[partno];
+
+	if (part->loaded && part->fd >= 0)
+		close(part->fd);
+	part->fd = -1;
+	part->loaded = false;
+}
+
+/*
+ * Look the key up in the loaded partition. Returns true and fills "entry" if
+ * the key is found. Otherwise "free_pos" is set to the offset of the slot
+ * where the key should be added or to -1 if the partition is full or absent.
+ */
+static bool
+partition_lookup(uint32 partno, const PageStoreKey *key,
+				 PageStoreIndexEntry *entry, off_t *free_pos)
+{
+	PageStorePartition *part = &partitions[partno];
+	PageStoreIndexEntry slots[PAGE_STORE_BUCKET_SLOTS];
+	uint32		bucket;
+	uint32		n;
+
+	if (free_pos)
+		*free_pos = -1;
+
+	if (part->n_buckets == 0)
+		return false;
+
+	bucket = (uint32) key->hash & (part->n_buckets - 1);
+	for (n = 0; n < part->n_buckets; n++)
+	{
+		int			i;
+
+		if (pread(part->fd, slots, PAGE_STORE_BUCKET_SIZE,
+				  bucket_offset(bucket)) != PAGE_STORE_BUCKET_SIZE)
+			elog(ERROR, "Cannot read page store index %02X: %s",
+				 partno, strerror(errno));
+
+		for (i = 0; i < PAGE_STORE_BUCKET_SLOTS; i++)
+		{
+			if (slots[i].pack == 0)
+			{
+				if (free_pos)
+					*free_pos = bucket_offset(bucket) +
+						i * sizeof(PageStoreIndexEntry);
+				return false;
+			}
+
+			if (key_compare(&slots[i].key, key) == 0)
+			{
+				if (entry)
+					*entry = slots[i];
+				return true;
+			}
+		}
+
+		bucket = (bucket + 1) & (part->n_buckets - 1);
+	}
+
+	return false;
+}
+
+/*
+ * Read all entries of the loaded partition. The array has room for one more
+ * entry.
+ */
+static PageStoreIndexEntry *
+partition_read_entries(uint32 partno, size_t *n_entries)
+{
+	PageStorePartition *part = &partitions[partno];
+	PageStoreIndexEntry *entries;
+	PageStoreIndexEntry slots[PAGE_STORE_BUCKET_SLOTS];
+	size_t		max_entries = Max(part->n_entries, 1024);
+	uint32		bucket;
+
+	*n_entries = 0;
+	entries = (PageStoreIndexEntry *)
+		pgut_malloc(sizeof(PageStoreIndexEntry) * (max_entries + 1));
+
+	for (bucket = 0; bucket < part->n_buckets; bucket++)
+	{
+		int			i;
+
+		if (pread(part->fd, slots, PAGE_STORE_BUCKET_SIZE,
+				  bucket_offset(bucket)) != PAGE_STORE_BUCKET_SIZE)
+			elog(ERROR, "Cannot read page store index %02X: %s",
+				 partno, strerror(errno));
+
+		for (i = 0; i < PAGE_STORE_BUCKET_SLOTS; i++)
+		{
+			if (slots[i].pack == 0)
+				continue;
+
+			if (*n_entries == max_entries)
+			{
+				max_entries *= 2;
+				entries = (PageStoreIndexEntry *)
+					pgut_realloc(entries, sizeof(PageStoreIndexEntry) *
+								 (max_entries + 1));
+			}
+			entries[(*n_entries)++] = slots[i];
+		}
+	}
+
+	return entries;
+}
+
+/*
+ * Write the temporary partition file holding given entries, the first entry
+ * of a key is kept. partition_install() replaces the partition with it.
+ */
+static void
+partition_write_temp(uint32 partno, const PageStoreIndexEntry *entries,
+					 size_t n_entries)
+{
+	PageStorePartitionHeader header;
+	PageStoreIndexEntry *slots;
+	uint64		n_slots;
+	char		path[MAXPGPATH];
+	size_t		i;
+	FILE	   *out;
+
+	header.magic = PAGE_STORE_PARTITION_MAGIC;
+	header.n_buckets = partition_buckets(n_entries);
+	header.n_entries = 0;
+
+	/* The first slots are taken by the header */
+	n_slots = (uint64) header.n_buckets * PAGE_STORE_BUCKET_SLOTS;
+	slots = (PageStoreIndexEntry *)
+		pgut_malloc(PAGE_STORE_BUCKET_SIZE + n_slots * sizeof(PageStoreIndexEntry));
+	MemSet(slots, 0, PAGE_STORE_BUCKET_SIZE + n_slots * sizeof(PageStoreIndexEntry));
+
+	for (i = 0; i < n_entries; i++)
+	{
+		uint64		slot;
+
+		slot = ((uint32) entries[i].key.hash & (header.n_buckets - 1)) *
+			(uint64) PAGE_STORE_BUCKET_SLOTS;
+		while (slots[PAGE_STORE_BUCKET_SLOTS + slot].pack != 0 &&
+			   key_compare(&slots[PAGE_STORE_BUCKET_SLOTS + slot].key,
+						   &entries[i].key) != 0)
+			slot = (slot + 1) % n_slots;
+
+		if (slots[PAGE_STORE_BUCKET_SLOTS + slot].pack == 0)
+		{
+			slots[PAGE_STORE_BUCKET_SLOTS + slot] = entries[i];
+			header.n_entries++;
+		}
+	}
+	memcpy(slots, &header, sizeof(header));
+
+	partition_file_path(partno, true, path, lengthof(path));
+	out = fopen(path, PG_BINARY_W);
+	if (out == NULL)
+		elog(ERROR, "Cannot create page store index \"%s\": %s",
+			 path, strerror(errno));
+
+	if (fwrite(slots, sizeof(PageStoreIndexEntry),
+			   PAGE_STORE_BUCKET_SLOTS + n_slots,
+			   out) != PAGE_STORE_BUCKET_SLOTS + n_slots ||
+		fflush(out) != 0 || fsync(fileno(out)) != 0)
+	{
+		int			errno_tmp = errno;
+
+		fclose(out);
+		unlink(path);
+		elog(ERROR, "Cannot write page store index \"%s\": %s",
+			 path, strerror(errno_tmp));
+	}
+	if (fclose(out) != 0)
+		elog(ERROR, "Cannot write page store index \"%s\": %s",
+			 path, strerror(errno));
+
+	pg_free(slots);
+}
+
+/*
+ * Replace the partition with its temporary file, or remove it if "empty".
+ * The caller holds mutex of the partition.
+ */
+static void
+partition_install(uint32 partno, bool empty)
+{
+	char		path[MAXPGPATH];
+	char		tmp_path[MAXPGPATH];
+
+	partition_unload(partno);
+
+	partition_file_path(partno, false, path, lengthof(path));
+	if (empty)
+	{
+		if (unlink(path) != 0 && errno != ENOENT)
+			elog(ERROR, "Cannot remove page store index \"%s\": %s",
+				 path, strerror(errno));
+		return;
+	}
+
+	partition_file_path(partno, true, tmp_path, lengthof(tmp_path));
+	if (rename(tmp_path, path) != 0)
+		elog(ERROR, "Cannot rename page store index \"%s\" to \"%s\": %s",
+			 tmp_path, path, strerror(errno));
+}
+
+/*
+ * Add the entry, which is absent from the loaded partition, into the slot
+ * found by partition_lookup(). The partition is rebuilt if it is full. The
+ * caller holds mutex of the partition.
+ */
+static void
+partition_insert(uint32 partno, const PageStoreIndexEntry *entry,
+				 off_t free_pos)
+{
+	PageStorePartition *part = &partitions[partno];
+
+	if (free_pos < 0 ||
+		(part->n_entries + 1) * 4 >
+		(uint64) part->n_buckets * PAGE_STORE_BUCKET_SLOTS * 3)
+	{
+		PageStoreIndexEntry *entries;
+		size_t		n_entries;
+
+		entries = partition_read_entries(partno, &n_entries);
+		entries[n_entries++] = *entry;
+
+		partition_write_temp(partno, entries, n_entries);
+		partition_install(partno, false);
+		partition_load(partno);
+
+		pg_free(entries);
+		return;
+	}
+
+	if (pwrite(part->fd, entry, sizeof(PageStoreIndexEntry),
+			   free_pos) != sizeof(PageStoreIndexEntry))
+		elog(ERROR, "Cannot write page store index %02X: %s",
+			 partno, strerror(errno));
+
+	part->n_entries++;
+	part->changed = true;
+}
+
+/*
+ * Write the number of entries of the partition and sync it. The caller holds
+ * mutex of the partition.
+ */
+static void
+partition_sync(uint32 partno)
+{
+	PageStorePartition *part = &partitions[partno];
+	PageStorePartitionHeader header;
+
+	if (!part->loaded || !part->changed)
+		return;
+
+	header.magic = PAGE_STORE_PARTITION_MAGIC;
+	header.n_buckets = part->n_buckets;
+	header.n_entries = part->n_entries;
+
+	if (pwrite(part->fd, &header, sizeof(header), 0) != sizeof(header) ||
+		fsync(part->fd) != 0)
+		elog(ERROR, "Cannot write page store index %02X: %s",
+			 partno, strerror(errno));
+
+	part->changed = false;
+}
+
+/*
+ * Read PID from the lock file. Returns 0 if the file is absent or bogus.
+ */
+static pid_t
+read_lock_pid(const char *path)
+{
+	char		buffer[64];
+	FILE	   *in;
+	size_t		len;
+
+	in = fopen(path, PG_BINARY_R);
+	if (in == NULL)
+	{
+		if (errno == ENOENT)
+			return 0;
+		elog(ERROR, "Cannot open lock file \"%s\": %s", path, strerror(errno));
+	}
+	len = fread(buffer, 1, sizeof(buffer) - 1, in);
+	fclose(in);
+
+	buffer[len] = '\0';
+	return (pid_t) atoi(buffer);
+}
+
+/*
+ * Is the process with given PID, other than ours, running?
+ */
+static bool
+process_is_running(pid_t pid)
+{
+	if (pid <= 0 || pid == getpid())
+		return false;
+	if (kill(pid, 0) == 0)
+		return true;
+	if (errno != ESRCH)
+		elog(ERROR, "Failed to send signal 0 to a process %d: %s",
+			 (int) pid, strerror(errno));
+	return false;
+}
+
+static void
+write_lock_file(const char *path, int flags)
+{
+	char		buffer[64];
+	int			fd;
+
+	fd = open(path, O_WRONLY | O_CREAT | flags | PG_BINARY, FILE_PERMISSION);
+	if (fd < 0)
+	{
+		if (errno == EEXIST)
+			return;
+		elog(ERROR, "Cannot create lock file \"%s\": %s", path,
+			 strerror(errno));
+	}
+
+	snprintf(buffer, sizeof(buffer), "%d\n", (int) getpid());
+	if (write(fd, buffer, strlen(buffer)) != strlen(buffer) || close(fd) != 0)
+		elog(ERROR, "Cannot write lock file \"%s\": %s", path,
+			 strerror(errno));
+}
+
+/*
+ * Take the exclusive lock file unless it is held by a running process. Returns
+ * PID of that process or 0 if the lock is taken.
+ */
+static pid_t
+take_lock_file(const char *path)
+{
+	while (true)
+	{
+		pid_t		pid;
+
+		write_lock_file(path, O_EXCL);
+
+		pid = read_lock_pid(path);
+		if (pid == getpid())
+			return 0;
+		if (process_is_running(pid))
+			return pid;
+
+		if (unlink(path) != 0 && errno != ENOENT)
+			elog(ERROR, "Cannot remove lock file \"%s\": %s", path,
+				 strerror(errno));
+	}
+}
+
+static void
+page_store_unlock_atexit(void)
+{
+	char		path[MAXPGPATH];
+
+	if (pin_created)
+	{
+		snprintf(path, lengthof(path), "%s/pin_%d", page_store_path,
+				 (int) getpid());
+		unlink(path);
+	}
+	if (write_locked)
+	{
+		join_path_components(path, page_store_path, PAGE_STORE_WRITE_LOCK);
+		unlink(path);
+	}
+	if (gc_locked)
+	{
+		join_path_components(path, page_store_path, PAGE_STORE_GC_LOCK);
+		unlink(path);
+	}
+}
+
+/*
+ * Pin the store, partitions are opened on the first access to them. The
+ * caller holds page_store_mutex.
+ */
+static void
+page_store_open(void)
+{
+	char		pin_path[MAXPGPATH];
+	char		lock_path[MAXPGPATH];
+	int			i;
+
+	if (store_opened)
+		return;
+
+	dir_create_dir(page_store_path, DIR_PERMISSION);
+
+	snprintf(pin_path, lengthof(pin_path), "%s/pin_%d", page_store_path,
+			 (int) getpid());
+	join_path_components(lock_path, page_store_path, PAGE_STORE_GC_LOCK);
+
+	if (!unlock_registered)
+	{
+		atexit(page_store_unlock_atexit);
+		unlock_registered = true;
+	}
+
+	/* Pin the store first and then check that cleanup is not running */
+	while (true)
+	{
+		pid_t		gc_pid;
+
+		write_lock_file(pin_path, O_TRUNC);
+		pin_created = true;
+
+		gc_pid = read_lock_pid(lock_path);
+		if (!process_is_running(gc_pid))
+			break;
+
+		unlink(pin_path);
+		pin_created = false;
+
+		if (interrupted)
+			elog(ERROR, "Interrupted while waiting for page store cleanup");
+		elog(LOG, "Waiting for page store cleanup by process %d",
+			 (int) gc_pid);
+		sleep(1);
+	}
+
+	if (!partitions_initialized)
+	{
+		for (i = 0; i < PAGE_STORE_PARTITIONS; i++)
+		{
+			pthread_mutex_init(&partitions[i].mutex, NULL);
+			partitions[i].loaded = false;
+			partitions[i].fd = -1;
+		}
+		partitions_initialized = true;
+	}
+
+	pg_write_barrier();
+	store_opened = true;
+}
+
+static void
+page_store_ensure_open(void)
+{
+	if (!store_opened)
+	{
+		pthread_lock(&page_store_mutex);
+		page_store_open();
+		pthread_mutex_unlock(&page_store_mutex);
+	}
+	pg_read_barrier();
+}
+
+/*
+ * Forget the state of the store, packs may be changed by page_store_gc().
+ * Must not be called while other threads use the store.
+ */
+static void
+page_store_reset(void)
+{
+	uint32		i;
+
+	for (i = 0; i < n_pack_fds; i++)
+		if (pack_fds[i] > 0)
+			close(pack_fds[i]);
+	pg_free(pack_fds);
+	pack_fds = NULL;
+	n_pack_fds = 0;
+
+	if (partitions_initialized)
+		for (i = 0; i < PAGE_STORE_PARTITIONS; i++)
+			partition_unload(i);
+
+	store_writer = WRITER_UNKNOWN;
+	store_opened = false;
+}
+
+/*
+ * Write indexes of packs left without them by failed processes. Returns array
+ * of recovered packs. The caller holds the write or the cleanup lock.
+ */
+static parray *
+page_store_recover_packs(void)
+{
+	parray	   *recovered = parray_new();
+	parray	   *packs = list_packs();
+	int			i;
+
+	for (i = 0; i < parray_num(packs); i++)
+	{
+		uint32		pack = (uint32) (uintptr_t) parray_get(packs, i);
+		PageStoreRecoveredPack *rec;
+		PageStoreIndexEntry *entries;
+		uint32		n_entries;
+		char		path[MAXPGPATH];
+
+		pack_file_path(pack, true, path, lengthof(path));
+		if (access(path, F_OK) == 0)
+			continue;
+
+		entries = scan_pack(pack, &n_entries);
+		if (n_entries > 0)
+			write_pack_index(pack, entries, n_entries);
+		else
+		{
+			pack_file_path(pack, false, path, lengthof(path));
+			if (unlink(path) != 0)
+				elog(ERROR, "Cannot remove page store pack \"%s\": %s",
+					 path, strerror(errno));
+		}
+
+		elog(LOG, "Page store pack %08X is recovered, %u pages", pack,
+			 n_entries);
+
+		rec = pgut_new(PageStoreRecoveredPack);
+		rec->pack = pack;
+		rec->end = n_entries > 0 ?
+			entries[n_entries - 1].offset + entries[n_entries - 1].size : 0;
+		parray_append(recovered, rec);
+
+		pg_free(entries);
+	}
+	parray_free(packs);
+
+	return recovered;
+}
+
+/*
+ * Remove entries referring to lost pages of recovered packs from partitions.
+ */
+static void
+page_store_purge_partitions(parray *recovered)
+{
+	uint32		partno;
+
+	for (partno = 0; partno < PAGE_STORE_PARTITIONS; partno++)
+	{
+		PageStoreIndexEntry *entries;
+		size_t		n_entries;
+		size_t		n_kept = 0;
+		size_t		i;
+
+		pthread_lock(&partitions[partno].mutex);
+		partition_load(partno);
+
+		entries = partition_read_entries(partno, &n_entries);
+		for (i = 0; i < n_entries; i++)
+		{
+			bool		lost = false;
+			int			j;
+
+			for (j = 0; j < parray_num(recovered); j++)
+			{
+				PageStoreRecoveredPack *rec = parray_get(recovered, j);
+
+				if (entries[i].pack == rec->pack &&
+					entries[i].offset + entries[i].size > rec->end)
+					lost = true;
+			}
+
+			if (!lost)
+				entries[n_kept++] = entries[i];
+		}
+
+		if (n_kept < n_entries)
+		{
+			if (n_kept > 0)
+				partition_write_temp(partno, entries, n_kept);
+			partition_install(partno, n_kept == 0);
+		}
+
+		pg_free(entries);
+		pthread_mutex_unlock(&partitions[partno].mutex);
+	}
+}
+
+/*
+ * Take the write lock of the store on the first call. Returns false if pages
+ * are added to the store by another process.
+ */
+static bool
+page_store_open_write(void)
+{
+	if (store_writer == WRITER_UNKNOWN)
+	{
+		pthread_lock(&page_store_mutex);
+
+		if (store_writer == WRITER_UNKNOWN)
+		{
+			char		lock_path[MAXPGPATH];
+			pid_t		pid;
+
+			page_store_open();
+
+			join_path_components(lock_path, page_store_path,
+								 PAGE_STORE_WRITE_LOCK);
+			pid = take_lock_file(lock_path);
+			if (pid != 0)
+			{
+				elog(WARNING, "Page store is written by process %d, pages are not deduplicated",
+					 (int) pid);
+				pg_write_barrier();
+				store_writer = WRITER_NO;
+			}
+			else
+			{
+				parray	   *recovered;
+				int			i;
+
+				write_locked = true;
+
+				/* Partitions are opened for writing from now on */
+				for (i = 0; i < PAGE_STORE_PARTITIONS; i++)
+				{
+					pthread_lock(&partitions[i].mutex);
+					partition_unload(i);
+					pthread_mutex_unlock(&partitions[i].mutex);
+				}
+
+				recovered = page_store_recover_packs();
+				if (parray_num(recovered) > 0)
+					page_store_purge_partitions(recovered);
+				parray_walk(recovered, pfree);
+				parray_free(recovered);
+
+				pg_write_barrier();
+				store_writer = WRITER_YES;
+			}
+		}
+
+		pthread_mutex_unlock(&page_store_mutex);
+	}
+	pg_read_barrier();
+
+	return store_writer == WRITER_YES;
+}
+
+static void
+pack_fds_reserve(uint32 pack)
+{
+	if (pack >= n_pack_fds)
+	{
+		uint32		n = Max(pack + 1, n_pack_fds * 2);
+
+		pack_fds = (int *) pgut_realloc(pack_fds, sizeof(int) * n);
+		MemSet(pack_fds + n_pack_fds, 0, sizeof(int) * (n - n_pack_fds));
+		n_pack_fds = n;
+	}
+}
+
+/*
+ * Get read descriptor of the pack. The caller holds pack_mutex.
+ */
+static int
+pack_fd(uint32 pack)
+{
+	pack_fds_reserve(pack);
+
+	if (pack_fds[pack] <= 0)
+	{
+		char		path[MAXPGPATH];
+
+		pack_file_path(pack, false, path, lengthof(path));
+		pack_fds[pack] = open(path, O_RDONLY | PG_BINARY, 0);
+		if (pack_fds[pack] < 0)
+			elog(ERROR, "Cannot open page store pack \"%s\": %s",
+				 path, strerror(errno));
+	}
+
+	return pack_fds[pack];
+}
+
+/*
+ * Read the page of the index entry into "page" uncompressing it and check
+ * that it matches the key. Returns false if the page is broken.
+ */
+static bool
+page_store_read_entry(const PageStoreIndexEntry *entry, char *page)
+{
+	char		buf[sizeof(PageStoreEntryHeader) + BLCKSZ];
+	PageStoreEntryHeader *header = (PageStoreEntryHeader *) buf;
+	ssize_t		read_len;
+	int			fd;
+
+	pthread_lock(&pack_mutex);
+	fd = pack_fd(entry->pack);
+	pthread_mutex_unlock(&pack_mutex);
+
+	read_len = pread(fd, buf, sizeof(buf), entry->offset);
+
+	if (read_len < (ssize_t) sizeof(PageStoreEntryHeader) ||
+		header->compressed_size <= 0 ||
+		header->compressed_size > BLCKSZ ||
+		read_len < (ssize_t) (sizeof(PageStoreEntryHeader) +
+							  header->compressed_size) ||
+		key_compare(&header->key, &entry->key) != 0 ||
+		!decode_entry(header, buf + sizeof(PageStoreEntryHeader), page))
+	{
+		elog(WARNING, "Page at offset %u of page store pack %08X is corrupted",
+			 entry->offset, entry->pack);
+		return false;
+	}
+
+	return true;
+}
+
+/*
+ * Append the entry to the pack of this process, starting a new pack if
+ * needed, and fill index entry of it. The caller holds pack_mutex.
+ */
+static void
+page_store_append(const PageStoreEntryHeader *header, const char *data,
+				  PageStoreIndexEntry *entry)
+{
+	char		buf[sizeof(PageStoreEntryHeader) + BLCKSZ];
+	uint32		size = sizeof(PageStoreEntryHeader) + header->compressed_size;
+
+	if (cur_pack != 0 && cur_pack_size + size > PAGE_STORE_PACK_SIZE)
+		page_store_finish_pack();
+
+	if (cur_pack == 0)
+	{
+		PageStorePackHeader pack_header;
+		char		path[MAXPGPATH];
+
+		dir_create_dir(page_store_path, DIR_PERMISSION);
+
+		/* Cleanup may create packs concurrently */
+		for (cur_pack = last_pack + 1;; cur_pack++)
+		{
+			pack_file_path(cur_pack, false, path, lengthof(path));
+			cur_pack_fd = open(path, O_RDWR | O_CREAT | O_EXCL | PG_BINARY,
+							   FILE_PERMISSION);
+			if (cur_pack_fd >= 0)
+				break;
+			if (errno != EEXIST)
+				elog(ERROR, "Cannot create page store pack \"%s\": %s",
+					 path, strerror(errno));
+		}
+		last_pack = cur_pack;
+
+		pack_header.magic = PAGE_STORE_PACK_MAGIC;
+		pack_header.block_size = BLCKSZ;
+		if (write(cur_pack_fd, &pack_header,
+				  sizeof(pack_header)) != sizeof(pack_header))
+			elog(ERROR, "Cannot write page store pack \"%s\": %s",
+				 path, strerror(errno));
+		cur_pack_size = sizeof(pack_header);
+		n_cur_entries = 0;
+
+		/* Pages of the pack are read through the same descriptor */
+		pack_fds_reserve(cur_pack);
+		pack_fds[cur_pack] = cur_pack_fd;
+	}
+
+	memcpy(buf, header, sizeof(PageStoreEntryHeader));
+	memcpy(buf + sizeof(PageStoreEntryHeader), data, header->compressed_size);
+
+	if (pwrite(cur_pack_fd, buf, size, cur_pack_size) != size)
+		elog(ERROR, "Cannot write page store pack %08X: %s",
+			 cur_pack, strerror(errno));
+
+	entry->key = header->key;
+	entry->pack = cur_pack;
+	entry->offset = cur_pack_size;
+	entry->size = size;
+	entry->padding = 0;
+	cur_pack_size += size;
+
+	if (n_cur_entries == max_cur_entries)
+	{
+		max_cur_entries = Max(max_cur_entries * 2, 1024);
+		cur_entries = (PageStoreIndexEntry *)
+			pgut_realloc(cur_entries,
+						 sizeof(PageStoreIndexEntry) * max_cur_entries);
+	}
+	cur_entries[n_cur_entries++] = *entry;
+}
+
+/*
+ * Sync the pack of this process and write its index. The caller holds
+ * pack_mutex.
+ */
+static void
+page_store_finish_pack(void)
+{
+	if (cur_pack == 0)
+		return;
+
+	if (fsync(cur_pack_fd) != 0)
+		elog(ERROR, "Cannot sync page store pack %08X: %s",
+			 cur_pack, strerror(errno));
+
+	write_pack_index(cur_pack, cur_entries, n_cur_entries);
+
+	elog(LOG, "Page store pack %08X is written, %u pages", cur_pack,
+		 n_cur_entries);
+
+	/* The descriptor stays in pack_fds for reading */
+	cur_pack = 0;
+	cur_pack_fd = -1;
+	n_cur_entries = 0;
+}
+
+/*
+ * Finish the pack written by this process, sync partitions and release the
+ * write lock. Must be called before the backup which added pages is
+ * completed.
+ */
+void
+page_store_close(void)
+{
+	pthread_lock(&pack_mutex);
+	page_store_finish_pack();
+	pthread_mutex_unlock(&pack_mutex);
+
+	pthread_lock(&page_store_mutex);
+
+	if (store_writer == WRITER_YES)
+	{
+		char		lock_path[MAXPGPATH];
+		int			i;
+
+		for (i = 0; i < PAGE_STORE_PARTITIONS; i++)
+		{
+			pthread_lock(&partitions[i].mutex);
+			partition_sync(i);
+			partition_unload(i);
+			pthread_mutex_unlock(&partitions[i].mutex);
+		}
+
+		join_path_components(lock_path, page_store_path,
+							 PAGE_STORE_WRITE_LOCK);
+		unlink(lock_path);
+		write_locked = false;
+	}
+	store_writer = WRITER_UNKNOWN;
+
+	pthread_mutex_unlock(&page_store_mutex);
+}
+
+/*
+ * Put the page into the store, unless its key is already there. "data" is the
+ * page as it is written into backup file: compressed with "alg", or the raw
+ * page if size is BLCKSZ. Returns true if the store contains the page on exit
+ * and the backup may refer to it instead of storing the page itself.
+ */
+bool
+page_store_put(const PageStoreKey *key, const char *data, int32 size,
+			   CompressAlg alg)
+{
+	uint32		partno = key_partition(key);
+	off_t		free_pos;
+
+	if (!page_store_open_write())
+		return false;
+
+	pthread_lock(&partitions[partno].mutex);
+	partition_load(partno);
+
+	if (!partition_lookup(partno, key, NULL, &free_pos))
+	{
+		PageStoreEntryHeader header;
+		PageStoreIndexEntry entry;
+
+		header.key = *key;
+		header.compress_alg = alg;
+		header.compressed_size = size;
+
+		pthread_lock(&pack_mutex);
+		page_store_append(&header, data, &entry);
+		pthread_mutex_unlock(&pack_mutex);
+
+		partition_insert(partno, &entry, free_pos);
+	}
+
+	pthread_mutex_unlock(&partitions[partno].mutex);
+
+	return true;
+}
+
+/*
+ * Read the page with given key from the store into "page" uncompressing it.
+ * Returns false if the page is absent or broken.
+ */
+bool
+page_store_get(const PageStoreKey *key, char *page)
+{
+	uint32		partno = key_partition(key);
+	PageStoreIndexEntry entry;
+	bool		found;
+
+	page_store_ensure_open();
+
+	pthread_lock(&partitions[partno].mutex);
+	partition_load(partno);
+	found = partition_lookup(partno, key, &entry, NULL);
+	pthread_mutex_unlock(&partitions[partno].mutex);
+
+	if (!found)
+		return false;
+
+	return page_store_read_entry(&entry, page);
+}
+
+/*
+ * Temporary files of page_store_gc(), one for each partition.
+ */
+static void
+gc_file_path(const char *prefix, uint32 partno, char *path, size_t len)
+{
+	snprintf(path, len, "%s/gc_%s_%02X", page_store_path, prefix, partno);
+}
+
+static void
+gc_files_open(const char *prefix, FILE **files)
+{
+	uint32		partno;
+
+	for (partno = 0; partno < PAGE_STORE_PARTITIONS; partno++)
+	{
+		char		path[MAXPGPATH];
+
+		gc_file_path(prefix, partno, path, lengthof(path));
+		files[partno] = fopen(path, PG_BINARY_W);
+		if (files[partno] == NULL)
+			elog(ERROR, "Cannot create file \"%s\": %s", path,
+				 strerror(errno));
+	}
+}
+
+static void
+gc_files_close(const char *prefix, FILE **files)
+{
+	uint32		partno;
+
+	for (partno = 0; partno < PAGE_STORE_PARTITIONS; partno++)
+	{
+		if (fclose(files[partno]) != 0)
+		{
+			char		path[MAXPGPATH];
+
+			gc_file_path(prefix, partno, path, lengthof(path));
+			elog(ERROR, "Cannot write file \"%s\": %s", path,
+				 strerror(errno));
+		}
+	}
+}
+
+static void
+gc_file_write(FILE *out, const void *item, size_t size)
+{
+	if (fwrite(item, 1, size, out) != size)
+		elog(ERROR, "Cannot write temporary file of page store cleanup: %s",
+			 strerror(errno));
+}
+
+/*
+ * Read items of the temporary file of the partition and remove the file.
+ */
+static void *
+gc_file_read(const char *prefix, uint32 partno, size_t item_size,
+			 size_t *n_items)
+{
+	char		path[MAXPGPATH];
+	struct stat	st;
+	char	   *items;
+	FILE	   *in;
+
+	gc_file_path(prefix, partno, path, lengthof(path));
+	in = fopen(path, PG_BINARY_R);
+	if (in == NULL)
+		elog(ERROR, "Cannot open file \"%s\": %s", path, strerror(errno));
+	if (fstat(fileno(in), &st) != 0)
+		elog(ERROR, "Cannot stat file \"%s\": %s", path, strerror(errno));
+
+	*n_items = st.st_size / item_size;
+	items = pgut_malloc(Max(*n_items * item_size, 1));
+	if (fread(items, item_size, *n_items, in) != *n_items)
+		elog(ERROR, "Cannot read file \"%s\": %s", path, strerror(errno));
+	fclose(in);
+
+	if (unlink(path) != 0)
+		elog(ERROR, "Cannot remove file \"%s\": %s", path, strerror(errno));
+
+	return items;
+}
+
+/*
+ * Write keys of pages referenced by the backup file into files of their
+ * partitions.
+ */
+static void
+page_store_mark_file(const char *path, FILE **spill)
+{
+	FILE	   *in;
+	BackupPageHeader header;
+
+	in = fopen(path, PG_BINARY_R);
+	if (in == NULL)
+	{
+		if (errno == ENOENT)
+			return;
+		elog(ERROR, "Cannot open backup file \"%s\": %s", path,
+			 strerror(errno));
+	}
+
+	while (fread(&header, 1, sizeof(header), in) == sizeof(header))
+	{
+		if (interrupted)
+			elog(ERROR, "Interrupted during page store cleanup");
+
+		if (header.compressed_size == PageIsDeduplicated)
+		{
+			PageStoreKey key;
+
+			if (fread(&key, 1, sizeof(key), in) != sizeof(key))
+				break;
+
+			gc_file_write(spill[key_partition(&key)], &key, sizeof(key));
+		}
+		else if (header.compressed_size > 0)
+		{
+			if (fseek(in, MAXALIGN(header.compressed_size), SEEK_CUR) != 0)
+				break;
+		}
+	}
+
+	fclose(in);
+}
+
+/*
+ * Take the cleanup lock. Returns false if the store is used by other
+ * processes.
+ */
+static bool
+page_store_lock_gc(void)
+{
+	char		lock_path[MAXPGPATH];
+	DIR		   *dir;
+	struct dirent *dent;
+	pid_t		pid;
+	bool		busy = false;
+
+	join_path_components(lock_path, page_store_path, PAGE_STORE_GC_LOCK);
+
+	if (!unlock_registered)
+	{
+		atexit(page_store_unlock_atexit);
+		unlock_registered = true;
+	}
+
+	pid = take_lock_file(lock_path);
+	if (pid != 0)
+	{
+		elog(WARNING, "Page store is being cleaned up by process %d, skip page store cleanup",
+			 (int) pid);
+		return false;
+	}
+	gc_locked = true;
+
+	/* Processes pin the store first and then check the cleanup lock */
+	dir = opendir(page_store_path);
+	if (dir == NULL)
+		elog(ERROR, "Cannot open page store directory \"%s\": %s",
+			 page_store_path, strerror(errno));
+
+	while (!busy && (dent = readdir(dir)) != NULL)
+	{
+		int			pin_pid;
+		char		pin_path[MAXPGPATH];
+
+		if (sscanf(dent->d_name, "pin_%d", &pin_pid) != 1)
+			continue;
+
+		if (process_is_running((pid_t) pin_pid))
+		{
+			elog(WARNING, "Page store is used by process %d, skip page store cleanup",
+				 pin_pid);
+			busy = true;
+		}
+		else if (pin_pid != getpid())
+		{
+			join_path_components(pin_path, page_store_path, dent->d_name);
+			unlink(pin_path);
+		}
+	}
+	closedir(dir);
+
+	if (busy)
+	{
+		unlink(lock_path);
+		gc_locked = false;
+		return false;
+	}
+
+	return true;
+}
+
+/*
+ * Remove pages, which are not referenced by backups anymore.
+ *
+ * Keys referenced by backups which use the store and entries of pack indexes
+ * are written into temporary files of their partitions first, so only one
+ * partition at a time is kept in memory. Packs without referenced pages are
+ * removed, packs where unreferenced pages take at least a half are rewritten:
+ * their referenced pages are appended to new packs. Partitions are built from
+ * the referenced entries and replace the old ones when the new packs are
+ * synced, the old packs are removed after that.
+ */
+void
+page_store_gc(void)
+{
+	parray	   *backup_list;
+	parray	   *packs = NULL;
+	parray	   *recovered = NULL;
+	PageStorePackStat *stats = NULL;
+	uint32		n_stats;
+	FILE	   *spill[PAGE_STORE_PARTITIONS];
+	bool		partition_empty[PAGE_STORE_PARTITIONS];
+	char		lock_path[MAXPGPATH];
+	uint64		n_removed = 0;
+	uint32		n_rewritten = 0;
+	uint32		n_obsolete = 0;
+	uint32		partno;
+	uint32		pack;
+	int			i;
+
+	if (fio_access(page_store_path, F_OK, FIO_BACKUP_HOST) != 0)
+		return;
+
+	backup_list = catalog_get_backup_list(INVALID_BACKUP_ID);
+
+	for (i = 0; i < parray_num(backup_list); i++)
+	{
+		pgBackup   *backup = (pgBackup *) parray_get(backup_list, i);
+
+		if (backup->status == BACKUP_STATUS_RUNNING ||
+			backup->status == BACKUP_STATUS_MERGING)
+		{
+			elog(WARNING, "Backup %s is %s, skip page store cleanup",
+				 base36enc(backup->start_time), status2str(backup->status));
+			goto cleanup;
+		}
+	}
+
+	/* Pages of this process are not used after cleanup */
+	page_store_close();
+
+	pthread_lock(&page_store_mutex);
+	pthread_lock(&pack_mutex);
+	page_store_reset();
+
+	if (!page_store_lock_gc())
+	{
+		pthread_mutex_unlock(&pack_mutex);
+		pthread_mutex_unlock(&page_store_mutex);
+		goto cleanup;
+	}
+
+	elog(INFO, "Cleanup page store \"%s\"", page_store_path);
+
+	/* Partitions are built from pack indexes, so recover them first */
+	recovered = page_store_recover_packs();
+
+	/* Keys referenced by backups */
+	gc_files_open("refs", spill);
+	for (i = 0; i < parray_num(backup_list); i++)
+	{
+		pgBackup   *backup = (pgBackup *) parray_get(backup_list, i);
+		char		database_path[MAXPGPATH];
+		char		list_path[MAXPGPATH];
+		FileListReader *reader;
+		pgFile	   *file;
+
+		if (!backup->page_dedup || backup->status == BACKUP_STATUS_DELETING ||
+			backup->status == BACKUP_STATUS_DELETED)
+			continue;
+
+		pgBackupGetPath(backup, database_path, lengthof(database_path),
+						DATABASE_DIR);
+		pgBackupGetPath(backup, list_path, lengthof(list_path),
+						DATABASE_FILE_LIST);
+		reader = open_file_list(list_path, FIO_BACKUP_HOST);
+
+		while ((file = read_file_list_entry(reader, database_path,
+											NULL)) != NULL)
+		{
+			if (S_ISREG(file->mode) && file->is_datafile && !file->is_cfs &&
+				file->write_size > 0)
+				page_store_mark_file(file->path, spill);
+			pgFileFree(file);
+		}
+
+		close_file_list(reader);
+	}
+	gc_files_close("refs", spill);
+
+	/* Entries of packs */
+	packs = list_packs();
+	/* New packs are not counted */
+	n_stats = last_pack + 1;
+	stats = (PageStorePackStat *)
+		pgut_malloc(sizeof(PageStorePackStat) * n_stats);
+	MemSet(stats, 0, sizeof(PageStorePackStat) * n_stats);
+
+	gc_files_open("entries", spill);
+	for (i = 0; i < parray_num(packs); i++)
+	{
+		PageStoreIndexEntry *entries;
+		uint32		n_entries;
+		uint32		j;
+
+		pack = (uint32) (uintptr_t) parray_get(packs, i);
+		entries = read_pack_index(pack, &n_entries);
+		if (entries == NULL)
+			continue;
+
+		stats[pack].action = PACK_KEEP;
+		stats[pack].n_entries = n_entries;
+		for (j = 0; j < n_entries; j++)
+		{
+			stats[pack].total_size += entries[j].size;
+			gc_file_write(spill[key_partition(&entries[j].key)],
+						  &entries[j], sizeof(PageStoreIndexEntry));
+		}
+		pg_free(entries);
+	}
+	gc_files_close("entries", spill);
+
+	/* Referenced entries of each partition, a page is kept once */
+	gc_files_open("live", spill);
+	for (partno = 0; partno < PAGE_STORE_PARTITIONS; partno++)
+	{
+		PageStoreKey *refs;
+		PageStoreIndexEntry *entries;
+		size_t		n_refs;
+		size_t		n_entries;
+		size_t		j;
+
+		if (interrupted)
+			elog(ERROR, "Interrupted during page store cleanup");
+
+		refs = gc_file_read("refs", partno, sizeof(PageStoreKey), &n_refs);
+		entries = gc_file_read("entries", partno, sizeof(PageStoreIndexEntry),
+							   &n_entries);
+		qsort(refs, n_refs, sizeof(PageStoreKey), key_qsort_compare);
+		qsort(entries, n_entries, sizeof(PageStoreIndexEntry), entry_compare);
+
+		for (j = 0; j < n_entries; j++)
+		{
+			if (j > 0 &&
+				key_compare(&entries[j].key, &entries[j - 1].key) == 0)
+				continue;
+			if (bsearch(&entries[j].key, refs, n_refs, sizeof(PageStoreKey),
+						key_qsort_compare) == NULL)
+				continue;
+
+			stats[entries[j].pack].n_live++;
+			stats[entries[j].pack].live_size += entries[j].size;
+			gc_file_write(spill[partno], &entries[j],
+						  sizeof(PageStoreIndexEntry));
+		}
+
+		pg_free(refs);
+		pg_free(entries);
+	}
+	gc_files_close("live", spill);
+
+	for (pack = 1; pack < n_stats; pack++)
+	{
+		if (stats[pack].action == PACK_ABSENT)
+			continue;
+
+		if (stats[pack].n_live == 0)
+			stats[pack].action = PACK_REMOVE;
+		/* Not worth rewriting */
+		else if (stats[pack].live_size * 2 > stats[pack].total_size)
+			continue;
+		else
+		{
+			stats[pack].action = PACK_REWRITE;
+			n_rewritten++;
+		}
+
+		n_removed += stats[pack].n_entries - stats[pack].n_live;
+		n_obsolete++;
+	}
+
+	/* Move referenced pages of rewritten packs and build partitions */
+	for (partno = 0; partno < PAGE_STORE_PARTITIONS; partno++)
+	{
+		PageStoreIndexEntry *entries;
+		size_t		n_entries;
+		size_t		j;
+
+		if (interrupted)
+			elog(ERROR, "Interrupted during page store cleanup");
+
+		entries = gc_file_read("live", partno, sizeof(PageStoreIndexEntry),
+							   &n_entries);
+		qsort(entries, n_entries, sizeof(PageStoreIndexEntry),
+			  entry_location_compare);
+
+		for (j = 0; j < n_entries; j++)
+		{
+			char		buf[sizeof(PageStoreEntryHeader) + BLCKSZ];
+			PageStoreEntryHeader *header = (PageStoreEntryHeader *) buf;
+
+			if (entries[j].pack >= n_stats ||
+				stats[entries[j].pack].action != PACK_REWRITE)
+				continue;
+
+			if (entries[j].size > sizeof(buf) ||
+				pread(pack_fd(entries[j].pack), buf, entries[j].size,
+					  entries[j].offset) != entries[j].size)
+				elog(ERROR, "Cannot read page at offset %u of page store pack %08X: %s",
+					 entries[j].offset, entries[j].pack, strerror(errno));
+
+			page_store_append(header, buf + sizeof(PageStoreEntryHeader),
+							  &entries[j]);
+		}
+
+		partition_empty[partno] = (n_entries == 0);
+		if (n_entries > 0)
+			partition_write_temp(partno, entries, n_entries);
+
+		pg_free(entries);
+	}
+
+	/* Replace partitions and remove old packs when new packs are synced */
+	page_store_finish_pack();
+
+	for (partno = 0; partno < PAGE_STORE_PARTITIONS; partno++)
+		partition_install(partno, partition_empty[partno]);
+
+	for (pack = 1; pack < n_stats; pack++)
+	{
+		char		path[MAXPGPATH];
+
+		if (stats[pack].action != PACK_REWRITE &&
+			stats[pack].action != PACK_REMOVE)
+			continue;
+
+		pack_file_path(pack, true, path, lengthof(path));
+		if (unlink(path) != 0 && errno != ENOENT)
+			elog(ERROR, "Cannot remove page store index \"%s\": %s",
+				 path, strerror(errno));
+		pack_file_path(pack, false, path, lengthof(path));
+		if (unlink(path) != 0)
+			elog(ERROR, "Cannot remove page store pack \"%s\": %s",
+				 path, strerror(errno));
+	}
+
+	elog(INFO, "Removed " UINT64_FORMAT " pages from the page store, %u packs are rewritten, %u packs are removed",
+		 n_removed, n_rewritten, n_obsolete - n_rewritten);
+
+	page_store_reset();
+
+	join_path_components(lock_path, page_store_path, PAGE_STORE_GC_LOCK);
+	unlink(lock_path);
+	gc_locked = false;
+
+	pthread_mutex_unlock(&pack_mutex);
+	pthread_mutex_unlock(&page_store_mutex);
+
+cleanup:
+	pg_free(stats);
+	if (recovered)
+	{
+		parray_walk(recovered, pfree);
+		parray_free(recovered);
+	}
+	if (packs)
+		parray_free(packs);
+	parray_walk(backup_list, pgBackupFree);
+	parray_free(backup_list);
+}
+
+/*
+ * Remove the page store of the instance entirely.
+ */
+void
+page_store_remove(void)
+{
+	parray	   *files;
+	int			i;
+
+	if (fio_access(page_store_path, F_OK, FIO_BACKUP_HOST) != 0)
+		return;
+
+	files = parray_new();
+	dir_list_file(files, page_store_path, false, false, true, 0,
+				  FIO_BACKUP_HOST);
+
+	/* delete leaf node first */
+	parray_qsort(files, pgFileComparePathDesc);
+	for (i = 0; i < parray_num(files); i++)
+		pgFileDelete((pgFile *) parray_get(files, i));
+
+	parray_walk(files, pgFileFree);
+	parray_free(files);
+}
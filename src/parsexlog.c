@@ -94,6 +94,58 @@ typedef struct XLogRecTarget
 	XLogRecPtr	rec_lsn;
 } XLogRecTarget;
 
+/*
+ * WalSummary describes WAL records which start within a single WAL segment:
+ * their LSN, xid and timestamp ranges and blocks of main relation forks
+ * modified by them. It is followed by n_blocks sorted WalSummaryBlock entries.
+ *
+ * Summaries are written by archive-push into WAL_SUMMARY_DIR of the archive,
+ * a file is named after its WAL segment. They allow to build a page map and
+ * to search a recovery target without decoding of archived segments.
+ */
+#define WAL_SUMMARY_MAGIC		0x57534D31		/* "WSM1" */
+
+/* Some record of the segment modifies a relation in unknown way */
+#define WAL_SUMMARY_UNKNOWN_REL_UPDATE	0x01
+
+typedef struct WalSummaryBlock
+{
+	RelFileNode	rnode;
+	BlockNumber	blkno;
+} WalSummaryBlock;
+
+typedef struct WalSummary
+{
+	uint32		magic;
+	uint32		flags;
+	XLogRecPtr	start_lsn;		/* first record of the segment */
+	XLogRecPtr	last_lsn;		/* last record of the segment */
+	XLogRecPtr	end_lsn;		/* end+1 of the last record */
+	TransactionId min_xid;		/* range of normal xids of the records */
+	TransactionId max_xid;
+	TransactionId last_xid;		/* last valid xid */
+	uint32		n_blocks;
+	TimestampTz	min_time;		/* range of timestamps of the records */
+	TimestampTz	max_time;
+	TimestampTz	last_time;		/* last timestamp */
+	uint32		seg_size;
+	pg_crc32	crc;			/* CRC of the summary with zero crc field */
+} WalSummary;
+
+/*
+ * WAL segment read into memory ahead of the decoding threads by a prefetch
+ * worker, see wal_prefetch_worker().
+ */
+typedef struct WalPrefetchSlot
+{
+	XLogSegNo	segno;
+	char	   *buf;			/* content of the segment */
+	bool		loaded;			/* false while the segment is being read */
+	bool		valid;			/* the whole segment was read */
+	bool		consumed;		/* the thread assigned to the segment took it */
+	int			pins;			/* number of threads reading the buffer */
+} WalPrefetchSlot;
+
 typedef struct XLogReaderData
 {
 	int			thread_num;
@@ -101,7 +153,13 @@ typedef struct XLogReaderData
 
 	XLogRecTarget cur_rec;
 	XLogSegNo	xlogsegno;
+	XLogSegNo	assigned_segno;	/* segment the thread has to decode */
 	bool		xlogexists;
+	WalPrefetchSlot *prefetch_slot;	/* prefetched segment being read */
+
+	/* Block references seen by extractPageInfo() and skipped by the filter */
+	uint64		n_block_refs;
+	uint64		n_block_refs_filtered;
 
 	char		 page_buf[XLOG_BLCKSZ];
 	uint32		 prev_page_off;
@@ -145,6 +203,43 @@ typedef struct
 	int			ret;
 } xlog_thread_arg;
 
+/* Result of sample_wal_segment() */
+typedef enum WalSegmentSample
+{
+	WAL_SEGMENT_INVALID,		/* segment is absent or has no valid record */
+	WAL_SEGMENT_NO_TIME,		/* segment has no record with a timestamp */
+	WAL_SEGMENT_TIME			/* timestamp of the segment is found */
+} WalSegmentSample;
+
+/* An argument for a thread building WAL summaries */
+typedef struct
+{
+	const char *archivedir;
+	TimeLineID	tli;
+	uint32		seg_size;
+	XLogSegNo	from_segno;
+	XLogSegNo	to_segno;
+	int			thread_num;
+
+	/*
+	 * Return value from the thread.
+	 * 0 means there is no error, 1 - there is an error.
+	 */
+	int			ret;
+} wal_summary_arg;
+
+/* An argument for a WAL prefetch thread */
+typedef struct
+{
+	int			thread_num;
+
+	/*
+	 * Return value from the thread.
+	 * 0 means there is no error, 1 - there is an error.
+	 */
+	int			ret;
+} wal_prefetch_arg;
+
 static int SimpleXLogPageRead(XLogReaderState *xlogreader,
 				   XLogRecPtr targetPagePtr,
 				   int reqLen, XLogRecPtr targetRecPtr, char *readBuf,
@@ -168,6 +263,10 @@ static bool SwitchThreadToNextWal(XLogReaderState *xlogreader,
 								  xlog_thread_arg *arg);
 static bool XLogWaitForConsistency(XLogReaderState *xlogreader);
 static void *XLogThreadWorker(void *arg);
+static void *wal_prefetch_worker(void *arg);
+static bool wal_prefetch_load(int thread_num, XLogSegNo segno, char *buf);
+static bool wal_prefetch_get(XLogReaderData *reader_data);
+static void wal_prefetch_release(WalPrefetchSlot *slot);
 static void CleanupXLogPageRead(XLogReaderState *xlogreader);
 static void PrintXLogCorruptionMsg(XLogReaderData *reader_data, int elevel);
 
@@ -176,6 +275,24 @@ static void extractPageInfo(XLogReaderState *record,
 static void validateXLogRecord(XLogReaderState *record,
 							   XLogReaderData *reader_data, bool *stop_reading);
 static bool getRecordTimestamp(XLogReaderState *record, TimestampTz *recordXtime);
+static bool IsUnknownRelUpdate(XLogReaderState *record);
+
+static bool build_wal_summary(const char *archivedir, TimeLineID tli,
+							  XLogSegNo segno, uint32 seg_size);
+static void build_wal_summaries(const char *archivedir, TimeLineID tli,
+								uint32 seg_size, XLogSegNo from_segno,
+								XLogSegNo to_segno);
+static void *build_wal_summaries_worker(void *arg);
+static WalSummary *read_wal_summary(const char *archivedir, TimeLineID tli,
+									XLogSegNo segno, uint32 seg_size);
+
+static WalSegmentSample sample_wal_segment(const char *archivedir,
+										   TimeLineID tli, XLogSegNo segno,
+										   uint32 seg_size, bool need_time,
+										   TimestampTz *first_time);
+static XLogSegNo seek_wal_target(const char *archivedir, TimeLineID tli,
+								 uint32 seg_size, time_t target_time,
+								 XLogRecPtr target_lsn, XLogSegNo from_segno);
 
 static XLogSegNo segno_start = 0;
 /* Segment number where target record is located */
@@ -188,6 +305,37 @@ static uint32 segnum_read = 0;
 static uint32 segnum_corrupted = 0;
 static pthread_mutex_t wal_segment_mutex = PTHREAD_MUTEX_INITIALIZER;
 
+/*
+ * Segments are read and decompressed by prefetch workers into memory ahead
+ * of the threads decoding them. Variables below are protected by
+ * wal_segment_mutex, wal_prefetch_cond is signaled when a segment is loaded
+ * or released and when decoding threads move on.
+ */
+#define WAL_PREFETCH_CHUNK	(XLOG_BLCKSZ * 8)
+/* Memory limit of prefetched segments */
+#define WAL_PREFETCH_MAX_MEMORY	((size_t) 256 * 1024 * 1024)
+/* Interval to check for interrupts while waiting on wal_prefetch_cond */
+#define WAL_PREFETCH_WAIT_MS	1000
+
+static pthread_cond_t wal_prefetch_cond = PTHREAD_COND_INITIALIZER;
+
+static bool wal_prefetch = false;
+/* Prefetched segments, see WalPrefetchSlot */
+static parray *wal_prefetch_slots = NULL;
+/* Next segment number to prefetch */
+static XLogSegNo prefetch_next = 0;
+/* Last segment number to prefetch, 0 if it is unknown */
+static XLogSegNo prefetch_end = 0;
+static TimeLineID prefetch_tli = 0;
+static bool prefetch_stop = false;
+static uint32 prefetch_count = 0;
+/* Memory reserved by prefetched segments */
+static size_t prefetch_memory = 0;
+
+/* Block references of the threads of extractPageMap() */
+static uint64 block_refs = 0;
+static uint64 block_refs_filtered = 0;
+
 /* copied from timestamp.c */
 static pg_time_t
 timestamptz_to_time_t(TimestampTz t)
@@ -228,7 +376,10 @@ static XLogRecPtr		wal_target_lsn = InvalidXLogRecPtr;
  * Read WAL from the archive directory, from 'startpoint' to 'endpoint' on the
  * given timeline. Collect data blocks touched by the WAL records into a page map.
  *
- * Pagemap extracting is processed using threads. Eeach thread reads single WAL
+ * Blocks of segments which have a summary in the archive are taken from the
+ * summary. Missing summaries of complete segments are built first, so that
+ * next backups don't decode them again. Other segments are decoded, pagemap
+ * extracting is processed using threads then. Eeach thread reads single WAL
  * file.
  */
 void
@@ -238,14 +389,105 @@ extractPageMap(const char *archivedir, TimeLineID tli, uint32 wal_seg_size,
 	bool		extract_isok = true;
 	time_t		start_time,
 				end_time;
+	XLogSegNo	start_segno,
+				end_segno,
+				segno;
+	XLogSegNo	run_start = 0;
+	bool		in_run = false;
+	uint32		n_summaries = 0;
 
 	elog(LOG, "Compiling pagemap");
 	time(&start_time);
 
-	extract_isok = RunXLogThreads(archivedir, 0, InvalidTransactionId,
-								  InvalidXLogRecPtr, tli, wal_seg_size,
-								  startpoint, endpoint, false, extractPageInfo,
-								  NULL);
+	block_refs = 0;
+	block_refs_filtered = 0;
+
+	GetXLogSegNo(startpoint, start_segno, wal_seg_size);
+	GetXLogSegNo(endpoint, end_segno, wal_seg_size);
+
+	/* The last segment may be incomplete yet, it is decoded */
+	if (end_segno > start_segno)
+		build_wal_summaries(archivedir, tli, wal_seg_size, start_segno,
+							end_segno - 1);
+
+	/*
+	 * Look one segment past end_segno to finish the last run of segments
+	 * without summaries.
+	 */
+	for (segno = start_segno; segno <= end_segno + 1; segno++)
+	{
+		WalSummary *summary = NULL;
+		bool		summary_used = false;
+
+		if (segno <= end_segno)
+			summary = read_wal_summary(archivedir, tli, segno, wal_seg_size);
+
+		if (summary != NULL &&
+			(summary->flags & WAL_SUMMARY_UNKNOWN_REL_UPDATE) == 0)
+		{
+			WalSummaryBlock *blocks = (WalSummaryBlock *) (summary + 1);
+			uint32		i;
+
+			for (i = 0; i < summary->n_blocks; i++)
+				process_block_change(MAIN_FORKNUM, blocks[i].rnode,
+									 blocks[i].blkno);
+			summary_used = true;
+			n_summaries++;
+		}
+		if (summary != NULL)
+			pg_free(summary);
+
+		if (!summary_used && segno <= end_segno)
+		{
+			/* The segment should be decoded, extend the run of such segments */
+			if (!in_run)
+			{
+				run_start = segno;
+				in_run = true;
+			}
+		}
+		else if (in_run)
+		{
+			XLogRecPtr	run_startpoint;
+			XLogRecPtr	run_endpoint;
+
+			/*
+			 * Decode segments from run_start to segno - 1. Records which
+			 * continue from the previous segment are skipped, they are
+			 * described by its summary.
+			 */
+			if (run_start == start_segno)
+				run_startpoint = startpoint;
+			else
+			{
+				GetXLogRecPtr(run_start, 0, wal_seg_size, run_startpoint);
+				run_startpoint += SizeOfXLogLongPHD;
+			}
+
+			if (segno > end_segno)
+				run_endpoint = endpoint;
+			else
+			{
+				GetXLogRecPtr(segno, 0, wal_seg_size, run_endpoint);
+				run_endpoint -= 1;
+			}
+
+			if (!RunXLogThreads(archivedir, 0, InvalidTransactionId,
+								InvalidXLogRecPtr, tli, wal_seg_size,
+								run_startpoint, run_endpoint, false,
+								extractPageInfo, NULL))
+				extract_isok = false;
+			/* Collect page maps of the finished threads */
+			merge_block_changes();
+			in_run = false;
+		}
+	}
+
+	if (n_summaries > 0)
+		elog(LOG, "Used summaries of %u WAL segments", n_summaries);
+	elog(LOG, "Skipped " UINT64_FORMAT " of " UINT64_FORMAT " block references "
+		 "to relations which are not in the backup",
+		 block_refs_filtered, block_refs);
 
 	time(&end_time);
 	if (extract_isok)
@@ -292,6 +534,177 @@ validate_backup_wal_from_start_to_stop(pgBackup *backup,
 	}
 }
 
+/*
+ * Read the first record of the WAL segment with number 'segno'. If 'need_time'
+ * is true read records further until a record with a timestamp is found and
+ * save the timestamp in *first_time. Records which begin in the next segment
+ * are not considered.
+ */
+static WalSegmentSample
+sample_wal_segment(const char *archivedir, TimeLineID tli, XLogSegNo segno,
+				   uint32 seg_size, bool need_time, TimestampTz *first_time)
+{
+	XLogReaderState *xlogreader;
+	XLogReaderData reader_data;
+	XLogRecPtr	startpoint;
+	XLogRecPtr	found;
+	WalSegmentSample res = WAL_SEGMENT_NO_TIME;
+
+	xlogreader = InitXLogPageRead(&reader_data, archivedir, tli, seg_size,
+								  false, false, true);
+
+	GetXLogRecPtr(segno, 0, seg_size, startpoint);
+	found = XLogFindNextRecord(xlogreader, startpoint);
+	if (XLogRecPtrIsInvalid(found))
+	{
+		res = WAL_SEGMENT_INVALID;
+		goto cleanup;
+	}
+	startpoint = found;
+
+	while (need_time)
+	{
+		XLogRecord *record;
+		char	   *errormsg;
+		XLogSegNo	rec_segno;
+
+		if (interrupted)
+			elog(ERROR, "Interrupted during WAL reading");
+
+		/* Read errors are reported later by the reading of WAL records */
+		record = XLogReadRecord(xlogreader, startpoint, &errormsg);
+		if (record == NULL)
+			break;
+		startpoint = InvalidXLogRecPtr;
+
+		GetXLogSegNo(xlogreader->ReadRecPtr, rec_segno, seg_size);
+		if (rec_segno != segno)
+			break;
+
+		if (getRecordTimestamp(xlogreader, first_time))
+		{
+			res = WAL_SEGMENT_TIME;
+			break;
+		}
+	}
+
+cleanup:
+	CleanupXLogPageRead(xlogreader);
+	XLogReaderFree(xlogreader);
+
+	return res;
+}
+
+/*
+ * Find the WAL segment from which the recovery target time or LSN should be
+ * searched, starting from the segment 'from_segno'.
+ *
+ * The segment of a target LSN is known. For a target time first timestamps of
+ * segments are sampled: segments are probed with an exponentially growing
+ * step until a segment with a later timestamp is found, then the found
+ * interval is divided by binary search. Commit timestamps are only roughly
+ * ordered, so the search stops at the last segment which starts before the
+ * target, records from it are read fully.
+ *
+ * Skipped segments must be continuous, their first pages are checked. If
+ * some of them is absent or invalid 'from_segno' is returned.
+ */
+static XLogSegNo
+seek_wal_target(const char *archivedir, TimeLineID tli, uint32 seg_size,
+				time_t target_time, XLogRecPtr target_lsn,
+				XLogSegNo from_segno)
+{
+	XLogSegNo	lo = from_segno;
+	XLogSegNo	segno;
+	uint32		n_sampled = 0;
+	char		xlogfname[MAXFNAMELEN];
+	time_t		start,
+				end;
+
+	time(&start);
+
+	if (target_time != 0)
+	{
+		XLogSegNo	hi;
+		XLogSegNo	step = 1;
+		TimestampTz	seg_time;
+		WalSegmentSample sample;
+
+		/* Find an upper bound of the target segment */
+		while (true)
+		{
+			hi = lo + step;
+			sample = sample_wal_segment(archivedir, tli, hi, seg_size, true,
+										&seg_time);
+			n_sampled++;
+
+			if (sample == WAL_SEGMENT_INVALID ||
+				(sample == WAL_SEGMENT_TIME &&
+				 timestamptz_to_time_t(seg_time) >= target_time))
+				break;
+			if (sample == WAL_SEGMENT_TIME)
+				lo = hi;
+			step *= 2;
+		}
+
+		/* The target is between the first records of 'lo' and 'hi' */
+		while (hi - lo > 1)
+		{
+			XLogSegNo	mid = lo + (hi - lo) / 2;
+
+			/*
+			 * Segments without commits cannot contain the target, use the
+			 * first following segment which has a timestamp.
+			 */
+			sample = WAL_SEGMENT_NO_TIME;
+			for (segno = mid; segno < hi && sample == WAL_SEGMENT_NO_TIME;
+				 segno++)
+			{
+				sample = sample_wal_segment(archivedir, tli, segno, seg_size,
+											true, &seg_time);
+				n_sampled++;
+			}
+
+			if (sample == WAL_SEGMENT_TIME &&
+				timestamptz_to_time_t(seg_time) < target_time)
+				lo = segno - 1;
+			else
+				hi = mid;
+		}
+	}
+
+	if (XRecOffIsValid(target_lsn))
+	{
+		GetXLogSegNo(target_lsn, segno, seg_size);
+		if (target_time == 0 || segno < lo)
+			lo = Max(segno, from_segno);
+	}
+
+	/* Check continuity of the skipped segments */
+	for (segno = from_segno; segno < lo; segno++)
+	{
+		if (interrupted)
+			elog(ERROR, "Interrupted during WAL reading");
+
+		if (sample_wal_segment(archivedir, tli, segno, seg_size, false,
+							   NULL) == WAL_SEGMENT_INVALID)
+		{
+			GetXLogFileName(xlogfname, tli, segno, seg_size);
+			elog(LOG, "WAL segment \"%s\" is absent or invalid, WAL is read from the beginning",
+				 xlogfname);
+			return from_segno;
+		}
+	}
+
+	time(&end);
+	GetXLogFileName(xlogfname, tli, lo, seg_size);
+	elog(LOG, "Recovery target is searched from WAL segment \"%s\", sampled %u segments, skipped " UINT64_FORMAT " segments, time elapsed %.0f sec",
+		 xlogfname, n_sampled, (uint64) (lo - from_segno),
+		 difftime(end, start));
+
+	return lo;
+}
+
 /*
  * Ensure that the backup has all wal files needed for recovery to consistent
  * state. And check if we have in archive all files needed to restore the backup
@@ -308,6 +721,8 @@ validate_wal(pgBackup *backup, const char *archivedir,
 				target_timestamp[100];
 	bool		all_wal = false;
 	char		backup_xlog_path[MAXPGPATH];
+	XLogRecPtr	startpoint;
+	XLogSegNo	segno;
 
 	/* We need free() this later */
 	backup_id = base36enc(backup->start_time);
@@ -326,7 +741,9 @@ validate_wal(pgBackup *backup, const char *archivedir,
 	 * Check that the backup has all wal files needed
 	 * for recovery to consistent state.
 	 */
-	if (backup->stream)
+	if (backup->wal_valid && backup->tli == tli)
+		elog(LOG, "WAL segments of backup %s are already validated", backup_id);
+	else if (backup->stream)
 	{
 		pgBackupGetPath2(backup, backup_xlog_path, lengthof(backup_xlog_path),
 						 DATABASE_DIR, PG_XLOG_DIR);
@@ -380,9 +797,34 @@ validate_wal(pgBackup *backup, const char *archivedir,
 		|| (XRecOffIsValid(target_lsn) && last_rec.rec_lsn >= target_lsn))
 		all_wal = true;
 
+	/*
+	 * WAL is decoded from the end of the backup to check CRCs and links of
+	 * all records, summaries of segments are not used here.
+	 */
+	startpoint = backup->stop_lsn;
+	GetXLogSegNo(startpoint, segno, wal_seg_size);
+
+	/*
+	 * Seek the segment of the recovery target time or LSN instead of reading
+	 * all WAL. Transaction IDs are not ordered in WAL, so WAL is read to
+	 * the target xid.
+	 */
+	if (wal_seek && !all_wal && !TransactionIdIsValid(target_xid))
+	{
+		XLogSegNo	seek_segno;
+
+		seek_segno = seek_wal_target(archivedir, tli, wal_seg_size,
+									 target_time, target_lsn, segno);
+		if (seek_segno > segno)
+		{
+			GetXLogRecPtr(seek_segno, 0, wal_seg_size, startpoint);
+			startpoint += SizeOfXLogLongPHD;
+		}
+	}
+
 	all_wal = all_wal ||
 		RunXLogThreads(archivedir, target_time, target_xid, target_lsn,
-					   tli, wal_seg_size, backup->stop_lsn,
+					   tli, wal_seg_size, startpoint,
 					   InvalidXLogRecPtr, true, validateXLogRecord, &last_rec);
 	if (last_rec.rec_time > 0)
 		time2iso(last_timestamp, lengthof(last_timestamp),
@@ -417,6 +859,124 @@ validate_wal(pgBackup *backup, const char *archivedir,
 	}
 }
 
+/*
+ * Comparison function to sort backups by timeline and start LSN.
+ */
+static int
+backup_wal_range_comp(const void *a1, const void *a2)
+{
+	pgBackup   *backup1 = *(pgBackup **) a1;
+	pgBackup   *backup2 = *(pgBackup **) a2;
+
+	if (backup1->tli != backup2->tli)
+		return backup1->tli > backup2->tli ? 1 : -1;
+	if (backup1->start_lsn != backup2->start_lsn)
+		return backup1->start_lsn > backup2->start_lsn ? 1 : -1;
+	return 0;
+}
+
+/*
+ * Validate WAL needed by archive backups of the list for recovery to
+ * consistent state.
+ *
+ * WAL ranges of the backups from start_lsn to stop_lsn which share or
+ * adjoin segments are merged per timeline and every merged range is read once
+ * by parallel threads, so each WAL segment is read once however many backups
+ * need it. Backups whose merged range is read successfully are marked as
+ * wal_valid and validate_wal() does not read their WAL again. If a merged
+ * range is broken, WAL of its backups is validated by validate_wal() one by
+ * one as before to find which of them are corrupted.
+ */
+void
+validate_wal_ranges(parray *backups, const char *archivedir, uint32 seg_size)
+{
+	parray	   *ranges = parray_new();
+	int			i,
+				j,
+				k;
+	uint32		n_valid = 0;
+	time_t		start_time,
+				end_time;
+
+	for (i = 0; i < parray_num(backups); i++)
+	{
+		pgBackup   *backup = (pgBackup *) parray_get(backups, i);
+
+		if ((backup->status == BACKUP_STATUS_OK ||
+			 backup->status == BACKUP_STATUS_DONE) &&
+			!backup->stream &&
+			XRecOffIsValid(backup->start_lsn) &&
+			XRecOffIsValid(backup->stop_lsn) &&
+			backup->start_lsn <= backup->stop_lsn)
+			parray_append(ranges, backup);
+	}
+
+	time(&start_time);
+	parray_qsort(ranges, backup_wal_range_comp);
+
+	for (i = 0; i < parray_num(ranges); i = j)
+	{
+		pgBackup   *first = (pgBackup *) parray_get(ranges, i);
+		XLogRecPtr	stop_lsn = first->stop_lsn;
+		XLogSegNo	stop_segno;
+
+		GetXLogSegNo(stop_lsn, stop_segno, seg_size);
+
+		/*
+		 * Merge following backups which start within the range or in the
+		 * next segment, so their WAL is read in parallel too.
+		 */
+		for (j = i + 1; j < parray_num(ranges); j++)
+		{
+			pgBackup   *backup = (pgBackup *) parray_get(ranges, j);
+			XLogSegNo	start_segno;
+
+			if (backup->tli != first->tli)
+				break;
+
+			GetXLogSegNo(backup->start_lsn, start_segno, seg_size);
+			if (start_segno > stop_segno + 1)
+				break;
+
+			if (backup->stop_lsn > stop_lsn)
+			{
+				stop_lsn = backup->stop_lsn;
+				GetXLogSegNo(stop_lsn, stop_segno, seg_size);
+			}
+		}
+
+		/* Single backups are validated by validate_wal() */
+		if (j - i < 2)
+			continue;
+
+		elog(LOG, "Validate WAL of %d backups from %X/%X to %X/%X on timeline %u",
+			 j - i,
+			 (uint32) (first->start_lsn >> 32), (uint32) (first->start_lsn),
+			 (uint32) (stop_lsn >> 32), (uint32) (stop_lsn),
+			 first->tli);
+
+		if (!RunXLogThreads(archivedir, 0, InvalidTransactionId,
+							InvalidXLogRecPtr, first->tli, seg_size,
+							first->start_lsn, stop_lsn, false, NULL, NULL))
+			continue;
+
+		for (k = i; k < j; k++)
+		{
+			pgBackup   *backup = (pgBackup *) parray_get(ranges, k);
+
+			backup->wal_valid = true;
+			n_valid++;
+		}
+	}
+
+	time(&end_time);
+	if (n_valid > 0)
+		elog(LOG, "WAL of %u backups is validated, time elapsed %.0f sec",
+			 n_valid, difftime(end_time, start_time));
+
+	parray_free(ranges);
+}
+
 /*
  * Read from archived WAL segments latest recovery time and xid. All necessary
  * segments present at archive folder. We waited **stop_lsn** in
@@ -605,29 +1165,402 @@ get_last_wal_lsn(const char *archivedir, XLogRecPtr start_lsn,
 			PrintXLogCorruptionMsg(&reader_data, ERROR);
 		}
 
-		/* continue reading at next record */
-		startpoint = InvalidXLogRecPtr;
+		/* continue reading at next record */
+		startpoint = InvalidXLogRecPtr;
+
+		GetXLogSegNo(xlogreader->EndRecPtr, next_segno, wal_seg_size);
+		if (next_segno > segno)
+			break;
+
+		if (seek_prev_segment)
+		{
+			/* end+1 of last record read */
+			res = xlogreader->EndRecPtr;
+		}
+		else
+			res = xlogreader->ReadRecPtr;
+
+		if (xlogreader->EndRecPtr >= stop_lsn)
+			break;
+	}
+
+	CleanupXLogPageRead(xlogreader);
+	XLogReaderFree(xlogreader);
+
+	return res;
+}
+
+/*
+ * Comparison function to sort WalSummaryBlock array.
+ */
+static int
+wal_summary_block_compare(const void *a1, const void *a2)
+{
+	const WalSummaryBlock *b1 = (const WalSummaryBlock *) a1;
+	const WalSummaryBlock *b2 = (const WalSummaryBlock *) a2;
+
+	if (b1->rnode.spcNode != b2->rnode.spcNode)
+		return (b1->rnode.spcNode < b2->rnode.spcNode) ? -1 : 1;
+	if (b1->rnode.dbNode != b2->rnode.dbNode)
+		return (b1->rnode.dbNode < b2->rnode.dbNode) ? -1 : 1;
+	if (b1->rnode.relNode != b2->rnode.relNode)
+		return (b1->rnode.relNode < b2->rnode.relNode) ? -1 : 1;
+	if (b1->blkno != b2->blkno)
+		return (b1->blkno < b2->blkno) ? -1 : 1;
+	return 0;
+}
+
+/*
+ * Build the summary of WAL segment 'segno' from 'archivedir' and save it into
+ * WAL_SUMMARY_DIR of the archive. The summary describes records which start
+ * within the segment, so the next segment should be archived already.
+ *
+ * Returns false if the segment couldn't be read, the summary isn't saved then.
+ */
+static bool
+build_wal_summary(const char *archivedir, TimeLineID tli, XLogSegNo segno,
+				  uint32 wal_seg_size)
+{
+	XLogReaderState *xlogreader;
+	XLogReaderData reader_data;
+	WalSummary	summary;
+	WalSummaryBlock *blocks = NULL;
+	uint32		n_blocks = 0;
+	uint32		max_blocks = 0;
+	XLogRecPtr	startpoint;
+	XLogRecPtr	found;
+	char		xlogfname[MAXFNAMELEN];
+	char		summary_dir[MAXPGPATH];
+	char		path[MAXPGPATH];
+	char		path_temp[MAXPGPATH];
+	FILE	   *out;
+	uint32		i;
+	bool		res = false;
+
+	GetXLogFileName(xlogfname, tli, segno, wal_seg_size);
+
+	MemSet(&summary, 0, sizeof(WalSummary));
+	summary.magic = WAL_SUMMARY_MAGIC;
+	summary.seg_size = wal_seg_size;
+	summary.min_xid = InvalidTransactionId;
+	summary.max_xid = InvalidTransactionId;
+	summary.last_xid = InvalidTransactionId;
+
+	xlogreader = InitXLogPageRead(&reader_data, archivedir, tli, wal_seg_size,
+								  false, false, true);
+
+	GetXLogRecPtr(segno, 0, wal_seg_size, startpoint);
+	found = XLogFindNextRecord(xlogreader, startpoint);
+	if (XLogRecPtrIsInvalid(found))
+	{
+		elog(LOG, "Could not find a WAL record in segment \"%s\", its summary is not built",
+			 xlogfname);
+		goto cleanup;
+	}
+	startpoint = found;
+	summary.start_lsn = found;
+
+	while (true)
+	{
+		XLogRecord *record;
+		char	   *errormsg;
+		XLogSegNo	rec_segno;
+		TransactionId xid;
+		TimestampTz	rec_time;
+		uint8		block_id;
+
+		if (interrupted)
+			elog(ERROR, "Interrupted during WAL reading");
+
+		record = XLogReadRecord(xlogreader, startpoint, &errormsg);
+		if (record == NULL)
+		{
+			XLogRecPtr	errptr;
+
+			errptr = XLogRecPtrIsInvalid(startpoint) ? xlogreader->EndRecPtr :
+				startpoint;
+
+			if (errormsg)
+				elog(LOG, "Could not read WAL record at %X/%X: %s, summary of segment \"%s\" is not built",
+					 (uint32) (errptr >> 32), (uint32) (errptr),
+					 errormsg, xlogfname);
+			else
+				elog(LOG, "Could not read WAL record at %X/%X, summary of segment \"%s\" is not built",
+					 (uint32) (errptr >> 32), (uint32) (errptr), xlogfname);
+			goto cleanup;
+		}
+
+		/* continue reading at next record */
+		startpoint = InvalidXLogRecPtr;
+
+		/* Stop at the first record of the next segment */
+		GetXLogSegNo(xlogreader->ReadRecPtr, rec_segno, wal_seg_size);
+		if (rec_segno > segno)
+			break;
+
+		summary.last_lsn = xlogreader->ReadRecPtr;
+		summary.end_lsn = xlogreader->EndRecPtr;
+
+		xid = XLogRecGetXid(xlogreader);
+		if (TransactionIdIsNormal(xid))
+		{
+			if (!TransactionIdIsValid(summary.min_xid) ||
+				NormalTransactionIdPrecedes(xid, summary.min_xid))
+				summary.min_xid = xid;
+			if (!TransactionIdIsValid(summary.max_xid) ||
+				NormalTransactionIdFollows(xid, summary.max_xid))
+				summary.max_xid = xid;
+		}
+		if (TransactionIdIsValid(xid))
+			summary.last_xid = xid;
+
+		if (getRecordTimestamp(xlogreader, &rec_time))
+		{
+			if (summary.min_time == 0 || rec_time < summary.min_time)
+				summary.min_time = rec_time;
+			if (rec_time > summary.max_time)
+				summary.max_time = rec_time;
+			summary.last_time = rec_time;
+		}
+
+		if (IsUnknownRelUpdate(xlogreader))
+			summary.flags |= WAL_SUMMARY_UNKNOWN_REL_UPDATE;
+
+		for (block_id = 0; block_id <= xlogreader->max_block_id; block_id++)
+		{
+			RelFileNode rnode;
+			ForkNumber	forknum;
+			BlockNumber blkno;
+
+			if (!XLogRecGetBlockTag(xlogreader, block_id, &rnode, &forknum,
+									&blkno))
+				continue;
+
+			/* We only care about the main fork; others are copied in toto */
+			if (forknum != MAIN_FORKNUM)
+				continue;
+
+			if (n_blocks == max_blocks)
+			{
+				max_blocks = (max_blocks == 0) ? 1024 : max_blocks * 2;
+				blocks = (WalSummaryBlock *) pgut_realloc(blocks,
+											sizeof(WalSummaryBlock) * max_blocks);
+			}
+			MemSet(&blocks[n_blocks], 0, sizeof(WalSummaryBlock));
+			blocks[n_blocks].rnode = rnode;
+			blocks[n_blocks].blkno = blkno;
+			n_blocks++;
+		}
+	}
+
+	/* Sort blocks and remove duplicates */
+	if (n_blocks > 1)
+	{
+		uint32		n_unique = 1;
+
+		qsort(blocks, n_blocks, sizeof(WalSummaryBlock),
+			  wal_summary_block_compare);
+		for (i = 1; i < n_blocks; i++)
+		{
+			if (wal_summary_block_compare(&blocks[i],
+										  &blocks[n_unique - 1]) != 0)
+				blocks[n_unique++] = blocks[i];
+		}
+		n_blocks = n_unique;
+	}
+	summary.n_blocks = n_blocks;
+
+	INIT_FILE_CRC32(true, summary.crc);
+	COMP_FILE_CRC32(true, summary.crc, &summary, sizeof(WalSummary));
+	if (n_blocks > 0)
+		COMP_FILE_CRC32(true, summary.crc, blocks,
+						sizeof(WalSummaryBlock) * n_blocks);
+	FIN_FILE_CRC32(true, summary.crc);
+
+	/* Save the summary */
+	join_path_components(summary_dir, archivedir, WAL_SUMMARY_DIR);
+	fio_mkdir(summary_dir, DIR_PERMISSION, FIO_BACKUP_HOST);
+	join_path_components(path, summary_dir, xlogfname);
+	/* Other processes may build the same summary concurrently */
+	snprintf(path_temp, sizeof(path_temp), "%s.tmp.%d", path, (int) getpid());
+
+	out = fio_fopen(path_temp, PG_BINARY_W, FIO_BACKUP_HOST);
+	if (out == NULL)
+	{
+		elog(WARNING, "Cannot open WAL summary file \"%s\": %s",
+			 path_temp, strerror(errno));
+		goto cleanup;
+	}
+
+	if (fio_fwrite(out, &summary, sizeof(WalSummary)) != sizeof(WalSummary) ||
+		(n_blocks > 0 &&
+		 fio_fwrite(out, blocks, sizeof(WalSummaryBlock) * n_blocks) !=
+			sizeof(WalSummaryBlock) * n_blocks))
+	{
+		elog(WARNING, "Cannot write WAL summary file \"%s\": %s",
+			 path_temp, strerror(errno));
+		fio_fclose(out);
+		fio_unlink(path_temp, FIO_BACKUP_HOST);
+		goto cleanup;
+	}
+
+	if (fio_fflush(out) || fio_fclose(out))
+	{
+		elog(WARNING, "Cannot write WAL summary file \"%s\": %s",
+			 path_temp, strerror(errno));
+		fio_unlink(path_temp, FIO_BACKUP_HOST);
+		goto cleanup;
+	}
+
+	if (fio_rename(path_temp, path, FIO_BACKUP_HOST) < 0)
+	{
+		elog(WARNING, "Cannot rename WAL summary file \"%s\" to \"%s\": %s",
+			 path_temp, path, strerror(errno));
+		fio_unlink(path_temp, FIO_BACKUP_HOST);
+		goto cleanup;
+	}
+
+	elog(LOG, "Saved summary of WAL segment \"%s\", blocks: %u",
+		 xlogfname, n_blocks);
+	res = true;
+
+cleanup:
+	CleanupXLogPageRead(xlogreader);
+	XLogReaderFree(xlogreader);
+	pg_free(blocks);
+
+	return res;
+}
+
+/*
+ * Build summaries of segments from 'from_segno' to 'to_segno' which don't
+ * have them, using threads. Segments which can't be read are left without
+ * summaries.
+ */
+static void
+build_wal_summaries(const char *archivedir, TimeLineID tli, uint32 seg_size,
+					XLogSegNo from_segno, XLogSegNo to_segno)
+{
+	pthread_t  *threads;
+	wal_summary_arg *threads_args;
+	int			i;
+
+	threads = (pthread_t *) pgut_malloc(sizeof(pthread_t) * num_threads);
+	threads_args = (wal_summary_arg *)
+		pgut_malloc(sizeof(wal_summary_arg) * num_threads);
+
+	for (i = 0; i < num_threads; i++)
+	{
+		wal_summary_arg *arg = &threads_args[i];
+
+		arg->archivedir = archivedir;
+		arg->tli = tli;
+		arg->seg_size = seg_size;
+		arg->from_segno = from_segno;
+		arg->to_segno = to_segno;
+		arg->thread_num = i + 1;
+		/* By default there is some error */
+		arg->ret = 1;
+
+		pthread_create(&threads[i], NULL, build_wal_summaries_worker, arg);
+	}
+
+	for (i = 0; i < num_threads; i++)
+		pthread_join(threads[i], NULL);
+
+	pfree(threads);
+	pfree(threads_args);
+}
+
+/*
+ * Build summaries of every num_threads'th segment starting from the segment
+ * of the thread.
+ */
+static void *
+build_wal_summaries_worker(void *arg)
+{
+	wal_summary_arg *args = (wal_summary_arg *) arg;
+	char		summary_dir[MAXPGPATH];
+	XLogSegNo	segno;
+
+	join_path_components(summary_dir, args->archivedir, WAL_SUMMARY_DIR);
+
+	for (segno = args->from_segno + args->thread_num - 1;
+		 segno <= args->to_segno;
+		 segno += num_threads)
+	{
+		char		xlogfname[MAXFNAMELEN];
+		char		path[MAXPGPATH];
+
+		if (interrupted || thread_interrupted)
+			elog(ERROR, "Interrupted during WAL reading");
+
+		GetXLogFileName(xlogfname, args->tli, segno, args->seg_size);
+		join_path_components(path, summary_dir, xlogfname);
+		if (fileExists(path, FIO_BACKUP_HOST))
+			continue;
 
-		GetXLogSegNo(xlogreader->EndRecPtr, next_segno, wal_seg_size);
-		if (next_segno > segno)
-			break;
+		build_wal_summary(args->archivedir, args->tli, segno, args->seg_size);
+	}
 
-		if (seek_prev_segment)
-		{
-			/* end+1 of last record read */
-			res = xlogreader->EndRecPtr;
-		}
-		else
-			res = xlogreader->ReadRecPtr;
+	args->ret = 0;
 
-		if (xlogreader->EndRecPtr >= stop_lsn)
-			break;
+	return NULL;
+}
+
+/*
+ * Read the summary of WAL segment 'segno' from WAL_SUMMARY_DIR of the archive.
+ * Blocks follow the returned WalSummary, it should be freed by pg_free().
+ *
+ * Returns NULL if there is no summary or it is corrupted.
+ */
+static WalSummary *
+read_wal_summary(const char *archivedir, TimeLineID tli, XLogSegNo segno,
+				 uint32 seg_size)
+{
+	char		summary_dir[MAXPGPATH];
+	char		xlogfname[MAXFNAMELEN];
+	char	   *buf;
+	size_t		size;
+	WalSummary *summary;
+	pg_crc32	crc;
+	pg_crc32	saved_crc;
+
+	join_path_components(summary_dir, archivedir, WAL_SUMMARY_DIR);
+	GetXLogFileName(xlogfname, tli, segno, seg_size);
+
+	buf = slurpFile(summary_dir, xlogfname, &size, true, FIO_BACKUP_HOST);
+	if (buf == NULL)
+		return NULL;
+
+	summary = (WalSummary *) buf;
+	if (size < sizeof(WalSummary) ||
+		summary->magic != WAL_SUMMARY_MAGIC ||
+		summary->seg_size != seg_size ||
+		size != sizeof(WalSummary) +
+			sizeof(WalSummaryBlock) * (size_t) summary->n_blocks)
+	{
+		elog(WARNING, "Summary of WAL segment \"%s\" is corrupted", xlogfname);
+		pg_free(buf);
+		return NULL;
 	}
 
-	CleanupXLogPageRead(xlogreader);
-	XLogReaderFree(xlogreader);
+	saved_crc = summary->crc;
+	summary->crc = 0;
+	INIT_FILE_CRC32(true, crc);
+	COMP_FILE_CRC32(true, crc, buf, size);
+	FIN_FILE_CRC32(true, crc);
+	summary->crc = saved_crc;
 
-	return res;
+	if (!EQ_CRC32C(crc, saved_crc))
+	{
+		elog(WARNING, "Summary of WAL segment \"%s\" has invalid CRC",
+			 xlogfname);
+		pg_free(buf);
+		return NULL;
+	}
+
+	return summary;
 }
 
 #ifdef HAVE_LIBZ
@@ -718,7 +1651,15 @@ SimpleXLogPageRead(XLogReaderState *xlogreader, XLogRecPtr targetPagePtr,
 		snprintf(reader_data->xlogpath, MAXPGPATH, "%s/%s", wal_archivedir,
 				 xlogfname);
 
-		if (fileExists(reader_data->xlogpath, FIO_BACKUP_HOST))
+		/* Take the segment read ahead by a prefetch worker */
+		if (wal_prefetch && wal_prefetch_get(reader_data))
+		{
+			elog(LOG, "Thread [%d]: Using prefetched WAL segment \"%s\"",
+				 reader_data->thread_num, reader_data->xlogpath);
+
+			reader_data->xlogexists = true;
+		}
+		else if (fileExists(reader_data->xlogpath, FIO_BACKUP_HOST))
 		{
 			elog(LOG, "Thread [%d]: Opening WAL segment \"%s\"",
 				 reader_data->thread_num, reader_data->xlogpath);
@@ -782,7 +1723,10 @@ SimpleXLogPageRead(XLogReaderState *xlogreader, XLogRecPtr targetPagePtr,
 	}
 
 	/* Read the requested page */
-	if (reader_data->xlogfile != -1)
+	if (reader_data->prefetch_slot != NULL)
+		memcpy(readBuf, reader_data->prefetch_slot->buf + targetPageOff,
+			   XLOG_BLCKSZ);
+	else if (reader_data->xlogfile != -1)
 	{
 		if (fio_seek(reader_data->xlogfile, (off_t) targetPageOff) < 0)
 		{
@@ -886,6 +1830,8 @@ RunXLogThreads(const char *archivedir, time_t target_time,
 {
 	pthread_t  *threads;
 	xlog_thread_arg *thread_args;
+	pthread_t  *prefetch_threads;
+	wal_prefetch_arg *prefetch_args;
 	int			i;
 	int			threads_need = 0;
 	XLogSegNo	endSegNo = 0;
@@ -931,6 +1877,7 @@ RunXLogThreads(const char *archivedir, time_t target_time,
 		InitXLogPageRead(&arg->reader_data, archivedir, tli, segment_size, true,
 						 consistent_read, false);
 		arg->reader_data.xlogsegno = segno_next;
+		arg->reader_data.assigned_segno = segno_next;
 		arg->reader_data.thread_num = i + 1;
 		arg->process_record = process_record;
 		arg->startpoint = startpoint;
@@ -951,8 +1898,31 @@ RunXLogThreads(const char *archivedir, time_t target_time,
 		GetXLogRecPtr(segno_next, 0, segment_size, startpoint);
 	}
 
+	/* Initialize prefetching */
+	wal_prefetch_slots = parray_new();
+	prefetch_next = segno_start;
+	prefetch_end = endSegNo;
+	prefetch_tli = tli;
+	prefetch_stop = false;
+	prefetch_count = 0;
+	prefetch_memory = 0;
+	wal_prefetch = true;
+
+	prefetch_threads = (pthread_t *) pgut_malloc(sizeof(pthread_t) * num_threads);
+	prefetch_args = (wal_prefetch_arg *) pgut_malloc(sizeof(wal_prefetch_arg) * num_threads);
+
 	/* Run threads */
 	thread_interrupted = false;
+	for (i = 0; i < num_threads; i++)
+	{
+		prefetch_args[i].thread_num = i + 1;
+		/* By default there is some error */
+		prefetch_args[i].ret = 1;
+
+		elog(VERBOSE, "Start WAL prefetch thread: %d", i + 1);
+		pthread_create(&prefetch_threads[i], NULL, wal_prefetch_worker,
+					   &prefetch_args[i]);
+	}
 	for (i = 0; i < threads_need; i++)
 	{
 		elog(VERBOSE, "Start WAL reader thread: %d", i + 1);
@@ -965,7 +1935,39 @@ RunXLogThreads(const char *archivedir, time_t target_time,
 		pthread_join(threads[i], NULL);
 		if (thread_args[i].ret == 1)
 			result = false;
+
+		block_refs += thread_args[i].reader_data.n_block_refs;
+		block_refs_filtered += thread_args[i].reader_data.n_block_refs_filtered;
+	}
+
+	/* Stop prefetching, segments which are not read yet aren't needed */
+	pthread_lock(&wal_segment_mutex);
+	prefetch_stop = true;
+	pthread_cond_broadcast(&wal_prefetch_cond);
+	pthread_mutex_unlock(&wal_segment_mutex);
+
+	for (i = 0; i < num_threads; i++)
+	{
+		pthread_join(prefetch_threads[i], NULL);
+		if (prefetch_args[i].ret == 1)
+			result = false;
+	}
+	wal_prefetch = false;
+
+	elog(LOG, "Prefetched %u WAL segments", prefetch_count);
+
+	for (i = 0; i < parray_num(wal_prefetch_slots); i++)
+	{
+		WalPrefetchSlot *slot = (WalPrefetchSlot *) parray_get(wal_prefetch_slots, i);
+
+		pg_free(slot->buf);
+		pfree(slot);
 	}
+	parray_free(wal_prefetch_slots);
+	wal_prefetch_slots = NULL;
+
+	pfree(prefetch_threads);
+	pfree(prefetch_args);
 
 	/* Release threads here, use thread_args only below */
 	pfree(threads);
@@ -1221,6 +2223,252 @@ XLogThreadWorker(void *arg)
 	return NULL;
 }
 
+/*
+ * WAL prefetch worker. Reads and decompresses segments into memory in
+ * order, staying at most num_threads segments ahead of the segments
+ * assigned to the decoding threads and within WAL_PREFETCH_MAX_MEMORY.
+ * At least one segment is prefetched even if it is larger than the limit.
+ */
+static void *
+wal_prefetch_worker(void *arg)
+{
+	wal_prefetch_arg *prefetch_arg = (wal_prefetch_arg *) arg;
+
+	for (;;)
+	{
+		WalPrefetchSlot *slot = NULL;
+		char	   *buf;
+		bool		valid;
+
+		if (interrupted || thread_interrupted)
+			elog(ERROR, "Prefetch thread [%d]: Interrupted during WAL reading",
+				 prefetch_arg->thread_num);
+
+		pthread_lock(&wal_segment_mutex);
+		if (prefetch_stop ||
+			(prefetch_end != 0 && prefetch_next > prefetch_end))
+		{
+			pthread_mutex_unlock(&wal_segment_mutex);
+			break;
+		}
+		/* Do not go too far ahead of the decoding threads */
+		if (prefetch_next >= segno_next + num_threads ||
+			(prefetch_memory > 0 &&
+			 prefetch_memory + wal_seg_size > WAL_PREFETCH_MAX_MEMORY))
+		{
+			pthread_cond_wait_ms(&wal_prefetch_cond, &wal_segment_mutex,
+								 WAL_PREFETCH_WAIT_MS);
+			pthread_mutex_unlock(&wal_segment_mutex);
+			continue;
+		}
+
+		slot = pgut_new(WalPrefetchSlot);
+		slot->segno = prefetch_next++;
+		slot->buf = NULL;
+		slot->loaded = false;
+		slot->valid = false;
+		slot->consumed = false;
+		slot->pins = 0;
+		parray_append(wal_prefetch_slots, slot);
+		prefetch_memory += wal_seg_size;
+		pthread_mutex_unlock(&wal_segment_mutex);
+
+		buf = pgut_malloc(wal_seg_size);
+		valid = wal_prefetch_load(prefetch_arg->thread_num, slot->segno, buf);
+		if (!valid)
+		{
+			pg_free(buf);
+			buf = NULL;
+		}
+
+		pthread_lock(&wal_segment_mutex);
+		slot->buf = buf;
+		slot->valid = valid;
+		slot->loaded = true;
+		if (valid)
+			prefetch_count++;
+		else
+			prefetch_memory -= wal_seg_size;
+		pthread_cond_broadcast(&wal_prefetch_cond);
+		pthread_mutex_unlock(&wal_segment_mutex);
+	}
+
+	/* Prefetching is successful */
+	prefetch_arg->ret = 0;
+	return NULL;
+}
+
+/*
+ * Read the whole WAL segment into "buf", decompressing it if needed.
+ * Returns false if the segment is absent or cannot be read, the decoding
+ * thread reads such segment by itself and reports the error.
+ */
+static bool
+wal_prefetch_load(int thread_num, XLogSegNo segno, char *buf)
+{
+	char		xlogfname[MAXFNAMELEN];
+	char		xlogpath[MAXPGPATH];
+	uint32		read_len = 0;
+
+	GetXLogFileName(xlogfname, prefetch_tli, segno, wal_seg_size);
+	snprintf(xlogpath, MAXPGPATH, "%s/%s", wal_archivedir, xlogfname);
+
+	if (fileExists(xlogpath, FIO_BACKUP_HOST))
+	{
+		int			fd;
+
+		fd = fio_open(xlogpath, O_RDONLY | PG_BINARY, FIO_BACKUP_HOST);
+		if (fd < 0)
+			return false;
+
+		while (read_len < wal_seg_size)
+		{
+			int			rc;
+
+			rc = fio_read(fd, buf + read_len,
+						  Min(WAL_PREFETCH_CHUNK, wal_seg_size - read_len));
+			if (rc <= 0)
+				break;
+			read_len += rc;
+		}
+		fio_close(fd);
+	}
+#ifdef HAVE_LIBZ
+	else
+	{
+		gzFile		gz;
+
+		strncat(xlogpath, ".gz", MAXPGPATH - strlen(xlogpath) - 1);
+		if (!fileExists(xlogpath, FIO_BACKUP_HOST))
+			return false;
+
+		gz = fio_gzopen(xlogpath, "rb", -1, FIO_BACKUP_HOST);
+		if (gz == NULL)
+			return false;
+
+		while (read_len < wal_seg_size)
+		{
+			int			rc;
+
+			rc = fio_gzread(gz, buf + read_len,
+							Min(WAL_PREFETCH_CHUNK, wal_seg_size - read_len));
+			if (rc <= 0)
+				break;
+			read_len += rc;
+		}
+		fio_gzclose(gz);
+	}
+#endif
+
+	if (read_len != wal_seg_size)
+		return false;
+
+	elog(VERBOSE, "Prefetch thread [%d]: Read WAL segment \"%s\"",
+		 thread_num, xlogpath);
+	return true;
+}
+
+/*
+ * Take the prefetched segment reader_data->xlogsegno. Waits if a prefetch
+ * worker is reading the segment. Returns false if the segment was not
+ * prefetched, the thread should read the segment by itself then.
+ */
+static bool
+wal_prefetch_get(XLogReaderData *reader_data)
+{
+	XLogSegNo	segno = reader_data->xlogsegno;
+	bool		own = (segno == reader_data->assigned_segno);
+	WalPrefetchSlot *slot = NULL;
+	int			i;
+
+	pthread_lock(&wal_segment_mutex);
+	for (;;)
+	{
+		if (interrupted || thread_interrupted)
+		{
+			pthread_mutex_unlock(&wal_segment_mutex);
+			elog(ERROR, "Thread [%d]: Interrupted during WAL reading",
+				 reader_data->thread_num);
+		}
+
+		for (i = 0; i < parray_num(wal_prefetch_slots); i++)
+		{
+			slot = (WalPrefetchSlot *) parray_get(wal_prefetch_slots, i);
+			if (slot->segno == segno)
+				break;
+		}
+
+		if (i == parray_num(wal_prefetch_slots))
+		{
+			/*
+			 * The thread got ahead of the prefetch workers, don't let them
+			 * read the segment again.
+			 */
+			if (own && prefetch_next <= segno)
+				prefetch_next = segno + 1;
+			pthread_mutex_unlock(&wal_segment_mutex);
+			return false;
+		}
+
+		if (slot->loaded)
+			break;
+
+		/* The slot may be gone after the wait, look for it again */
+		pthread_cond_wait_ms(&wal_prefetch_cond, &wal_segment_mutex,
+							 WAL_PREFETCH_WAIT_MS);
+	}
+
+	if (!slot->valid)
+	{
+		/* Nobody needs the slot if the assigned thread reads the segment */
+		if (own)
+		{
+			parray_remove(wal_prefetch_slots, i);
+			pfree(slot);
+		}
+		pthread_mutex_unlock(&wal_segment_mutex);
+		return false;
+	}
+
+	slot->pins++;
+	if (own)
+		slot->consumed = true;
+	reader_data->prefetch_slot = slot;
+	pthread_mutex_unlock(&wal_segment_mutex);
+
+	return true;
+}
+
+/*
+ * Release the prefetched segment. The memory is freed when the thread
+ * assigned to the segment and all other threads reading it are done.
+ */
+static void
+wal_prefetch_release(WalPrefetchSlot *slot)
+{
+	pthread_lock(&wal_segment_mutex);
+	slot->pins--;
+	if (slot->consumed && slot->pins == 0)
+	{
+		int			i;
+
+		for (i = 0; i < parray_num(wal_prefetch_slots); i++)
+		{
+			if (parray_get(wal_prefetch_slots, i) == slot)
+			{
+				parray_remove(wal_prefetch_slots, i);
+				break;
+			}
+		}
+		pg_free(slot->buf);
+		pfree(slot);
+		prefetch_memory -= wal_seg_size;
+		/* Let prefetch workers use the memory */
+		pthread_cond_broadcast(&wal_prefetch_cond);
+	}
+	pthread_mutex_unlock(&wal_segment_mutex);
+}
+
 /*
  * Do manual switch to the next WAL segment.
  *
@@ -1239,8 +2487,11 @@ SwitchThreadToNextWal(XLogReaderState *xlogreader, xlog_thread_arg *arg)
 	pthread_lock(&wal_segment_mutex);
 	Assert(segno_next);
 	reader_data->xlogsegno = segno_next;
+	reader_data->assigned_segno = segno_next;
 	segnum_read++;
 	segno_next++;
+	/* Let prefetch workers read further */
+	pthread_cond_broadcast(&wal_prefetch_cond);
 	pthread_mutex_unlock(&wal_segment_mutex);
 
 	/* We've reached the end */
@@ -1365,6 +2616,11 @@ CleanupXLogPageRead(XLogReaderState *xlogreader)
 	XLogReaderData *reader_data;
 
 	reader_data = (XLogReaderData *) xlogreader->private_data;
+	if (reader_data->prefetch_slot != NULL)
+	{
+		wal_prefetch_release(reader_data->prefetch_slot);
+		reader_data->prefetch_slot = NULL;
+	}
 	if (reader_data->xlogfile >= 0)
 	{
 		fio_close(reader_data->xlogfile);
@@ -1393,7 +2649,8 @@ PrintXLogCorruptionMsg(XLogReaderData *reader_data, int elevel)
 		if (!reader_data->xlogexists)
 			elog(elevel, "Thread [%d]: WAL segment \"%s\" is absent",
 				 reader_data->thread_num, reader_data->xlogpath);
-		else if (reader_data->xlogfile != -1)
+		else if (reader_data->xlogfile != -1 ||
+				 reader_data->prefetch_slot != NULL)
 			elog(elevel, "Thread [%d]: Possible WAL corruption. "
 						 "Error has occured during reading WAL segment \"%s\"",
 				 reader_data->thread_num, reader_data->xlogpath);
@@ -1422,6 +2679,55 @@ extractPageInfo(XLogReaderState *record, XLogReaderData *reader_data,
 	uint8		block_id;
 	RmgrId		rmid = XLogRecGetRmid(record);
 	uint8		info = XLogRecGetInfo(record);
+
+	if (IsUnknownRelUpdate(record))
+	{
+		/*
+		 * This record type modifies a relation file in some special way, but
+		 * we don't recognize the type. That's bad - we don't know how to
+		 * track that change.
+		 */
+		elog(ERROR, "WAL record modifies a relation, but record type is not recognized\n"
+			 "lsn: %X/%X, rmgr: %s, info: %02X",
+		  (uint32) (record->ReadRecPtr >> 32), (uint32) (record->ReadRecPtr),
+				 RmgrNames[rmid], info);
+	}
+
+	for (block_id = 0; block_id <= record->max_block_id; block_id++)
+	{
+		RelFileNode rnode;
+		ForkNumber	forknum;
+		BlockNumber blkno;
+
+		if (!XLogRecGetBlockTag(record, block_id, &rnode, &forknum, &blkno))
+			continue;
+
+		/* We only care about the main fork; others are copied in toto */
+		if (forknum != MAIN_FORKNUM)
+			continue;
+
+		reader_data->n_block_refs++;
+
+		/* Skip relations of excluded databases, temporary relations etc. */
+		if (!relation_in_backup_filter(rnode))
+		{
+			reader_data->n_block_refs_filtered++;
+			continue;
+		}
+
+		process_block_change(forknum, rnode, blkno);
+	}
+}
+
+/*
+ * Returns true if the record modifies a relation file in some special way,
+ * which we cannot track in a page map.
+ */
+static bool
+IsUnknownRelUpdate(XLogReaderState *record)
+{
+	RmgrId		rmid = XLogRecGetRmid(record);
+	uint8		info = XLogRecGetInfo(record);
 	uint8		rminfo = info & ~XLR_INFO_MASK;
 
 	/* Is this a special record type that I recognize? */
@@ -1432,6 +2738,7 @@ extractPageInfo(XLogReaderState *record, XLogReaderData *reader_data,
 		 * New databases can be safely ignored. They would be completely
 		 * copied if found.
 		 */
+		return false;
 	}
 	else if (rmid == RM_DBASE_ID && rminfo == XLOG_DBASE_DROP)
 	{
@@ -1439,6 +2746,7 @@ extractPageInfo(XLogReaderState *record, XLogReaderData *reader_data,
 		 * An existing database was dropped. It is fine to ignore that
 		 * they will be removed appropriately.
 		 */
+		return false;
 	}
 	else if (rmid == RM_SMGR_ID && rminfo == XLOG_SMGR_CREATE)
 	{
@@ -1446,6 +2754,7 @@ extractPageInfo(XLogReaderState *record, XLogReaderData *reader_data,
 		 * We can safely ignore these. The file will be removed when
 		 * combining the backups in the case of differential on.
 		 */
+		return false;
 	}
 	else if (rmid == RM_SMGR_ID && rminfo == XLOG_SMGR_TRUNCATE)
 	{
@@ -1454,35 +2763,10 @@ extractPageInfo(XLogReaderState *record, XLogReaderData *reader_data,
 		 * we'll notice that they differ, and copy the missing tail from
 		 * source system.
 		 */
+		return false;
 	}
-	else if (info & XLR_SPECIAL_REL_UPDATE)
-	{
-		/*
-		 * This record type modifies a relation file in some special way, but
-		 * we don't recognize the type. That's bad - we don't know how to
-		 * track that change.
-		 */
-		elog(ERROR, "WAL record modifies a relation, but record type is not recognized\n"
-			 "lsn: %X/%X, rmgr: %s, info: %02X",
-		  (uint32) (record->ReadRecPtr >> 32), (uint32) (record->ReadRecPtr),
-				 RmgrNames[rmid], info);
-	}
-
-	for (block_id = 0; block_id <= record->max_block_id; block_id++)
-	{
-		RelFileNode rnode;
-		ForkNumber	forknum;
-		BlockNumber blkno;
-
-		if (!XLogRecGetBlockTag(record, block_id, &rnode, &forknum, &blkno))
-			continue;
-
-		/* We only care about the main fork; others are copied in toto */
-		if (forknum != MAIN_FORKNUM)
-			continue;
 
-		process_block_change(forknum, rnode, blkno);
-	}
+	return (info & XLR_SPECIAL_REL_UPDATE) != 0;
 }
 
 /*
@@ -33,6 +33,7 @@ typedef enum ProbackupSubcmd
 	DELETE_INSTANCE_CMD,
 	ARCHIVE_PUSH_CMD,
 	ARCHIVE_GET_CMD,
+	ARCHIVE_SERVER_CMD,
 	BACKUP_CMD,
 	RESTORE_CMD,
 	VALIDATE_CMD,
@@ -59,6 +60,11 @@ char		backup_instance_path[MAXPGPATH];
  * $BACKUP_PATH/wal/instance_name
  */
 char		arclog_path[MAXPGPATH] = "";
+/*
+ * path to the page store in the backup catalog
+ * $BACKUP_PATH/pages/instance_name
+ */
+char		page_store_path[MAXPGPATH] = "";
 
 /* colon separated external directories list ("/path1:/path2") */
 char	   *externaldir = NULL;
@@ -75,6 +81,7 @@ bool		temp_slot = false;
 /* backup options */
 bool		backup_logs = false;
 bool		smooth_checkpoint;
+bool		page_dedup = false;
 char       *remote_agent;
 
 /* restore options */
@@ -95,6 +102,8 @@ bool no_validate = false;
 
 bool skip_block_validation = false;
 bool skip_external_dirs = false;
+bool incremental_restore = false;
+bool wal_seek = false;
 
 /* checkdb options */
 bool need_amcheck = false;
@@ -114,14 +123,20 @@ bool 		compress_shortcut = false;
 /* other options */
 char	   *instance_name;
 
-/* archive push options */
+/* archive push and get options */
 static char *wal_file_path;
 static char *wal_file_name;
 static bool	file_overwrite = false;
+static char *archive_socket = NULL;
+int			archive_batch_size = 1;
+int			archive_prefetch = 0;
 
 /* show options */
 ShowFormat show_format = SHOW_PLAIN;
 
+/* backup and merge options */
+FileListFormat filelist_format = FILELIST_BINARY;
+
 /* current settings */
 pgBackup	current;
 static ProbackupSubcmd backup_subcmd = NO_CMD;
@@ -130,6 +145,7 @@ static bool help_opt = false;
 
 static void opt_backup_mode(ConfigOption *opt, const char *arg);
 static void opt_show_format(ConfigOption *opt, const char *arg);
+static void opt_filelist_format(ConfigOption *opt, const char *arg);
 
 static void compress_init(void);
 
@@ -152,10 +168,12 @@ static ConfigOption cmd_options[] =
 	{ 'b', 'C', "smooth-checkpoint", &smooth_checkpoint,	SOURCE_CMD_STRICT },
 	{ 's', 'S', "slot",				&replication_slot,	SOURCE_CMD_STRICT },
 	{ 'b', 234, "temp-slot",		&temp_slot,			SOURCE_CMD_STRICT },
+	{ 'b', 158, "page-dedup",		&page_dedup,		SOURCE_CMD_STRICT },
 	{ 'b', 134, "delete-wal",		&delete_wal,		SOURCE_CMD_STRICT },
 	{ 'b', 135, "delete-expired",	&delete_expired,	SOURCE_CMD_STRICT },
 	{ 'b', 235, "merge-expired",	&merge_expired,		SOURCE_CMD_STRICT },
 	{ 'b', 237, "dry-run",			&dry_run,			SOURCE_CMD_STRICT },
+	{ 'f', 160, "filelist-format",	opt_filelist_format,	SOURCE_CMD_STRICT },
 	/* restore options */
 	{ 's', 136, "recovery-target-time",	&target_time,	SOURCE_CMD_STRICT },
 	{ 's', 137, "recovery-target-xid",	&target_xid,	SOURCE_CMD_STRICT },
@@ -171,6 +189,8 @@ static ConfigOption cmd_options[] =
 	{ 'b', 143, "no-validate",		&no_validate,		SOURCE_CMD_STRICT },
 	{ 'b', 154, "skip-block-validation", &skip_block_validation,	SOURCE_CMD_STRICT },
 	{ 'b', 156, "skip-external-dirs", &skip_external_dirs,	SOURCE_CMD_STRICT },
+	{ 'b', 159, "incremental",		&incremental_restore,	SOURCE_CMD_STRICT },
+	{ 'b', 164, "wal-seek",			&wal_seek,			SOURCE_CMD_STRICT },
 	/* checkdb options */
 	{ 'b', 195, "amcheck",			&need_amcheck,		SOURCE_CMD_STRICT },
 	{ 'b', 196, "heapallindexed",	&heapallindexed,	SOURCE_CMD_STRICT },
@@ -191,6 +211,9 @@ static ConfigOption cmd_options[] =
 	{ 's', 150, "wal-file-path",	&wal_file_path,		SOURCE_CMD_STRICT },
 	{ 's', 151, "wal-file-name",	&wal_file_name,		SOURCE_CMD_STRICT },
 	{ 'b', 152, "overwrite",		&file_overwrite,	SOURCE_CMD_STRICT },
+	{ 's', 161, "archive-socket",	&archive_socket,	SOURCE_CMD_STRICT },
+	{ 'u', 162, "batch-size",		&archive_batch_size,	SOURCE_CMD_STRICT },
+	{ 'u', 163, "prefetch",			&archive_prefetch,	SOURCE_CMD_STRICT },
 	/* show options */
 	{ 'f', 153, "format",			opt_show_format,	SOURCE_CMD_STRICT },
 
@@ -215,7 +238,8 @@ setMyLocation(void)
 #endif
 
 	MyLocation = IsSshProtocol()
-		? (backup_subcmd == ARCHIVE_PUSH_CMD || backup_subcmd == ARCHIVE_GET_CMD)
+		? (backup_subcmd == ARCHIVE_PUSH_CMD || backup_subcmd == ARCHIVE_GET_CMD ||
+		   backup_subcmd == ARCHIVE_SERVER_CMD)
 		   ? FIO_DB_HOST
 		   : (backup_subcmd == BACKUP_CMD || backup_subcmd == RESTORE_CMD || backup_subcmd == ADD_INSTANCE_CMD)
 		      ? FIO_BACKUP_HOST
@@ -268,6 +292,8 @@ main(int argc, char *argv[])
 			backup_subcmd = ARCHIVE_PUSH_CMD;
 		else if (strcmp(argv[1], "archive-get") == 0)
 			backup_subcmd = ARCHIVE_GET_CMD;
+		else if (strcmp(argv[1], "archive-server") == 0)
+			backup_subcmd = ARCHIVE_SERVER_CMD;
 		else if (strcmp(argv[1], "add-instance") == 0)
 			backup_subcmd = ADD_INSTANCE_CMD;
 		else if (strcmp(argv[1], "del-instance") == 0)
@@ -438,6 +464,7 @@ main(int argc, char *argv[])
 		sprintf(backup_instance_path, "%s/%s/%s",
 				backup_path, BACKUPS_DIR, instance_name);
 		sprintf(arclog_path, "%s/%s/%s", backup_path, "wal", instance_name);
+		sprintf(page_store_path, "%s/%s/%s", backup_path, "pages", instance_name);
 
 		/*
 		 * Ensure that requested backup instance exists.
@@ -452,6 +479,18 @@ main(int argc, char *argv[])
 		}
 	}
 
+	/*
+	 * If the archive server is running, archive-push only passes the segment
+	 * to it, the server has the instance configuration already.
+	 */
+	if (backup_subcmd == ARCHIVE_PUSH_CMD && archive_socket != NULL)
+	{
+		rc = archive_server_push(archive_socket, wal_file_path, wal_file_name,
+								 file_overwrite);
+		if (rc >= 0)
+			return rc;
+	}
+
 	/*
 	 * We read options from command line, now we need to read them from
 	 * configuration file since we got backup path and instance name.
@@ -512,9 +551,10 @@ main(int argc, char *argv[])
 		command = NULL;
 	}
 
-	/* For archive-push and archive-get skip full path lookup */
+	/* For archive-push, archive-get and archive-server skip full path lookup */
 	if ((backup_subcmd != ARCHIVE_GET_CMD &&
-		backup_subcmd != ARCHIVE_PUSH_CMD) &&
+		backup_subcmd != ARCHIVE_PUSH_CMD &&
+		backup_subcmd != ARCHIVE_SERVER_CMD) &&
 		(find_my_exec(argv[0],(char *) PROGRAM_FULL_PATH) < 0))
 	{
 			PROGRAM_FULL_PATH = NULL;
@@ -595,6 +635,9 @@ main(int argc, char *argv[])
 	if (num_threads < 1)
 		num_threads = 1;
 
+	if (archive_batch_size < 1)
+		archive_batch_size = 1;
+
 	compress_init();
 
 	/* do actual operation */
@@ -604,6 +647,8 @@ main(int argc, char *argv[])
 			return do_archive_push(wal_file_path, wal_file_name, file_overwrite);
 		case ARCHIVE_GET_CMD:
 			return do_archive_get(wal_file_path, wal_file_name);
+		case ARCHIVE_SERVER_CMD:
+			return do_archive_server(archive_socket);
 		case ADD_INSTANCE_CMD:
 			return do_add_instance();
 		case DELETE_INSTANCE_CMD:
@@ -707,12 +752,38 @@ opt_show_format(ConfigOption *opt, const char *arg)
 		elog(ERROR, "Invalid show format \"%s\"", arg);
 }
 
+static void
+opt_filelist_format(ConfigOption *opt, const char *arg)
+{
+	const char *v = arg;
+	size_t		len;
+
+	/* Skip all spaces detected */
+	while (IsSpace(*v))
+		v++;
+	len = strlen(v);
+
+	if (len > 0)
+	{
+		if (pg_strncasecmp("binary", v, len) == 0)
+			filelist_format = FILELIST_BINARY;
+		else if (pg_strncasecmp("text", v, len) == 0)
+			filelist_format = FILELIST_TEXT;
+		else
+			elog(ERROR, "Invalid file list format \"%s\"", arg);
+	}
+	else
+		elog(ERROR, "Invalid file list format \"%s\"", arg);
+}
+
 /*
  * Initialize compress and sanity checks for compress.
  */
 static void
 compress_init(void)
 {
+	int			max_level = COMPRESS_LEVEL_MAX;
+
 	/* Default algorithm is zlib */
 	if (compress_shortcut)
 		instance_config.compress_alg = ZLIB_COMPRESS;
@@ -724,18 +795,36 @@ compress_init(void)
 			elog(ERROR, "Cannot specify compress-level option without compress-alg option");
 	}
 
-	if (instance_config.compress_level < 0 || instance_config.compress_level > 9)
-		elog(ERROR, "--compress-level value must be in the range from 0 to 9");
+	/* zstd and lz4 have more compression levels than zlib */
+	if (instance_config.compress_alg == ZSTD_COMPRESS)
+		max_level = ZSTD_COMPRESS_LEVEL_MAX;
+	else if (instance_config.compress_alg == LZ4_COMPRESS)
+		max_level = LZ4_COMPRESS_LEVEL_MAX;
+
+	if (instance_config.compress_level < 0 || instance_config.compress_level > max_level)
+		elog(ERROR, "--compress-level value must be in the range from 0 to %d",
+			 max_level);
 
 	if (instance_config.compress_alg == ZLIB_COMPRESS && instance_config.compress_level == 0)
 		elog(WARNING, "Compression level 0 will lead to data bloat!");
 
-	if (backup_subcmd == BACKUP_CMD || backup_subcmd == ARCHIVE_PUSH_CMD)
+	if (backup_subcmd == BACKUP_CMD || backup_subcmd == ARCHIVE_PUSH_CMD ||
+		backup_subcmd == ARCHIVE_SERVER_CMD)
 	{
 #ifndef HAVE_LIBZ
 		if (instance_config.compress_alg == ZLIB_COMPRESS)
 			elog(ERROR, "This build does not support zlib compression");
 		else
+#endif
+#ifndef HAVE_LIBZSTD
+		if (instance_config.compress_alg == ZSTD_COMPRESS)
+			elog(ERROR, "This build does not support zstd compression");
+		else
+#endif
+#ifndef HAVE_LIBLZ4
+		if (instance_config.compress_alg == LZ4_COMPRESS)
+			elog(ERROR, "This build does not support lz4 compression");
+		else
 #endif
 		if (instance_config.compress_alg == PGLZ_COMPRESS && num_threads > 1)
 			elog(ERROR, "Multithread backup does not support pglz compression");
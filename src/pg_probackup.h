@@ -55,7 +55,11 @@ extern const char  *PROGRAM_EMAIL;
 #define BACKUP_CONTROL_FILE		"backup.control"
 #define BACKUP_CATALOG_CONF_FILE	"pg_probackup.conf"
 #define BACKUP_CATALOG_PID		"backup.pid"
+#define BACKUP_CATALOG_INDEX_FILE	"catalog.index"
+#define BACKUP_CATALOG_INDEX_LOCK_FILE	"catalog.index.lock"
 #define DATABASE_FILE_LIST		"backup_content.control"
+#define PAGE_INDEX_FILE			"page_index"
+#define WAL_SUMMARY_DIR			"summary"
 #define PG_BACKUP_LABEL_FILE	"backup_label"
 #define PG_BLACK_LIST			"black_list"
 #define PG_TABLESPACE_MAP_FILE "tablespace_map"
@@ -89,6 +93,8 @@ typedef enum CompressAlg
 	NONE_COMPRESS,
 	PGLZ_COMPRESS,
 	ZLIB_COMPRESS,
+	ZSTD_COMPRESS,
+	LZ4_COMPRESS,
 } CompressAlg;
 
 #define INIT_FILE_CRC32(use_crc32c, crc) \
@@ -114,6 +120,18 @@ do { \
 } while (0)
 
 
+/*
+ * Entry of the page index of a backup data file. Indexes of all data files of
+ * the backup are stored in PAGE_INDEX_FILE, position of the index of the file
+ * is kept in backup_content.control.
+ */
+typedef struct BackupPageIndex
+{
+	BlockNumber	block;				/* block number */
+	int32		compressed_size;	/* as in BackupPageHeader of the block */
+	int64		pos;				/* offset of BackupPageHeader in the file */
+} BackupPageIndex;
+
 /* Information about single file (or dir) in backup */
 typedef struct pgFile
 {
@@ -146,11 +164,100 @@ typedef struct pgFile
 	datapagemap_t pagemap;	/* bitmap of pages updated since previous backup */
 	bool	pagemap_isabsent; /* Used to mark files with unknown state of pagemap,
 							   * i.e. datafiles without _ptrack */
+	BackupPageIndex *page_index; /* index of pages written into the backup file */
+	int		n_page_index;
+	int		max_page_index;
+	int64	idx_off;		/* offset of the page index in PAGE_INDEX_FILE */
+	int		idx_num;		/* number of index entries, 0 if there is no index */
+	pg_crc32 idx_crc;		/* CRC of the index entries */
 } pgFile;
 
+/* PAGE_INDEX_FILE opened for writing */
+typedef struct PageIndexMap
+{
+	char		path[MAXPGPATH];
+	FILE	   *fp;
+	int64		size;			/* current size of the file */
+} PageIndexMap;
+
+/* Copy of the data file in one of the backups of the restored chain */
+typedef struct RestoreFileSource
+{
+	pgFile	   *file;
+	uint32		backup_version;
+	const char *index_path;		/* PAGE_INDEX_FILE of the backup */
+} RestoreFileSource;
+
 /* Special values of datapagemap_t bitmapsize */
 #define PageBitmapIsEmpty 0		/* Used to mark unchanged datafiles */
 
+/*
+ * Big data files are split into ranges of BACKUP_RANGE_BLOCKS blocks, which
+ * are copied by backup threads independently into memory buffers. Finished
+ * ranges are appended to the backup file in block order, the thread which
+ * finishes the last range of the file completes it.
+ */
+#define BACKUP_RANGE_BLOCKS	((16 * 1024 * 1024) / BLCKSZ)
+
+typedef struct pgFileRange
+{
+	pgFile	   *file;			/* data file the range belongs to */
+	int			range_num;		/* number of the range within the file */
+	int			n_ranges;		/* total number of ranges of the file */
+	BlockNumber	start_block;	/* first block of the range */
+	BlockNumber	end_block;		/* first block after the range */
+	struct pgFileRange *first;	/* first range of the file, it holds
+								 * the counter of unfinished ranges */
+	pg_atomic_uint32 n_unfinished;
+	volatile pg_atomic_flag lock;	/* lock for synchronization of parallel threads */
+
+	/* Results of the range copying */
+	size_t		read_size;
+	int64		write_size;
+	BlockNumber	n_blocks_read;
+	BlockNumber	n_blocks_skipped;
+	bool		truncated;		/* relation ends inside of the range */
+	bool		missing;		/* file disappeared during backup */
+	BackupPageIndex *page_index;	/* page index of the range output */
+	int			n_page_index;
+
+	/* Output of the range waiting for preceding ranges to be appended */
+	char	   *buf;
+	size_t		buf_size;
+	bool		spilled;		/* output is moved to "<to_path>.<range_num>" */
+	volatile bool done;			/* range is copied */
+	bool		appended;		/* range is appended to the backup file */
+
+	/* Fields below are used in the first range only */
+	volatile pg_atomic_flag append_lock;	/* held by the appending thread */
+	volatile int next_append;	/* next range to append */
+	FILE	   *out;			/* backup file */
+	bool		stop;			/* following ranges are not appended */
+} pgFileRange;
+
+/* Files located on the same device, see pgFileScheduler */
+typedef struct pgDeviceQueue
+{
+	dev_t		dev;
+	parray	   *files;
+	int			next;			/* first file which is not claimed yet */
+	int			active;			/* number of threads working on the device */
+} pgDeviceQueue;
+
+/*
+ * Hands out files to backup and restore threads. Files are grouped by the
+ * device they are located on, and the next file is taken from the device
+ * with the least number of working threads.
+ */
+typedef struct pgFileScheduler
+{
+	pgDeviceQueue *devices;
+	int			n_devices;
+	int			last;			/* device of the last claimed file */
+	int			n_files;
+	int			n_claimed;
+} pgFileScheduler;
+
 /* Current state of backup */
 typedef enum BackupStatus
 {
@@ -181,14 +288,23 @@ typedef enum ShowFormat
 	SHOW_JSON
 } ShowFormat;
 
+typedef enum FileListFormat
+{
+	FILELIST_BINARY,
+	FILELIST_TEXT
+} FileListFormat;
+
+/* Reader of DATABASE_FILE_LIST, see open_file_list() */
+typedef struct FileListReader FileListReader;
+
 
 /* special values of pgBackup fields */
 #define INVALID_BACKUP_ID	0    /* backup ID is not provided by user */
 #define BYTES_INVALID		(-1) /* file didn`t changed since previous backup, DELTA backup do not rely on it */
 #define FILE_NOT_FOUND		(-2) /* file disappeared during backup */
 #define BLOCKNUM_INVALID	(-1)
-#define PROGRAM_VERSION	"2.1.3"
-#define AGENT_PROTOCOL_VERSION 20103
+#define PROGRAM_VERSION	"2.1.4"
+#define AGENT_PROTOCOL_VERSION 20104
 
 
 typedef struct ConnectionOptions
@@ -299,10 +415,14 @@ struct pgBackup
 	bool			stream;			/* Was this backup taken in stream mode?
 									 * i.e. does it include all needed WAL files? */
 	bool			from_replica;	/* Was this backup taken from replica */
+	bool			page_dedup;		/* May data files refer to the page store? */
 	time_t			parent_backup; 	/* Identifier of the previous backup.
 									 * Which is basic backup for this
 									 * incremental backup. */
 	pgBackup		*parent_backup_link;
+	bool			wal_valid;		/* Was WAL from start_lsn to stop_lsn
+									 * already validated? Not stored in
+									 * the catalog */
 	char			*primary_conninfo; /* Connection parameters of the backup
 										* in the format suitable for recovery.conf */
 	char			*external_dir_str;	/* List of external directories,
@@ -337,6 +457,9 @@ typedef struct
 	const char *external_prefix;
 
 	parray	   *files_list;
+	pgFileScheduler *scheduler;	/* hands out files of files_list */
+	parray	   *ranges_list;	/* ranges of big data files, see pgFileRange */
+	PageIndexMap *index_map;
 	parray	   *prev_filelist;
 	parray	   *external_dirs;
 	XLogRecPtr	prev_start_lsn;
@@ -366,6 +489,15 @@ typedef struct BackupPageHeader
 #define PageIsTruncated -2
 #define SkipCurrentPage -3
 #define PageIsCorrupted -4 /* used by checkdb */
+#define PageIsDeduplicated -5 /* page is in the page store, PageStoreKey follows */
+
+/* Key of the page in the page store */
+typedef struct PageStoreKey
+{
+	uint64		hash;
+	pg_crc32	crc;
+	uint32		padding;
+} PageStoreKey;
 
 
 /*
@@ -398,6 +530,8 @@ typedef struct BackupPageHeader
 	XLogFileName(fname, tli, logSegNo, wal_segsz_bytes)
 #define IsInXLogSeg(xlrp, logSegNo, wal_segsz_bytes) \
 	XLByteInSeg(xlrp, logSegNo, wal_segsz_bytes)
+#define GetXLogFromFileName(fname, tli, logSegNo, wal_segsz_bytes) \
+	XLogFromFileName(fname, tli, logSegNo, wal_segsz_bytes)
 #else
 #define GetXLogSegNo(xlrp, logSegNo, wal_segsz_bytes) \
 	XLByteToSeg(xlrp, logSegNo)
@@ -407,6 +541,8 @@ typedef struct BackupPageHeader
 	XLogFileName(fname, tli, logSegNo)
 #define IsInXLogSeg(xlrp, logSegNo, wal_segsz_bytes) \
 	XLByteInSeg(xlrp, logSegNo)
+#define GetXLogFromFileName(fname, tli, logSegNo, wal_segsz_bytes) \
+	XLogFromFileName(fname, tli, logSegNo)
 #endif
 
 #define IsSshProtocol() (instance_config.remote.host && strcmp(instance_config.remote.proto, "ssh") == 0)
@@ -416,6 +552,7 @@ extern char    *pg_probackup;
 extern char	   *backup_path;
 extern char		backup_instance_path[MAXPGPATH];
 extern char		arclog_path[MAXPGPATH];
+extern char		page_store_path[MAXPGPATH];
 
 /* common options */
 extern int		num_threads;
@@ -429,6 +566,7 @@ extern bool 	temp_slot;
 
 /* backup options */
 extern bool		smooth_checkpoint;
+extern bool		page_dedup;
 
 /* remote probackup options */
 extern char* remote_agent;
@@ -440,6 +578,8 @@ extern bool exclusive_backup;
 extern bool restore_as_replica;
 extern bool skip_block_validation;
 extern bool skip_external_dirs;
+extern bool incremental_restore;
+extern bool wal_seek;
 
 /* delete options */
 extern bool		delete_wal;
@@ -454,9 +594,16 @@ extern bool		compress_shortcut;
 /* other options */
 extern char *instance_name;
 
+/* archive push and get options */
+extern int	archive_batch_size;
+extern int	archive_prefetch;
+
 /* show options */
 extern ShowFormat show_format;
 
+/* format of DATABASE_FILE_LIST written by backup and merge */
+extern FileListFormat filelist_format;
+
 /* checkdb options */
 extern bool heapallindexed;
 
@@ -478,6 +625,8 @@ extern BackupMode parse_backup_mode(const char *value);
 extern const char *deparse_backup_mode(BackupMode mode);
 extern void process_block_change(ForkNumber forknum, RelFileNode rnode,
 								 BlockNumber blkno);
+extern void merge_block_changes(void);
+extern bool relation_in_backup_filter(RelFileNode rnode);
 
 extern char *pg_ptrack_get_block(ConnectionArgs *arguments,
 								 Oid dbOid, Oid tblsOid, Oid relOid,
@@ -508,6 +657,9 @@ extern int do_add_instance(void);
 extern int do_archive_push(char *wal_file_path, char *wal_file_name,
 						   bool overwrite);
 extern int do_archive_get(char *wal_file_path, char *wal_file_name);
+extern int do_archive_server(const char *socket_path);
+extern int archive_server_push(const char *socket_path, char *wal_file_path,
+							   char *wal_file_name, bool overwrite);
 
 
 /* in configure.c */
@@ -524,6 +676,15 @@ extern void delete_backup_files(pgBackup *backup);
 extern int do_retention(void);
 extern int do_delete_instance(void);
 
+/* in pagestore.c */
+extern void page_store_key(const char *page, PageStoreKey *key);
+extern bool page_store_put(const PageStoreKey *key, const char *data,
+						   int32 size, CompressAlg alg);
+extern bool page_store_get(const PageStoreKey *key, char *page);
+extern void page_store_close(void);
+extern void page_store_gc(void);
+extern void page_store_remove(void);
+
 /* in fetch.c */
 extern char *slurpFile(const char *datadir,
 					   const char *path,
@@ -580,6 +741,9 @@ extern void launch_ssh(char* argv[]);
 
 #define COMPRESS_ALG_DEFAULT NOT_DEFINED_COMPRESS
 #define COMPRESS_LEVEL_DEFAULT 1
+#define COMPRESS_LEVEL_MAX 9
+#define ZSTD_COMPRESS_LEVEL_MAX 22
+#define LZ4_COMPRESS_LEVEL_MAX 12
 
 extern CompressAlg parse_compress_alg(const char *arg);
 extern const char* deparse_compress_alg(int alg);
@@ -603,8 +767,18 @@ extern char *get_external_remap(char *current_dir);
 
 extern void print_file_list(FILE *out, const parray *files, const char *root,
 							const char *external_prefix, parray *external_list);
+extern void write_binary_file_list(FILE *out, const parray *files,
+								   const char *root,
+								   const char *external_prefix,
+								   parray *external_list);
 extern parray *dir_read_file_list(const char *root, const char *external_prefix,
 								  const char *file_txt, fio_location location);
+extern FileListReader *open_file_list(const char *file_txt,
+									  fio_location location);
+extern pgFile *read_file_list_entry(FileListReader *reader, const char *root,
+									const char *external_prefix);
+extern int file_list_num(FileListReader *reader);
+extern void close_file_list(FileListReader *reader);
 extern parray *make_external_directory_list(const char *colon_separated_dirs,
 											bool remap);
 extern void free_dir_list(parray *list);
@@ -635,6 +809,13 @@ extern int pgFileComparePathWithExternalDesc(const void *f1, const void *f2);
 extern int pgFileCompareLinked(const void *f1, const void *f2);
 extern int pgFileCompareSize(const void *f1, const void *f2);
 
+extern pgFileScheduler *file_scheduler_new(parray *files, const char *root,
+										   parray *external_dirs,
+										   fio_location location);
+extern pgFile *file_scheduler_next(pgFileScheduler *scheduler, int *device,
+								   int *num);
+extern void file_scheduler_free(pgFileScheduler *scheduler);
+
 /* in data.c */
 extern bool check_data_file(ConnectionArgs* arguments, pgFile* file, uint32 checksum_version);
 extern bool backup_data_file(backup_files_arg* arguments,
@@ -643,15 +824,36 @@ extern bool backup_data_file(backup_files_arg* arguments,
 							 BackupMode backup_mode,
 							 CompressAlg calg, int clevel,
 							 bool missing_ok);
+extern void backup_data_file_range(backup_files_arg* arguments,
+								   const char *to_path, pgFileRange *range,
+								   XLogRecPtr prev_backup_start_lsn,
+								   BackupMode backup_mode,
+								   CompressAlg calg, int clevel);
+extern void append_data_file_range(const char *to_path, pgFileRange *range);
+extern bool join_data_file_ranges(const char *to_path, pgFileRange *first,
+								  BackupMode backup_mode);
 extern void restore_data_file(const char *to_path,
 							  pgFile *file, bool allow_truncate,
 							  bool write_header,
 							  uint32 backup_version);
+extern void restore_data_file_chain(const char *to_path,
+									RestoreFileSource *sources, int n_sources,
+									bool incremental);
+extern void merge_data_file(const char *to_path, pgFile *file,
+							RestoreFileSource *sources, int n_sources);
 extern bool copy_file(fio_location from_location, const char *to_root,
 					  fio_location to_location, pgFile *file, bool missing_ok);
 
 extern bool check_file_pages(pgFile *file, XLogRecPtr stop_lsn,
 							 uint32 checksum_version, uint32 backup_version);
+extern void page_index_add(pgFile *file, BlockNumber block,
+						   int32 compressed_size, int64 pos);
+extern void build_page_index(pgFile *file, const char *path);
+extern void open_page_index_map(PageIndexMap *map, const char *path);
+extern void close_page_index_map(PageIndexMap *map);
+extern void write_page_index(PageIndexMap *map, pgFile *file);
+extern BackupPageIndex *read_page_index(pgFile *file, const char *index_path);
+extern bool check_page_index(pgFile *file, const char *index_path);
 /* parsexlog.c */
 extern void extractPageMap(const char *archivedir,
 						   TimeLineID tli, uint32 seg_size,
@@ -660,6 +862,8 @@ extern void validate_wal(pgBackup *backup, const char *archivedir,
 						 time_t target_time, TransactionId target_xid,
 						 XLogRecPtr target_lsn, TimeLineID tli,
 						 uint32 seg_size);
+extern void validate_wal_ranges(parray *backups, const char *archivedir,
+								uint32 seg_size);
 extern bool read_recovery_info(const char *archivedir, TimeLineID tli,
 							   uint32 seg_size,
 							   XLogRecPtr start_lsn, XLogRecPtr stop_lsn,
@@ -694,6 +898,8 @@ extern uint32 parse_program_version(const char *program_version);
 extern bool   parse_page(Page page, XLogRecPtr *lsn);
 int32  do_compress(void* dst, size_t dst_size, void const* src, size_t src_size,
 				   CompressAlg alg, int level, const char **errormsg);
+int32  do_decompress(void* dst, size_t dst_size, void const* src, size_t src_size,
+					 CompressAlg alg, const char **errormsg);
 
 
 extern PGconn *pgdata_basic_setup(ConnectionOptions conn_opt, PGNodeInfo *nodeInfo);
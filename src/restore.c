@@ -17,14 +17,25 @@
 
 #include "utils/thread.h"
 
+/* Backup of the restored chain with its file list */
 typedef struct
 {
-	parray	   *files;
 	pgBackup   *backup;
+	parray	   *files;			/* sorted by pgFileCompareRelPathWithExternal */
 	parray	   *external_dirs;
-	char	   *external_prefix;
-	parray	   *dest_external_dirs;
+	char		database_path[MAXPGPATH];
+	char		external_prefix[MAXPGPATH];
+	char		index_path[MAXPGPATH];
+	uint32		backup_version;
+} restore_chain_item;
+
+typedef struct
+{
 	parray	   *dest_files;
+	pgFileScheduler *scheduler;	/* hands out files of dest_files */
+	restore_chain_item *chain;	/* from dest_backup to the FULL backup */
+	int			n_chain;
+	parray	   *dest_external_dirs;
 
 	/*
 	 * Return value from the thread.
@@ -33,8 +44,11 @@ typedef struct
 	int			ret;
 } restore_files_arg;
 
-static void restore_backup(pgBackup *backup, parray *dest_external_dirs,
-						   parray *dest_files);
+static void restore_chain(parray *parent_chain, parray *dest_external_dirs,
+						  parray *dest_files);
+static void check_incremental_destination(void);
+static void remove_tablespace_links(void);
+static void remove_extra_files(parray *dest_files);
 static void create_recovery_conf(time_t backup_id,
 								 pgRecoveryTarget *rt,
 								 pgBackup *backup);
@@ -65,7 +79,9 @@ do_restore_or_validate(time_t target_backup_id, pgRecoveryTarget *rt,
 			elog(ERROR,
 				"required parameter not specified: PGDATA (-D, --pgdata)");
 		/* Check if restore destination empty */
-		if (!dir_is_empty(instance_config.pgdata, FIO_DB_HOST))
+		if (incremental_restore)
+			check_incremental_destination();
+		else if (!dir_is_empty(instance_config.pgdata, FIO_DB_HOST))
 			elog(ERROR, "restore destination is not empty: \"%s\"",
 				 instance_config.pgdata);
 	}
@@ -437,6 +453,13 @@ do_restore_or_validate(time_t target_backup_id, pgRecoveryTarget *rt,
 										FIO_BACKUP_HOST);
 		parray_qsort(dest_files, pgFileCompareRelPathWithExternal);
 
+		/*
+		 * Tablespace links of the existing PGDATA are created again
+		 * according to the backup and tablespace mapping.
+		 */
+		if (incremental_restore)
+			remove_tablespace_links();
+
 		/*
 		 * Restore dest_backup internal directories.
 		 */
@@ -445,6 +468,10 @@ do_restore_or_validate(time_t target_backup_id, pgRecoveryTarget *rt,
 		create_data_directories(dest_files, instance_config.pgdata, dest_backup_path, true,
 								FIO_DB_HOST);
 
+		/* Remove files which don't exist in the backup */
+		if (incremental_restore)
+			remove_extra_files(dest_files);
+
 		/*
 		 * Restore dest_backup external directories.
 		 */
@@ -462,7 +489,7 @@ do_restore_or_validate(time_t target_backup_id, pgRecoveryTarget *rt,
 		}
 
 		/*
-		 * At least restore backups files starting from the parent backup.
+		 * Lock backups of the chain and restore their files at once.
 		 */
 		for (i = parray_num(parent_chain) - 1; i >= 0; i--)
 		{
@@ -480,10 +507,10 @@ do_restore_or_validate(time_t target_backup_id, pgRecoveryTarget *rt,
 			 */
 			if (rt->no_validate && !lock_backup(backup))
 				elog(ERROR, "Cannot lock backup directory");
-
-			restore_backup(backup, dest_external_dirs, dest_files);
 		}
 
+		restore_chain(parent_chain, dest_external_dirs, dest_files);
+
 		if (dest_external_dirs != NULL)
 			free_dir_list(dest_external_dirs);
 
@@ -505,100 +532,120 @@ do_restore_or_validate(time_t target_backup_id, pgRecoveryTarget *rt,
 }
 
 /*
- * Restore one backup.
+ * Restore the chain of backups.
+ *
+ * Files are restored in a single pass: every data file is assembled block by
+ * block from the backups of the chain, so each block is written only once,
+ * other files are copied from the newest backup which contains them.
  */
-void
-restore_backup(pgBackup *backup, parray *dest_external_dirs, parray *dest_files)
+static void
+restore_chain(parray *parent_chain, parray *dest_external_dirs,
+			  parray *dest_files)
 {
-	char		timestamp[100];
-	char		database_path[MAXPGPATH];
-	char		external_prefix[MAXPGPATH];
-	char		list_path[MAXPGPATH];
+	restore_chain_item *chain;
+	int			n_chain = parray_num(parent_chain);
 	parray	   *files;
-	parray	   *external_dirs = NULL;
 	int			i;
 	/* arrays with meta info for multi threaded backup */
 	pthread_t  *threads;
 	restore_files_arg *threads_args;
+	pgFileScheduler *scheduler;
 	bool		restore_isok = true;
 
-	if (backup->status != BACKUP_STATUS_OK &&
-		backup->status != BACKUP_STATUS_DONE)
-		elog(ERROR, "Backup %s cannot be restored because it is not valid",
-			 base36enc(backup->start_time));
+	chain = (restore_chain_item *) palloc0(sizeof(restore_chain_item) * n_chain);
 
-	/* confirm block size compatibility */
-	if (backup->block_size != BLCKSZ)
-		elog(ERROR,
-			"BLCKSZ(%d) is not compatible(%d expected)",
-			backup->block_size, BLCKSZ);
-	if (backup->wal_block_size != XLOG_BLCKSZ)
-		elog(ERROR,
-			"XLOG_BLCKSZ(%d) is not compatible(%d expected)",
-			backup->wal_block_size, XLOG_BLCKSZ);
+	for (i = 0; i < n_chain; i++)
+	{
+		restore_chain_item *item = &chain[i];
+		pgBackup   *backup = (pgBackup *) parray_get(parent_chain, i);
+		char		timestamp[100];
+		char		list_path[MAXPGPATH];
+
+		if (backup->status != BACKUP_STATUS_OK &&
+			backup->status != BACKUP_STATUS_DONE)
+			elog(ERROR, "Backup %s cannot be restored because it is not valid",
+				 base36enc(backup->start_time));
+
+		/* confirm block size compatibility */
+		if (backup->block_size != BLCKSZ)
+			elog(ERROR,
+				"BLCKSZ(%d) is not compatible(%d expected)",
+				backup->block_size, BLCKSZ);
+		if (backup->wal_block_size != XLOG_BLCKSZ)
+			elog(ERROR,
+				"XLOG_BLCKSZ(%d) is not compatible(%d expected)",
+				backup->wal_block_size, XLOG_BLCKSZ);
 
-	time2iso(timestamp, lengthof(timestamp), backup->start_time);
-	elog(LOG, "Restoring database from backup %s", timestamp);
+		time2iso(timestamp, lengthof(timestamp), backup->start_time);
+		elog(LOG, "Restoring database from backup %s", timestamp);
 
-	if (backup->external_dir_str)
-		external_dirs = make_external_directory_list(backup->external_dir_str,
-													 true);
+		item->backup = backup;
+		item->backup_version = parse_program_version(backup->program_version);
 
-	/*
-	 * Get list of files which need to be restored.
-	 */
-	pgBackupGetPath(backup, database_path, lengthof(database_path), DATABASE_DIR);
-	pgBackupGetPath(backup, external_prefix, lengthof(external_prefix),
-					EXTERNAL_DIR);
-	pgBackupGetPath(backup, list_path, lengthof(list_path), DATABASE_FILE_LIST);
-	files = dir_read_file_list(database_path, external_prefix, list_path,
-							   FIO_BACKUP_HOST);
+		if (backup->external_dir_str)
+			item->external_dirs = make_external_directory_list(
+												backup->external_dir_str,
+												true);
 
-	/* Restore directories in do_backup_instance way */
-	parray_qsort(files, pgFileComparePath);
+		/*
+		 * Get list of files of the backup.
+		 */
+		pgBackupGetPath(backup, item->database_path,
+						lengthof(item->database_path), DATABASE_DIR);
+		pgBackupGetPath(backup, item->external_prefix,
+						lengthof(item->external_prefix), EXTERNAL_DIR);
+		pgBackupGetPath(backup, item->index_path, lengthof(item->index_path),
+						PAGE_INDEX_FILE);
+		pgBackupGetPath(backup, list_path, lengthof(list_path),
+						DATABASE_FILE_LIST);
+		item->files = dir_read_file_list(item->database_path,
+										 item->external_prefix, list_path,
+										 FIO_BACKUP_HOST);
+		parray_qsort(item->files, pgFileCompareRelPathWithExternal);
+	}
 
 	/*
-	 * Make external directories before restore
-	 * and setup threads at the same time
+	 * Make external directories before restore. Files of dest_backup describe
+	 * all of them.
 	 */
-	for (i = 0; i < parray_num(files); i++)
+	files = chain[0].files;
+	for (i = 0; !skip_external_dirs && i < parray_num(files); i++)
 	{
 		pgFile	   *file = (pgFile *) parray_get(files, i);
+		char	   *external_path;
 
-		/*
-		 * If the entry was an external directory, create it in the backup.
-		 */
-		if (!skip_external_dirs &&
-			file->external_dir_num && S_ISDIR(file->mode) &&
-			/* Do not create unnecessary external directories */
-			parray_bsearch(dest_files, file, pgFileCompareRelPathWithExternal))
-		{
-			char	   *external_path;
+		if (!file->external_dir_num || !S_ISDIR(file->mode))
+			continue;
 
-			if (!external_dirs ||
-				parray_num(external_dirs) < file->external_dir_num - 1)
-				elog(ERROR, "Inconsistent external directory backup metadata");
+		if (!chain[0].external_dirs ||
+			parray_num(chain[0].external_dirs) < file->external_dir_num - 1)
+			elog(ERROR, "Inconsistent external directory backup metadata");
 
-			external_path = parray_get(external_dirs,
-									   file->external_dir_num - 1);
-			if (backup_contains_external(external_path, dest_external_dirs))
-			{
-				char		container_dir[MAXPGPATH];
-				char		dirpath[MAXPGPATH];
-				char	   *dir_name;
-
-				makeExternalDirPathByNum(container_dir, external_prefix,
-										file->external_dir_num);
-				dir_name = GetRelativePath(file->path, container_dir);
-				elog(VERBOSE, "Create directory \"%s\"", dir_name);
-				join_path_components(dirpath, external_path, dir_name);
-				fio_mkdir(dirpath, DIR_PERMISSION, FIO_DB_HOST);
-			}
+		external_path = parray_get(chain[0].external_dirs,
+								   file->external_dir_num - 1);
+		if (backup_contains_external(external_path, dest_external_dirs))
+		{
+			char		dirpath[MAXPGPATH];
+
+			elog(VERBOSE, "Create directory \"%s\"", file->rel_path);
+			join_path_components(dirpath, external_path, file->rel_path);
+			fio_mkdir(dirpath, DIR_PERMISSION, FIO_DB_HOST);
 		}
+	}
+
+	/* setup threads */
+	for (i = 0; i < parray_num(dest_files); i++)
+	{
+		pgFile	   *file = (pgFile *) parray_get(dest_files, i);
 
-		/* setup threads */
 		pg_atomic_clear_flag(&file->lock);
 	}
+	/*
+	 * Spread the threads across the devices holding the files, external
+	 * directories are taken with --external-mapping applied.
+	 */
+	scheduler = file_scheduler_new(dest_files, instance_config.pgdata,
+								   dest_external_dirs, FIO_DB_HOST);
 	threads = (pthread_t *) palloc(sizeof(pthread_t) * num_threads);
 	threads_args = (restore_files_arg *) palloc(sizeof(restore_files_arg) *
 												num_threads);
@@ -609,17 +656,16 @@ restore_backup(pgBackup *backup, parray *dest_external_dirs, parray *dest_files)
 	{
 		restore_files_arg *arg = &(threads_args[i]);
 
-		arg->files = files;
-		arg->backup = backup;
-		arg->external_dirs = external_dirs;
-		arg->external_prefix = external_prefix;
-		arg->dest_external_dirs = dest_external_dirs;
 		arg->dest_files = dest_files;
+		arg->scheduler = scheduler;
+		arg->chain = chain;
+		arg->n_chain = n_chain;
+		arg->dest_external_dirs = dest_external_dirs;
 		/* By default there are some error */
 		threads_args[i].ret = 1;
 
 		/* Useless message TODO: rewrite */
-		elog(LOG, "Start thread for num:%zu", parray_num(files));
+		elog(LOG, "Start thread for num:%zu", parray_num(dest_files));
 
 		pthread_create(&threads[i], NULL, restore_files, arg);
 	}
@@ -636,15 +682,20 @@ restore_backup(pgBackup *backup, parray *dest_external_dirs, parray *dest_files)
 
 	pfree(threads);
 	pfree(threads_args);
+	file_scheduler_free(scheduler);
 
 	/* cleanup */
-	parray_walk(files, pgFileFree);
-	parray_free(files);
+	for (i = 0; i < n_chain; i++)
+	{
+		parray_walk(chain[i].files, pgFileFree);
+		parray_free(chain[i].files);
 
-	if (external_dirs != NULL)
-		free_dir_list(external_dirs);
+		if (chain[i].external_dirs != NULL)
+			free_dir_list(chain[i].external_dirs);
+	}
+	pfree(chain);
 
-	elog(LOG, "Restore %s backup completed", base36enc(backup->start_time));
+	elog(LOG, "Restore of %d backups completed", n_chain);
 }
 
 /*
@@ -653,19 +704,22 @@ restore_backup(pgBackup *backup, parray *dest_external_dirs, parray *dest_files)
 static void *
 restore_files(void *arg)
 {
-	int			i;
 	restore_files_arg *arguments = (restore_files_arg *)arg;
+	RestoreFileSource *sources;
+	pgFile	   *dest_file;
+	int			device = -1;
+	int			num;
 
-	for (i = 0; i < parray_num(arguments->files); i++)
-	{
-		char		from_root[MAXPGPATH];
-		pgFile	   *file = (pgFile *) parray_get(arguments->files, i);
-
-		if (!pg_atomic_test_set_flag(&file->lock))
-			continue;
+	sources = (RestoreFileSource *) palloc(sizeof(RestoreFileSource) *
+										   arguments->n_chain);
 
-		pgBackupGetPath(arguments->backup, from_root,
-						lengthof(from_root), DATABASE_DIR);
+	while ((dest_file = file_scheduler_next(arguments->scheduler, &device,
+											&num)) != NULL)
+	{
+		pgFile	   *file = NULL;
+		restore_chain_item *item = NULL;
+		int			n_sources = 0;
+		int			j;
 
 		/* check for interrupt */
 		if (interrupted || thread_interrupted)
@@ -673,48 +727,53 @@ restore_files(void *arg)
 
 		if (progress)
 			elog(INFO, "Progress: (%d/%lu). Process file %s ",
-				 i + 1, (unsigned long) parray_num(arguments->files),
-				 file->rel_path);
-
-		/*
-		 * For PAGE and PTRACK backups skip datafiles which haven't changed
-		 * since previous backup and thus were not backed up.
-		 * We cannot do the same when restoring DELTA backup because we need information
-		 * about every datafile to correctly truncate them.
-		 */
-		if (file->write_size == BYTES_INVALID)
-		{
-			/* data file, only PAGE and PTRACK can skip */
-			if (((file->is_datafile && !file->is_cfs) &&
-				(arguments->backup->backup_mode == BACKUP_MODE_DIFF_PAGE ||
-				 arguments->backup->backup_mode == BACKUP_MODE_DIFF_PTRACK)) ||
-				/* non-data file can be skipped regardless of backup type */
-				!(file->is_datafile && !file->is_cfs))
-			{
-				elog(VERBOSE, "The file didn`t change. Skip restore: \"%s\"", file->path);
-				continue;
-			}
-		}
+				 num, (unsigned long) parray_num(arguments->dest_files),
+				 dest_file->rel_path);
 
 		/* Directories were created before */
-		if (S_ISDIR(file->mode))
+		if (S_ISDIR(dest_file->mode))
 			continue;
 
 		/* Do not restore tablespace_map file */
-		if (path_is_prefix_of_path(PG_TABLESPACE_MAP_FILE, file->rel_path))
+		if (path_is_prefix_of_path(PG_TABLESPACE_MAP_FILE, dest_file->rel_path))
 		{
 			elog(VERBOSE, "Skip tablespace_map");
 			continue;
 		}
 
 		/* Do no restore external directory file if a user doesn't want */
-		if (skip_external_dirs && file->external_dir_num > 0)
+		if (skip_external_dirs && dest_file->external_dir_num > 0)
 			continue;
 
-		/* Skip unnecessary file */
-		if (parray_bsearch(arguments->dest_files, file,
-						   pgFileCompareRelPathWithExternal) == NULL)
-			continue;
+		/*
+		 * Find copies of the file in the backups of the chain, from the newest
+		 * one. Non-data files are taken from the newest backup which copied
+		 * them.
+		 */
+		for (j = 0; j < arguments->n_chain; j++)
+		{
+			restore_chain_item *cur = &arguments->chain[j];
+			pgFile	  **found;
+
+			found = (pgFile **) parray_bsearch(cur->files, dest_file,
+											   pgFileCompareRelPathWithExternal);
+			if (found == NULL)
+				continue;
+
+			if (dest_file->is_datafile && !dest_file->is_cfs)
+			{
+				sources[n_sources].file = *found;
+				sources[n_sources].backup_version = cur->backup_version;
+				sources[n_sources].index_path = cur->index_path;
+				n_sources++;
+			}
+			else if ((*found)->write_size != BYTES_INVALID)
+			{
+				file = *found;
+				item = cur;
+				break;
+			}
+		}
 
 		/*
 		 * restore the file.
@@ -723,21 +782,32 @@ restore_files(void *arg)
 		 * copy the file from backup.
 		 */
 		elog(VERBOSE, "Restoring file %s, is_datafile %i, is_cfs %i",
-			 file->path, file->is_datafile?1:0, file->is_cfs?1:0);
-		if (file->is_datafile && !file->is_cfs)
+			 dest_file->rel_path, dest_file->is_datafile?1:0,
+			 dest_file->is_cfs?1:0);
+		if (dest_file->is_datafile && !dest_file->is_cfs)
 		{
 			char		to_path[MAXPGPATH];
 
+			if (n_sources == 0)
+				continue;
+
 			join_path_components(to_path, instance_config.pgdata,
-								 file->rel_path);
-			restore_data_file(to_path, file,
-							  arguments->backup->backup_mode == BACKUP_MODE_DIFF_DELTA,
-							  false,
-							  parse_program_version(arguments->backup->program_version));
+								 dest_file->rel_path);
+			restore_data_file_chain(to_path, sources, n_sources,
+									incremental_restore);
+			continue;
+		}
+
+		if (file == NULL)
+		{
+			elog(VERBOSE, "The file didn`t change. Skip restore: \"%s\"",
+				 dest_file->rel_path);
+			continue;
 		}
-		else if (file->external_dir_num)
+
+		if (file->external_dir_num)
 		{
-			char	   *external_path = parray_get(arguments->external_dirs,
+			char	   *external_path = parray_get(item->external_dirs,
 												   file->external_dir_num - 1);
 			if (backup_contains_external(external_path,
 										 arguments->dest_external_dirs))
@@ -745,7 +815,7 @@ restore_files(void *arg)
 						  external_path, FIO_DB_HOST, file, false);
 		}
 		else if (strcmp(file->name, "pg_control") == 0)
-			copy_pgcontrol_file(from_root, FIO_BACKUP_HOST,
+			copy_pgcontrol_file(item->database_path, FIO_BACKUP_HOST,
 								instance_config.pgdata, FIO_DB_HOST,
 								file);
 		else
@@ -754,17 +824,137 @@ restore_files(void *arg)
 					  file, false);
 
 		/* print size of restored file */
-		if (file->write_size != BYTES_INVALID)
-			elog(VERBOSE, "Restored file %s : " INT64_FORMAT " bytes",
-				 file->path, file->write_size);
+		elog(VERBOSE, "Restored file %s : " INT64_FORMAT " bytes",
+			 file->path, file->write_size);
 	}
 
+	pfree(sources);
+
+	/* Close connection with remote agent */
+	fio_disconnect();
+
 	/* Data files restoring is successful */
 	arguments->ret = 0;
 
 	return NULL;
 }
 
+/*
+ * Check that the existing PGDATA can be used as the destination of the
+ * incremental restore: the server is stopped and it is the same cluster.
+ */
+static void
+check_incremental_destination(void)
+{
+	char		path[MAXPGPATH];
+	uint64		system_id;
+
+	join_path_components(path, instance_config.pgdata, "postmaster.pid");
+	if (fileExists(path, FIO_DB_HOST))
+		elog(ERROR, "Cannot restore incrementally into \"%s\": postmaster.pid exists, "
+			 "stop the server first", instance_config.pgdata);
+
+	join_path_components(path, instance_config.pgdata, XLOG_CONTROL_FILE);
+	if (!fileExists(path, FIO_DB_HOST))
+	{
+		if (!dir_is_empty(instance_config.pgdata, FIO_DB_HOST))
+			elog(ERROR, "restore destination is not empty and is not a database cluster: \"%s\"",
+				 instance_config.pgdata);
+		return;
+	}
+
+	system_id = get_system_identifier(instance_config.pgdata);
+	if (system_id != instance_config.system_identifier)
+		elog(ERROR, "Cannot restore incrementally into \"%s\": database system identifier "
+			 UINT64_FORMAT " differs from the instance one " UINT64_FORMAT,
+			 instance_config.pgdata, system_id,
+			 instance_config.system_identifier);
+}
+
+/*
+ * Remove symbolic links of pg_tblspc directory of the existing PGDATA,
+ * create_data_directories() creates them again. Contents of the tablespaces
+ * are kept.
+ */
+static void
+remove_tablespace_links(void)
+{
+	char		tblspc_path[MAXPGPATH];
+	DIR		   *dir;
+	struct dirent *dent;
+
+	join_path_components(tblspc_path, instance_config.pgdata, PG_TBLSPC_DIR);
+	dir = fio_opendir(tblspc_path, FIO_DB_HOST);
+	if (dir == NULL)
+	{
+		if (errno == ENOENT)
+			return;
+		elog(ERROR, "Cannot open directory \"%s\": %s", tblspc_path,
+			 strerror(errno));
+	}
+
+	while ((dent = fio_readdir(dir)) != NULL)
+	{
+		char		link_path[MAXPGPATH];
+		struct stat	st;
+
+		if (strcmp(dent->d_name, ".") == 0 || strcmp(dent->d_name, "..") == 0)
+			continue;
+
+		join_path_components(link_path, tblspc_path, dent->d_name);
+		if (fio_stat(link_path, &st, false, FIO_DB_HOST) == 0 &&
+			S_ISLNK(st.st_mode))
+		{
+			elog(VERBOSE, "Remove symbolic link \"%s\"", link_path);
+			if (fio_unlink(link_path, FIO_DB_HOST) != 0)
+				elog(ERROR, "Cannot remove symbolic link \"%s\": %s",
+					 link_path, strerror(errno));
+		}
+	}
+	fio_closedir(dir);
+}
+
+/*
+ * Remove files and directories of the existing PGDATA which are absent
+ * in the backup being restored.
+ */
+static void
+remove_extra_files(parray *dest_files)
+{
+	parray	   *files = parray_new();
+	int			i;
+	int			n_removed = 0;
+
+	dir_list_file(files, instance_config.pgdata, false, true, false, 0,
+				  FIO_DB_HOST);
+
+	/* Remove the contents of directories before them */
+	parray_qsort(files, pgFileComparePathDesc);
+
+	for (i = 0; i < parray_num(files); i++)
+	{
+		pgFile	   *file = (pgFile *) parray_get(files, i);
+		pgFile	  **dest_file;
+
+		dest_file = (pgFile **) parray_bsearch(dest_files, file,
+											   pgFileCompareRelPathWithExternal);
+		if (dest_file &&
+			S_ISDIR((*dest_file)->mode) == S_ISDIR(file->mode))
+			continue;
+
+		elog(VERBOSE, "Remove \"%s\"", file->path);
+		if (fio_unlink(file->path, FIO_DB_HOST) != 0)
+			elog(ERROR, "Cannot remove \"%s\": %s", file->path,
+				 strerror(errno));
+		n_removed++;
+	}
+
+	elog(INFO, "Removed %d files absent in the backup", n_removed);
+
+	parray_walk(files, pgFileFree);
+	parray_free(files);
+}
+
 /* Create recovery.conf with given recovery target parameters */
 static void
 create_recovery_conf(time_t backup_id,
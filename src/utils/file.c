@@ -2,46 +2,104 @@
 #include <unistd.h>
 #include <sys/stat.h>
 
-#ifdef WIN32
-#define __thread __declspec(thread)
-#else
+#ifndef WIN32
 #include <pthread.h>
+#include <sys/wait.h>
 #endif
 
 #include "pg_probackup.h"
 #include "file.h"
+#include "thread.h"
 #include "storage/checksum.h"
 
 #define PRINTF_BUF_SIZE  1024
 #define FILE_PERMISSIONS 0600
 #define PAGE_READ_ATTEMPTS 100
+#define FIO_BUFFER_SIZE  (64*1024)
+
+/*
+ * Buffer coalescing messages passed through the pipe. Requests which do not
+ * need a reply (write, seek, truncate) are accumulated by the master and sent
+ * together with the next request; the agent sends its replies when it runs
+ * out of already received requests.
+ */
+typedef struct
+{
+	int    fd;
+	size_t pos;  /* position of the first unread byte in input buffer */
+	size_t used; /* amount of data in the buffer */
+	char   data[FIO_BUFFER_SIZE];
+} fio_buffer;
 
 static __thread unsigned long fio_fdset = 0;
+static __thread unsigned long fio_wrset = 0; /* files with unacknowledged writes */
 static __thread void* fio_stdin_buffer;
-static __thread int fio_stdout = 0;
+static __thread fio_buffer* fio_output = NULL;
 static __thread int fio_stdin = 0;
+static __thread int fio_agent_pid = 0;
 
 fio_location MyLocation;
 
 typedef struct
 {
+	BlockNumber startBlock;
 	BlockNumber nblocks;
 	BlockNumber segBlockNum;
 	XLogRecPtr  horizonLsn;
 	uint32      checksumVersion;
 	int         calg;
 	int         clevel;
+	uint32      bitmapsize; /* size of pagemap following the request, 0 to send all blocks */
 } fio_send_request;
 
+/* Entry of FIO_CHECK_FILES request, followed by the path of the file */
+typedef struct
+{
+	int64       mtime;
+	int64       size;
+	pg_crc32    crc;
+	uint32      path_len;
+} fio_check_request;
+
+/* Maximal size of FIO_CHECK_FILES request, it must fit in fio_header.size */
+#define FIO_CHECK_BATCH_SIZE (512*1024)
+
+/* Entry of the directory tree sent in reply to FIO_LIST_TREE, followed by relative path */
+typedef struct
+{
+	uint32      mode;
+	uint32      rel_path_len;
+	int64       size;
+} fio_list_entry;
+
+/* Flags of FIO_LIST_TREE request passed in fio_header.arg */
+#define FIO_LIST_FOLLOW_SYMLINKS 1
+#define FIO_LIST_EXCLUDE         2
+
+/* Parameters of the directory tree walk done by the agent */
+typedef struct
+{
+	fio_buffer*  out;
+	bool         follow_symlinks;
+	char const** exclude_dirs; /* NULL terminated */
+	char const** black_list;   /* NULL terminated */
+	size_t       root_len;
+} fio_list_state;
+
 
 /* Convert FIO pseudo handle to index in file descriptor array */
 #define fio_fileno(f) (((size_t)f - 1) | FIO_PIPE_MARKER)
 
 /* Use specified file descriptors as stding/stdout for FIO functions */
-void fio_redirect(int in, int out)
+void fio_redirect(int in, int out, int pid)
 {
 	fio_stdin = in;
-	fio_stdout = out;
+	fio_agent_pid = pid;
+	if (fio_output == NULL)
+		fio_output = (fio_buffer*)pgut_malloc(sizeof(fio_buffer));
+	fio_output->fd = out;
+	fio_output->pos = 0;
+	fio_output->used = 0;
 }
 
 /* Check if file descriptor is local or remote (created by FIO) */
@@ -107,7 +165,7 @@ static int remove_file_or_dir(char const* path)
 #endif
 
 /* Check if specified location is local for current node */
-static bool fio_is_remote(fio_location location)
+bool fio_is_remote(fio_location location)
 {
 	bool is_remote = MyLocation != FIO_LOCAL_HOST
 		&& location != FIO_LOCAL_HOST
@@ -155,6 +213,112 @@ static ssize_t fio_write_all(int fd, void const* buf, size_t size)
 	return offs;
 }
 
+/* Send all data accumulated in the output buffer */
+static int fio_flush_buffer(fio_buffer* out)
+{
+	if (out->used != 0)
+	{
+		if (fio_write_all(out->fd, out->data, out->used) != (ssize_t)out->used)
+			return -1;
+		out->used = 0;
+	}
+	return 0;
+}
+
+/* Append data to the output buffer, sending the buffer when it is full */
+static ssize_t fio_write_buffered(fio_buffer* out, void const* buf, size_t size)
+{
+	if (out->used + size > FIO_BUFFER_SIZE)
+	{
+		if (fio_flush_buffer(out) < 0)
+			return -1;
+		if (size > FIO_BUFFER_SIZE)
+			return fio_write_all(out->fd, buf, size);
+	}
+	memcpy(out->data + out->used, buf, size);
+	out->used += size;
+	return size;
+}
+
+/*
+ * Read specified amount of bytes through the input buffer unless error or EOF
+ * are encountered. Pending output is sent before blocking on the pipe, so
+ * replies to all requests received in one read are sent in one write.
+ */
+static ssize_t fio_read_buffered(fio_buffer* in, fio_buffer* out, void* buf, size_t size)
+{
+	size_t offs = 0;
+	while (offs < size)
+	{
+		ssize_t rc;
+
+		if (in->pos < in->used)
+		{
+			size_t n = Min(in->used - in->pos, size - offs);
+			memcpy((char*)buf + offs, in->data + in->pos, n);
+			in->pos += n;
+			offs += n;
+			continue;
+		}
+		if (fio_flush_buffer(out) < 0)
+			return -1;
+
+		in->pos = in->used = 0;
+		if (size - offs >= FIO_BUFFER_SIZE)
+		{
+			/* No need to copy large messages through the buffer */
+			rc = fio_read_all(in->fd, (char*)buf + offs, size - offs);
+			return rc < 0 ? rc : offs + rc;
+		}
+		rc = read(in->fd, in->data, FIO_BUFFER_SIZE);
+		if (rc < 0) {
+			if (errno == EINTR) {
+				continue;
+			}
+			return rc;
+		} else if (rc == 0) {
+			break;
+		}
+		in->used = rc;
+	}
+	return offs;
+}
+
+/* Send pending requests to the agent and read its reply */
+static ssize_t fio_read_reply(void* buf, size_t size)
+{
+	if (fio_flush_buffer(fio_output) < 0)
+		return -1;
+	return fio_read_all(fio_stdin, buf, size);
+}
+
+/*
+ * Close connection with the agent of the current thread. Worker threads call
+ * it before exit, so agents do not outlive threads which spawned them.
+ * Connection is reestablished on demand by the next remote operation.
+ */
+void fio_disconnect(void)
+{
+	if (fio_stdin)
+	{
+		/* Send remaining requests, e.g. closing of files opened for reading */
+		fio_flush_buffer(fio_output);
+
+		close(fio_stdin);
+		close(fio_output->fd);
+		free(fio_output);
+		fio_output = NULL;
+		fio_stdin = 0;
+		fio_fdset = 0;
+		fio_wrset = 0;
+#ifndef WIN32
+		/* Agent exits when it gets EOF */
+		waitpid(fio_agent_pid, NULL, 0);
+#endif
+		fio_agent_pid = 0;
+	}
+}
+
 /* Open input stream. Remote file is fetched to the in-memory buffer and then accessed through Linux fmemopen */
 FILE* fio_open_stream(char const* path, fio_location location)
 {
@@ -165,16 +329,16 @@ FILE* fio_open_stream(char const* path, fio_location location)
 		hdr.cop = FIO_LOAD;
 		hdr.size = strlen(path) + 1;
 
-		IO_CHECK(fio_write_all(fio_stdout, &hdr, sizeof(hdr)), sizeof(hdr));
-		IO_CHECK(fio_write_all(fio_stdout, path, hdr.size), hdr.size);
+		IO_CHECK(fio_write_buffered(fio_output, &hdr, sizeof(hdr)), sizeof(hdr));
+		IO_CHECK(fio_write_buffered(fio_output, path, hdr.size), hdr.size);
 
-		IO_CHECK(fio_read_all(fio_stdin, &hdr, sizeof(hdr)), sizeof(hdr));
+		IO_CHECK(fio_read_reply(&hdr, sizeof(hdr)), sizeof(hdr));
 		Assert(hdr.cop == FIO_SEND);
 		if (hdr.size > 0)
 		{
 			Assert(fio_stdin_buffer == NULL);
 			fio_stdin_buffer = pgut_malloc(hdr.size);
-			IO_CHECK(fio_read_all(fio_stdin, fio_stdin_buffer, hdr.size), hdr.size);
+			IO_CHECK(fio_read_reply(fio_stdin_buffer, hdr.size), hdr.size);
 #ifdef WIN32
 			f = tmpfile();
 			IO_CHECK(fwrite(f, 1, hdr.size, fio_stdin_buffer), hdr.size);
@@ -226,10 +390,10 @@ DIR* fio_opendir(char const* path, fio_location location)
 		hdr.size = strlen(path) + 1;
 		fio_fdset |= 1 << i;
 
-		IO_CHECK(fio_write_all(fio_stdout, &hdr, sizeof(hdr)), sizeof(hdr));
-		IO_CHECK(fio_write_all(fio_stdout, path, hdr.size), hdr.size);
+		IO_CHECK(fio_write_buffered(fio_output, &hdr, sizeof(hdr)), sizeof(hdr));
+		IO_CHECK(fio_write_buffered(fio_output, path, hdr.size), hdr.size);
 
-		IO_CHECK(fio_read_all(fio_stdin, &hdr, sizeof(hdr)), sizeof(hdr));
+		IO_CHECK(fio_read_reply(&hdr, sizeof(hdr)), sizeof(hdr));
 
 		if (hdr.arg != 0)
 		{
@@ -256,13 +420,13 @@ struct dirent* fio_readdir(DIR *dir)
 		hdr.cop = FIO_READDIR;
 		hdr.handle = (size_t)dir - 1;
 		hdr.size = 0;
-		IO_CHECK(fio_write_all(fio_stdout, &hdr, sizeof(hdr)), sizeof(hdr));
+		IO_CHECK(fio_write_buffered(fio_output, &hdr, sizeof(hdr)), sizeof(hdr));
 
-		IO_CHECK(fio_read_all(fio_stdin, &hdr, sizeof(hdr)), sizeof(hdr));
+		IO_CHECK(fio_read_reply(&hdr, sizeof(hdr)), sizeof(hdr));
 		Assert(hdr.cop == FIO_SEND);
 		if (hdr.size) {
 			Assert(hdr.size == sizeof(entry));
-			IO_CHECK(fio_read_all(fio_stdin, &entry, sizeof(entry)), sizeof(entry));
+			IO_CHECK(fio_read_reply(&entry, sizeof(entry)), sizeof(entry));
 		}
 
 		return hdr.size ? &entry : NULL;
@@ -273,6 +437,82 @@ struct dirent* fio_readdir(DIR *dir)
 	}
 }
 
+/*
+ * List the directory tree "root" of the remote host in one request.
+ * The agent walks the tree and streams back relative path, mode and size of
+ * every entry in pre-order, "callback" is called for each of them. Entries
+ * whose absolute paths are in black_list are skipped together with their
+ * content. Content of directories matching exclude_dirs (NULL terminated,
+ * may be NULL) is not listed, these rules are the same as in dir_check_file().
+ */
+void fio_list_tree(char const* root, bool follow_symlinks,
+				   char const** exclude_dirs, parray* black_list,
+				   fio_list_callback callback, void* arg,
+				   fio_location location)
+{
+	fio_header hdr;
+	size_t size = strlen(root) + 2;
+	char* buf = NULL;
+	size_t buf_size = 0;
+	int i;
+
+	Assert(fio_is_remote(location));
+
+	for (i = 0; exclude_dirs && exclude_dirs[i]; i++)
+		size += strlen(exclude_dirs[i]) + 1;
+	for (i = 0; black_list && i < parray_num(black_list); i++)
+		size += strlen((char*)parray_get(black_list, i)) + 1;
+
+	hdr.cop = FIO_LIST_TREE;
+	hdr.handle = -1;
+	hdr.size = size + 1;
+	hdr.arg = (follow_symlinks ? FIO_LIST_FOLLOW_SYMLINKS : 0)
+		| (exclude_dirs ? FIO_LIST_EXCLUDE : 0);
+
+	/* root, exclude_dirs and black_list, each list ends with empty string */
+	IO_CHECK(fio_write_buffered(fio_output, &hdr, sizeof(hdr)), sizeof(hdr));
+	IO_CHECK(fio_write_buffered(fio_output, root, strlen(root) + 1), strlen(root) + 1);
+	for (i = 0; exclude_dirs && exclude_dirs[i]; i++)
+		IO_CHECK(fio_write_buffered(fio_output, exclude_dirs[i], strlen(exclude_dirs[i]) + 1),
+				 strlen(exclude_dirs[i]) + 1);
+	IO_CHECK(fio_write_buffered(fio_output, "", 1), 1);
+	for (i = 0; black_list && i < parray_num(black_list); i++)
+	{
+		char* item = (char*)parray_get(black_list, i);
+		IO_CHECK(fio_write_buffered(fio_output, item, strlen(item) + 1), strlen(item) + 1);
+	}
+	IO_CHECK(fio_write_buffered(fio_output, "", 1), 1);
+
+	while (true)
+	{
+		IO_CHECK(fio_read_reply(&hdr, sizeof(hdr)), sizeof(hdr));
+		if (hdr.size > buf_size)
+		{
+			buf_size = hdr.size;
+			buf = (char*)pgut_realloc(buf, buf_size);
+		}
+		if (hdr.size != 0)
+			IO_CHECK(fio_read_reply(buf, hdr.size), hdr.size);
+
+		if (hdr.cop == FIO_LIST_TREE) /* end of the tree */
+		{
+			if (hdr.arg != 0)
+				elog(ERROR, "Cannot list directory \"%s\": %s",
+					 buf, strerror(hdr.arg));
+			break;
+		}
+		else
+		{
+			fio_list_entry entry;
+
+			Assert(hdr.cop == FIO_SEND);
+			memcpy(&entry, buf, sizeof(entry));
+			callback(buf + sizeof(entry), entry.mode, entry.size, arg);
+		}
+	}
+	pg_free(buf);
+}
+
 /* Close directory */
 int fio_closedir(DIR *dir)
 {
@@ -284,7 +524,7 @@ int fio_closedir(DIR *dir)
 		hdr.size = 0;
 		fio_fdset &= ~(1 << hdr.handle);
 
-		IO_CHECK(fio_write_all(fio_stdout, &hdr, sizeof(hdr)), sizeof(hdr));
+		IO_CHECK(fio_write_buffered(fio_output, &hdr, sizeof(hdr)), sizeof(hdr));
 		return 0;
 	}
 	else
@@ -314,10 +554,10 @@ int fio_open(char const* path, int mode, fio_location location)
 		hdr.arg = mode & ~O_EXCL;
 		fio_fdset |= 1 << i;
 
-		IO_CHECK(fio_write_all(fio_stdout, &hdr, sizeof(hdr)), sizeof(hdr));
-		IO_CHECK(fio_write_all(fio_stdout, path, hdr.size), hdr.size);
+		IO_CHECK(fio_write_buffered(fio_output, &hdr, sizeof(hdr)), sizeof(hdr));
+		IO_CHECK(fio_write_buffered(fio_output, path, hdr.size), hdr.size);
 
-		IO_CHECK(fio_read_all(fio_stdin, &hdr, sizeof(hdr)), sizeof(hdr));
+		IO_CHECK(fio_read_reply(&hdr, sizeof(hdr)), sizeof(hdr));
 
 		if (hdr.arg != 0)
 		{
@@ -388,11 +628,15 @@ int fio_fprintf(FILE* f, char const* format, ...)
 	return rc;
 }
 
-/* Flush stream data  (does nothing for remote file) */
+/* Flush stream data (for remote file only sends pending requests to the agent) */
 int fio_fflush(FILE* f)
 {
 	int rc = 0;
-	if (!fio_is_remote_file(f))
+	if (fio_is_remote_file(f))
+	{
+		rc = fio_flush_buffer(fio_output);
+	}
+	else
 	{
 		rc = fflush(f);
 		if (rc == 0) {
@@ -402,10 +646,10 @@ int fio_fflush(FILE* f)
 	return rc;
 }
 
-/* Sync file to the disk (does nothing for remote file) */
+/* Sync file to the disk (for remote file only sends pending requests to the agent) */
 int fio_flush(int fd)
 {
-	return fio_is_remote_fd(fd) ? 0 : fsync(fd);
+	return fio_is_remote_fd(fd) ? fio_flush_buffer(fio_output) : fsync(fd);
 }
 
 /* Close output stream */
@@ -416,7 +660,10 @@ int fio_fclose(FILE* f)
 		: fclose(f);
 }
 
-/* Close file */
+/*
+ * Close file. Errors of asynchronous writes, seeks and truncates are
+ * reported by the agent when the file is closed.
+ */
 int fio_close(int fd)
 {
 	if (fio_is_remote_fd(fd))
@@ -426,10 +673,23 @@ int fio_close(int fd)
 		hdr.cop = FIO_CLOSE;
 		hdr.handle = fd & ~FIO_PIPE_MARKER;
 		hdr.size = 0;
+		hdr.arg = (fio_wrset >> hdr.handle) & 1; /* wait for reply only if file was modified */
 		fio_fdset &= ~(1 << hdr.handle);
+		fio_wrset &= ~(1 << hdr.handle);
+
+		IO_CHECK(fio_write_buffered(fio_output, &hdr, sizeof(hdr)), sizeof(hdr));
 
-		IO_CHECK(fio_write_all(fio_stdout, &hdr, sizeof(hdr)), sizeof(hdr));
+		if (hdr.arg != 0)
+		{
+			IO_CHECK(fio_read_reply(&hdr, sizeof(hdr)), sizeof(hdr));
+			Assert(hdr.cop == FIO_CLOSE);
 
+			if (hdr.arg != 0)
+			{
+				errno = hdr.arg;
+				return -1;
+			}
+		}
 		return 0;
 	}
 	else
@@ -457,8 +717,9 @@ int fio_truncate(int fd, off_t size)
 		hdr.handle = fd & ~FIO_PIPE_MARKER;
 		hdr.size = 0;
 		hdr.arg = size;
+		fio_wrset |= 1 << hdr.handle;
 
-		IO_CHECK(fio_write_all(fio_stdout, &hdr, sizeof(hdr)), sizeof(hdr));
+		IO_CHECK(fio_write_buffered(fio_output, &hdr, sizeof(hdr)), sizeof(hdr));
 
 		return 0;
 	}
@@ -484,12 +745,12 @@ int fio_pread(FILE* f, void* buf, off_t offs)
 		hdr.size = 0;
 		hdr.arg = offs;
 
-		IO_CHECK(fio_write_all(fio_stdout, &hdr, sizeof(hdr)), sizeof(hdr));
+		IO_CHECK(fio_write_buffered(fio_output, &hdr, sizeof(hdr)), sizeof(hdr));
 
-		IO_CHECK(fio_read_all(fio_stdin, &hdr, sizeof(hdr)), sizeof(hdr));
+		IO_CHECK(fio_read_reply(&hdr, sizeof(hdr)), sizeof(hdr));
 		Assert(hdr.cop == FIO_SEND);
 		if (hdr.size != 0)
-			IO_CHECK(fio_read_all(fio_stdin, buf, hdr.size), hdr.size);
+			IO_CHECK(fio_read_reply(buf, hdr.size), hdr.size);
 
 		return hdr.arg;
 	}
@@ -516,8 +777,9 @@ int fio_seek(int fd, off_t offs)
 		hdr.handle = fd & ~FIO_PIPE_MARKER;
 		hdr.size = 0;
 		hdr.arg = offs;
+		fio_wrset |= 1 << hdr.handle;
 
-		IO_CHECK(fio_write_all(fio_stdout, &hdr, sizeof(hdr)), sizeof(hdr));
+		IO_CHECK(fio_write_buffered(fio_output, &hdr, sizeof(hdr)), sizeof(hdr));
 
 		return 0;
 	}
@@ -545,9 +807,10 @@ ssize_t fio_write(int fd, void const* buf, size_t size)
 		hdr.cop = FIO_WRITE;
 		hdr.handle = fd & ~FIO_PIPE_MARKER;
 		hdr.size = size;
+		fio_wrset |= 1 << hdr.handle;
 
-		IO_CHECK(fio_write_all(fio_stdout, &hdr, sizeof(hdr)), sizeof(hdr));
-		IO_CHECK(fio_write_all(fio_stdout, buf, size), size);
+		IO_CHECK(fio_write_buffered(fio_output, &hdr, sizeof(hdr)), sizeof(hdr));
+		IO_CHECK(fio_write_buffered(fio_output, buf, size), size);
 
 		return size;
 	}
@@ -579,11 +842,11 @@ ssize_t fio_read(int fd, void* buf, size_t size)
 		hdr.size = 0;
 		hdr.arg = size;
 
-		IO_CHECK(fio_write_all(fio_stdout, &hdr, sizeof(hdr)), sizeof(hdr));
+		IO_CHECK(fio_write_buffered(fio_output, &hdr, sizeof(hdr)), sizeof(hdr));
 
-		IO_CHECK(fio_read_all(fio_stdin, &hdr, sizeof(hdr)), sizeof(hdr));
+		IO_CHECK(fio_read_reply(&hdr, sizeof(hdr)), sizeof(hdr));
 		Assert(hdr.cop == FIO_SEND);
-		IO_CHECK(fio_read_all(fio_stdin, buf, hdr.size), hdr.size);
+		IO_CHECK(fio_read_reply(buf, hdr.size), hdr.size);
 
 		return hdr.size;
 	}
@@ -612,11 +875,11 @@ int fio_fstat(int fd, struct stat* st)
 		hdr.handle = fd & ~FIO_PIPE_MARKER;
 		hdr.size = 0;
 
-		IO_CHECK(fio_write_all(fio_stdout, &hdr, sizeof(hdr)), sizeof(hdr));
+		IO_CHECK(fio_write_buffered(fio_output, &hdr, sizeof(hdr)), sizeof(hdr));
 
-		IO_CHECK(fio_read_all(fio_stdin, &hdr, sizeof(hdr)), sizeof(hdr));
+		IO_CHECK(fio_read_reply(&hdr, sizeof(hdr)), sizeof(hdr));
 		Assert(hdr.cop == FIO_FSTAT);
-		IO_CHECK(fio_read_all(fio_stdin, st, sizeof(*st)), sizeof(*st));
+		IO_CHECK(fio_read_reply(st, sizeof(*st)), sizeof(*st));
 
 		if (hdr.arg != 0)
 		{
@@ -644,12 +907,12 @@ int fio_stat(char const* path, struct stat* st, bool follow_symlinks, fio_locati
 		hdr.arg = follow_symlinks;
 		hdr.size = path_len;
 
-		IO_CHECK(fio_write_all(fio_stdout, &hdr, sizeof(hdr)), sizeof(hdr));
-		IO_CHECK(fio_write_all(fio_stdout, path, path_len), path_len);
+		IO_CHECK(fio_write_buffered(fio_output, &hdr, sizeof(hdr)), sizeof(hdr));
+		IO_CHECK(fio_write_buffered(fio_output, path, path_len), path_len);
 
-		IO_CHECK(fio_read_all(fio_stdin, &hdr, sizeof(hdr)), sizeof(hdr));
+		IO_CHECK(fio_read_reply(&hdr, sizeof(hdr)), sizeof(hdr));
 		Assert(hdr.cop == FIO_STAT);
-		IO_CHECK(fio_read_all(fio_stdin, st, sizeof(*st)), sizeof(*st));
+		IO_CHECK(fio_read_reply(st, sizeof(*st)), sizeof(*st));
 
 		if (hdr.arg != 0)
 		{
@@ -676,10 +939,10 @@ int fio_access(char const* path, int mode, fio_location location)
 		hdr.size = path_len;
 		hdr.arg = mode;
 
-		IO_CHECK(fio_write_all(fio_stdout, &hdr, sizeof(hdr)), sizeof(hdr));
-		IO_CHECK(fio_write_all(fio_stdout, path, path_len), path_len);
+		IO_CHECK(fio_write_buffered(fio_output, &hdr, sizeof(hdr)), sizeof(hdr));
+		IO_CHECK(fio_write_buffered(fio_output, path, path_len), path_len);
 
-		IO_CHECK(fio_read_all(fio_stdin, &hdr, sizeof(hdr)), sizeof(hdr));
+		IO_CHECK(fio_read_reply(&hdr, sizeof(hdr)), sizeof(hdr));
 		Assert(hdr.cop == FIO_ACCESS);
 
 		if (hdr.arg != 0)
@@ -695,6 +958,269 @@ int fio_access(char const* path, int mode, fio_location location)
 	}
 }
 
+/*
+ * Check that the file is older than mtime and has the expected size
+ * and CRC. Any error is treated as a change of the file.
+ */
+static bool fio_file_is_unchanged(char const* path, int64 mtime, int64 size, pg_crc32 expected_crc)
+{
+	struct stat st;
+	char buf[BLCKSZ];
+	pg_crc32 crc;
+	ssize_t rc;
+	int fd;
+
+	if (stat(path, &st) < 0 || !S_ISREG(st.st_mode) ||
+		st.st_mtime >= mtime || st.st_size != size)
+		return false;
+
+	fd = open(path, O_RDONLY | PG_BINARY, 0);
+	if (fd < 0)
+		return false;
+
+	INIT_FILE_CRC32(true, crc);
+	while ((rc = read(fd, buf, sizeof(buf))) > 0)
+		COMP_FILE_CRC32(true, crc, buf, rc);
+	FIN_FILE_CRC32(true, crc);
+	close(fd);
+
+	return rc == 0 && EQ_TRADITIONAL_CRC32(crc, expected_crc);
+}
+
+/*
+ * Check which files are not changed: unchanged file is older than its "mtime"
+ * and has the same size and CRC. Remote files are checked by the agent in
+ * batches, one round trip per batch instead of reading every file.
+ */
+void fio_check_unchanged_files(fio_file_check* files, int n_files, fio_location location)
+{
+	int i = 0;
+
+	if (n_files == 0)
+		return;
+
+	if (fio_is_remote(location))
+	{
+		char* result = (char*)pgut_malloc(n_files);
+
+		while (i < n_files)
+		{
+			fio_header hdr;
+			size_t size = 0;
+			int first = i;
+			int j;
+
+			/* Put as many files as possible into one request */
+			for (; i < n_files; i++)
+			{
+				size_t len = sizeof(fio_check_request) + strlen(files[i].path) + 1;
+				if (i > first && size + len > FIO_CHECK_BATCH_SIZE)
+					break;
+				size += len;
+			}
+			hdr.cop = FIO_CHECK_FILES;
+			hdr.handle = -1;
+			hdr.size = size;
+			hdr.arg = i - first;
+
+			IO_CHECK(fio_write_buffered(fio_output, &hdr, sizeof(hdr)), sizeof(hdr));
+			for (j = first; j < i; j++)
+			{
+				fio_check_request req;
+				req.mtime = files[j].mtime;
+				req.size = files[j].size;
+				req.crc = files[j].crc;
+				req.path_len = strlen(files[j].path) + 1;
+				IO_CHECK(fio_write_buffered(fio_output, &req, sizeof(req)), sizeof(req));
+				IO_CHECK(fio_write_buffered(fio_output, files[j].path, req.path_len), req.path_len);
+			}
+
+			IO_CHECK(fio_read_reply(&hdr, sizeof(hdr)), sizeof(hdr));
+			Assert(hdr.cop == FIO_CHECK_FILES);
+			Assert(hdr.size == (unsigned)(i - first));
+			IO_CHECK(fio_read_reply(result, hdr.size), hdr.size);
+
+			for (j = first; j < i; j++)
+				files[j].unchanged = result[j - first] != 0;
+		}
+		free(result);
+	}
+	else
+	{
+		for (; i < n_files; i++)
+		{
+			if (interrupted)
+				elog(ERROR, "interrupted during CRC calculation");
+			files[i].unchanged = fio_file_is_unchanged(files[i].path, files[i].mtime,
+													   files[i].size, files[i].crc);
+		}
+	}
+}
+
+/*
+ * Send entries of directory "path" and its subdirectories in reply to
+ * FIO_LIST_TREE. Returns 0 or errno, in the last case "path" contains
+ * path of the failed file or directory.
+ */
+static int fio_list_tree_walk(fio_list_state* state, char* path)
+{
+	size_t len = strlen(path);
+	struct dirent* dent;
+	DIR* dir;
+	int rc = 0;
+	int i;
+
+	dir = opendir(path);
+	if (dir == NULL)
+		return errno == ENOENT ? 0 : errno; /* maybe the directory was removed */
+
+	while (true)
+	{
+		fio_header hdr;
+		fio_list_entry entry;
+		struct stat st;
+		char* rel_path;
+		bool skip = false;
+
+		errno = 0;
+		dent = readdir(dir);
+		if (dent == NULL)
+		{
+			if (errno != 0 && errno != ENOENT)
+				rc = errno;
+			break;
+		}
+		if (strcmp(dent->d_name, ".") == 0 || strcmp(dent->d_name, "..") == 0)
+			continue;
+
+		snprintf(path + len, MAXPGPATH - len, "/%s", dent->d_name);
+		if ((state->follow_symlinks ? stat(path, &st) : lstat(path, &st)) < 0)
+		{
+			if (errno == ENOENT)
+				continue;
+			rc = errno;
+			closedir(dir);
+			return rc;
+		}
+
+		/* Skip if the entry is in black_list defined by user */
+		for (i = 0; state->black_list[i]; i++)
+			if (strcmp(path, state->black_list[i]) == 0)
+				skip = true;
+		if (skip)
+			continue;
+
+		rel_path = path + state->root_len + 1;
+		entry.mode = st.st_mode;
+		entry.size = st.st_size;
+		entry.rel_path_len = strlen(rel_path) + 1;
+		hdr.cop = FIO_SEND;
+		hdr.size = sizeof(entry) + entry.rel_path_len;
+		IO_CHECK(fio_write_buffered(state->out, &hdr, sizeof(hdr)), sizeof(hdr));
+		IO_CHECK(fio_write_buffered(state->out, &entry, sizeof(entry)), sizeof(entry));
+		IO_CHECK(fio_write_buffered(state->out, rel_path, entry.rel_path_len), entry.rel_path_len);
+
+		if (!S_ISDIR(st.st_mode))
+			continue;
+
+		/* Do not list content of excluded directories */
+		if (state->exclude_dirs && !path_is_prefix_of_path(PG_TBLSPC_DIR, rel_path))
+		{
+			for (i = 0; state->exclude_dirs[i]; i++)
+			{
+				if (state->exclude_dirs[i][0] == '/'
+					? strcmp(path, state->exclude_dirs[i]) == 0
+					: strcmp(dent->d_name, state->exclude_dirs[i]) == 0)
+					skip = true;
+			}
+			if (skip)
+				continue;
+		}
+
+		rc = fio_list_tree_walk(state, path);
+		if (rc != 0)
+		{
+			closedir(dir);
+			return rc;
+		}
+	}
+	closedir(dir);
+	path[len] = '\0';
+	return rc;
+}
+
+/* Parse FIO_LIST_TREE request and send the directory tree */
+static void fio_list_tree_impl(fio_buffer* out, char* buf, int flags)
+{
+	char path[MAXPGPATH];
+	char const** lists[2];
+	fio_list_state state;
+	fio_header hdr;
+	int rc;
+	int i;
+
+	strncpy(path, buf, MAXPGPATH);
+	buf += strlen(buf) + 1;
+
+	/* Split lists of strings into arrays */
+	for (i = 0; i < 2; i++)
+	{
+		char* p = buf;
+		int n = 0;
+
+		while (p[0] != '\0')
+		{
+			p += strlen(p) + 1;
+			n += 1;
+		}
+		lists[i] = (char const**)pgut_malloc(sizeof(char*) * (n + 1));
+		for (n = 0; buf[0] != '\0'; buf += strlen(buf) + 1)
+			lists[i][n++] = buf;
+		lists[i][n] = NULL;
+		buf += 1;
+	}
+
+	state.out = out;
+	state.follow_symlinks = (flags & FIO_LIST_FOLLOW_SYMLINKS) != 0;
+	state.exclude_dirs = (flags & FIO_LIST_EXCLUDE) ? lists[0] : NULL;
+	state.black_list = lists[1];
+	state.root_len = strlen(path);
+
+	rc = fio_list_tree_walk(&state, path);
+
+	hdr.cop = FIO_LIST_TREE;
+	hdr.arg = rc;
+	hdr.size = rc != 0 ? strlen(path) + 1 : 0;
+	IO_CHECK(fio_write_buffered(out, &hdr, sizeof(hdr)), sizeof(hdr));
+	if (hdr.size != 0)
+		IO_CHECK(fio_write_buffered(out, path, hdr.size), hdr.size);
+
+	free(lists[0]);
+	free(lists[1]);
+}
+
+/* Check files of FIO_CHECK_FILES request and send one byte per file: 1 if it is unchanged */
+static void fio_check_files_impl(fio_buffer* out, char* buf, int n_files)
+{
+	char* result = (char*)pgut_malloc(n_files);
+	fio_header hdr;
+	int i;
+
+	for (i = 0; i < n_files; i++)
+	{
+		fio_check_request req;
+		memcpy(&req, buf, sizeof(req));
+		buf += sizeof(req);
+		result[i] = fio_file_is_unchanged(buf, req.mtime, req.size, req.crc);
+		buf += req.path_len;
+	}
+	hdr.cop = FIO_CHECK_FILES;
+	hdr.size = n_files;
+	IO_CHECK(fio_write_buffered(out, &hdr, sizeof(hdr)), sizeof(hdr));
+	IO_CHECK(fio_write_buffered(out, result, n_files), n_files);
+	free(result);
+}
+
 /* Create symbolink link */
 int fio_symlink(char const* target, char const* link_path, fio_location location)
 {
@@ -707,9 +1233,10 @@ int fio_symlink(char const* target, char const* link_path, fio_location location
 		hdr.handle = -1;
 		hdr.size = target_len + link_path_len;
 
-		IO_CHECK(fio_write_all(fio_stdout, &hdr, sizeof(hdr)), sizeof(hdr));
-		IO_CHECK(fio_write_all(fio_stdout, target, target_len), target_len);
-		IO_CHECK(fio_write_all(fio_stdout, link_path, link_path_len), link_path_len);
+		IO_CHECK(fio_write_buffered(fio_output, &hdr, sizeof(hdr)), sizeof(hdr));
+		IO_CHECK(fio_write_buffered(fio_output, target, target_len), target_len);
+		IO_CHECK(fio_write_buffered(fio_output, link_path, link_path_len), link_path_len);
+		IO_CHECK(fio_flush_buffer(fio_output), 0);
 
 		return 0;
 	}
@@ -731,9 +1258,10 @@ int fio_rename(char const* old_path, char const* new_path, fio_location location
 		hdr.handle = -1;
 		hdr.size = old_path_len + new_path_len;
 
-		IO_CHECK(fio_write_all(fio_stdout, &hdr, sizeof(hdr)), sizeof(hdr));
-		IO_CHECK(fio_write_all(fio_stdout, old_path, old_path_len), old_path_len);
-		IO_CHECK(fio_write_all(fio_stdout, new_path, new_path_len), new_path_len);
+		IO_CHECK(fio_write_buffered(fio_output, &hdr, sizeof(hdr)), sizeof(hdr));
+		IO_CHECK(fio_write_buffered(fio_output, old_path, old_path_len), old_path_len);
+		IO_CHECK(fio_write_buffered(fio_output, new_path, new_path_len), new_path_len);
+		IO_CHECK(fio_flush_buffer(fio_output), 0);
 
 		return 0;
 	}
@@ -754,8 +1282,9 @@ int fio_unlink(char const* path, fio_location location)
 		hdr.handle = -1;
 		hdr.size = path_len;
 
-		IO_CHECK(fio_write_all(fio_stdout, &hdr, sizeof(hdr)), sizeof(hdr));
-		IO_CHECK(fio_write_all(fio_stdout, path, path_len), path_len);
+		IO_CHECK(fio_write_buffered(fio_output, &hdr, sizeof(hdr)), sizeof(hdr));
+		IO_CHECK(fio_write_buffered(fio_output, path, path_len), path_len);
+		IO_CHECK(fio_flush_buffer(fio_output), 0);
 
 		return 0;
 	}
@@ -777,10 +1306,10 @@ int fio_mkdir(char const* path, int mode, fio_location location)
 		hdr.size = path_len;
 		hdr.arg = mode;
 
-		IO_CHECK(fio_write_all(fio_stdout, &hdr, sizeof(hdr)), sizeof(hdr));
-		IO_CHECK(fio_write_all(fio_stdout, path, path_len), path_len);
+		IO_CHECK(fio_write_buffered(fio_output, &hdr, sizeof(hdr)), sizeof(hdr));
+		IO_CHECK(fio_write_buffered(fio_output, path, path_len), path_len);
 
-		IO_CHECK(fio_read_all(fio_stdin, &hdr, sizeof(hdr)), sizeof(hdr));
+		IO_CHECK(fio_read_reply(&hdr, sizeof(hdr)), sizeof(hdr));
 		Assert(hdr.cop == FIO_MKDIR);
 
 		return hdr.arg;
@@ -803,8 +1332,9 @@ int fio_chmod(char const* path, int mode, fio_location location)
 		hdr.size = path_len;
 		hdr.arg = mode;
 
-		IO_CHECK(fio_write_all(fio_stdout, &hdr, sizeof(hdr)), sizeof(hdr));
-		IO_CHECK(fio_write_all(fio_stdout, path, path_len), path_len);
+		IO_CHECK(fio_write_buffered(fio_output, &hdr, sizeof(hdr)), sizeof(hdr));
+		IO_CHECK(fio_write_buffered(fio_output, path, path_len), path_len);
+		IO_CHECK(fio_flush_buffer(fio_output), 0);
 
 		return 0;
 	}
@@ -1088,7 +1618,7 @@ z_off_t fio_gzseek(gzFile f, z_off_t offset, int whence)
 #endif
 
 /* Send file content */
-static void fio_send_file(int out, char const* path)
+static void fio_send_file(fio_buffer* out, char const* path)
 {
 	int fd = open(path, O_RDONLY);
 	fio_header hdr;
@@ -1106,46 +1636,59 @@ static void fio_send_file(int out, char const* path)
 		hdr.size = size;
 		SYS_CHECK(close(fd));
 	}
-	IO_CHECK(fio_write_all(out, &hdr, sizeof(hdr)), sizeof(hdr));
+	IO_CHECK(fio_write_buffered(out, &hdr, sizeof(hdr)), sizeof(hdr));
 	if (buf)
 	{
-		IO_CHECK(fio_write_all(out, buf, hdr.size), hdr.size);
+		IO_CHECK(fio_write_buffered(out, buf, hdr.size), hdr.size);
 		free(buf);
 	}
 }
 
+/*
+ * Send blocks [startBlock, endBlock) of the data file to the agent for
+ * reading, checking and compression. If pagemap is not NULL, only blocks
+ * marked in it are sent. Returns number of processed blocks (number of sent
+ * blocks in case of pagemap) or negative error code.
+ */
 int fio_send_pages(FILE* in, FILE* out, pgFile *file,
-				   XLogRecPtr horizonLsn, BlockNumber* nBlocksSkipped, int calg, int clevel)
+				   BlockNumber startBlock, BlockNumber endBlock,
+				   XLogRecPtr horizonLsn, datapagemap_t* pagemap,
+				   BlockNumber* nBlocksSkipped, bool* truncated,
+				   int calg, int clevel)
 {
 	struct {
 		fio_header hdr;
 		fio_send_request arg;
 	} req;
 	BlockNumber	n_blocks_read = 0;
-	BlockNumber blknum = 0;
+	BlockNumber blknum = startBlock;
 
 	Assert(fio_is_remote_file(in));
 
 	req.hdr.cop = FIO_SEND_PAGES;
-	req.hdr.size = sizeof(fio_send_request);
 	req.hdr.handle = fio_fileno(in) & ~FIO_PIPE_MARKER;
 
-	req.arg.nblocks = file->size/BLCKSZ;
+	req.arg.startBlock = startBlock;
+	req.arg.nblocks = endBlock;
 	req.arg.segBlockNum = file->segno * RELSEG_SIZE;
 	req.arg.horizonLsn = horizonLsn;
 	req.arg.checksumVersion = current.checksum_version;
 	req.arg.calg = calg;
 	req.arg.clevel = clevel;
+	req.arg.bitmapsize = pagemap != NULL ? pagemap->bitmapsize : 0;
+	req.hdr.size = sizeof(fio_send_request) + req.arg.bitmapsize;
 
 	file->compress_alg = calg;
 
-	IO_CHECK(fio_write_all(fio_stdout, &req, sizeof(req)), sizeof(req));
+	IO_CHECK(fio_write_buffered(fio_output, &req, sizeof(req)), sizeof(req));
+	if (req.arg.bitmapsize != 0)
+		IO_CHECK(fio_write_buffered(fio_output, pagemap->bitmap, req.arg.bitmapsize), req.arg.bitmapsize);
 
 	while (true)
 	{
 		fio_header hdr;
 		char buf[BLCKSZ + sizeof(BackupPageHeader)];
-		IO_CHECK(fio_read_all(fio_stdin, &hdr, sizeof(hdr)), sizeof(hdr));
+		IO_CHECK(fio_read_reply(&hdr, sizeof(hdr)), sizeof(hdr));
 		Assert(hdr.cop == FIO_PAGE);
 
 		if (hdr.arg < 0) /* read error */
@@ -1156,9 +1699,12 @@ int fio_send_pages(FILE* in, FILE* out, pgFile *file,
 			break;
 
 		Assert(hdr.size <= sizeof(buf));
-		IO_CHECK(fio_read_all(fio_stdin, buf, hdr.size), hdr.size);
+		IO_CHECK(fio_read_reply(buf, hdr.size), hdr.size);
 
 		COMP_FILE_CRC32(true, file->crc, buf, hdr.size);
+		page_index_add(file, ((BackupPageHeader*)buf)->block,
+					   ((BackupPageHeader*)buf)->compressed_size,
+					   file->write_size);
 
 		if (fio_fwrite(out, buf, hdr.size) != hdr.size)
 		{
@@ -1173,28 +1719,45 @@ int fio_send_pages(FILE* in, FILE* out, pgFile *file,
 		if (((BackupPageHeader*)buf)->compressed_size == PageIsTruncated)
 		{
 			blknum += 1;
+			*truncated = true;
 			break;
 		}
 		file->read_size += BLCKSZ;
 	}
-	*nBlocksSkipped = blknum - n_blocks_read;
-	return blknum;
+	if (pagemap != NULL)
+	{
+		/* Blocks absent in the pagemap are not skipped, they are not changed */
+		*nBlocksSkipped = 0;
+		return n_blocks_read;
+	}
+	*nBlocksSkipped = blknum - startBlock - n_blocks_read;
+	return blknum - startBlock;
 }
 
-static void fio_send_pages_impl(int fd, int out, fio_send_request* req)
+static void fio_send_pages_impl(int fd, fio_buffer* out, fio_send_request* req)
 {
 	BlockNumber blknum;
 	char read_buffer[BLCKSZ+1];
+	unsigned char* bitmap = (unsigned char*)(req + 1);
 	fio_header hdr;
 
 	hdr.cop = FIO_PAGE;
 	read_buffer[BLCKSZ] = 1; /* barrier */
 
-	for (blknum = 0; blknum < req->nblocks; blknum++)
+	for (blknum = req->startBlock; blknum < req->nblocks; blknum++)
 	{
 		int retry_attempts = PAGE_READ_ATTEMPTS;
 		XLogRecPtr page_lsn = InvalidXLogRecPtr;
 
+		/* Skip blocks which are not marked in the pagemap */
+		if (req->bitmapsize != 0)
+		{
+			if (blknum / 8 >= req->bitmapsize)
+				break;
+			if ((bitmap[blknum / 8] & (1 << (blknum % 8))) == 0)
+				continue;
+		}
+
 		while (true)
 		{
 			ssize_t rc = pread(fd, read_buffer, BLCKSZ, blknum*BLCKSZ);
@@ -1206,7 +1769,7 @@ static void fio_send_pages_impl(int fd, int out, fio_send_request* req)
 					hdr.arg = -errno;
 					hdr.size = 0;
 					Assert(hdr.arg < 0);
-					IO_CHECK(fio_write_all(out, &hdr, sizeof(hdr)), sizeof(hdr));
+					IO_CHECK(fio_write_buffered(out, &hdr, sizeof(hdr)), sizeof(hdr));
 				}
 				else
 				{
@@ -1215,8 +1778,8 @@ static void fio_send_pages_impl(int fd, int out, fio_send_request* req)
 					bph.compressed_size = PageIsTruncated;
 					hdr.arg = blknum;
 					hdr.size = sizeof(bph);
-					IO_CHECK(fio_write_all(out, &hdr, sizeof(hdr)), sizeof(hdr));
-					IO_CHECK(fio_write_all(out, &bph, sizeof(bph)), sizeof(bph));
+					IO_CHECK(fio_write_buffered(out, &hdr, sizeof(hdr)), sizeof(hdr));
+					IO_CHECK(fio_write_buffered(out, &bph, sizeof(bph)), sizeof(bph));
 				}
 				return;
 			}
@@ -1242,7 +1805,7 @@ static void fio_send_pages_impl(int fd, int out, fio_send_request* req)
 			{
 				hdr.size = 0;
 				hdr.arg = PAGE_CHECKSUM_MISMATCH;
-				IO_CHECK(fio_write_all(out, &hdr, sizeof(hdr)), sizeof(hdr));
+				IO_CHECK(fio_write_buffered(out, &hdr, sizeof(hdr)), sizeof(hdr));
 				return;
 			}
 		}
@@ -1267,13 +1830,13 @@ static void fio_send_pages_impl(int fd, int out, fio_send_request* req)
 			}
 			hdr.size += MAXALIGN(bph->compressed_size);
 
-			IO_CHECK(fio_write_all(out, &hdr, sizeof(hdr)), sizeof(hdr));
-			IO_CHECK(fio_write_all(out, write_buffer, hdr.size), hdr.size);
+			IO_CHECK(fio_write_buffered(out, &hdr, sizeof(hdr)), sizeof(hdr));
+			IO_CHECK(fio_write_buffered(out, write_buffer, hdr.size), hdr.size);
 		}
 	}
 	hdr.size = 0;
 	hdr.arg = blknum;
-	IO_CHECK(fio_write_all(out, &hdr, sizeof(hdr)), sizeof(hdr));
+	IO_CHECK(fio_write_buffered(out, &hdr, sizeof(hdr)), sizeof(hdr));
 }
 
 /* Execute commands at remote host */
@@ -1286,37 +1849,49 @@ void fio_communicate(int in, int out)
 	 */
 	int fd[FIO_FDMAX];
 	DIR* dir[FIO_FDMAX];
+	/*
+	 * Errors of write, seek and truncate are not reported immediately:
+	 * the first one is remembered and returned when the file is closed.
+	 */
+	int fd_errno[FIO_FDMAX];
 	struct dirent* entry;
 	size_t buf_size = 128*1024;
 	char* buf = (char*)pgut_malloc(buf_size);
+	fio_buffer* input = (fio_buffer*)pgut_malloc(sizeof(fio_buffer));
+	fio_buffer* output = (fio_buffer*)pgut_malloc(sizeof(fio_buffer));
 	fio_header hdr;
 	struct stat st;
 	int rc;
 
+	input->fd = in;
+	input->pos = input->used = 0;
+	output->fd = out;
+	output->pos = output->used = 0;
+
 #ifdef WIN32
     SYS_CHECK(setmode(in, _O_BINARY));
     SYS_CHECK(setmode(out, _O_BINARY));
 #endif
 
     /* Main loop until command of processing master command */
-	while ((rc = fio_read_all(in, &hdr, sizeof hdr)) == sizeof(hdr)) {
+	while ((rc = fio_read_buffered(input, output, &hdr, sizeof hdr)) == sizeof(hdr)) {
 		if (hdr.size != 0) {
 			if (hdr.size > buf_size) {
 				/* Extend buffer on demand */
 				buf_size = hdr.size;
 				buf = (char*)realloc(buf, buf_size);
 			}
-			IO_CHECK(fio_read_all(in, buf, hdr.size), hdr.size);
+			IO_CHECK(fio_read_buffered(input, output, buf, hdr.size), hdr.size);
 		}
 		switch (hdr.cop) {
 		  case FIO_LOAD: /* Send file content */
-			fio_send_file(out, buf);
+			fio_send_file(output, buf);
 			break;
 		  case FIO_OPENDIR: /* Open directory for traversal */
 			dir[hdr.handle] = opendir(buf);
 			hdr.arg = dir[hdr.handle] == NULL ? errno : 0;
 			hdr.size = 0;
-			IO_CHECK(fio_write_all(out, &hdr, sizeof(hdr)), sizeof(hdr));
+			IO_CHECK(fio_write_buffered(output, &hdr, sizeof(hdr)), sizeof(hdr));
 			break;
 		  case FIO_READDIR: /* Get next directory entry */
 			hdr.cop = FIO_SEND;
@@ -1324,13 +1899,13 @@ void fio_communicate(int in, int out)
 			if (entry != NULL)
 			{
 				hdr.size = sizeof(*entry);
-				IO_CHECK(fio_write_all(out, &hdr, sizeof(hdr)), sizeof(hdr));
-				IO_CHECK(fio_write_all(out, entry, hdr.size), hdr.size);
+				IO_CHECK(fio_write_buffered(output, &hdr, sizeof(hdr)), sizeof(hdr));
+				IO_CHECK(fio_write_buffered(output, entry, hdr.size), hdr.size);
 			}
 			else
 			{
 				hdr.size = 0;
-				IO_CHECK(fio_write_all(out, &hdr, sizeof(hdr)), sizeof(hdr));
+				IO_CHECK(fio_write_buffered(output, &hdr, sizeof(hdr)), sizeof(hdr));
 			}
 			break;
 		  case FIO_CLOSEDIR: /* Finish directory traversal */
@@ -1338,15 +1913,30 @@ void fio_communicate(int in, int out)
 			break;
 		  case FIO_OPEN: /* Open file */
 			fd[hdr.handle] = open(buf, hdr.arg, FILE_PERMISSIONS);
+			fd_errno[hdr.handle] = 0;
 			hdr.arg = fd[hdr.handle] < 0 ? errno : 0;
 			hdr.size = 0;
-			IO_CHECK(fio_write_all(out, &hdr, sizeof(hdr)), sizeof(hdr));
+			IO_CHECK(fio_write_buffered(output, &hdr, sizeof(hdr)), sizeof(hdr));
 			break;
-		  case FIO_CLOSE: /* Close file */
-			SYS_CHECK(close(fd[hdr.handle]));
+		  case FIO_CLOSE: /* Close file and report deferred error if requested */
+			rc = close(fd[hdr.handle]);
+			if (hdr.arg != 0)
+			{
+				hdr.arg = fd_errno[hdr.handle] != 0 ? fd_errno[hdr.handle]
+					: rc < 0 ? errno : 0;
+				hdr.size = 0;
+				IO_CHECK(fio_write_buffered(output, &hdr, sizeof(hdr)), sizeof(hdr));
+			}
+			else
+				SYS_CHECK(rc);
 			break;
 		  case FIO_WRITE: /* Write to the current position in file */
-			IO_CHECK(fio_write_all(fd[hdr.handle], buf, hdr.size), hdr.size);
+			if (fd_errno[hdr.handle] == 0)
+			{
+				errno = 0;
+				if (fio_write_all(fd[hdr.handle], buf, hdr.size) != hdr.size)
+					fd_errno[hdr.handle] = errno != 0 ? errno : ENOSPC;
+			}
 			break;
 		  case FIO_READ: /* Read from the current position in file */
 			if ((size_t)hdr.arg > buf_size) {
@@ -1356,36 +1946,36 @@ void fio_communicate(int in, int out)
 			rc = read(fd[hdr.handle], buf, hdr.arg);
 			hdr.cop = FIO_SEND;
 			hdr.size = rc > 0 ? rc : 0;
-			IO_CHECK(fio_write_all(out, &hdr, sizeof(hdr)), sizeof(hdr));
+			IO_CHECK(fio_write_buffered(output, &hdr, sizeof(hdr)), sizeof(hdr));
 			if (hdr.size != 0)
-				IO_CHECK(fio_write_all(out, buf, hdr.size), hdr.size);
+				IO_CHECK(fio_write_buffered(output, buf, hdr.size), hdr.size);
 			break;
 		  case FIO_PREAD: /* Read from specified position in file, ignoring pages beyond horizon of delta backup */
 			rc = pread(fd[hdr.handle], buf, BLCKSZ, hdr.arg);
 			hdr.cop = FIO_SEND;
 			hdr.arg = rc;
 			hdr.size = rc >= 0 ? rc : 0;
-			IO_CHECK(fio_write_all(out, &hdr, sizeof(hdr)), sizeof(hdr));
+			IO_CHECK(fio_write_buffered(output, &hdr, sizeof(hdr)), sizeof(hdr));
 			if (hdr.size != 0)
-				IO_CHECK(fio_write_all(out, buf, hdr.size),  hdr.size);
+				IO_CHECK(fio_write_buffered(output, buf, hdr.size),  hdr.size);
 			break;
 		  case FIO_FSTAT: /* Get information about opened file */
 			hdr.size = sizeof(st);
 			hdr.arg = fstat(fd[hdr.handle], &st) < 0 ? errno : 0;
-			IO_CHECK(fio_write_all(out, &hdr, sizeof(hdr)), sizeof(hdr));
-			IO_CHECK(fio_write_all(out, &st, sizeof(st)), sizeof(st));
+			IO_CHECK(fio_write_buffered(output, &hdr, sizeof(hdr)), sizeof(hdr));
+			IO_CHECK(fio_write_buffered(output, &st, sizeof(st)), sizeof(st));
 			break;
 		  case FIO_STAT: /* Get information about file with specified path */
 			hdr.size = sizeof(st);
 			rc = hdr.arg ? stat(buf, &st) : lstat(buf, &st);
 			hdr.arg = rc < 0 ? errno : 0;
-			IO_CHECK(fio_write_all(out, &hdr, sizeof(hdr)), sizeof(hdr));
-			IO_CHECK(fio_write_all(out, &st, sizeof(st)), sizeof(st));
+			IO_CHECK(fio_write_buffered(output, &hdr, sizeof(hdr)), sizeof(hdr));
+			IO_CHECK(fio_write_buffered(output, &st, sizeof(st)), sizeof(st));
 			break;
 		  case FIO_ACCESS: /* Check presence of file with specified name */
 			hdr.size = 0;
 			hdr.arg = access(buf, hdr.arg) < 0 ? errno  : 0;
-			IO_CHECK(fio_write_all(out, &hdr, sizeof(hdr)), sizeof(hdr));
+			IO_CHECK(fio_write_buffered(output, &hdr, sizeof(hdr)), sizeof(hdr));
 			break;
 		  case FIO_RENAME: /* Rename file */
 			SYS_CHECK(rename(buf, buf + strlen(buf) + 1));
@@ -1399,26 +1989,36 @@ void fio_communicate(int in, int out)
 		  case FIO_MKDIR:  /* Create direcory */
 			hdr.size = 0;
 			hdr.arg = dir_create_dir(buf, hdr.arg);
-			IO_CHECK(fio_write_all(out, &hdr, sizeof(hdr)), sizeof(hdr));
+			IO_CHECK(fio_write_buffered(output, &hdr, sizeof(hdr)), sizeof(hdr));
 			break;
 		  case FIO_CHMOD:  /* Change file mode */
 			SYS_CHECK(chmod(buf, hdr.arg));
 			break;
 		  case FIO_SEEK:   /* Set current position in file */
-			SYS_CHECK(lseek(fd[hdr.handle], hdr.arg, SEEK_SET));
+			if (fd_errno[hdr.handle] == 0 && lseek(fd[hdr.handle], hdr.arg, SEEK_SET) < 0)
+				fd_errno[hdr.handle] = errno;
 			break;
 		  case FIO_TRUNCATE: /* Truncate file */
-			SYS_CHECK(ftruncate(fd[hdr.handle], hdr.arg));
+			if (fd_errno[hdr.handle] == 0 && ftruncate(fd[hdr.handle], hdr.arg) < 0)
+				fd_errno[hdr.handle] = errno;
 			break;
 		  case FIO_SEND_PAGES:
-			Assert(hdr.size == sizeof(fio_send_request));
-			fio_send_pages_impl(fd[hdr.handle], out, (fio_send_request*)buf);
+			Assert(hdr.size == sizeof(fio_send_request) + ((fio_send_request*)buf)->bitmapsize);
+			fio_send_pages_impl(fd[hdr.handle], output, (fio_send_request*)buf);
+			break;
+		  case FIO_CHECK_FILES: /* Find files which are not changed since previous backup */
+			fio_check_files_impl(output, buf, hdr.arg);
+			break;
+		  case FIO_LIST_TREE: /* List directory tree */
+			fio_list_tree_impl(output, buf, hdr.arg);
 			break;
 		  default:
 			Assert(false);
 		}
 	}
 	free(buf);
+	free(input);
+	free(output);
 	if (rc != 0) { /* Not end of stream: normal pipe close */
 		perror("read");
 		exit(EXIT_FAILURE);
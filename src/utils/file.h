@@ -33,7 +33,9 @@ typedef enum
 	FIO_READDIR,
 	FIO_CLOSEDIR,
 	FIO_SEND_PAGES,
-	FIO_PAGE
+	FIO_PAGE,
+	FIO_CHECK_FILES,
+	FIO_LIST_TREE
 } fio_operations;
 
 typedef enum
@@ -59,12 +61,27 @@ typedef struct
 	unsigned arg;
 } fio_header;
 
+/* File checked by fio_check_unchanged_files() */
+typedef struct
+{
+	char const* path;
+	int64       mtime;     /* file should be modified before this time */
+	int64       size;      /* expected size of the file */
+	pg_crc32    crc;       /* expected CRC of the file */
+	bool        unchanged; /* result of the check */
+} fio_file_check;
+
+/* Called by fio_list_tree() for every entry of the directory tree */
+typedef void (*fio_list_callback)(char const* rel_path, mode_t mode, int64 size, void* arg);
+
 extern fio_location MyLocation;
 
 /* Check if FILE handle is local or remote (created by FIO) */
 #define fio_is_remote_file(file) ((size_t)(file) <= FIO_FDMAX)
 
-extern void    fio_redirect(int in, int out);
+extern bool    fio_is_remote(fio_location location);
+extern void    fio_redirect(int in, int out, int pid);
+extern void    fio_disconnect(void);
 extern void    fio_communicate(int in, int out);
 
 extern FILE*   fio_fopen(char const* name, char const* mode, fio_location location);
@@ -79,8 +96,11 @@ extern int     fio_fclose(FILE* f);
 extern int     fio_ffstat(FILE* f, struct stat* st);
 
 struct pgFile;
-extern  int    fio_send_pages(FILE* in, FILE* out, struct pgFile *file, XLogRecPtr horizonLsn, 
-							  BlockNumber* nBlocksSkipped, int calg, int clevel);
+struct datapagemap;
+extern  int    fio_send_pages(FILE* in, FILE* out, struct pgFile *file,
+							  BlockNumber startBlock, BlockNumber endBlock, XLogRecPtr horizonLsn,
+							  struct datapagemap* pagemap,
+							  BlockNumber* nBlocksSkipped, bool* truncated, int calg, int clevel);
 
 extern int     fio_open(char const* name, int mode, fio_location location);
 extern ssize_t fio_write(int fd, void const* buf, size_t size);
@@ -98,9 +118,14 @@ extern int     fio_mkdir(char const* path, int mode, fio_location location);
 extern int     fio_chmod(char const* path, int mode, fio_location location);
 extern int     fio_access(char const* path, int mode, fio_location location);
 extern int     fio_stat(char const* path, struct stat* st, bool follow_symlinks, fio_location location);
+extern void    fio_check_unchanged_files(fio_file_check* files, int n_files, fio_location location);
 extern DIR*    fio_opendir(char const* path, fio_location location);
 extern struct dirent * fio_readdir(DIR *dirp);
 extern int     fio_closedir(DIR *dirp);
+extern void    fio_list_tree(char const* root, bool follow_symlinks,
+							 char const** exclude_dirs, parray* black_list,
+							 fio_list_callback callback, void* arg,
+							 fio_location location);
 extern FILE*   fio_open_stream(char const* name, fio_location location);
 extern int     fio_close_stream(FILE* f);
 
@@ -4,6 +4,7 @@
 #include <sys/types.h>
 #include <sys/wait.h>
 #include <signal.h>
+#include <fcntl.h>
 
 #include "pg_probackup.h"
 #include "file.h"
@@ -52,13 +53,8 @@ static int split_options(int argc, char* argv[], int max_options, char* options)
 	return argc;
 }
 
-static int child_pid;
-#if 0
-static void kill_child(void)
-{
-	kill(child_pid, SIGTERM);
-}
-#endif
+/* Serializes spawning of agents by concurrent threads */
+static pthread_mutex_t agent_mutex = PTHREAD_MUTEX_INITIALIZER;
 
 #ifdef WIN32
 void launch_ssh(char* argv[])
@@ -84,6 +80,7 @@ bool launch_agent(void)
 	int ssh_argc;
 	int outfd[2];
 	int infd[2];
+	int child_pid;
 
 	ssh_argc = 0;
 #ifdef WIN32
@@ -158,10 +155,36 @@ bool launch_agent(void)
 			return false;
 		child_pid = GetProcessId((HANDLE)pid);
 #else
-	SYS_CHECK(pipe(infd));
-	SYS_CHECK(pipe(outfd));
+	pthread_lock(&agent_mutex);
 
-	SYS_CHECK(child_pid = fork());
+	if (pipe(infd) < 0 || pipe(outfd) < 0)
+	{
+		int			errno_tmp = errno;
+
+		pthread_mutex_unlock(&agent_mutex);
+		elog(ERROR, "Cannot create pipe for agent: %s", strerror(errno_tmp));
+	}
+
+	/*
+	 * Each thread has its own agent. Agents spawned by other threads must not
+	 * inherit the pipes, otherwise our agent doesn't get EOF when this thread
+	 * disconnects from it. Descriptors duplicated by dup2() in the child don't
+	 * have the flag. The mutex is held until the parent closes the ends used
+	 * by the child, so no other thread forks while they are open.
+	 */
+	SYS_CHECK(fcntl(infd[0], F_SETFD, FD_CLOEXEC));
+	SYS_CHECK(fcntl(infd[1], F_SETFD, FD_CLOEXEC));
+	SYS_CHECK(fcntl(outfd[0], F_SETFD, FD_CLOEXEC));
+	SYS_CHECK(fcntl(outfd[1], F_SETFD, FD_CLOEXEC));
+
+	child_pid = fork();
+	if (child_pid < 0)
+	{
+		int			errno_tmp = errno;
+
+		pthread_mutex_unlock(&agent_mutex);
+		elog(ERROR, "Cannot fork agent process: %s", strerror(errno_tmp));
+	}
 
 	if (child_pid == 0) { /* child */
 		SYS_CHECK(close(STDIN_FILENO));
@@ -182,9 +205,11 @@ bool launch_agent(void)
 		elog(LOG, "Spawn agent %d version %s", child_pid, PROGRAM_VERSION);
 		SYS_CHECK(close(infd[1]));  /* These are being used by the child */
 		SYS_CHECK(close(outfd[0]));
-		/*atexit(kill_child);*/
+#ifndef WIN32
+		pthread_mutex_unlock(&agent_mutex);
+#endif
 
-		fio_redirect(infd[0], outfd[1]); /* write to stdout */
+		fio_redirect(infd[0], outfd[1], child_pid); /* write to stdout */
 	}
 	return true;
 }
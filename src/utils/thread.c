@@ -11,6 +11,10 @@
 
 #include "thread.h"
 
+#ifndef WIN32
+#include <sys/time.h>
+#endif
+
 bool thread_interrupted = false;
 
 #ifdef WIN32
@@ -87,6 +91,13 @@ pthread_join(pthread_t th, void **thread_return)
 	return 0;
 }
 
+int
+pthread_cond_broadcast(pthread_cond_t *cond)
+{
+	WakeAllConditionVariable(cond);
+	return 0;
+}
+
 #endif   /* WIN32 */
 
 int
@@ -107,3 +118,38 @@ pthread_lock(pthread_mutex_t *mp)
 #endif
 	return pthread_mutex_lock(mp);
 }
+
+/*
+ * Wait on the condition variable at most msec milliseconds. The mutex should
+ * be locked by pthread_lock(). Returns ETIMEDOUT if the time is out.
+ */
+int
+pthread_cond_wait_ms(pthread_cond_t *cond, pthread_mutex_t *mp, long msec)
+{
+#ifdef WIN32
+	if (!SleepConditionVariableCS(cond, *mp, (DWORD) msec))
+	{
+		DWORD		err = GetLastError();
+
+		if (err == ERROR_TIMEOUT)
+			return ETIMEDOUT;
+		_dosmaperr(err);
+		return errno;
+	}
+	return 0;
+#else
+	struct timeval tv;
+	struct timespec ts;
+
+	gettimeofday(&tv, NULL);
+	ts.tv_sec = tv.tv_sec + msec / 1000;
+	ts.tv_nsec = tv.tv_usec * 1000L + (msec % 1000) * 1000000L;
+	if (ts.tv_nsec >= 1000000000L)
+	{
+		ts.tv_sec++;
+		ts.tv_nsec -= 1000000000L;
+	}
+
+	return pthread_cond_timedwait(cond, mp, &ts);
+#endif
+}
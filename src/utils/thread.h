@@ -21,8 +21,16 @@ typedef int pthread_attr_t;
 #define PTHREAD_MUTEX_INITIALIZER NULL //{ NULL, 0 }
 #define PTHREAD_ONCE_INIT false
 
+/* Use native condition variables, they work with critical sections */
+typedef CONDITION_VARIABLE pthread_cond_t;
+#define PTHREAD_COND_INITIALIZER CONDITION_VARIABLE_INIT
+
+/* Thread-local storage */
+#define __thread __declspec(thread)
+
 extern int pthread_create(pthread_t *thread, pthread_attr_t *attr, void *(*start_routine) (void *), void *arg);
 extern int pthread_join(pthread_t th, void **thread_return);
+extern int pthread_cond_broadcast(pthread_cond_t *cond);
 #else
 /* Use platform-dependent pthread capability */
 #include <pthread.h>
@@ -37,5 +45,7 @@ extern pthread_t main_tid;
 extern bool			thread_interrupted;
 
 extern int pthread_lock(pthread_mutex_t *mp);
+extern int pthread_cond_wait_ms(pthread_cond_t *cond, pthread_mutex_t *mp,
+								long msec);
 
 #endif   /* PROBACKUP_THREAD_H */
@@ -21,10 +21,16 @@ static void do_validate_instance(void);
 static bool corrupted_backup_found = false;
 static bool skipped_due_to_lock = false;
 
+/* Number of files read from the backup content list and validated at once */
+#define VALIDATE_FILES_BATCH	10000
+
 typedef struct
 {
 	const char *base_path;
+	const char *index_path;
 	parray	   *files;
+	int			first_num;		/* number of files in previous batches */
+	int			total_files;
 	bool		corrupted;
 	XLogRecPtr	stop_lsn;
 	uint32		checksum_version;
@@ -46,7 +52,12 @@ pgBackupValidate(pgBackup *backup)
 	char		base_path[MAXPGPATH];
 	char		external_prefix[MAXPGPATH];
 	char		path[MAXPGPATH];
+	char		index_path[MAXPGPATH];
+	FileListReader *reader;
 	parray	   *files;
+	pgFile	   *file;
+	int			total_files;
+	int			first_num = 0;
 	bool		corrupted = false;
 	bool		validation_isok = true;
 	/* arrays with meta info for multi threaded validate */
@@ -102,57 +113,79 @@ pgBackupValidate(pgBackup *backup)
 	pgBackupGetPath(backup, base_path, lengthof(base_path), DATABASE_DIR);
 	pgBackupGetPath(backup, external_prefix, lengthof(external_prefix), EXTERNAL_DIR);
 	pgBackupGetPath(backup, path, lengthof(path), DATABASE_FILE_LIST);
-	files = dir_read_file_list(base_path, external_prefix, path, FIO_BACKUP_HOST);
+	pgBackupGetPath(backup, index_path, lengthof(index_path), PAGE_INDEX_FILE);
 
-	/* setup threads */
-	for (i = 0; i < parray_num(files); i++)
-	{
-		pgFile	   *file = (pgFile *) parray_get(files, i);
-		pg_atomic_clear_flag(&file->lock);
-	}
+	/*
+	 * Files are read from the backup content list and validated by batches,
+	 * so the list of a large backup is not kept in memory entirely.
+	 */
+	reader = open_file_list(path, FIO_BACKUP_HOST);
+	total_files = file_list_num(reader);
+	files = parray_new();
 
 	/* init thread args with own file lists */
 	threads = (pthread_t *) palloc(sizeof(pthread_t) * num_threads);
 	threads_args = (validate_files_arg *)
 		palloc(sizeof(validate_files_arg) * num_threads);
 
-	/* Validate files */
 	thread_interrupted = false;
-	for (i = 0; i < num_threads; i++)
+	while (true)
 	{
-		validate_files_arg *arg = &(threads_args[i]);
-
-		arg->base_path = base_path;
-		arg->files = files;
-		arg->corrupted = false;
-		arg->stop_lsn = backup->stop_lsn;
-		arg->checksum_version = backup->checksum_version;
-		arg->backup_version = parse_program_version(backup->program_version);
-		/* By default there are some error */
-		threads_args[i].ret = 1;
-
-		pthread_create(&threads[i], NULL, pgBackupValidateFiles, arg);
-	}
+		while (parray_num(files) < VALIDATE_FILES_BATCH &&
+			   (file = read_file_list_entry(reader, base_path,
+											external_prefix)) != NULL)
+		{
+			pg_atomic_clear_flag(&file->lock);
+			parray_append(files, file);
+		}
 
-	/* Wait theads */
-	for (i = 0; i < num_threads; i++)
-	{
-		validate_files_arg *arg = &(threads_args[i]);
+		if (parray_num(files) == 0)
+			break;
 
-		pthread_join(threads[i], NULL);
-		if (arg->corrupted)
-			corrupted = true;
-		if (arg->ret == 1)
-			validation_isok = false;
+		/* Validate files */
+		for (i = 0; i < num_threads; i++)
+		{
+			validate_files_arg *arg = &(threads_args[i]);
+
+			arg->base_path = base_path;
+			arg->index_path = index_path;
+			arg->files = files;
+			arg->first_num = first_num;
+			arg->total_files = total_files;
+			arg->corrupted = false;
+			arg->stop_lsn = backup->stop_lsn;
+			arg->checksum_version = backup->checksum_version;
+			arg->backup_version = parse_program_version(backup->program_version);
+			/* By default there are some error */
+			threads_args[i].ret = 1;
+
+			pthread_create(&threads[i], NULL, pgBackupValidateFiles, arg);
+		}
+
+		/* Wait theads */
+		for (i = 0; i < num_threads; i++)
+		{
+			validate_files_arg *arg = &(threads_args[i]);
+
+			pthread_join(threads[i], NULL);
+			if (arg->corrupted)
+				corrupted = true;
+			if (arg->ret == 1)
+				validation_isok = false;
+		}
+		if (!validation_isok)
+			elog(ERROR, "Data files validation failed");
+
+		first_num += parray_num(files);
+		while (parray_num(files) > 0)
+			pgFileFree(parray_remove(files, parray_num(files) - 1));
 	}
-	if (!validation_isok)
-		elog(ERROR, "Data files validation failed");
 
 	pfree(threads);
 	pfree(threads_args);
 
 	/* cleanup */
-	parray_walk(files, pgFileFree);
+	close_file_list(reader);
 	parray_free(files);
 
 	/* Update backup status */
@@ -209,7 +242,8 @@ pgBackupValidateFiles(void *arg)
 
 		if (progress)
 			elog(INFO, "Progress: (%d/%d). Process file \"%s\"",
-				 i + 1, num_files, file->path);
+				 arguments->first_num + i + 1, arguments->total_files,
+				 file->path);
 
 		if (stat(file->path, &st) == -1)
 		{
@@ -277,6 +311,11 @@ pgBackupValidateFiles(void *arg)
 								  arguments->backup_version))
 				arguments->corrupted = true;
 		}
+
+		/* Backups of older versions have no page index */
+		if (file->is_datafile && file->idx_num > 0 &&
+			!check_page_index(file, arguments->index_path))
+			arguments->corrupted = true;
 	}
 
 	/* Data files validation is successful */
@@ -392,6 +431,9 @@ do_validate_instance(void)
 	/* Get list of all backups sorted in order of descending start time */
 	backups = catalog_get_backup_list(INVALID_BACKUP_ID);
 
+	/* Read WAL shared by archive backups once */
+	validate_wal_ranges(backups, arclog_path, instance_config.xlog_seg_size);
+
 	/* Examine backups one by one and validate them */
 	for (i = 0; i < parray_num(backups); i++)
 	{
@@ -1,6 +1,7 @@
 import os
 import shutil
 import gzip
+import tempfile
 import unittest
 from .helpers.ptrack_helpers import ProbackupTest, ProbackupException, GdbException
 from datetime import datetime, timedelta
@@ -860,3 +861,255 @@ class ArchiveTest(ProbackupTest, unittest.TestCase):
         # Clean after yourself
         pg_receivexlog.kill()
         self.del_test_dir(module_name, fname)
+
+    # @unittest.skip("skip")
+    def test_archive_push_wal_summaries(self):
+        """
+        Check that archive-push doesn't summarize WAL segments, PAGE backup
+        writes summaries of archived WAL segments on first use and backup
+        built from them is restored correctly
+        """
+        fname = self.id().split('.')[3]
+        backup_dir = os.path.join(self.tmp_path, module_name, fname, 'backup')
+        node = self.make_simple_node(
+            base_dir=os.path.join(module_name, fname, 'node'),
+            set_replication=True,
+            initdb_params=['--data-checksums'],
+            pg_options={
+                'checkpoint_timeout': '30s'}
+            )
+        self.init_pb(backup_dir)
+        self.add_instance(backup_dir, 'node', node)
+        self.set_archiving(backup_dir, 'node', node)
+        node.slow_start()
+
+        node.safe_psql(
+            "postgres",
+            "create table t_heap as select i as id, md5(i::text) as text, "
+            "md5(repeat(i::text,10))::tsvector as tsvector "
+            "from generate_series(0,10000) i")
+
+        self.backup_node(backup_dir, 'node', node)
+
+        for i in range(3):
+            node.safe_psql(
+                "postgres",
+                "update t_heap set id = id + 1 where id % 10 = {0}".format(i))
+            self.switch_wal_segment(node)
+
+        summary_dir = os.path.join(backup_dir, 'wal', 'node', 'summary')
+        self.assertFalse(
+            os.path.isdir(summary_dir) and len(os.listdir(summary_dir)) > 0,
+            'WAL summaries are written by archive-push')
+
+        self.backup_node(
+            backup_dir, 'node', node, backup_type='page',
+            options=['--log-level-file=verbose'])
+        pgdata = self.pgdata_content(node.data_dir)
+
+        self.assertTrue(
+            os.path.isdir(summary_dir) and len(os.listdir(summary_dir)) > 0,
+            'WAL summaries are not written by PAGE backup')
+
+        with open(os.path.join(backup_dir, 'log', 'pg_probackup.log')) as f:
+            log_content = f.read()
+            self.assertIn('Used summaries of', log_content)
+
+        node.cleanup()
+        self.restore_node(backup_dir, 'node', node)
+        pgdata_restored = self.pgdata_content(node.data_dir)
+        self.compare_pgdata(pgdata, pgdata_restored)
+
+        # Clean after yourself
+        self.del_test_dir(module_name, fname)
+
+    # @unittest.skip("skip")
+    def test_archive_server(self):
+        """
+        Check that archive-push passes WAL segments to archive-server
+        and falls back to pushing them by itself when the server is gone
+        """
+        fname = self.id().split('.')[3]
+        backup_dir = os.path.join(self.tmp_path, module_name, fname, 'backup')
+        socket_dir = tempfile.mkdtemp()
+        archive_socket = os.path.join(socket_dir, 'archive.sock')
+        node = self.make_simple_node(
+            base_dir=os.path.join(module_name, fname, 'node'),
+            initdb_params=['--data-checksums'])
+        self.init_pb(backup_dir)
+        self.add_instance(backup_dir, 'node', node)
+        self.set_archiving(
+            backup_dir, 'node', node, archive_socket=archive_socket)
+
+        server = subprocess.Popen(
+            [self.probackup_path, 'archive-server', '-B', backup_dir,
+             '--instance=node', '--archive-socket={0}'.format(archive_socket),
+             '-j', '2'],
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            env=self.test_env)
+
+        for i in range(10):
+            if os.path.exists(archive_socket):
+                break
+            sleep(1)
+        self.assertTrue(
+            os.path.exists(archive_socket),
+            'archive-server has not created socket')
+
+        node.slow_start()
+
+        node.safe_psql(
+            "postgres",
+            "create table t_heap as select i as id, md5(i::text) as text "
+            "from generate_series(0,10000) i")
+
+        # backup waits for the WAL segments pushed through the server
+        self.backup_node(backup_dir, 'node', node)
+
+        server.terminate()
+        output = server.communicate()[0].decode('utf-8')
+        self.assertEqual(server.returncode, 0, output)
+        self.assertIn('archive-server is listening', output)
+        self.assertFalse(
+            os.path.exists(archive_socket),
+            'archive-server has not removed socket')
+
+        # archive-push works without the server
+        node.safe_psql(
+            "postgres",
+            "insert into t_heap select i as id, md5(i::text) as text "
+            "from generate_series(0,10000) i")
+        self.backup_node(backup_dir, 'node', node, backup_type='page')
+
+        # Clean after yourself
+        shutil.rmtree(socket_dir, ignore_errors=True)
+        self.del_test_dir(module_name, fname)
+
+    # @unittest.skip("skip")
+    def test_archive_push_batch(self):
+        """
+        Check that archive-push with --batch-size pushes other WAL segments
+        ready for archiving and marks them as archived
+        """
+        fname = self.id().split('.')[3]
+        backup_dir = os.path.join(self.tmp_path, module_name, fname, 'backup')
+        node = self.make_simple_node(
+            base_dir=os.path.join(module_name, fname, 'node'),
+            initdb_params=['--data-checksums'])
+        self.init_pb(backup_dir)
+        self.add_instance(backup_dir, 'node', node)
+        self.set_archiving(backup_dir, 'node', node)
+        node.append_conf(
+            'postgresql.auto.conf', "archive_command = 'exit 1'")
+        node.slow_start()
+
+        node.safe_psql(
+            "postgres",
+            "create table t_heap as select i as id, md5(i::text) as text "
+            "from generate_series(0,10000) i")
+
+        for i in range(3):
+            self.switch_wal_segment(node)
+
+        if self.get_version(node) < 100000:
+            wal_dir = 'pg_xlog'
+        else:
+            wal_dir = 'pg_wal'
+        status_dir = os.path.join(node.data_dir, wal_dir, 'archive_status')
+
+        ready = sorted(
+            f[:-len('.ready')] for f in os.listdir(status_dir)
+            if f.endswith('.ready'))
+        self.assertTrue(len(ready) > 1, 'WAL segments are not ready')
+
+        subprocess.check_output(
+            [self.probackup_path, 'archive-push', '-B', backup_dir,
+             '--instance=node', '--batch-size=10', '-j', '2',
+             '--wal-file-path={0}/{1}'.format(wal_dir, ready[0]),
+             '--wal-file-name={0}'.format(ready[0])],
+            cwd=node.data_dir, stderr=subprocess.STDOUT, env=self.test_env)
+
+        wals_dir = os.path.join(backup_dir, 'wal', 'node')
+        for segment in ready[:10]:
+            self.assertTrue(
+                os.path.exists(os.path.join(wals_dir, segment)) or
+                os.path.exists(os.path.join(wals_dir, segment + '.gz')),
+                'WAL segment {0} is not archived'.format(segment))
+
+        # the requested segment is marked as archived by the server
+        for segment in ready[1:10]:
+            self.assertTrue(
+                os.path.exists(
+                    os.path.join(status_dir, segment + '.done')),
+                'WAL segment {0} is not marked as archived'.format(segment))
+
+        # Clean after yourself
+        self.del_test_dir(module_name, fname)
+
+    # @unittest.skip("skip")
+    def test_archive_get_prefetch(self):
+        """
+        Check that archive-get with --prefetch fetches following WAL
+        segments in background and serves them from the prefetch directory
+        """
+        fname = self.id().split('.')[3]
+        backup_dir = os.path.join(self.tmp_path, module_name, fname, 'backup')
+        node = self.make_simple_node(
+            base_dir=os.path.join(module_name, fname, 'node'),
+            initdb_params=['--data-checksums'])
+        self.init_pb(backup_dir)
+        self.add_instance(backup_dir, 'node', node)
+        self.set_archiving(backup_dir, 'node', node)
+        node.slow_start()
+
+        node.safe_psql(
+            "postgres",
+            "create table t_heap as select i as id, md5(i::text) as text "
+            "from generate_series(0,10000) i")
+
+        for i in range(4):
+            self.switch_wal_segment(node)
+
+        # backup waits for archiving of the segments
+        self.backup_node(backup_dir, 'node', node)
+
+        wals_dir = os.path.join(backup_dir, 'wal', 'node')
+        wals = sorted(
+            f[:24] for f in os.listdir(wals_dir)
+            if os.path.isfile(os.path.join(wals_dir, f)) and
+            len(f) >= 24 and f[:24].isalnum() and
+            f[24:] in ['', '.gz'])
+
+        restore_dir = os.path.join(
+            self.tmp_path, module_name, fname, 'restore')
+        os.makedirs(os.path.join(restore_dir, 'pg_wal'))
+
+        def archive_get(wal_file_name):
+            return subprocess.check_output(
+                [self.probackup_path, 'archive-get', '-B', backup_dir,
+                 '--instance=node', '--prefetch=2',
+                 '--wal-file-path=pg_wal/RECOVERYXLOG',
+                 '--wal-file-name={0}'.format(wal_file_name)],
+                cwd=restore_dir, stderr=subprocess.STDOUT,
+                env=self.test_env).decode('utf-8')
+
+        archive_get(wals[0])
+
+        prefetch_dir = os.path.join(restore_dir, 'pg_wal', 'pbk_prefetch')
+        for i in range(10):
+            if not os.path.exists(
+                    os.path.join(prefetch_dir, 'prefetch.pid')):
+                break
+            sleep(1)
+
+        self.assertTrue(
+            os.path.exists(os.path.join(prefetch_dir, wals[1])),
+            'WAL segment {0} is not prefetched'.format(wals[1]))
+
+        output = archive_get(wals[1])
+        self.assertIn('was prefetched', output)
+        self.assertFalse(
+            os.path.exists(os.path.join(prefetch_dir, wals[1])))
+
+        # Clean after yourself
+        self.del_test_dir(module_name, fname)
@@ -1,5 +1,6 @@
 import unittest
 import os
+import struct
 from time import sleep
 from .helpers.ptrack_helpers import ProbackupTest, ProbackupException
 
@@ -1365,3 +1366,269 @@ class BackupTest(ProbackupTest, unittest.TestCase):
 
         # Clean after yourself
         self.del_test_dir(module_name, fname)
+
+    # @unittest.skip("skip")
+    def test_backup_big_file_threads(self):
+        """
+        make node, create table bigger than one range of blocks,
+        take full and delta backups in several threads, truncate
+        the table in the middle of the range, take delta backup,
+        restore and check data correctness
+        """
+        fname = self.id().split('.')[3]
+        backup_dir = os.path.join(self.tmp_path, module_name, fname, 'backup')
+        node = self.make_simple_node(
+            base_dir=os.path.join(module_name, fname, 'node'),
+            set_replication=True,
+            initdb_params=['--data-checksums'],
+            pg_options={'autovacuum': 'off'})
+
+        node_restored = self.make_simple_node(
+            base_dir=os.path.join(module_name, fname, 'node_restored'))
+
+        self.init_pb(backup_dir)
+        self.add_instance(backup_dir, 'node', node)
+        node.slow_start()
+
+        node.safe_psql(
+            "postgres",
+            "create table t_heap as select i as id, "
+            "md5(i::text) as text "
+            "from generate_series(0,1000000) i")
+
+        self.backup_node(
+            backup_dir, 'node', node,
+            options=['--stream', '-j', '4'])
+
+        node.safe_psql(
+            "postgres",
+            "update t_heap set text = md5(text) where id % 1000 = 0; "
+            "delete from t_heap where id > 900000")
+
+        node.safe_psql(
+            "postgres",
+            "vacuum t_heap")
+
+        self.backup_node(
+            backup_dir, 'node', node, backup_type='delta',
+            options=['--stream', '-j', '4'])
+
+        self.validate_pb(backup_dir)
+
+        pgdata = self.pgdata_content(node.data_dir)
+
+        node_restored.cleanup()
+        self.restore_node(
+            backup_dir, 'node', node_restored, options=['-j', '4'])
+
+        # Physical comparison
+        pgdata_restored = self.pgdata_content(node_restored.data_dir)
+        self.compare_pgdata(pgdata, pgdata_restored)
+
+        node_restored.append_conf(
+            "postgresql.auto.conf", "port = {0}".format(node_restored.port))
+        node_restored.slow_start()
+
+        result = node.safe_psql("postgres", "select * from t_heap")
+        result_restored = node_restored.safe_psql(
+            "postgres", "select * from t_heap")
+        self.assertEqual(result, result_restored)
+
+        # Clean after yourself
+        self.del_test_dir(module_name, fname)
+
+    # @unittest.skip("skip")
+    def test_backup_page_dedup(self):
+        """
+        make node, take two full backups with --page-dedup,
+        check that the second backup refers to pages of the first one,
+        delete the first backup, validate and restore the second one,
+        delete the second backup and check that the page store is empty
+        """
+        fname = self.id().split('.')[3]
+        backup_dir = os.path.join(self.tmp_path, module_name, fname, 'backup')
+        node = self.make_simple_node(
+            base_dir=os.path.join(module_name, fname, 'node'),
+            set_replication=True,
+            initdb_params=['--data-checksums'])
+
+        node_restored = self.make_simple_node(
+            base_dir=os.path.join(module_name, fname, 'node_restored'))
+
+        self.init_pb(backup_dir)
+        self.add_instance(backup_dir, 'node', node)
+        node.slow_start()
+
+        node.pgbench_init(scale=5)
+
+        full_id_1 = self.backup_node(
+            backup_dir, 'node', node,
+            options=['--stream', '--page-dedup', '--compress'])
+
+        page_store = os.path.join(backup_dir, 'pages', 'node')
+        store_size_1 = self.page_store_size(page_store)
+        self.assertGreater(store_size_1, 0)
+
+        full_id_2 = self.backup_node(
+            backup_dir, 'node', node,
+            options=['--stream', '--page-dedup', '--compress'])
+
+        # unchanged pages are shared by both backups
+        store_size_2 = self.page_store_size(page_store)
+        self.assertLess(store_size_2 - store_size_1, store_size_1)
+
+        pgdata = self.pgdata_content(node.data_dir)
+
+        self.delete_pb(backup_dir, 'node', full_id_1)
+        self.validate_pb(backup_dir)
+
+        node_restored.cleanup()
+        self.restore_node(
+            backup_dir, 'node', node_restored, options=['-j', '4'])
+
+        pgdata_restored = self.pgdata_content(node_restored.data_dir)
+        self.compare_pgdata(pgdata, pgdata_restored)
+
+        self.delete_pb(backup_dir, 'node', full_id_2)
+
+        self.assertEqual(
+            sum(len(files) for _, _, files in os.walk(page_store)), 0)
+
+        # Clean after yourself
+        self.del_test_dir(module_name, fname)
+
+    def page_store_size(self, page_store):
+        return sum(
+            os.path.getsize(os.path.join(root, f))
+            for root, _, files in os.walk(page_store)
+            for f in files if f.startswith('pack_'))
+
+    # @unittest.skip("skip")
+    def test_backup_filelist_format(self):
+        """
+        make node, take full backup with text file list and delta backup
+        with binary file list, check that file lists describe the same files,
+        restore delta backup and compare pgdata
+        """
+        fname = self.id().split('.')[3]
+        backup_dir = os.path.join(self.tmp_path, module_name, fname, 'backup')
+        node = self.make_simple_node(
+            base_dir=os.path.join(module_name, fname, 'node'),
+            set_replication=True,
+            initdb_params=['--data-checksums'])
+
+        node_restored = self.make_simple_node(
+            base_dir=os.path.join(module_name, fname, 'node_restored'))
+
+        self.init_pb(backup_dir)
+        self.add_instance(backup_dir, 'node', node)
+        node.slow_start()
+
+        node.pgbench_init(scale=1)
+
+        full_id = self.backup_node(
+            backup_dir, 'node', node,
+            options=['--stream', '--filelist-format=text'])
+
+        pgbench = node.pgbench(options=['-T', '5', '-c', '1'])
+        pgbench.wait()
+
+        delta_id = self.backup_node(
+            backup_dir, 'node', node, backup_type='delta',
+            options=['--stream'])
+
+        with open(os.path.join(
+                backup_dir, 'backups', 'node', full_id,
+                'backup_content.control'), 'rb') as f:
+            self.assertEqual(f.read(1), b'{')
+
+        with open(os.path.join(
+                backup_dir, 'backups', 'node', delta_id,
+                'backup_content.control'), 'rb') as f:
+            self.assertEqual(f.read(4), b'PBFL')
+            # version, n_files, strings_size, crc and byte order mark
+            header = struct.unpack('=5I', f.read(20))
+            self.assertEqual(header[0], 2)
+            self.assertEqual(header[4], 0x01020304)
+
+        filelist_full = self.get_backup_filelist(backup_dir, 'node', full_id)
+        filelist_delta = self.get_backup_filelist(
+            backup_dir, 'node', delta_id)
+        self.assertEqual(
+            sorted(filelist_full.keys()), sorted(filelist_delta.keys()))
+
+        pgdata = self.pgdata_content(node.data_dir)
+
+        self.validate_pb(backup_dir)
+
+        node_restored.cleanup()
+        self.restore_node(
+            backup_dir, 'node', node_restored, options=['-j', '4'])
+
+        pgdata_restored = self.pgdata_content(node_restored.data_dir)
+        self.compare_pgdata(pgdata, pgdata_restored)
+
+        # Clean after yourself
+        self.del_test_dir(module_name, fname)
+
+    # @unittest.skip("skip")
+    def test_backup_parallel_listing(self):
+        """
+        make node with several databases and tablespace, take full backups
+        with one and four threads, check that both file lists describe
+        the same files
+        """
+        fname = self.id().split('.')[3]
+        backup_dir = os.path.join(self.tmp_path, module_name, fname, 'backup')
+        node = self.make_simple_node(
+            base_dir=os.path.join(module_name, fname, 'node'),
+            set_replication=True,
+            initdb_params=['--data-checksums'])
+
+        self.init_pb(backup_dir)
+        self.add_instance(backup_dir, 'node', node)
+        node.slow_start()
+
+        self.create_tblspace_in_node(node, 'tblspace')
+
+        for i in range(1, 6):
+            node.safe_psql(
+                "postgres", "create database db{0}".format(i))
+            node.safe_psql(
+                "db{0}".format(i),
+                "create table t_heap as select i as id, "
+                "md5(i::text) as text from generate_series(0,1000) i")
+
+        node.safe_psql(
+            "db1",
+            "create table t_tblspace tablespace tblspace as select i as id, "
+            "md5(i::text) as text from generate_series(0,1000) i")
+
+        single_id = self.backup_node(
+            backup_dir, 'node', node, options=['--stream', '-j', '1'])
+
+        parallel_id = self.backup_node(
+            backup_dir, 'node', node,
+            options=['--stream', '-j', '4', '--log-level-file=verbose'])
+
+        if not self.remote:
+            with open(os.path.join(
+                    backup_dir, 'log', 'pg_probackup.log')) as f:
+                log_content = f.read()
+                self.assertIn('using 4 threads', log_content)
+
+        wal_dir = 'pg_wal' if self.get_version(node) >= 100000 else 'pg_xlog'
+
+        filelist_single = [
+            path for path in self.get_backup_filelist(
+                backup_dir, 'node', single_id)
+            if not path.startswith(wal_dir)]
+        filelist_parallel = [
+            path for path in self.get_backup_filelist(
+                backup_dir, 'node', parallel_id)
+            if not path.startswith(wal_dir)]
+
+        self.assertEqual(sorted(filelist_single), sorted(filelist_parallel))
+
+        # Clean after yourself
+        self.del_test_dir(module_name, fname)
@@ -541,3 +541,94 @@ class CompressionTest(ProbackupTest, unittest.TestCase):
 
         # Clean after yourself
         self.del_test_dir(module_name, fname)
+
+    def compression_stream_check(self, fname, compress_alg, compress_level):
+        """
+        make node, make full, page and delta stream backups with
+        given compression, merge them and check data correctness
+        in restored instance
+        """
+        backup_dir = os.path.join(self.tmp_path, module_name, fname, 'backup')
+        node = self.make_simple_node(
+            base_dir=os.path.join(module_name, fname, 'node'),
+            set_replication=True,
+            initdb_params=['--data-checksums'],
+            pg_options={'checkpoint_timeout': '30s'})
+
+        self.init_pb(backup_dir)
+        self.add_instance(backup_dir, 'node', node)
+        self.set_archiving(backup_dir, 'node', node)
+        node.slow_start()
+
+        compress_options = [
+            '--stream',
+            '--compress-algorithm={0}'.format(compress_alg),
+            '--compress-level={0}'.format(compress_level)]
+
+        # FULL BACKUP
+        node.safe_psql(
+            "postgres",
+            "create table t_heap as select i as id, md5(i::text) as text, "
+            "md5(repeat(i::text,10))::tsvector as tsvector "
+            "from generate_series(0,256) i")
+        try:
+            self.backup_node(
+                backup_dir, 'node', node, options=compress_options)
+        except ProbackupException as e:
+            if 'This build does not support' in e.message:
+                self.del_test_dir(module_name, fname)
+                self.skipTest(e.message)
+            raise
+
+        # PAGE BACKUP
+        node.safe_psql(
+            "postgres",
+            "insert into t_heap select i as id, md5(i::text) as text, "
+            "md5(repeat(i::text,10))::tsvector as tsvector "
+            "from generate_series(256,512) i")
+        self.backup_node(
+            backup_dir, 'node', node, backup_type='page',
+            options=compress_options)
+
+        # DELTA BACKUP
+        node.safe_psql(
+            "postgres",
+            "update t_heap set text = md5(text) where id % 2 = 0")
+        backup_id = self.backup_node(
+            backup_dir, 'node', node, backup_type='delta',
+            options=compress_options)
+
+        self.assertEqual(
+            self.show_pb(backup_dir, 'node', backup_id)['compress-alg'],
+            compress_alg)
+
+        result = node.execute("postgres", "SELECT * FROM t_heap")
+        pgdata = self.pgdata_content(node.data_dir)
+
+        self.validate_pb(backup_dir)
+        self.merge_backup(backup_dir, 'node', backup_id)
+
+        node.cleanup()
+        self.restore_node(backup_dir, 'node', node, options=["-j", "4"])
+
+        pgdata_restored = self.pgdata_content(node.data_dir)
+        self.compare_pgdata(pgdata, pgdata_restored)
+
+        node.slow_start()
+        self.assertEqual(
+            result, node.execute("postgres", "SELECT * FROM t_heap"))
+
+        # Clean after yourself
+        self.del_test_dir(module_name, fname)
+
+    # @unittest.skip("skip")
+    def test_compression_stream_zstd(self):
+        """zstd compressed backups can be restored and merged"""
+        fname = self.id().split('.')[3]
+        self.compression_stream_check(fname, 'zstd', 3)
+
+    # @unittest.skip("skip")
+    def test_compression_stream_lz4(self):
+        """lz4 and lz4hc compressed backups can be restored and merged"""
+        fname = self.id().split('.')[3]
+        self.compression_stream_check(fname, 'lz4', 9)
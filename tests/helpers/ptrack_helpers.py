@@ -12,6 +12,7 @@ import select
 from time import sleep
 import re
 import json
+import struct
 
 idx_ptrack = {
     't_heap': {
@@ -561,10 +562,13 @@ class ProbackupTest(object):
             backup_dir, 'backups',
             instance, backup_id, 'backup_content.control')
 
-        with open(filelist_path, 'r') as f:
+        with open(filelist_path, 'rb') as f:
                 filelist_raw = f.read()
 
-        filelist_splitted = filelist_raw.splitlines()
+        if filelist_raw[:4] == b'PBFL':
+            return self.parse_binary_filelist(filelist_raw)
+
+        filelist_splitted = filelist_raw.decode('utf-8').splitlines()
 
         filelist = {}
         for line in filelist_splitted:
@@ -573,6 +577,44 @@ class ProbackupTest(object):
 
         return filelist
 
+    def parse_binary_filelist(self, filelist_raw):
+        """ return dict of files from binary backup_content.control """
+        header = struct.Struct('=4sIIIII')
+        entry = struct.Struct('=qqIIIiiiiIIIII')
+
+        magic, version, n_files, strings_size, crc, padding = \
+            header.unpack_from(filelist_raw, 0)
+        strings_start = header.size + entry.size * n_files
+        strings = filelist_raw[strings_start:strings_start + strings_size]
+
+        def get_string(offset):
+            return strings[offset:strings.index(b'\0', offset)].decode('utf-8')
+
+        filelist = {}
+        for i in range(n_files):
+            (write_size, idx_off, mode, file_crc, idx_crc, idx_num, segno,
+             n_blocks, external_dir_num, dir_off, name_off, linked_off,
+             alg_off, flags) = entry.unpack_from(
+                filelist_raw, header.size + entry.size * i)
+
+            path = get_string(name_off)
+            if dir_off:
+                path = get_string(dir_off) + '/' + path
+
+            filelist[path] = {
+                'path': path,
+                'size': str(write_size),
+                'mode': str(mode),
+                'is_datafile': str(flags & 1),
+                'is_cfs': str((flags >> 1) & 1),
+                'crc': str(file_crc),
+                'compress_alg': get_string(alg_off),
+                'external_dir_num': str(external_dir_num)}
+            if linked_off:
+                filelist[path]['linked'] = get_string(linked_off)
+
+        return filelist
+
     # return dict of files from filelist A,
     # which are not exists in filelist_B
     def get_backup_filelist_diff(self, filelist_A, filelist_B):
@@ -986,7 +1028,8 @@ class ProbackupTest(object):
 
     def set_archiving(
             self, backup_dir, instance, node, replica=False,
-            overwrite=False, compress=False, old_binary=False):
+            overwrite=False, compress=False, old_binary=False,
+            archive_socket=None):
 
         if replica:
             archive_mode = 'always'
@@ -1018,6 +1061,10 @@ class ProbackupTest(object):
         if overwrite:
             archive_command = archive_command + '--overwrite '
 
+        if archive_socket:
+            archive_command = archive_command + '--archive-socket={0} '.format(
+                archive_socket)
+
         if os.name == 'posix':
             archive_command = archive_command + '--wal-file-path %p --wal-file-name %f'
 
@@ -2,6 +2,7 @@
 
 import unittest
 import os
+import re
 from .helpers.ptrack_helpers import ProbackupTest, ProbackupException
 import shutil
 from datetime import datetime, timedelta
@@ -2131,6 +2132,85 @@ class MergeTest(ProbackupTest, unittest.TestCase):
         self.del_test_dir(module_name, fname)
 
 
+    # @unittest.skip("skip")
+    def test_merge_compressed_pages_as_is(self):
+        """
+        Merge backups compressed by the same algorithm, pages must be
+        moved into FULL backup without recompression
+        """
+        fname = self.id().split('.')[3]
+        backup_dir = os.path.join(self.tmp_path, module_name, fname, 'backup')
+        node = self.make_simple_node(
+            base_dir=os.path.join(module_name, fname, 'node'),
+            set_replication=True,
+            initdb_params=['--data-checksums'],
+            pg_options={'autovacuum': 'off'})
+
+        self.init_pb(backup_dir)
+        self.add_instance(backup_dir, 'node', node)
+        self.set_archiving(backup_dir, 'node', node)
+        node.slow_start()
+
+        node.pgbench_init(scale=2)
+
+        # FULL backup
+        self.backup_node(
+            backup_dir, 'node', node, options=['--compress-algorithm=zlib'])
+
+        pgbench = node.pgbench(options=['-T', '5', '-c', '2'])
+        pgbench.wait()
+
+        node.safe_psql(
+            'postgres',
+            'delete from pgbench_accounts where aid > 100000; '
+            'vacuum pgbench_accounts')
+
+        # DELTA backup
+        self.backup_node(
+            backup_dir, 'node', node, backup_type='delta',
+            options=['--compress-algorithm=zlib'])
+
+        pgbench = node.pgbench(options=['-T', '5', '-c', '2'])
+        pgbench.wait()
+
+        # PAGE backup
+        page_id = self.backup_node(
+            backup_dir, 'node', node, backup_type='page',
+            options=['--compress-algorithm=zlib'])
+
+        pgdata = self.pgdata_content(node.data_dir)
+
+        self.merge_backup(
+            backup_dir, 'node', page_id,
+            options=['--log-level-file=VERBOSE'])
+
+        logfile = os.path.join(backup_dir, 'log', 'pg_probackup.log')
+        with open(logfile, 'r') as f:
+            logfile_content = f.read()
+
+        self.assertIn('without recompression', logfile_content)
+
+        # page index is rewritten, indexes of replaced files are not kept
+        backup_path = os.path.join(backup_dir, 'backups', 'node', page_id)
+        with open(os.path.join(backup_path, 'backup_content.control')) as f:
+            idx_num = sum(
+                int(n) for n in re.findall(r'"idx_num":"(\d+)"', f.read()))
+        self.assertEqual(
+            os.path.getsize(os.path.join(backup_path, 'page_index')),
+            idx_num * 16)
+
+        self.validate_pb(backup_dir, 'node')
+
+        node.cleanup()
+        self.restore_node(backup_dir, 'node', node)
+
+        pgdata_restored = self.pgdata_content(node.data_dir)
+        self.compare_pgdata(pgdata, pgdata_restored)
+
+        # Clean after yourself
+        self.del_test_dir(module_name, fname)
+
+
 # 1. always use parent link when merging (intermediates may be from different chain)
 # 2. page backup we are merging with may disappear after failed merge,
 # it should not be possible to continue merge after that
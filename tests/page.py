@@ -1124,3 +1124,156 @@ class PageBackupTest(ProbackupTest, unittest.TestCase):
 
         # Clean after yourself
         self.del_test_dir(module_name, fname)
+
+    # @unittest.skip("skip")
+    def test_page_remote_backup_restore(self):
+        """
+        make node, take full backup, update pages scattered over the table,
+        take multithreaded page backup via remote agent, validate,
+        restore and compare pgdata and data
+        """
+        if not self.remote:
+            return unittest.skip(
+                'Skipped because PGPROBACKUP_SSH_REMOTE is not set')
+
+        fname = self.id().split('.')[3]
+        backup_dir = os.path.join(self.tmp_path, module_name, fname, 'backup')
+        node = self.make_simple_node(
+            base_dir=os.path.join(module_name, fname, 'node'),
+            set_replication=True,
+            initdb_params=['--data-checksums'],
+            pg_options={'autovacuum': 'off'})
+
+        node_restored = self.make_simple_node(
+            base_dir=os.path.join(module_name, fname, 'node_restored'))
+
+        self.init_pb(backup_dir)
+        self.add_instance(backup_dir, 'node', node)
+        self.set_archiving(backup_dir, 'node', node)
+        node.slow_start()
+
+        node.safe_psql(
+            "postgres",
+            "create table t_heap as select i as id, md5(i::text) as text, "
+            "md5(i::text)::tsvector as tsvector "
+            "from generate_series(0,100000) i")
+
+        self.backup_node(backup_dir, 'node', node)
+
+        node.safe_psql(
+            "postgres",
+            "update t_heap set text = md5(text) where id % 97 = 0")
+        node.safe_psql(
+            "postgres",
+            "delete from t_heap where id % 389 = 0")
+
+        page_id = self.backup_node(
+            backup_dir, 'node', node,
+            backup_type='page', options=['-j', '4'])
+
+        if self.paranoia:
+            pgdata = self.pgdata_content(node.data_dir)
+
+        result = node.safe_psql("postgres", "select * from t_heap")
+
+        self.validate_pb(backup_dir, 'node', page_id)
+
+        self.restore_node(
+            backup_dir, 'node', node_restored, options=['-j', '4'])
+
+        if self.paranoia:
+            pgdata_restored = self.pgdata_content(node_restored.data_dir)
+            self.compare_pgdata(pgdata, pgdata_restored)
+
+        node_restored.append_conf(
+            "postgresql.auto.conf", "port = {0}".format(node_restored.port))
+        node_restored.slow_start()
+
+        self.assertEqual(
+            result,
+            node_restored.safe_psql("postgres", "select * from t_heap"))
+
+        # Clean after yourself
+        self.del_test_dir(module_name, fname)
+
+    # @unittest.skip("skip")
+    def test_page_compressed_archive_filtered_relations(self):
+        """
+        make archive node with compressed WAL archive, take full backup,
+        change table which will be dropped before page backup over several
+        WAL segments, take multithreaded page backup, check that block
+        references to dropped table were skipped, restore and compare
+        """
+        fname = self.id().split('.')[3]
+        backup_dir = os.path.join(self.tmp_path, module_name, fname, 'backup')
+        node = self.make_simple_node(
+            base_dir=os.path.join(module_name, fname, 'node'),
+            set_replication=True,
+            initdb_params=['--data-checksums'],
+            pg_options={'autovacuum': 'off'})
+
+        node_restored = self.make_simple_node(
+            base_dir=os.path.join(module_name, fname, 'node_restored'))
+
+        self.init_pb(backup_dir)
+        self.add_instance(backup_dir, 'node', node)
+        self.set_archiving(backup_dir, 'node', node, compress=True)
+        node.slow_start()
+
+        node.safe_psql(
+            "postgres",
+            "create table t_heap as select i as id, md5(i::text) as text "
+            "from generate_series(0,10000) i")
+        node.safe_psql(
+            "postgres",
+            "create table t_drop as select i as id, md5(i::text) as text "
+            "from generate_series(0,10000) i")
+
+        self.backup_node(backup_dir, 'node', node)
+
+        for i in range(3):
+            node.safe_psql(
+                "postgres",
+                "update t_drop set text = md5(text)")
+            node.safe_psql(
+                "postgres",
+                "update t_heap set text = md5(text) where id % 10 = 0")
+            self.switch_wal_segment(node)
+
+        node.safe_psql("postgres", "drop table t_drop")
+
+        self.backup_node(
+            backup_dir, 'node', node, backup_type='page',
+            options=['-j', '4', '--log-level-file=verbose'])
+
+        if not self.remote:
+            with open(os.path.join(
+                    backup_dir, 'log', 'pg_probackup.log')) as f:
+                log_content = f.read()
+                self.assertIn(
+                    'block references to relations which are '
+                    'not in the backup', log_content)
+                self.assertNotIn('Skipped 0 of', log_content)
+
+        if self.paranoia:
+            pgdata = self.pgdata_content(node.data_dir)
+
+        result = node.safe_psql("postgres", "select * from t_heap")
+
+        self.restore_node(
+            backup_dir, 'node', node_restored, options=['-j', '4'])
+
+        if self.paranoia:
+            pgdata_restored = self.pgdata_content(node_restored.data_dir)
+            self.compare_pgdata(pgdata, pgdata_restored)
+
+        node_restored.append_conf(
+            "postgresql.auto.conf", "port = {0}".format(node_restored.port))
+        node_restored.slow_start()
+
+        self.assertEqual(
+            result,
+            node_restored.safe_psql("postgres", "select * from t_heap"))
+
+        # Clean after yourself
+        self.del_test_dir(module_name, fname)
@@ -2340,3 +2340,144 @@ class RestoreTest(ProbackupTest, unittest.TestCase):
 
         # Clean after yourself
         self.del_test_dir(module_name, fname)
+
+    # @unittest.skip("skip")
+    def test_restore_chain_truncated_relation(self):
+        """
+        Restore chain FULL -> PAGE -> DELTA -> PAGE where the relation
+        is truncated by vacuum in the middle of the chain
+        """
+        fname = self.id().split('.')[3]
+        backup_dir = os.path.join(self.tmp_path, module_name, fname, 'backup')
+        node = self.make_simple_node(
+            base_dir=os.path.join(module_name, fname, 'node'),
+            set_replication=True,
+            initdb_params=['--data-checksums'],
+            pg_options={'autovacuum': 'off'})
+
+        self.init_pb(backup_dir)
+        self.add_instance(backup_dir, 'node', node)
+        self.set_archiving(backup_dir, 'node', node)
+        node.slow_start()
+
+        node.pgbench_init(scale=2)
+
+        # FULL backup
+        self.backup_node(backup_dir, 'node', node, options=['--compress'])
+
+        pgbench = node.pgbench(options=['-T', '5', '-c', '2'])
+        pgbench.wait()
+
+        # PAGE backup
+        self.backup_node(backup_dir, 'node', node, backup_type='page')
+
+        node.safe_psql(
+            'postgres',
+            'delete from pgbench_accounts where aid > 50000; '
+            'vacuum pgbench_accounts')
+
+        # DELTA backup
+        self.backup_node(backup_dir, 'node', node, backup_type='delta')
+
+        node.safe_psql(
+            'postgres',
+            'update pgbench_accounts set abalance = abalance + 1 '
+            'where aid < 1000')
+
+        # PAGE backup
+        self.backup_node(
+            backup_dir, 'node', node, backup_type='page',
+            options=['--compress'])
+
+        pgdata = self.pgdata_content(node.data_dir)
+        node.cleanup()
+
+        self.restore_node(backup_dir, 'node', node, options=['-j', '4'])
+
+        pgdata_restored = self.pgdata_content(node.data_dir)
+        self.compare_pgdata(pgdata, pgdata_restored)
+
+        # Clean after yourself
+        self.del_test_dir(module_name, fname)
+
+    # @unittest.skip("skip")
+    def test_incremental_restore(self):
+        """
+        Restore backup into PGDATA of the same cluster which went ahead
+        of the backup with --incremental option
+        """
+        fname = self.id().split('.')[3]
+        backup_dir = os.path.join(self.tmp_path, module_name, fname, 'backup')
+        node = self.make_simple_node(
+            base_dir=os.path.join(module_name, fname, 'node'),
+            set_replication=True,
+            initdb_params=['--data-checksums'])
+
+        self.init_pb(backup_dir)
+        self.add_instance(backup_dir, 'node', node)
+        self.set_archiving(backup_dir, 'node', node)
+        node.slow_start()
+
+        node.pgbench_init(scale=2)
+
+        self.create_tblspace_in_node(node, 'tblspace')
+        node.safe_psql(
+            'postgres',
+            'create table t_heap tablespace tblspace as '
+            'select i from generate_series(0,10000) i')
+
+        # FULL backup
+        self.backup_node(backup_dir, 'node', node, options=['--compress'])
+
+        pgbench = node.pgbench(options=['-T', '5', '-c', '2'])
+        pgbench.wait()
+
+        # PAGE backup
+        backup_id = self.backup_node(backup_dir, 'node', node, backup_type='page')
+
+        pgdata = self.pgdata_content(node.data_dir)
+        result = node.safe_psql('postgres', 'select * from t_heap')
+
+        # Cluster goes ahead of the backup
+        pgbench = node.pgbench(options=['-T', '5', '-c', '2'])
+        pgbench.wait()
+        node.safe_psql(
+            'postgres',
+            'create table t_extra as select i from generate_series(0,10000) i; '
+            'delete from pgbench_accounts where aid > 100000; '
+            'vacuum pgbench_accounts; '
+            'insert into t_heap select i from generate_series(0,10000) i')
+
+        # Restore into running cluster is not allowed
+        try:
+            self.restore_node(
+                backup_dir, 'node', node, options=['--incremental'])
+            self.assertEqual(
+                1, 0,
+                "Expecting Error because of running server.\n "
+                "Output: {0} \n CMD: {1}".format(
+                    self.output, self.cmd))
+        except ProbackupException as e:
+            self.assertIn(
+                'postmaster.pid exists', e.message,
+                '\n Unexpected Error Message: {0}\n CMD: {1}'.format(
+                    repr(e.message), self.cmd))
+
+        node.stop()
+
+        self.restore_node(
+            backup_dir, 'node', node, backup_id=backup_id,
+            options=[
+                '--incremental', '-j', '4',
+                '--immediate', '--recovery-target-action=promote'])
+
+        pgdata_restored = self.pgdata_content(node.data_dir)
+        self.compare_pgdata(pgdata, pgdata_restored)
+
+        node.slow_start()
+        node.safe_psql('postgres', 'select count(*) from pgbench_accounts')
+        self.assertEqual(
+            result, node.safe_psql('postgres', 'select * from t_heap'))
+
+        # Clean after yourself
+        self.del_test_dir(module_name, fname)
@@ -99,7 +99,7 @@ class RetentionTest(ProbackupTest, unittest.TestCase):
         backups = os.path.join(backup_dir, 'backups', 'node')
         days_delta = 5
         for backup in os.listdir(backups):
-            if backup == 'pg_probackup.conf':
+            if backup in ['pg_probackup.conf', 'catalog.index']:
                 continue
             with open(
                     os.path.join(
@@ -145,7 +145,7 @@ class RetentionTest(ProbackupTest, unittest.TestCase):
 
         backups = os.path.join(backup_dir, 'backups', 'node')
         for backup in os.listdir(backups):
-            if backup == 'pg_probackup.conf':
+            if backup in ['pg_probackup.conf', 'catalog.index']:
                 continue
             with open(
                     os.path.join(
@@ -190,7 +190,7 @@ class RetentionTest(ProbackupTest, unittest.TestCase):
 
         backups = os.path.join(backup_dir, 'backups', 'node')
         for backup in os.listdir(backups):
-            if backup == 'pg_probackup.conf':
+            if backup in ['pg_probackup.conf', 'catalog.index']:
                 continue
             with open(
                     os.path.join(
@@ -320,7 +320,8 @@ class RetentionTest(ProbackupTest, unittest.TestCase):
         # Purge backups
         backups = os.path.join(backup_dir, 'backups', 'node')
         for backup in os.listdir(backups):
-            if backup in [page_id_a2, page_id_b2, 'pg_probackup.conf']:
+            if backup in [
+                    page_id_a2, page_id_b2, 'pg_probackup.conf', 'catalog.index']:
                 continue
 
             with open(
@@ -534,7 +535,8 @@ class RetentionTest(ProbackupTest, unittest.TestCase):
         # Purge backups
         backups = os.path.join(backup_dir, 'backups', 'node')
         for backup in os.listdir(backups):
-            if backup in [page_id_a2, page_id_b2, 'pg_probackup.conf']:
+            if backup in [
+                    page_id_a2, page_id_b2, 'pg_probackup.conf', 'catalog.index']:
                 continue
 
             with open(
@@ -690,7 +692,8 @@ class RetentionTest(ProbackupTest, unittest.TestCase):
         # Purge backups
         backups = os.path.join(backup_dir, 'backups', 'node')
         for backup in os.listdir(backups):
-            if backup in [page_id_a1, page_id_b3, 'pg_probackup.conf']:
+            if backup in [
+                    page_id_a1, page_id_b3, 'pg_probackup.conf', 'catalog.index']:
                 continue
 
             with open(
@@ -923,7 +926,8 @@ class RetentionTest(ProbackupTest, unittest.TestCase):
         # Purge backups
         backups = os.path.join(backup_dir, 'backups', 'node')
         for backup in os.listdir(backups):
-            if backup in [page_id_a3, page_id_b3, 'pg_probackup.conf']:
+            if backup in [
+                    page_id_a3, page_id_b3, 'pg_probackup.conf', 'catalog.index']:
                 continue
 
             with open(
@@ -1081,7 +1085,8 @@ class RetentionTest(ProbackupTest, unittest.TestCase):
         # Purge backups
         backups = os.path.join(backup_dir, 'backups', 'node')
         for backup in os.listdir(backups):
-            if backup in [page_id_b3, 'pg_probackup.conf']:
+            if backup in [
+                    page_id_b3, 'pg_probackup.conf', 'catalog.index']:
                 continue
 
             with open(
@@ -1158,7 +1163,8 @@ class RetentionTest(ProbackupTest, unittest.TestCase):
         # Purge backups
         backups = os.path.join(backup_dir, 'backups', 'node')
         for backup in os.listdir(backups):
-            if backup in [page_id_b3, 'pg_probackup.conf']:
+            if backup in [
+                    page_id_b3, 'pg_probackup.conf', 'catalog.index']:
                 continue
 
             with open(
@@ -207,3 +207,44 @@ class OptionTest(ProbackupTest, unittest.TestCase):
 
         # Clean after yourself
         self.del_test_dir(module_name, fname)
+
+    # @unittest.skip("skip")
+    def test_show_catalog_index(self):
+        """
+        catalog index is used by show and doesn't hide
+        changes of backup.control
+        """
+        fname = self.id().split('.')[3]
+        backup_dir = os.path.join(self.tmp_path, module_name, fname, 'backup')
+        node = self.make_simple_node(
+            base_dir=os.path.join(module_name, fname, 'node'),
+            initdb_params=['--data-checksums'])
+
+        self.init_pb(backup_dir)
+        self.add_instance(backup_dir, 'node', node)
+        self.set_archiving(backup_dir, 'node', node)
+        node.slow_start()
+
+        backup_id = self.backup_node(backup_dir, 'node', node)
+        self.backup_node(backup_dir, 'node', node, backup_type='page')
+
+        show_before = self.show_pb(backup_dir, 'node')
+
+        self.assertTrue(
+            os.path.isfile(os.path.join(
+                backup_dir, 'backups', 'node', 'catalog.index')))
+
+        self.assertEqual(show_before, self.show_pb(backup_dir, 'node'))
+
+        # change status of the backup bypassing pg_probackup
+        file = os.path.join(
+            backup_dir, "backups", "node",
+            backup_id, "backup.control")
+        with open(file, 'a') as fd:
+            fd.write("status = ERROR\n")
+
+        self.assertEqual(
+            self.show_pb(backup_dir, 'node', backup_id)['status'], 'ERROR')
+
+        # Clean after yourself
+        self.del_test_dir(module_name, fname)
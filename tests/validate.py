@@ -215,6 +215,202 @@ class ValidateTest(ProbackupTest, unittest.TestCase):
         # Clean after yourself
         self.del_test_dir(module_name, fname)
 
+    # @unittest.skip("skip")
+    def test_validate_wal_seek(self):
+        """
+        make node with archiving, make archive backup, generate
+        several WAL segments, validate to time and lsn with --wal-seek
+        """
+        fname = self.id().split('.')[3]
+        node = self.make_simple_node(
+            base_dir=os.path.join(module_name, fname, 'node'),
+            initdb_params=['--data-checksums'])
+
+        backup_dir = os.path.join(self.tmp_path, module_name, fname, 'backup')
+        self.init_pb(backup_dir)
+        self.add_instance(backup_dir, 'node', node)
+        self.set_archiving(backup_dir, 'node', node)
+        node.slow_start()
+
+        node.pgbench_init(scale=3)
+        self.backup_node(backup_dir, 'node', node)
+
+        for i in range(8):
+            pgbench = node.pgbench(options=['-T', '2', '-c', '2'])
+            pgbench.wait()
+            self.switch_wal_segment(node)
+            if i == 4:
+                target_time = node.safe_psql(
+                    "postgres",
+                    "select now()").decode('utf-8').rstrip()
+                if self.get_version(node) < 100000:
+                    target_lsn = node.safe_psql(
+                        "postgres",
+                        "select pg_current_xlog_location()").decode(
+                            'utf-8').rstrip()
+                else:
+                    target_lsn = node.safe_psql(
+                        "postgres",
+                        "select pg_current_wal_lsn()").decode(
+                            'utf-8').rstrip()
+            time.sleep(1)
+
+        self.switch_wal_segment(node)
+        time.sleep(5)
+
+        # Validate to real time
+        output = self.validate_pb(
+            backup_dir, 'node',
+            options=["--time={0}".format(target_time), "--wal-seek",
+                     "-j", "4", "--log-level-console=log"])
+        self.assertIn(
+            "INFO: Backup validation completed successfully", output,
+            '\n Unexpected Error Message: {0}\n CMD: {1}'.format(
+                repr(self.output), self.cmd))
+        self.assertIn(
+            "Recovery target is searched from WAL segment", output,
+            '\n Unexpected Error Message: {0}\n CMD: {1}'.format(
+                repr(self.output), self.cmd))
+
+        # Validate to real lsn
+        self.assertIn(
+            "INFO: Backup validation completed successfully",
+            self.validate_pb(
+                backup_dir, 'node',
+                options=["--recovery-target-lsn={0}".format(target_lsn),
+                         "--wal-seek", "-j", "4"]),
+            '\n Unexpected Error Message: {0}\n CMD: {1}'.format(
+                repr(self.output), self.cmd))
+
+        # Validate to unreal time
+        unreal_time = datetime.now().replace(
+            second=0, microsecond=0) + timedelta(days=2)
+        try:
+            self.validate_pb(
+                backup_dir, 'node',
+                options=["--time={0}".format(unreal_time), "--wal-seek",
+                         "-j", "4"])
+            self.assertEqual(
+                1, 0,
+                "Expecting Error because of validation to unreal time.\n "
+                "Output: {0} \n CMD: {1}".format(
+                    repr(self.output), self.cmd))
+        except ProbackupException as e:
+            self.assertIn(
+                'ERROR: Not enough WAL records to time',
+                e.message,
+                '\n Unexpected Error Message: {0}\n CMD: {1}'.format(
+                    repr(e.message), self.cmd))
+
+        # Clean after yourself
+        self.del_test_dir(module_name, fname)
+
+    # @unittest.skip("skip")
+    def test_validate_wal_summary_missing_segment(self):
+        """
+        make node with archiving, make full and page backups, so that
+        summaries of WAL segments are built, remove WAL segment which has
+        a summary and expect validation of full backup to lsn to fail
+        """
+        fname = self.id().split('.')[3]
+        node = self.make_simple_node(
+            base_dir=os.path.join(module_name, fname, 'node'),
+            initdb_params=['--data-checksums'])
+
+        backup_dir = os.path.join(self.tmp_path, module_name, fname, 'backup')
+        self.init_pb(backup_dir)
+        self.add_instance(backup_dir, 'node', node)
+        self.set_archiving(backup_dir, 'node', node)
+        node.slow_start()
+
+        node.pgbench_init(scale=3)
+        full_id = self.backup_node(backup_dir, 'node', node)
+
+        for i in range(6):
+            pgbench = node.pgbench(options=['-T', '2', '-c', '2'])
+            pgbench.wait()
+            self.switch_wal_segment(node)
+
+        self.backup_node(backup_dir, 'node', node, backup_type='page')
+
+        if self.get_version(node) < 100000:
+            target_lsn = node.safe_psql(
+                "postgres",
+                "select pg_current_xlog_location()").decode('utf-8').rstrip()
+        else:
+            target_lsn = node.safe_psql(
+                "postgres",
+                "select pg_current_wal_lsn()").decode('utf-8').rstrip()
+
+        self.switch_wal_segment(node)
+        time.sleep(5)
+
+        self.validate_pb(
+            backup_dir, 'node', full_id,
+            options=["--recovery-target-lsn={0}".format(target_lsn)])
+
+        summary_dir = os.path.join(backup_dir, 'wal', 'node', 'summary')
+        summaries = sorted(os.listdir(summary_dir))
+        self.assertTrue(len(summaries) > 2)
+
+        os.remove(os.path.join(
+            backup_dir, 'wal', 'node', summaries[len(summaries) // 2]))
+
+        try:
+            self.validate_pb(
+                backup_dir, 'node', full_id,
+                options=["--recovery-target-lsn={0}".format(target_lsn)])
+            self.assertEqual(
+                1, 0,
+                "Expecting Error because of missing WAL segment.\n "
+                "Output: {0} \n CMD: {1}".format(
+                    repr(self.output), self.cmd))
+        except ProbackupException as e:
+            self.assertIn(
+                'ERROR: Not enough WAL records to lsn',
+                e.message,
+                '\n Unexpected Error Message: {0}\n CMD: {1}'.format(
+                    repr(e.message), self.cmd))
+
+        # Clean after yourself
+        self.del_test_dir(module_name, fname)
+
+    # @unittest.skip("skip")
+    def test_validate_instance_wal_once(self):
+        """
+        make node with archiving, make full and two page backups,
+        validate the instance, WAL of the backups is read at once
+        """
+        fname = self.id().split('.')[3]
+        node = self.make_simple_node(
+            base_dir=os.path.join(module_name, fname, 'node'),
+            initdb_params=['--data-checksums'])
+
+        backup_dir = os.path.join(self.tmp_path, module_name, fname, 'backup')
+        self.init_pb(backup_dir)
+        self.add_instance(backup_dir, 'node', node)
+        self.set_archiving(backup_dir, 'node', node)
+        node.slow_start()
+
+        self.backup_node(backup_dir, 'node', node)
+        self.backup_node(backup_dir, 'node', node, backup_type='page')
+        self.backup_node(backup_dir, 'node', node, backup_type='page')
+
+        output = self.validate_pb(
+            backup_dir, 'node',
+            options=["-j", "4", "--log-level-console=log"])
+        self.assertIn(
+            "Validate WAL of 3 backups", output,
+            '\n Unexpected Error Message: {0}\n CMD: {1}'.format(
+                repr(self.output), self.cmd))
+        self.assertIn(
+            "INFO: All backups are valid", output,
+            '\n Unexpected Error Message: {0}\n CMD: {1}'.format(
+                repr(self.output), self.cmd))
+
+        # Clean after yourself
+        self.del_test_dir(module_name, fname)
+
     # @unittest.skip("skip")
     def test_basic_validate_corrupted_intermediate_backup(self):
         """
@@ -3391,6 +3587,68 @@ class ValidateTest(ProbackupTest, unittest.TestCase):
         # Clean after yourself
         self.del_test_dir(module_name, fname)
 
+    # @unittest.skip("skip")
+    def test_validate_corrupted_page_index(self):
+        """
+        make node, take FULL and PAGE backups, merge them,
+        check that page index of merged backup is valid,
+        corrupt page index and expect backup to gain status CORRUPT
+        """
+        fname = self.id().split('.')[3]
+        node = self.make_simple_node(
+            base_dir=os.path.join(module_name, fname, 'node'),
+            initdb_params=['--data-checksums'])
+
+        backup_dir = os.path.join(self.tmp_path, module_name, fname, 'backup')
+        self.init_pb(backup_dir)
+        self.add_instance(backup_dir, 'node', node)
+        self.set_archiving(backup_dir, 'node', node)
+        node.slow_start()
+
+        node.pgbench_init(scale=2)
+
+        self.backup_node(
+            backup_dir, 'node', node, options=['-j', '4', '--compress'])
+
+        pgbench = node.pgbench(options=['-T', '10', '-c', '2', '--no-vacuum'])
+        pgbench.wait()
+
+        backup_id = self.backup_node(
+            backup_dir, 'node', node, backup_type='page')
+
+        self.merge_backup(backup_dir, 'node', backup_id)
+        self.validate_pb(backup_dir, 'node', backup_id)
+
+        index_path = os.path.join(
+            backup_dir, 'backups', 'node', backup_id, 'page_index')
+        self.assertTrue(os.path.getsize(index_path) > 0)
+
+        with open(index_path, "r+b", 0) as f:
+            f.write(b"\0" * os.path.getsize(index_path))
+            f.flush()
+            f.close
+
+        try:
+            self.validate_pb(backup_dir, 'node', backup_id)
+            self.assertEqual(
+                1, 0,
+                "Expecting Error because of page index corruption.\n "
+                "Output: {0} \n CMD: {1}".format(
+                    repr(self.output), self.cmd))
+        except ProbackupException as e:
+            self.assertIn(
+                'WARNING: Invalid CRC of page index of', e.message,
+                '\n Unexpected Error Message: {0}\n CMD: {1}'.format(
+                    repr(e.message), self.cmd))
+
+        self.assertEqual(
+            'CORRUPT',
+            self.show_pb(backup_dir, 'node', backup_id)['status'],
+            'Backup STATUS should be "CORRUPT"')
+
+        # Clean after yourself
+        self.del_test_dir(module_name, fname)
+
 # validate empty backup list
 # page from future during validate
 # page from future during backup